@@ -50,6 +50,10 @@ from components import utils
 CHUNK_SIZE = 512 * 1024
 
 
+# Maximum number of delete requests in flight in delete_files().
+MAX_CONCURRENT_DELETES = 100
+
+
 # Return value for get_file_info call.
 FileInfo = collections.namedtuple('FileInfo', ['size'])
 
@@ -149,8 +153,35 @@ def delete_files(bucket, filenames, ignore_missing=False):
     the RPC to return a Future.
   """
   # Sadly Google Cloud Storage client library doesn't support batch deletes,
-  # so do it one by one.
-  for filename in filenames:
+  # so issue the requests concurrently and retry the failed ones one by one.
+  # pylint: disable=protected-access
+  api = cloudstorage.storage_api._get_storage_api(
+      retry_params=_make_retry_params())
+  filenames = list(filenames)
+  failed = []
+  for i in xrange(0, len(filenames), MAX_CONCURRENT_DELETES):
+    futures = [
+      (f, api.delete_object_async(
+          cloudstorage.api_utils._quote_filename('/%s/%s' % (bucket, f))))
+      for f in filenames[i:i+MAX_CONCURRENT_DELETES]
+    ]
+    for filename, future in futures:
+      try:
+        status, _headers, _content = future.get_result()
+      except Exception as e:
+        logging.warning(
+            'Failed to delete /%s/%s: %s %s',
+            bucket, filename, e.__class__.__name__, e)
+        failed.append(filename)
+        continue
+      if status == 404:
+        if not ignore_missing:
+          logging.warning(
+              'Trying to delete a GS file that\'s not there: /%s/%s',
+              bucket, filename)
+      elif status != 204:
+        failed.append(filename)
+  for filename in failed:
     delete_file(bucket, filename, ignore_missing)
   return []
 
@@ -173,22 +204,32 @@ def get_file_info(bucket, filename):
     return None
 
 
-def read_file(bucket, filename, chunk_size=CHUNK_SIZE):
+def read_file(bucket, filename, chunk_size=CHUNK_SIZE, max_in_flight=None):
   """Reads a file and yields its content in chunks of a given size.
 
   Arguments:
     bucket: a bucket that contains the file.
     filename: name of the file to read.
     chunk_size: maximum size of a chunk to read and yield.
+    max_in_flight: if set, the file is read with concurrent range requests of
+        |chunk_size| up to this number of bytes, including the chunk being
+        processed by the caller. Otherwise, the file is streamed with a single
+        read-ahead buffer.
 
   Yields:
-    Chunks of a file (as str objects).
+    Chunks of a file (as str objects), in order.
   """
   path = '/%s/%s' % (bucket, filename)
   bytes_read = 0
   data = None
   file_ref = None
   try:
+    if max_in_flight:
+      for data in _read_ranges(path, chunk_size, max_in_flight):
+        bytes_read += len(data)
+        yield data
+        data = None
+      return
     with cloudstorage.open(
         path,
         read_buffer_size=chunk_size,
@@ -249,6 +290,52 @@ def write_file(bucket, filename, content):
     return False
 
 
+def _read_ranges(path, chunk_size, max_in_flight):
+  """Yields the content of a file fetched with concurrent range requests.
+
+  cloudstorage.open() only prefetches one buffer ahead so a large file is read
+  at the speed of one urlfetch round trip per chunk. Here range requests are
+  kept in flight while the caller processes the current chunk, as long as the
+  bytes requested and not yet processed stay within |max_in_flight|. At least
+  one request is always in flight.
+  """
+  # pylint: disable=protected-access
+  api = cloudstorage.storage_api._get_storage_api(
+      retry_params=_make_retry_params())
+  quoted = cloudstorage.api_utils._quote_filename(path)
+  status, headers, content = api.head_object(quoted)
+  cloudstorage.errors.check_status(
+      status, [200], quoted, resp_headers=headers, body=content)
+  size = long(cloudstorage.common.get_stored_content_length(headers))
+  etag = headers.get('etag')
+  # Pairs (future, length) of the range requests, in order.
+  futures = collections.deque()
+  in_flight = 0
+  offset = 0
+  while futures or offset < size:
+    while offset < size:
+      length = min(chunk_size, size - offset)
+      if futures and in_flight + length > max_in_flight:
+        break
+      futures.append((
+        api.get_object_async(
+            quoted,
+            headers={'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}),
+        length,
+      ))
+      in_flight += length
+      offset += length
+    future, length = futures.popleft()
+    status, resp_headers, content = future.get_result()
+    cloudstorage.errors.check_status(
+        status, [200, 206], quoted, resp_headers=resp_headers, body=content)
+    if resp_headers.get('etag') != etag:
+      raise ValueError('File %s changed while reading' % path)
+    yield content
+    content = None
+    in_flight -= length
+
+
 def _make_retry_params():
   """RetryParams structure configured to store access token in Datastore."""
   # Note that 'cloudstorage.set_default_retry_params' function stores retry
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import sys
+import unittest
+
+import test_env
+test_env.setup_test_env()
+
+import cloudstorage
+
+from test_support import test_case
+
+import gcs
+
+
+# Access to a protected member _XXX of a client class
+# pylint: disable=W0212
+
+
+class FakeFuture(object):
+  def __init__(self, api, result):
+    self._api = api
+    self._result = result
+
+  def get_result(self):
+    self._api.outstanding -= 1
+    return self._result
+
+
+class FakeStorageApi(object):
+  """Serves a single file and records the range requests in flight."""
+  def __init__(self, content, etags):
+    self.content = content
+    # Etag returned by each request, the first one is for head_object().
+    self.etags = list(etags)
+    self.outstanding = 0
+    self.max_outstanding = 0
+    self.ranges = []
+
+  def head_object(self, _path):
+    return 200, {
+      'content-length': str(len(self.content)),
+      'etag': self.etags.pop(0),
+    }, ''
+
+  def get_object_async(self, _path, headers):
+    start, end = headers['Range'][len('bytes='):].split('-')
+    start = int(start)
+    end = int(end)
+    self.ranges.append((start, end))
+    self.outstanding += 1
+    self.max_outstanding = max(self.max_outstanding, self.outstanding)
+    return FakeFuture(
+        self, (206, {'etag': self.etags.pop(0)}, self.content[start:end+1]))
+
+
+class GCSTest(test_case.TestCase):
+  def mock_api(self, content, etags):
+    api = FakeStorageApi(content, etags)
+    self.mock(
+        cloudstorage.storage_api, '_get_storage_api', lambda **_kwargs: api)
+    return api
+
+  def test_read_ranges(self):
+    content = ''.join(chr(ord('a') + i) for i in xrange(26))
+    api = self.mock_api(content, ['e'] * 7)
+    chunks = []
+    for chunk in gcs._read_ranges('/bucket/file', 4, 10):
+      # The chunk being processed counts against the bytes in flight.
+      self.assertLessEqual((api.outstanding + 1) * 4, 10)
+      chunks.append(chunk)
+    self.assertEqual(
+        ['abcd', 'efgh', 'ijkl', 'mnop', 'qrst', 'uvwx', 'yz'], chunks)
+    self.assertEqual(
+        [(0, 3), (4, 7), (8, 11), (12, 15), (16, 19), (20, 23), (24, 25)],
+        api.ranges)
+    self.assertEqual(2, api.max_outstanding)
+    self.assertEqual(0, api.outstanding)
+
+  def test_read_ranges_chunk_larger_than_cap(self):
+    # At least one request is always in flight.
+    api = self.mock_api('abcdefgh', ['e'] * 3)
+    chunks = list(gcs._read_ranges('/bucket/file', 4, 2))
+    self.assertEqual(['abcd', 'efgh'], chunks)
+    self.assertEqual(1, api.max_outstanding)
+
+  def test_read_ranges_empty(self):
+    api = self.mock_api('', ['e'])
+    self.assertEqual([], list(gcs._read_ranges('/bucket/file', 4, 10)))
+    self.assertEqual([], api.ranges)
+
+  def test_read_ranges_etag_changed(self):
+    self.mock_api('abcdefgh', ['e', 'e', 'f'])
+    stream = gcs._read_ranges('/bucket/file', 4, 10)
+    self.assertEqual('abcd', next(stream))
+    with self.assertRaises(ValueError):
+      next(stream)
+
+  def test_read_file_max_in_flight(self):
+    self.mock_api('abcdefgh', ['e'] * 3)
+    chunks = list(
+        gcs.read_file('bucket', 'file', chunk_size=4, max_in_flight=8))
+    self.assertEqual(['abcd', 'efgh'], chunks)
+
+
+if __name__ == '__main__':
+  if '-v' in sys.argv:
+    unittest.TestCase.maxDiff = None
+  unittest.main()
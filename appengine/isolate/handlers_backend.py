@@ -7,6 +7,7 @@
 import binascii
 import hashlib
 import logging
+import threading
 import time
 import zlib
 
@@ -14,6 +15,7 @@ import webapp2
 from google.appengine import runtime
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
+from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
 import config
@@ -24,12 +26,69 @@ import stats
 import template
 from components import decorators
 from components import utils
+import gae_ts_mon
 
 
 # The maximum number of items to delete at a time.
 ITEMS_TO_DELETE_ASYNC = 100
 
 
+# Number of letters of the hash used to partition the expired entries cleanup;
+# there is one chain of tasks per prefix.
+CLEANUP_SHARD_LETTERS = 1
+
+
+# Number of seconds a cleanup task runs before checkpointing its position and
+# enqueuing a continuation. It is well under the task queue deadline.
+CLEANUP_TASK_DURATION = 8*60
+
+
+# Number of expired entries fetched and deleted at once by a cleanup task.
+CLEANUP_PAGE_SIZE = 500
+
+
+# GCS objects at least this large are verified with concurrent range reads.
+VERIFY_PARALLEL_MIN_SIZE = 32*1024*1024
+
+
+# Size of each range read when verifying a large GCS object.
+VERIFY_PARALLEL_CHUNK_SIZE = 4*1024*1024
+
+
+# Maximum number of bytes of a large GCS object requested ahead while verifying
+# it, including the chunk being hashed. It is the same on retries.
+VERIFY_MAX_BYTES_IN_FLIGHT = 32*1024*1024
+
+
+# Maximum number of large GCS objects verified with concurrent range reads at
+# once on an instance; the others are streamed. With VERIFY_MAX_BYTES_IN_FLIGHT,
+# it caps the memory used by range reads on a F2 (256mb) backend instance
+# serving many verify tasks to 64mb.
+VERIFY_MAX_PARALLEL_PER_INSTANCE = 2
+
+
+# Held by the verify tasks using concurrent range reads.
+_verify_parallel_slots = threading.BoundedSemaphore(
+    VERIFY_MAX_PARALLEL_PER_INSTANCE)
+
+
+# Counts the expired ContentEntry deleted, per hash prefix.
+_cleanup_deleted = gae_ts_mon.CounterMetric(
+    'isolate/cleanup/old/deleted',
+    'Number of expired entries deleted.', [
+        gae_ts_mon.StringField('prefix'),
+    ])
+
+
+# Deletion throughput of each cleanup task, by whether it caught up with its
+# prefix or had to checkpoint.
+_cleanup_throughput = gae_ts_mon.CumulativeDistributionMetric(
+    'isolate/cleanup/old/throughput',
+    'Expired entries deleted per second by a cleanup task.', [
+        gae_ts_mon.StringField('result'),
+    ])
+
+
 ### Utility
 
 
@@ -81,6 +140,24 @@ def payload_to_hashes(request):
       model.MAX_KEYS_PER_DB_OPS)
 
 
+def cleanup_prefixes():
+  """Returns the hash prefixes each handled by one chain of cleanup tasks."""
+  letters = min(CLEANUP_SHARD_LETTERS, config.settings().sharding_letters)
+  return ['%0*x' % (letters, i) for i in xrange(16**letters)]
+
+
+def content_shard_ids(prefix, start=None):
+  """Yields the ContentShard ids starting with |prefix|, in order.
+
+  If |start| is set, the ids before it are skipped.
+  """
+  width = config.settings().sharding_letters - len(prefix)
+  for i in xrange(16**width):
+    shard_id = prefix + ('%0*x' % (width, i) if width else '')
+    if not start or shard_id >= start:
+      yield shard_id
+
+
 def incremental_delete(query, delete, check=None):
   """Applies |delete| to objects in a query asynchrously.
 
@@ -134,6 +211,9 @@ def incremental_delete(query, delete, check=None):
 class InternalCleanupOldEntriesWorkerHandler(webapp2.RequestHandler):
   """Removes the old data from the datastore.
 
+  Fans out one InternalCleanupOldShardWorkerHandler task per hash prefix,
+  unless the previous chain of tasks for this prefix is still running.
+
   Only a task queue task can use this handler.
   """
   # pylint: disable=R0201
@@ -144,11 +224,82 @@ class InternalCleanupOldEntriesWorkerHandler(webapp2.RequestHandler):
       runtime.DeadlineExceededError)
   @decorators.require_taskqueue('cleanup')
   def post(self):
-    q = model.ContentEntry.query(
-        model.ContentEntry.expiration_ts < utils.utcnow()
-        ).iter(keys_only=True)
-    total = incremental_delete(q, delete=model.delete_entry_and_gs_entry)
-    logging.info('Deleting %s expired entries', total)
+    now = utils.utcnow().strftime('%Y-%m-%d_%H-%M-%S')
+    for prefix in cleanup_prefixes():
+      # The lease is refreshed by each task of the chain.
+      if not memcache.add(
+          prefix, now, time=CLEANUP_TASK_DURATION*2, namespace='cleanup_old'):
+        logging.info('Cleanup of %s is still running', prefix)
+        continue
+      url = '/internal/taskqueue/cleanup/old/%s' % prefix
+      if not utils.enqueue_task(
+          url, 'cleanup', name='old_%s_%s' % (prefix, now)):
+        memcache.delete(prefix, namespace='cleanup_old')
+
+
+class InternalCleanupOldShardWorkerHandler(webapp2.RequestHandler):
+  """Removes the expired ContentEntry of the ContentShard starting with a
+  prefix.
+
+  Each ContentShard is queried with an ancestor query. The position, as the
+  ContentShard id and the query cursor, is checkpointed in a continuation task
+  before the deadline.
+
+  Only a task queue task can use this handler.
+  """
+  @decorators.silence(
+      datastore_errors.InternalError,
+      datastore_errors.Timeout,
+      datastore_errors.TransactionFailedError,
+      runtime.DeadlineExceededError)
+  @decorators.require_taskqueue('cleanup')
+  def post(self, prefix):
+    start = time.time()
+    now = utils.utcnow()
+    cursor = None
+    if self.request.get('cursor'):
+      cursor = datastore_query.Cursor(urlsafe=self.request.get('cursor'))
+    deleted = 0
+    shards = 0
+    result = 'done'
+    for shard_id in content_shard_ids(prefix, self.request.get('shard')):
+      q = model.ContentEntry.query(
+          model.ContentEntry.expiration_ts < now,
+          ancestor=ndb.Key('ContentShard', shard_id))
+      more = True
+      while more:
+        if time.time() - start > CLEANUP_TASK_DURATION:
+          result = 'checkpoint'
+          break
+        keys, cursor, more = q.fetch_page(
+            CLEANUP_PAGE_SIZE, keys_only=True, start_cursor=cursor)
+        if keys:
+          model.delete_entry_and_gs_entry(keys)
+          deleted += len(keys)
+      if result == 'checkpoint':
+        break
+      cursor = None
+      shards += 1
+
+    duration = time.time() - start
+    _cleanup_deleted.increment_by(deleted, fields={'prefix': prefix})
+    _cleanup_throughput.add(
+        deleted / (duration or 1.), fields={'result': result})
+    logging.info(
+        'Deleted %d expired entries in %d shards in %.1fs', deleted, shards,
+        duration)
+    if result == 'done':
+      memcache.delete(prefix, namespace='cleanup_old')
+      return
+
+    memcache.set(
+        prefix, shard_id, time=CLEANUP_TASK_DURATION*2, namespace='cleanup_old')
+    params = {'shard': shard_id, 'cursor': cursor.urlsafe() if cursor else ''}
+    if not utils.enqueue_task(
+        '/internal/taskqueue/cleanup/old/%s' % prefix, 'cleanup',
+        params=params):
+      # The next cron job will restart the prefix from the beginning.
+      memcache.delete(prefix, namespace='cleanup_old')
 
 
 class InternalObliterateWorkerHandler(webapp2.RequestHandler):
@@ -281,23 +432,28 @@ class InternalTagWorkerHandler(webapp2.RequestHandler):
     expiration = config.settings().default_expiration
     try:
       digests = payload_to_hashes(self)
-      # Requests all the entities at once.
-      futures = ndb.get_multi_async(
-          model.get_entry_key(namespace, binascii.hexlify(d)) for d in digests)
-
+      # Requests all the entities at once. The payload was already deduped by
+      # preupload so every entity is needed; there is no point in waiting for
+      # them one by one.
+      keys = [
+        model.get_entry_key(namespace, binascii.hexlify(d)) for d in digests
+      ]
       to_save = []
-      while futures:
-        # Return opportunistically the first entity that can be retrieved.
-        future = ndb.Future.wait_any(futures)
-        futures.remove(future)
-        item = future.get_result()
-        if item and item.next_tag_ts < now:
-          # Update the timestamp. Add a bit of pseudo randomness.
-          item.expiration_ts, item.next_tag_ts = model.expiration_jitter(
-              now, expiration)
-          to_save.append(item)
-      if to_save:
-        ndb.put_multi(to_save)
+      for i in xrange(0, len(keys), model.MAX_KEYS_PER_DB_OPS):
+        for item in ndb.get_multi(keys[i:i+model.MAX_KEYS_PER_DB_OPS]):
+          if item and item.next_tag_ts < now:
+            # Update the timestamp. Add a bit of pseudo randomness.
+            item.expiration_ts, item.next_tag_ts = model.expiration_jitter(
+                now, expiration)
+            to_save.append(item)
+      # Writes are batched too, all in parallel.
+      futures = []
+      for i in xrange(0, len(to_save), model.MAX_KEYS_PER_DB_OPS):
+        futures.extend(
+            ndb.put_multi_async(to_save[i:i+model.MAX_KEYS_PER_DB_OPS]))
+      ndb.Future.wait_all(futures)
+      for f in futures:
+        f.check_success()
       logging.info(
           'Timestamped %d entries out of %s', len(to_save), len(digests))
     except Exception as e:
@@ -362,10 +518,19 @@ class InternalVerifyWorkerHandler(webapp2.RequestHandler):
     expanded_size = 0
     digest = hashlib.sha1()
     data = None
+    parallel = (
+        entry.compressed_size >= VERIFY_PARALLEL_MIN_SIZE and
+        _verify_parallel_slots.acquire(False))
+    start = time.time()
 
     try:
       # Start a loop where it reads the data in block.
-      stream = gcs.read_file(gs_bucket, entry.key.id())
+      if parallel:
+        stream = gcs.read_file(
+            gs_bucket, entry.key.id(), chunk_size=VERIFY_PARALLEL_CHUNK_SIZE,
+            max_in_flight=VERIFY_MAX_BYTES_IN_FLIGHT)
+      else:
+        stream = gcs.read_file(gs_bucket, entry.key.id())
       if save_to_memcache:
         # Wraps stream with a generator that accumulates the data.
         stream = Accumulator(stream)
@@ -405,14 +570,20 @@ class InternalVerifyWorkerHandler(webapp2.RequestHandler):
           'Failed to read the file (%s): %s\n%s',
           e.__class__.__name__, e, original_request)
       return
+    finally:
+      if parallel:
+        _verify_parallel_slots.release()
 
     # Verified. Data matches the hash.
     entry.expanded_size = expanded_size
     entry.is_verified = True
     future = entry.put_async()
+    duration = time.time() - start
     logging.info(
-        '%d bytes (%d bytes expanded) verified\n%s',
-        entry.compressed_size, expanded_size, original_request)
+        '%d bytes (%d bytes expanded) verified in %.1fs (%.1fMb/s, %s)\n%s',
+        entry.compressed_size, expanded_size, duration,
+        entry.compressed_size / 1024. / 1024. / (duration or 1.),
+        'range reads' if parallel else 'streamed', original_request)
     if save_to_memcache:
       model.save_in_memcache(namespace, hash_key, ''.join(stream.accumulated))
     future.wait()
@@ -463,6 +634,9 @@ def get_routes():
     webapp2.Route(
         r'/internal/taskqueue/cleanup/old',
         InternalCleanupOldEntriesWorkerHandler),
+    webapp2.Route(
+        r'/internal/taskqueue/cleanup/old/<prefix:[0-9a-f]+>',
+        InternalCleanupOldShardWorkerHandler),
     webapp2.Route(
         r'/internal/taskqueue/cleanup/obliterate',
         InternalObliterateWorkerHandler),
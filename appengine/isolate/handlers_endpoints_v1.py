@@ -5,11 +5,14 @@
 """This module defines Isolate Server frontend url handlers."""
 
 import binascii
+import collections
 import datetime
 import hashlib
+import json
 import logging
 import os
 import re
+import threading
 import time
 import zlib
 
@@ -23,10 +26,12 @@ import endpoints
 from protorpc import message_types
 from protorpc import messages
 from protorpc import remote
+from protorpc.remote import protojson
 
 from components import auth
 from components import endpoints_webapp2
 from components import utils
+import gae_ts_mon
 
 import acl
 import config
@@ -40,6 +45,51 @@ import stats
 MIN_SIZE_FOR_GS = 501
 
 
+# Number of seconds a digest confirmed present by preupload is remembered by
+# the instance. Only entries that do not expire before are remembered.
+EXISTENCE_CACHE_TTL = 10*60
+
+
+# Maximum number of digests remembered by the instance; about 15mb.
+EXISTENCE_CACHE_SIZE = 100000
+
+
+# Number of seconds during which a digest tagged by preupload is not tagged
+# again, across all instances. Many bots look up the same hot digests within
+# minutes of each other and a single tag is sufficient.
+TAG_COALESCE_EXPIRATION = 60*60
+
+
+# Number of seconds a flattened tree is kept in memcache. It must be well under
+# DEFAULT_LINK_EXPIRATION since the response embeds signed URLs.
+FLATTEN_CACHE_EXPIRATION = 60*60
+
+
+# Maximum number of .isolated files in a flattened tree.
+MAX_FLATTEN_ISOLATED = 1000
+
+
+# Maximum number of signed URLs in a flattened tree, for the largest files.
+# Signing is relatively expensive.
+MAX_FLATTEN_URLS = 1000
+
+
+# Counts the existing digests seen by preupload, by whether they were tagged.
+_preupload_tags = gae_ts_mon.CounterMetric(
+    'isolate/preupload/tags',
+    'Number of existing digests seen by preupload.', [
+        gae_ts_mon.StringField('result'),
+    ])
+
+
+# Counts the digests looked up by preupload, by where the answer came from.
+_preupload_lookups = gae_ts_mon.CounterMetric(
+    'isolate/preupload/lookups',
+    'Number of digests looked up by preupload.', [
+        gae_ts_mon.StringField('result'),
+    ])
+
+
 ### Request Types
 
 
@@ -81,6 +131,12 @@ class RetrieveRequest(messages.Message):
   offset = messages.IntegerField(3, default=0)
 
 
+class FlattenRequest(messages.Message):
+  """Request to expand a .isolated file and all its includes."""
+  digest = messages.StringField(1, required=True)
+  namespace = messages.MessageField(Namespace, 2)
+
+
 ### Response Types
 
 
@@ -102,6 +158,33 @@ class RetrievedContent(messages.Message):
   url = messages.StringField(2)
 
 
+class FlattenedFile(messages.Message):
+  """A file entry of a .isolated file, see isolated_format.py."""
+  path = messages.StringField(1)
+  # 'h', the digest of the content.
+  digest = messages.StringField(2)
+  # 's', the size of the content.
+  size = messages.IntegerField(3)
+  # 'm', the file mode.
+  mode = messages.IntegerField(4)
+  # 'l', the destination of a symlink.
+  link = messages.StringField(5)
+  # 't', the type of the file, e.g. 'tar'.
+  type = messages.StringField(6)
+  # Signed GS URL of the content, only set for entries stored in GS.
+  url = messages.StringField(7)
+
+
+class FlattenedTree(messages.Message):
+  """A .isolated file with all its includes merged in, in traversal order."""
+  files = messages.MessageField(FlattenedFile, 1, repeated=True)
+  command = messages.StringField(2, repeated=True)
+  read_only = messages.IntegerField(3)
+  relative_cwd = messages.StringField(4)
+  # Digests of all the .isolated files of the tree, root first.
+  isolated = messages.StringField(5, repeated=True)
+
+
 class PushPing(messages.Message):
   """Indicates whether data storage executed successfully."""
   ok = messages.BooleanField(1)
@@ -110,6 +193,10 @@ class PushPing(messages.Message):
 class ServerDetails(messages.Message):
   """Reports the current API version."""
   server_version = messages.StringField(1)
+  # True if /isolate/api/v1/raw/<namespace>/<digest> is supported.
+  raw_retrieve = messages.BooleanField(2)
+  # True if the flatten endpoint is supported.
+  flatten = messages.BooleanField(3)
 
 
 ### Utility
@@ -141,6 +228,76 @@ def store_and_enqueue_verify_task(entry, task_queue_host):
   )
 
 
+class ExistenceCache(object):
+  """LRU of the digests recently confirmed present in the datastore.
+
+  It is per instance and never invalidated by other instances. This is safe
+  because only verified entries that won't expire within the TTL are added,
+  and only expired entries are ever deleted.
+  """
+
+  def __init__(self, max_size, ttl):
+    self._max_size = max_size
+    self._ttl = datetime.timedelta(seconds=ttl)
+    self._lock = threading.Lock()
+    # (namespace, digest) -> (expanded_size, datetime when to forget it,
+    # next_tag_ts).
+    self._entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    with self._lock:
+      return len(self._entries)
+
+  @property
+  def hit_rate(self):
+    """Ratio of lookups answered by the cache."""
+    with self._lock:
+      total = self.hits + self.misses
+      return float(self.hits) / total if total else 0.
+
+  def get(self, namespace, digest, size, now):
+    """Returns the entry's next_tag_ts if the digest is known to be present with
+    this size, None otherwise.
+    """
+    key = (namespace, digest)
+    with self._lock:
+      value = self._entries.pop(key, None)
+      if value and value[1] > now and value[0] == size:
+        self._entries[key] = value
+        self.hits += 1
+        return value[2]
+      self.misses += 1
+      return None
+
+  def add(self, namespace, entry, now):
+    """Remembers a ContentEntry found in the datastore, if it is safe to."""
+    if not entry.is_verified or entry.expanded_size in (None, -1):
+      return
+    forget_ts = now + self._ttl
+    if not entry.expiration_ts or entry.expiration_ts <= forget_ts:
+      return
+    digest = entry.key.id().rsplit('/', 1)[1]
+    with self._lock:
+      self._entries.pop((namespace, digest), None)
+      self._entries[(namespace, digest)] = (
+          entry.expanded_size, forget_ts,
+          entry.next_tag_ts or datetime.datetime.min)
+      while len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+
+# The instance's cache of digests known to be present.
+existence_cache = ExistenceCache(EXISTENCE_CACHE_SIZE, EXISTENCE_CACHE_TTL)
+
+
 def entry_key_or_error(namespace, digest):
   try:
     return model.get_entry_key(namespace, digest)
@@ -148,6 +305,67 @@ def entry_key_or_error(namespace, digest):
     raise endpoints.BadRequestException(error.message)
 
 
+def _load_isolated(namespace, digest):
+  """Returns the decoded .isolated file.
+
+  Raises endpoints exceptions.
+  """
+  try:
+    content, entity = model.get_content(namespace, digest)
+  except ValueError as e:
+    raise endpoints.BadRequestException(e.message)
+  except LookupError:
+    raise endpoints.NotFoundException('Unable to retrieve %s.' % digest)
+  if content is None:
+    content = ''.join(
+        gcs.read_file(config.settings().gs_bucket, entity.key.id()))
+  try:
+    return json.loads(''.join(model.expand_content(namespace, [content])))
+  except (IOError, ValueError, zlib.error) as e:
+    raise endpoints.BadRequestException(
+        'Invalid .isolated file %s: %s' % (digest, e))
+
+
+def flatten_isolated(namespace, digest):
+  """Expands the .isolated file |digest| and its includes into a FlattenedTree.
+
+  The includes are walked the same way the client does, root first then the
+  includes left to right, recursively. The first .isolated file that lists a
+  path or a property wins.
+  """
+  tree = FlattenedTree()
+  seen = set()
+  files = {}
+  def walk(d):
+    if d in seen:
+      raise endpoints.BadRequestException(
+          '.isolated file %s is included recursively' % d)
+    if len(seen) >= MAX_FLATTEN_ISOLATED:
+      raise endpoints.BadRequestException(
+          'Too many .isolated files, max is %d' % MAX_FLATTEN_ISOLATED)
+    seen.add(d)
+    tree.isolated.append(d)
+    data = _load_isolated(namespace, d)
+    if not isinstance(data, dict):
+      raise endpoints.BadRequestException('Invalid .isolated file %s' % d)
+    if not tree.command and data.get('command'):
+      tree.command = data['command']
+    if tree.read_only is None and data.get('read_only') is not None:
+      tree.read_only = data['read_only']
+    if tree.relative_cwd is None and data.get('relative_cwd') is not None:
+      tree.relative_cwd = data['relative_cwd']
+    for path, props in sorted(data.get('files', {}).iteritems()):
+      if path not in files:
+        files[path] = FlattenedFile(
+            path=path, digest=props.get('h'), size=props.get('s'),
+            mode=props.get('m'), link=props.get('l'), type=props.get('t'))
+        tree.files.append(files[path])
+    for child in data.get('includes', []):
+      walk(child)
+  walk(digest)
+  return tree
+
+
 def hash_content(content, namespace):
   """Decompresses and hashes given |content|.
 
@@ -164,7 +382,7 @@ def hash_content(content, namespace):
       # Make sure the data is GC'ed.
       del data
     return digest.hexdigest(), expanded_size
-  except zlib.error as e:
+  except (IOError, zlib.error) as e:
     raise ValueError('Data is corrupted: %s' % e)
 
 
@@ -214,13 +432,18 @@ class IsolateService(remote.Service):
       raise endpoints.BadRequestException(
           'Invalid namespace; allowed keys must pass regexp "%s"' %
           model.NAMESPACE_RE)
+    if not model.is_compression_supported(request.namespace.namespace):
+      raise endpoints.BadRequestException(
+          'Compression %s is not supported by this server' %
+          model.get_compression(request.namespace.namespace))
 
     if len(request.items) > 1000:
       raise endpoints.BadRequestException(
           'Only up to 1000 items can be looked up at once')
 
     # check for existing elements
-    new_digests, existing_digests = self.partition_collection(request)
+    new_digests, existing_digests, due_digests = self.partition_collection(
+        request)
 
     # process all elements; add an upload ticket for cache misses
     for index, digest_element in enumerate(request.items):
@@ -248,9 +471,16 @@ class IsolateService(remote.Service):
         response.items.append(status)
 
     # Tag existing entities and collect stats.
-    self.tag_existing(DigestCollection(
-        items=list(existing_digests), namespace=request.namespace))
+    tagged = self.tag_existing(DigestCollection(
+        items=list(due_digests), namespace=request.namespace))
     stats.add_entry(stats.LOOKUP, len(request.items), len(existing_digests))
+    if existing_digests:
+      # Existing digests that were not enqueued, either because they were not
+      # due or because another request already enqueued them, are coalesced.
+      coalesced = len(existing_digests) - tagged
+      stats.add_entry(stats.TAG, tagged, coalesced)
+      _preupload_tags.increment_by(tagged, fields={'result': 'enqueued'})
+      _preupload_tags.increment_by(coalesced, fields={'result': 'coalesced'})
     return response
 
   @auth.endpoints_method(StorageRequest, PushPing)
@@ -290,6 +520,9 @@ class IsolateService(remote.Service):
         raise endpoints.NotFoundException('Unable to retrieve the entry.')
       content = stored.content  # will be None if entity is in GCS
       found = 'inline'
+      if content is not None and model.promote_if_hot(
+          request.namespace.namespace, request.digest, content):
+        found = 'inline; promoted'
 
     # Return and log stats here if something has been found.
     if content is not None:
@@ -316,6 +549,38 @@ class IsolateService(remote.Service):
         filename=key.id(),
         expiration=DEFAULT_LINK_EXPIRATION))
 
+  @auth.endpoints_method(FlattenRequest, FlattenedTree)
+  @auth.require(acl.isolate_readable)
+  def flatten(self, request):
+    """Returns the files of a .isolated file and all its includes at once.
+
+    It saves the client one round trip per level of includes. Files stored in
+    GS have a signed URL so they can be fetched directly. The response is cached
+    per root digest.
+    """
+    if not request.namespace:
+      raise endpoints.BadRequestException('namespace is required.')
+    namespace = request.namespace.namespace
+    memcache_namespace = 'flatten_%s' % namespace
+    cached = memcache.get(request.digest, namespace=memcache_namespace)
+    if cached is not None:
+      return protojson.decode_message(FlattenedTree, zlib.decompress(cached))
+
+    tree = flatten_isolated(namespace, request.digest)
+    if not utils.is_local_dev_server():
+      self._sign_gs_files(namespace, tree.files)
+    try:
+      memcache.set(
+          request.digest, zlib.compress(protojson.encode_message(tree)),
+          time=FLATTEN_CACHE_EXPIRATION, namespace=memcache_namespace)
+    except ValueError:
+      # Too large for memcache.
+      logging.warning('Failed to cache the flattened %s', request.digest)
+    logging.info(
+        'Flattened %s: %d .isolated, %d files', request.digest,
+        len(tree.isolated), len(tree.files))
+    return tree
+
   # TODO(kjlubick): Rework these APIs, the http_method part seems to break
   # API explorer.
   @auth.endpoints_method(
@@ -323,10 +588,38 @@ class IsolateService(remote.Service):
     http_method='GET')
   @auth.require(acl.isolate_readable)
   def server_details(self, _request):
-    return ServerDetails(server_version=utils.get_app_version())
+    return ServerDetails(
+        server_version=utils.get_app_version(), raw_retrieve=True,
+        flatten=True)
 
   ### Utility
 
+  def _sign_gs_files(self, namespace, files):
+    """Sets a signed GS URL on the largest |files| stored in GS.
+
+    Whether an entry is in GS is decided by its stored entity, not by its
+    expanded size, since the entry may be stored inline in compressed form.
+    """
+    # Only entries this large may have been pushed to GS, see
+    # should_push_to_gs().
+    large = sorted(
+        (f for f in files if f.digest and f.size >= MIN_SIZE_FOR_GS),
+        key=lambda f: -f.size)
+    signed = 0
+    for i in xrange(0, len(large), model.MAX_KEYS_PER_DB_OPS):
+      chunk = large[i:i+model.MAX_KEYS_PER_DB_OPS]
+      entities = ndb.get_multi(
+          [model.get_entry_key(namespace, f.digest) for f in chunk])
+      for f, entity in zip(chunk, entities):
+        if entity is None or entity.content is not None:
+          continue
+        f.url = self.gs_url_signer.get_download_url(
+            filename='%s/%s' % (namespace, f.digest),
+            expiration=DEFAULT_LINK_EXPIRATION)
+        signed += 1
+        if signed == MAX_FLATTEN_URLS:
+          return
+
   @staticmethod
   def storage_helper(request, uploaded_to_gs):
     """Implement shared logic between store_inline and finalize_gs.
@@ -445,6 +738,9 @@ class IsolateService(remote.Service):
   def check_entries_exist(entries):
     """Assess which entities already exist in the datastore.
 
+    The lookups are done in batches of model.MAX_KEYS_PER_DB_OPS keys, each
+    batch being a single datastore RPC.
+
     Arguments:
       entries: a DigestCollection to be posted
 
@@ -454,23 +750,41 @@ class IsolateService(remote.Service):
     Raises:
       BadRequestException if any digest is not a valid hexadecimal number.
     """
-    # Kick off all queries in parallel. Build mapping Future -> digest.
-    futures = {}
-    for digest in entries.items:
-      # check for error conditions
-      key = entry_key_or_error(entries.namespace.namespace, digest.digest)
-      futures[key.get_async(use_cache=False)] = digest
-
-    # Pick first one that finishes and yield it, rinse, repeat.
-    while futures:
-      future = ndb.Future.wait_any(futures)
-      yield futures.pop(future), future.get_result()
+    keys = [
+      entry_key_or_error(entries.namespace.namespace, digest.digest)
+      for digest in entries.items
+    ]
+    # Kick off all the batches in parallel.
+    futures = []
+    for i in xrange(0, len(keys), model.MAX_KEYS_PER_DB_OPS):
+      futures.extend(ndb.get_multi_async(
+          keys[i:i+model.MAX_KEYS_PER_DB_OPS], use_cache=False))
+    for digest, future in zip(entries.items, futures):
+      yield digest, future.get_result()
 
   @classmethod
   def partition_collection(cls, entries):
-    """Create sets of existent and new digests."""
+    """Create sets of new digests, existent digests and existent digests that
+    are due for a tag.
+
+    Digests found in the existence cache are not looked up in the datastore.
+    """
+    namespace = entries.namespace.namespace
+    now = utils.utcnow()
     seen_unseen = [set(), set()]
-    for digest, obj in cls.check_entries_exist(entries):
+    due = set()
+    to_lookup = []
+    for digest in entries.items:
+      next_tag_ts = existence_cache.get(
+          namespace, digest.digest, digest.size, now)
+      if next_tag_ts:
+        seen_unseen[True].add(digest)
+        if next_tag_ts < now:
+          due.add(digest)
+      else:
+        to_lookup.append(digest)
+    lookups = DigestCollection(items=to_lookup, namespace=entries.namespace)
+    for digest, obj in cls.check_entries_exist(lookups):
       if obj and obj.expanded_size != digest.size:
         # It is important to note that when a file is uploaded to GCS,
         # ContentEntry is only stored in the finalize call, which is (supposed)
@@ -500,14 +814,28 @@ class IsolateService(remote.Service):
             'Upload race.\n%s is not yet fully uploaded.', digest.digest)
         # TODO(maruel): Force the client to upload.
         #obj = None
+      elif obj:
+        existence_cache.add(namespace, obj, now)
+      if obj and not (obj.next_tag_ts and obj.next_tag_ts >= now):
+        due.add(digest)
       seen_unseen[bool(obj)].add(digest)
+    cached = len(entries.items) - len(to_lookup)
+    found = len(seen_unseen[True]) - cached
+    _preupload_lookups.increment_by(cached, fields={'result': 'cache'})
+    _preupload_lookups.increment_by(found, fields={'result': 'found'})
+    _preupload_lookups.increment_by(
+        len(to_lookup) - found, fields={'result': 'missing'})
+    logging.debug(
+        'Existence cache: %d/%d hits; %.1f%% hit rate over %d entries',
+        cached, len(entries.items), existence_cache.hit_rate * 100,
+        len(existence_cache))
     logging.debug(
         'Hit:%s',
         ''.join(sorted('\n%s' % d.digest for d in seen_unseen[True])))
     logging.debug(
         'Missing:%s',
         ''.join(sorted('\n%s' % d.digest for d in seen_unseen[False])))
-    return seen_unseen
+    return seen_unseen[False], seen_unseen[True], due
 
   @staticmethod
   def should_push_to_gs(digest):
@@ -535,19 +863,36 @@ class IsolateService(remote.Service):
   def tag_existing(collection):
     """Tag existing digests with new timestamp.
 
+    Digests already tagged by any instance in the last TAG_COALESCE_EXPIRATION
+    seconds are skipped; memcache.add_multi() is used as an atomic
+    "first one wins" check across concurrent requests.
+
     Arguments:
-      collection: a DigestCollection containing existing digests
+      collection: a DigestCollection containing existing digests due for a tag
 
     Returns:
-      the enqueued task if there were existing entries; None otherwise
+      number of digests enqueued in the tag task.
     """
-    if collection.items:
-      url = '/internal/taskqueue/tag/%s/%s' % (
-          collection.namespace.namespace,
-          utils.datetime_to_timestamp(utils.utcnow()))
-      payload = ''.join(
-          binascii.unhexlify(digest.digest) for digest in collection.items)
-      return utils.enqueue_task(url, 'tag', payload=payload)
+    if not collection.items:
+      return 0
+    namespace = collection.namespace.namespace
+    digests = sorted(set(d.digest for d in collection.items))
+    # add_multi() returns the keys that were not set because they were already
+    # present.
+    already = set(memcache.add_multi(
+        dict.fromkeys(digests, ''), time=TAG_COALESCE_EXPIRATION,
+        namespace='tagged_%s' % namespace))
+    to_tag = [d for d in digests if d not in already]
+    if not to_tag:
+      return 0
+    url = '/internal/taskqueue/tag/%s/%s' % (
+        namespace, utils.datetime_to_timestamp(utils.utcnow()))
+    payload = ''.join(binascii.unhexlify(d) for d in to_tag)
+    if not utils.enqueue_task(url, 'tag', payload=payload):
+      # Let another request retry.
+      memcache.delete_multi(to_tag, namespace='tagged_%s' % namespace)
+      return 0
+    return len(to_tag)
 
 
 def get_routes():
@@ -4,10 +4,12 @@
 # that can be found in the LICENSE file.
 
 import base64
+import datetime
 import hashlib
 import json
 import logging
 import sys
+import threading
 import unittest
 from Crypto.PublicKey import RSA
 
@@ -16,6 +18,7 @@ test_env.setup_test_env()
 
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
 from protorpc.remote import protojson
 import webapp2
@@ -139,6 +142,9 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     make_private_key()
     # Remove the check for dev server in should_push_to_gs().
     self.mock(utils, 'is_local_dev_server', lambda: False)
+    handlers_endpoints_v1.existence_cache.clear()
+    # pylint: disable=protected-access
+    self.mock(model, '_retrieve_sketch', model._FrequencySketch())
 
   @staticmethod
   def message_to_dict(message):
@@ -211,6 +217,18 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
       self.call_api(
           'preupload', self.message_to_dict(bad_collection), 200)
 
+  def test_pre_upload_unsupported_compression(self):
+    """Assert that status 400 is returned when the namespace's compression
+    can't be verified by the server.
+    """
+    # pylint: disable=protected-access
+    self.mock(model, '_EXPANDERS', dict(model._EXPANDERS, zstd=None))
+    collection = handlers_endpoints_v1.DigestCollection(
+        namespace=handlers_endpoints_v1.Namespace(namespace='default-zstd'))
+    collection.items.append(generate_digest('pangolin'))
+    with self.call_should_fail('400'):
+      self.call_api('preupload', self.message_to_dict(collection), 200)
+
   def test_check_existing_finds_existing_entities(self):
     """Assert that existence check is working."""
     collection = generate_collection(
@@ -241,14 +259,79 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     key = model.get_entry_key(
         collection.namespace.namespace, collection.items[0].digest)
 
-    # guarantee that one digest already exists in the datastore
-    model.new_content_entry(key).put()
+    # guarantee that one digest already exists in the datastore and is due for
+    # a tag
+    entry = model.new_content_entry(key)
+    entry.next_tag_ts = utils.utcnow() - datetime.timedelta(seconds=1)
+    entry.put()
+    self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    # The second lookup is coalesced with the first one.
     self.call_api(
         'preupload', self.message_to_dict(collection), 200)
 
     # find enqueued tasks
     enqueued_tasks = self.execute_tasks()
     self.assertEqual(1, enqueued_tasks)
+    self.assertLess(utils.utcnow(), key.get().next_tag_ts)
+
+  def test_check_existing_recently_tagged(self):
+    """Assert that existent entities tagged recently are not enqueued."""
+    collection = generate_collection(['some content'])
+    key = model.get_entry_key(
+        collection.namespace.namespace, collection.items[0].digest)
+    model.new_content_entry(key).put()
+    self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(0, self.execute_tasks())
+
+  def test_check_existing_existence_cache(self):
+    """Assert that verified entries are remembered by the instance."""
+    collection = generate_collection(['some content'])
+    key = model.get_entry_key(
+        collection.namespace.namespace, collection.items[0].digest)
+    model.new_content_entry(
+        key, expanded_size=collection.items[0].size, is_verified=True).put()
+    response = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(None, response.json.get('items'))
+
+    # The second lookup doesn't hit the datastore.
+    key.delete()
+    response = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(None, response.json.get('items'))
+    cache = handlers_endpoints_v1.existence_cache
+    self.assertEqual(1, len(cache))
+    self.assertEqual(0.5, cache.hit_rate)
+    # The entry was just created so it is not due for a tag.
+    self.assertEqual(0, self.execute_tasks())
+
+  def test_check_existing_existence_cache_skipped(self):
+    """Assert that entries about to expire or unverified are not remembered."""
+    collection = generate_collection(['some content', 'other content'])
+    namespace = collection.namespace.namespace
+    key_expiring = model.get_entry_key(
+        namespace, collection.items[0].digest)
+    entry = model.new_content_entry(
+        key_expiring, expanded_size=collection.items[0].size,
+        is_verified=True)
+    entry.expiration_ts = utils.utcnow() + datetime.timedelta(seconds=60)
+    entry.put()
+    key_unverified = model.get_entry_key(
+        namespace, collection.items[1].digest)
+    model.new_content_entry(
+        key_unverified, expanded_size=collection.items[1].size,
+        is_verified=False).put()
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(0, len(handlers_endpoints_v1.existence_cache))
+
+    ndb.delete_multi([key_expiring, key_unverified])
+    response = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(
+        [0, 1], [int(item['index']) for item in response.json['items']])
+    self.assertEqual(0, self.execute_tasks())
 
   def test_store_inline_ok(self):
     """Assert that inline content storage completes successfully."""
@@ -371,6 +454,62 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     self.assertEqual(1, self.execute_tasks())
     self.assertTrue(stored.key.get().is_verified)
 
+  def test_finalize_gs_verify_parallel(self):
+    """Assert that large GS entries are verified with concurrent reads."""
+    self.mock(handlers_backend, 'VERIFY_PARALLEL_MIN_SIZE', 0)
+    content = pad_string('empathy')
+    request = self.store_request(content)
+    embedded = validate(
+        request.upload_ticket, handlers_endpoints_v1.UPLOAD_MESSAGES[1])
+    key = model.get_entry_key(embedded['n'], embedded['d'])
+    self.mock(gcs, 'get_file_info', get_file_info_factory(content))
+    self.call_api(
+        'finalize_gs_upload', self.message_to_dict(request), 200)
+
+    calls = []
+    def read_file(bucket, filename, chunk_size, max_in_flight):
+      calls.append((bucket, filename, chunk_size, max_in_flight))
+      return [content[:10], content[10:]]
+    self.mock(gcs, 'read_file', read_file)
+    self.assertEqual(1, self.execute_tasks())
+    expected = [
+      (
+        'sample-app', key.id(), handlers_backend.VERIFY_PARALLEL_CHUNK_SIZE,
+        handlers_backend.VERIFY_MAX_BYTES_IN_FLIGHT,
+      ),
+    ]
+    self.assertEqual(expected, calls)
+    self.assertTrue(key.get().is_verified)
+    # The slot is released.
+    self.assertTrue(handlers_backend._verify_parallel_slots.acquire(False))
+    handlers_backend._verify_parallel_slots.release()
+
+  def test_finalize_gs_verify_parallel_busy(self):
+    """Assert that large GS entries are streamed when the instance already
+    verifies VERIFY_MAX_PARALLEL_PER_INSTANCE entries with concurrent reads.
+    """
+    self.mock(handlers_backend, 'VERIFY_PARALLEL_MIN_SIZE', 0)
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    self.mock(handlers_backend, '_verify_parallel_slots', slots)
+    content = pad_string('empathy')
+    request = self.store_request(content)
+    embedded = validate(
+        request.upload_ticket, handlers_endpoints_v1.UPLOAD_MESSAGES[1])
+    key = model.get_entry_key(embedded['n'], embedded['d'])
+    self.mock(gcs, 'get_file_info', get_file_info_factory(content))
+    self.call_api(
+        'finalize_gs_upload', self.message_to_dict(request), 200)
+
+    calls = []
+    def read_file(bucket, filename):
+      calls.append((bucket, filename))
+      return [content]
+    self.mock(gcs, 'read_file', read_file)
+    self.assertEqual(1, self.execute_tasks())
+    self.assertEqual([('sample-app', key.id())], calls)
+    self.assertTrue(key.get().is_verified)
+
   def test_storage_wrong_type(self):
     """Assert that GS and inline storage fail when the wrong type is sent."""
     small = 'elephant'
@@ -437,6 +576,27 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     retrieved = response.json
     self.assertEqual(content, base64.b64decode(retrieved.get(u'content', '')))
 
+  def test_retrieve_db_promoted(self):
+    """Assert that an inline entry retrieved often is promoted to memcache."""
+    content = 'Ode on Melancholy'
+    request = self.store_request(content)
+    embedded = validate(
+        request.upload_ticket, handlers_endpoints_v1.UPLOAD_MESSAGES[0])
+    self.call_api(
+        'store_inline', self.message_to_dict(request), 200)
+    retrieve_request = handlers_endpoints_v1.RetrieveRequest(
+        digest=embedded['d'], namespace=handlers_endpoints_v1.Namespace())
+    memcache.flush_all()
+    for _ in xrange(model.HOT_ENTRY_MIN_RETRIEVES - 1):
+      self.call_api('retrieve', self.message_to_dict(retrieve_request), 200)
+      self.assertIsNone(memcache.get(embedded['d'], namespace='table_default'))
+    response = self.call_api(
+        'retrieve', self.message_to_dict(retrieve_request), 200)
+    self.assertEqual(
+        content, base64.b64decode(response.json.get(u'content', '')))
+    self.assertEqual(
+        content, memcache.get(embedded['d'], namespace='table_default'))
+
   def test_retrieve_gs_url_ok(self):
     """Assert that URL retrieval works for GS entities."""
 
@@ -527,10 +687,107 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
       self.call_api(
           'retrieve', self.message_to_dict(retrieve_request), 200)
 
+  def put_isolated(self, data):
+    """Stores a .isolated file inline in the default namespace."""
+    content = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    digest = hash_content(content)
+    model.new_content_entry(
+        model.get_entry_key('default', digest),
+        content=content,
+        compressed_size=len(content),
+        expanded_size=len(content),
+        is_isolated=True,
+        is_verified=True).put()
+    return digest
+
+  def test_flatten_ok(self):
+    """Assert that includes are merged in, the root winning."""
+    large = hash_content('large')
+    # Only the entries stored in GS get an URL, not the ones stored inline
+    # even if their expanded size is large.
+    model.new_content_entry(
+        model.get_entry_key('default', large), expanded_size=1000,
+        is_verified=True).put()
+    inline = hash_content('inline')
+    model.new_content_entry(
+        model.get_entry_key('default', inline), content='inline',
+        expanded_size=1000, is_verified=True).put()
+    child = self.put_isolated({
+      'command': ['child'],
+      'files': {
+        'a': {'h': hash_content('child a'), 's': 7},
+        'b': {'h': large, 's': 1000, 'm': 0640},
+        'c': {'l': 'b'},
+        'd': {'h': inline, 's': 1000},
+      },
+      'relative_cwd': 'child',
+    })
+    root = self.put_isolated({
+      'files': {'a': {'h': hash_content('root a'), 's': 6}},
+      'includes': [child],
+      'read_only': 1,
+    })
+    request = handlers_endpoints_v1.FlattenRequest(
+        digest=root, namespace=handlers_endpoints_v1.Namespace())
+    response = self.call_api(
+        'flatten', self.message_to_dict(request), 200).json
+    url = response['files'][1].pop('url')
+    self.assertTrue(url.startswith(self.store_prefix + 'default/' + large), url)
+    # Integers may be encoded as strings.
+    for f in response['files']:
+      for k in ('mode', 'size'):
+        if k in f:
+          f[k] = int(f[k])
+    self.assertEqual(
+        [
+          {u'path': u'a', u'digest': hash_content('root a'), u'size': 6},
+          {u'path': u'b', u'digest': large, u'size': 1000, u'mode': 0640},
+          {u'path': u'c', u'link': u'b'},
+          {u'path': u'd', u'digest': inline, u'size': 1000},
+        ],
+        response['files'])
+    self.assertEqual([u'child'], response['command'])
+    self.assertEqual([root, child], response['isolated'])
+    self.assertEqual(1, int(response['read_only']))
+    self.assertEqual(u'child', response['relative_cwd'])
+
+    # The response is cached.
+    ndb.delete_multi(model.ContentEntry.query().fetch(keys_only=True))
+    response = self.call_api(
+        'flatten', self.message_to_dict(request), 200).json
+    self.assertEqual([root, child], response['isolated'])
+
+  def test_flatten_recursive(self):
+    """Assert that recursive includes are refused."""
+    # A .isolated file can't include itself by its own digest, so it is
+    # stored under another one.
+    digest = hash_content('recursive')
+    content = json.dumps({'includes': [digest]})
+    model.new_content_entry(
+        model.get_entry_key('default', digest),
+        content=content,
+        compressed_size=len(content),
+        expanded_size=len(content),
+        is_verified=True).put()
+    request = handlers_endpoints_v1.FlattenRequest(
+        digest=digest, namespace=handlers_endpoints_v1.Namespace())
+    with self.call_should_fail('400'):
+      self.call_api('flatten', self.message_to_dict(request), 200)
+
+  def test_flatten_not_found(self):
+    """Assert that a missing .isolated file is reported."""
+    request = handlers_endpoints_v1.FlattenRequest(
+        digest=hash_content('missing'),
+        namespace=handlers_endpoints_v1.Namespace())
+    with self.call_should_fail('404'):
+      self.call_api('flatten', self.message_to_dict(request), 200)
+
   def test_server_details_ok(self):
     """Assert that server_details returns the correct version."""
     response = self.call_api('server_details', {}, 200).json
     self.assertEqual(utils.get_app_version(), response['server_version'])
+    self.assertEqual(True, response['raw_retrieve'])
+    self.assertEqual(True, response['flatten'])
 
 
 if __name__ == '__main__':
@@ -8,10 +8,12 @@ import collections
 import datetime
 import json
 import logging
+import re
 
 import webapp2
 
 import cloudstorage
+from google.appengine.api import memcache
 from google.appengine.api import modules
 
 import acl
@@ -56,6 +58,10 @@ _GVIZ_COLUMNS_ORDER = (
   'contains_lookups',
 )
 
+# Raw content is addressed by its digest so it never changes. It is private
+# because it is ACL'ed.
+_RAW_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
 _ISOLATED_ROOT_MEMBERS = (
   'algo',
   'command',
@@ -67,6 +73,37 @@ _ISOLATED_ROOT_MEMBERS = (
 )
 
 
+### Utility
+
+
+def _parse_range(range_header, offset, size):
+  """Returns the [start, end) slice of a content of |size| bytes to return.
+
+  |range_header| is a single range 'bytes=<first>-[<last>]' or
+  'bytes=-<suffix>'. |offset| is the legacy equivalent of 'bytes=<offset>-',
+  already parsed as an int.
+
+  Raises ValueError if the range is invalid or not satisfiable.
+  """
+  if range_header:
+    m = re.match(r'^bytes=(\d*)-(\d*)$', range_header.strip())
+    if not m or not (m.group(1) or m.group(2)):
+      raise ValueError('Invalid range %r' % range_header)
+    if not m.group(1):
+      # Suffix range, the last N bytes.
+      return max(0, size - int(m.group(2))), size
+    start = int(m.group(1))
+    end = min(size, int(m.group(2)) + 1) if m.group(2) else size
+  else:
+    start = offset
+    end = size
+  # There's no byte to return at the end of the content, yet an empty content
+  # is returned as is.
+  if start < 0 or start > end or (start == end and (range_header or start)):
+    raise ValueError('Unsatisfiable range')
+  return start, end
+
+
 ### Restricted handlers
 
 
@@ -305,6 +342,79 @@ class ContentHandler(auth.AuthenticatingHandler):
     return actual.issubset(_ISOLATED_ROOT_MEMBERS) and 'files' in actual
 
 
+class RetrieveRawHandler(auth.AuthenticatingHandler):
+  """Returns the content of an entry as stored, i.e. compressed if the
+  namespace is.
+
+  Unlike the retrieve endpoint, the content is not base64 encoded in a JSON
+  message. The Range header and the offset query parameter are supported. The
+  content stored in GCS is redirected to a signed URL, which supports Range
+  too.
+  """
+
+  @auth.require(acl.isolate_readable)
+  def get(self, namespace, digest):
+    etag = '"%s"' % digest
+    if digest in self.request.if_none_match:
+      # The content never changes.
+      self.response.status_int = 304
+      self.response.headers['ETag'] = etag
+      return
+
+    try:
+      offset = int(self.request.get('offset') or 0)
+    except ValueError:
+      self.abort(400, 'Invalid offset')
+
+    content = memcache.get(digest, namespace='table_%s' % namespace)
+    found = 'memcache'
+    if content is None:
+      try:
+        key = model.get_entry_key(namespace, digest)
+      except ValueError:
+        self.abort(400, 'Invalid key')
+      entity = key.get()
+      if entity is None:
+        self.abort(404, 'Unable to retrieve the entry')
+      content = entity.content
+      found = 'inline'
+      if content is not None and model.promote_if_hot(
+          namespace, digest, content):
+        found = 'inline; promoted'
+      if content is None:
+        stats.add_entry(
+            stats.RETURN, entity.compressed_size, 'GS; %s' % key.id())
+        settings = config.settings()
+        signer = gcs.URLSigner(
+            settings.gs_bucket, settings.gs_client_id_email,
+            settings.gs_private_key)
+        self.redirect(signer.get_download_url(
+            filename=key.id(),
+            expiration=handlers_endpoints_v1.DEFAULT_LINK_EXPIRATION))
+        return
+
+    try:
+      start, end = _parse_range(
+          self.request.headers.get('Range'),
+          offset,
+          len(content))
+    except ValueError:
+      self.response.status_int = 416
+      self.response.headers['Content-Range'] = 'bytes */%d' % len(content)
+      return
+
+    stats.add_entry(stats.RETURN, end - start, found)
+    self.response.headers['Accept-Ranges'] = 'bytes'
+    self.response.headers['Cache-Control'] = _RAW_CACHE_CONTROL
+    self.response.headers['Content-Type'] = 'application/octet-stream'
+    self.response.headers['ETag'] = etag
+    if start or end != len(content):
+      self.response.status_int = 206
+      self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+          start, end - 1, len(content))
+    self.response.write(content[start:end])
+
+
 class StatsHandler(webapp2.RequestHandler):
   """Returns the statistics web page."""
   def get(self):
@@ -452,6 +562,10 @@ def get_routes():
       webapp2.Route(r'/', RootHandler),
       webapp2.Route(r'/newui', UIHandler),
     ])
+  routes.append(webapp2.Route(
+      r'/isolate/api/v1/raw/<namespace:%s>/<digest:[0-9a-f]+>' %
+          model.NAMESPACE_RE,
+      RetrieveRawHandler))
   routes.extend(handlers_endpoints_v1.get_routes())
   return routes
 
@@ -3,6 +3,7 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
+import base64
 import datetime
 import hashlib
 import logging
@@ -228,6 +229,80 @@ class MainTest(test_case.TestCase):
         '/content?namespace=default-gzip&digest=%s' % hashhex, status=404)
     self.assertEqual(None, key.get())
 
+  def test_retrieve_raw(self):
+    self.set_as_reader()
+    hashhex = self.gen_content_inline(content='Foo bar')
+    url = '/isolate/api/v1/raw/default/%s' % hashhex
+    resp = self.app_frontend.get(url)
+    self.assertEqual('Foo bar', resp.body)
+    self.assertEqual('"%s"' % hashhex, resp.headers['ETag'])
+    self.assertEqual(
+        'private, max-age=31536000, immutable', resp.headers['Cache-Control'])
+
+    resp = self.app_frontend.get(url, headers={'Range': 'bytes=4-'})
+    self.assertEqual(206, resp.status_int)
+    self.assertEqual('bar', resp.body)
+    self.assertEqual('bytes 4-6/7', resp.headers['Content-Range'])
+    resp = self.app_frontend.get(url, headers={'Range': 'bytes=1-2'})
+    self.assertEqual('oo', resp.body)
+    resp = self.app_frontend.get(url, headers={'Range': 'bytes=-2'})
+    self.assertEqual('ar', resp.body)
+    resp = self.app_frontend.get(url + '?offset=4')
+    self.assertEqual('bar', resp.body)
+    self.app_frontend.get(url + '?offset=foo', status=400)
+    self.app_frontend.get(url + '?offset=8', status=416)
+    # There's nothing to return at the end of the content.
+    resp = self.app_frontend.get(url + '?offset=7', status=416)
+    self.assertEqual('bytes */7', resp.headers['Content-Range'])
+    self.assertEqual('', resp.body)
+
+    resp = self.app_frontend.get(url, headers={'Range': 'bytes=7-'}, status=416)
+    self.assertEqual('bytes */7', resp.headers['Content-Range'])
+    self.app_frontend.get(
+        url, headers={'If-None-Match': '"%s"' % hashhex}, status=304)
+
+  def test_retrieve_raw_empty(self):
+    self.set_as_reader()
+    hashhex = self.gen_content_inline(content='')
+    url = '/isolate/api/v1/raw/default/%s' % hashhex
+    resp = self.app_frontend.get(url)
+    self.assertEqual(200, resp.status_int)
+    self.assertEqual('', resp.body)
+    self.app_frontend.get(url, headers={'Range': 'bytes=0-'}, status=416)
+
+  def test_retrieve_raw_missing(self):
+    self.set_as_reader()
+    hashhex = '0123456780123456780123456789990123456789'
+    self.app_frontend.get(
+        '/isolate/api/v1/raw/default/%s' % hashhex, status=404)
+
+  def test_retrieve_raw_anonymous(self):
+    hashhex = self.gen_content_inline()
+    self.app_frontend.get(
+        '/isolate/api/v1/raw/default/%s' % hashhex, status=403)
+
+  def test_retrieve_raw_gcs(self):
+    content = 'Foo'
+    compressed = zlib.compress(content)
+    namespace = 'default-gzip'
+    hashhex = hashlib.sha1(content).hexdigest()
+    self.mock(
+        gcs.URLSigner, 'get_download_url',
+        lambda _self, filename, expiration: 'https://gcs/%s' % filename)
+    key = model.get_entry_key(namespace, hashhex)
+    model.new_content_entry(
+        key,
+        is_isolated=False,
+        compressed_size=len(compressed),
+        expanded_size=len(content),
+        is_verified=True).put()
+
+    self.set_as_reader()
+    resp = self.app_frontend.get(
+        '/isolate/api/v1/raw/%s/%s' % (namespace, hashhex), status=302)
+    self.assertEqual(
+        'https://gcs/%s/%s' % (namespace, hashhex), resp.headers['Location'])
+
   def test_config(self):
     self.set_as_admin()
     resp = self.app_frontend.get('/restricted/config')
@@ -258,6 +333,69 @@ class MainTest(test_case.TestCase):
     self.assertIn('Update conflict', resp)
     self.assertEqual('', config.settings().google_analytics)
 
+  def _put_entry(self, hashhex, expiration_ts):
+    key = model.get_entry_key('default', hashhex)
+    entry = model.new_content_entry(key)
+    entry.expiration_ts = expiration_ts
+    entry.put()
+    return key
+
+  def test_cleanup_old(self):
+    headers = {'X-AppEngine-QueueName': 'cleanup'}
+    self.app_backend.post('/internal/taskqueue/cleanup/old', headers=headers)
+    tasks = self._taskqueue_stub.GetTasks('cleanup')
+    self.assertEqual(
+        ['/internal/taskqueue/cleanup/old/%x' % i for i in xrange(16)],
+        sorted(t['url'] for t in tasks))
+    # The chains of tasks are still running, no new one is started.
+    self.app_backend.post('/internal/taskqueue/cleanup/old', headers=headers)
+    self.assertEqual(16, len(self._taskqueue_stub.GetTasks('cleanup')))
+    self._taskqueue_stub.FlushQueue('cleanup')
+
+  def test_cleanup_old_shard(self):
+    deleted = []
+    def delete_files(bucket, filenames, ignore_missing=False):
+      self.assertEqual(u'sample-app', bucket)
+      self.assertTrue(ignore_missing)
+      deleted.extend(filenames)
+      return []
+    self.mock(gcs, 'delete_files', delete_files)
+    self.mock(handlers_backend, 'CLEANUP_PAGE_SIZE', 1)
+    now = utils.utcnow()
+    past = now - datetime.timedelta(seconds=1)
+    future = now + datetime.timedelta(days=1)
+    # Before the checkpoint.
+    skipped = self._put_entry('fff0' + '0' * 36, past)
+    expired = [
+      self._put_entry('fff1' + '0' * 36, past),
+      self._put_entry('fff1' + '1' * 36, past),
+      self._put_entry('ffff' + '0' * 36, past),
+    ]
+    fresh = self._put_entry('fff1' + '2' * 36, future)
+
+    headers = {'X-AppEngine-QueueName': 'cleanup'}
+    self.app_backend.post(
+        '/internal/taskqueue/cleanup/old/f', {'shard': 'fff1'},
+        headers=headers)
+    self.assertEqual(sorted(k.id() for k in expired), sorted(deleted))
+    self.assertEqual([None, None, None], ndb.get_multi(expired))
+    self.assertTrue(skipped.get())
+    self.assertTrue(fresh.get())
+
+  def test_cleanup_old_shard_checkpoint(self):
+    self.mock(handlers_backend, 'CLEANUP_TASK_DURATION', -1)
+    headers = {'X-AppEngine-QueueName': 'cleanup'}
+    self.app_backend.post(
+        '/internal/taskqueue/cleanup/old/f', {'shard': 'fff1'},
+        headers=headers)
+    tasks = self._taskqueue_stub.GetTasks('cleanup')
+    self.assertEqual(
+        ['/internal/taskqueue/cleanup/old/f'], [t['url'] for t in tasks])
+    self.assertEqual(
+        'cursor=&shard=fff1',
+        '&'.join(sorted(base64.b64decode(tasks[0]['body']).split('&'))))
+    self._taskqueue_stub.FlushQueue('cleanup')
+
   def disabled_test_stats(self):
     self._gen_stats()
     response = self.app_frontend.get('/stats')
@@ -30,6 +30,7 @@ import gae_ts_mon
 import config
 import handlers_frontend
 import handlers_endpoints_v1
+import stats
 
 
 def create_application():
@@ -49,7 +50,7 @@ def create_application():
       # luci-config service URL.
       config.ConfigApi,
   ], base_path='/_ah/api'))
-  return frontend, api
+  return stats.instrument_app(frontend), stats.instrument_app(api)
 
 
 frontend_app, endpoints_app = create_application()
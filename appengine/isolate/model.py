@@ -5,10 +5,12 @@
 
 """This module defines Isolate Server model(s)."""
 
+import array
 import datetime
 import hashlib
 import logging
 import random
+import threading
 import zlib
 
 from google.appengine.api import memcache
@@ -19,11 +21,32 @@ import gcs
 from components import datastore_utils
 from components import utils
 
+# zstd and lz4 are only supported when the module is deployed with the app.
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  import lz4.frame as lz4_frame
+except ImportError:
+  lz4_frame = None
+
 
 # The maximum number of entries that can be queried in a single request.
 MAX_KEYS_PER_DB_OPS = 1000
 
 
+# Number of retrieves of an inline entry, as estimated by the instance's
+# frequency sketch, at which it is promoted to memcache.
+HOT_ENTRY_MIN_RETRIEVES = 4
+
+
+# Promoted entries expire from memcache so the ones that are not retrieved
+# anymore are demoted. Those still hot are promoted again on the next miss.
+HOT_ENTRY_EXPIRATION = 60*60
+
+
 # Maximum size of file stored in GS to be saved in memcache. The value must be
 # small enough so that the whole content can safely fit in memory.
 MAX_MEMCACHE_ISOLATED = 500*1024
@@ -55,6 +78,7 @@ class ContentEntry(ndb.Model):
     - -deflate: The namespace contains the content in deflated format. The
                 content key is the hash of the uncompressed data, not the
                 compressed one. That is why it is in a separate namespace.
+    - -lz4, -zstd: Same with other compression formats, see _EXPANDERS.
   """
   # Cache the file size for statistics purposes.
   compressed_size = ndb.IntegerProperty(indexed=False)
@@ -89,7 +113,7 @@ class ContentEntry(ndb.Model):
     """Is it the raw data or was it modified in any form, e.g. compressed, so
     that the SHA-1 doesn't match.
     """
-    return self.key.parent().id().endswith(('-bzip2', '-deflate', '-gzip'))
+    return bool(get_compression(self.key.parent().id()))
 
 
 ### Private stuff.
@@ -99,6 +123,159 @@ class ContentEntry(ndb.Model):
 _HASH_LETTERS = frozenset('0123456789abcdef')
 
 
+class _FrequencySketch(object):
+  """Count-min sketch estimating how often each key was seen recently.
+
+  It uses a fixed amount of memory regardless of the number of keys and never
+  underestimates. All the counters are halved every |sample_size| additions so
+  keys that stop being seen fade out.
+  """
+
+  def __init__(self, width=8192, depth=4, sample_size=None):
+    self._width = width
+    self._depth = depth
+    self._sample_size = sample_size or 10 * width
+    self._lock = threading.Lock()
+    self._counters = array.array('I', [0]) * (width * depth)
+    self._additions = 0
+
+  def _indexes(self, key):
+    # Double hashing; the keys are already hex digests so hash() spreads well.
+    h = hash(key)
+    h1 = h & 0xffffffff
+    h2 = (h >> 32) | 1
+    return [
+      row * self._width + (h1 + row * h2) % self._width
+      for row in xrange(self._depth)
+    ]
+
+  def add(self, key):
+    """Counts one occurrence of |key| and returns its estimated count."""
+    indexes = self._indexes(key)
+    with self._lock:
+      for i in indexes:
+        self._counters[i] += 1
+      count = min(self._counters[i] for i in indexes)
+      self._additions += 1
+      if self._additions >= self._sample_size:
+        self._additions = 0
+        for i in xrange(len(self._counters)):
+          self._counters[i] >>= 1
+    return count
+
+  def estimate(self, key):
+    """Returns the estimated count of |key|."""
+    indexes = self._indexes(key)
+    with self._lock:
+      return min(self._counters[i] for i in indexes)
+
+
+# Retrieves of inline entries seen by this instance.
+_retrieve_sketch = _FrequencySketch()
+
+
+def _expand_zlib(source):
+  """Yields inflated data from source."""
+  zlib_state = zlib.decompressobj()
+  for i in source:
+    data = zlib_state.decompress(i, gcs.CHUNK_SIZE)
+    yield data
+    del data
+    # Once the stream ended, trailing data stays in unconsumed_tail.
+    while zlib_state.unconsumed_tail and not zlib_state.unused_data:
+      data = zlib_state.decompress(
+          zlib_state.unconsumed_tail, gcs.CHUNK_SIZE)
+      yield data
+      del data
+    del i
+  data = zlib_state.flush()
+  yield data
+  del data
+  # Forcibly delete the state.
+  del zlib_state
+
+
+class _ChunkReader(object):
+  """File-like object reading the chunks yielded by a generator."""
+
+  def __init__(self, source):
+    self._source = iter(source)
+    self._buf = ''
+
+  def read(self, size=-1):
+    """Returns at most |size| bytes of the current chunk, '' at the end."""
+    while not self._buf:
+      self._buf = next(self._source, None)
+      if self._buf is None:
+        self._buf = ''
+        return ''
+    if size < 0:
+      size = len(self._buf)
+    out, self._buf = self._buf[:size], self._buf[size:]
+    return out
+
+  def exhausted(self):
+    """Returns True if all the chunks were read."""
+    return not self.read(1)
+
+
+def _expand_lz4(source):
+  """Yields data from a lz4 frame."""
+  state = lz4_frame.LZ4FrameDecompressor()
+  try:
+    for i in source:
+      data = state.decompress(i, max_length=gcs.CHUNK_SIZE)
+      yield data
+      del data
+      # Drain the output buffered past gcs.CHUNK_SIZE before reading more.
+      while not state.needs_input and not state.eof:
+        data = state.decompress('', max_length=gcs.CHUNK_SIZE)
+        yield data
+        del data
+      del i
+  except (EOFError, RuntimeError) as e:
+    raise IOError('Data is corrupted: %s' % e)
+  if not state.eof or state.unused_data:
+    raise IOError('Data is corrupted: not all data was decompressed')
+
+
+def _expand_zstd(source):
+  """Yields data from a zstd frame."""
+  # decompressobj() can't bound its output, stream_reader() can. It stops at
+  # the end of the frame; the reader returns one chunk at a time so trailing
+  # chunks are left in it.
+  reader = _ChunkReader(source)
+  state = zstandard.ZstdDecompressor().stream_reader(reader)
+  try:
+    while True:
+      data = state.read(gcs.CHUNK_SIZE)
+      if not data:
+        break
+      yield data
+      del data
+  except zstandard.ZstdError as e:
+    raise IOError('Data is corrupted: %s' % e)
+  if not reader.exhausted():
+    raise IOError('Data is corrupted: not all data was decompressed')
+
+
+# Expanders keyed by namespace suffix. The value is None if the namespace can't
+# be expanded by this server:
+# - bzip2's decompressor can't bound the size of its output, so a small upload
+#   could expand to gigabytes in a single call.
+# - zstd and lz4 need a module that may not be available.
+# '-flate' is not a compressed namespace, its content has always been stored
+# as-is.
+_EXPANDERS = {
+  'bzip2': None,
+  'deflate': _expand_zlib,
+  # TODO(maruel): Remove '-gzip' since it's a misnomer.
+  'gzip': _expand_zlib,
+  'lz4': _expand_lz4 if lz4_frame else None,
+  'zstd': _expand_zstd if zstandard else None,
+}
+
+
 ### Public API.
 
 
@@ -169,41 +346,49 @@ def expiration_jitter(now, expiration):
   return expiration, next_tag
 
 
+def get_compression(namespace):
+  """Returns the compression suffix of |namespace|, e.g. 'zstd', or None if the
+  content is stored as-is.
+  """
+  suffix = namespace.rsplit('-', 1)[1] if '-' in namespace else None
+  return suffix if suffix in _EXPANDERS else None
+
+
+def is_compression_supported(namespace):
+  """Returns False if the content of |namespace| can't be expanded by this
+  server, so it can't be verified.
+  """
+  compression = get_compression(namespace)
+  return not compression or bool(_EXPANDERS[compression])
+
+
 def expand_content(namespace, source):
-  """Yields expanded data from source."""
-  # TODO(maruel): Add bzip2.
-  # TODO(maruel): Remove '-gzip' since it's a misnomer.
-  if namespace.endswith(('-deflate', '-gzip')):
-    zlib_state = zlib.decompressobj()
-    for i in source:
-      data = zlib_state.decompress(i, gcs.CHUNK_SIZE)
-      yield data
-      del data
-      while zlib_state.unconsumed_tail:
-        data = zlib_state.decompress(
-            zlib_state.unconsumed_tail, gcs.CHUNK_SIZE)
-        yield data
-        del data
-      del i
-    data = zlib_state.flush()
-    yield data
-    del data
-    # Forcibly delete the state.
-    del zlib_state
-  else:
+  """Yields expanded data from source.
+
+  Raises zlib.error or IOError if the data is corrupted.
+  """
+  compression = get_compression(namespace)
+  if not compression:
     # Returns the source as-is.
     for i in source:
       yield i
       del i
+    return
+  expander = _EXPANDERS[compression]
+  if not expander:
+    raise ValueError('Unsupported compression %s' % compression)
+  for data in expander(source):
+    yield data
+    del data
 
 
-def save_in_memcache(namespace, hash_key, content, async=False):
+def save_in_memcache(namespace, hash_key, content, async=False, time=0):
   namespace_key = 'table_%s' % namespace
   if async:
     return ndb.get_context().memcache_set(
-        hash_key, content, namespace=namespace_key)
+        hash_key, content, time=time, namespace=namespace_key)
   try:
-    if not memcache.set(hash_key, content, namespace=namespace_key):
+    if not memcache.set(hash_key, content, time=time, namespace=namespace_key):
       msg = 'Failed to save content to memcache.\n%s\\%s %d bytes' % (
           namespace_key, hash_key, len(content))
       if len(content) < 100*1024:
@@ -214,6 +399,24 @@ def save_in_memcache(namespace, hash_key, content, async=False):
     logging.error(e)
 
 
+def promote_if_hot(namespace, hash_key, content):
+  """Records a retrieve of an inline entry that was not in memcache, and saves
+  it in memcache if it is retrieved often.
+
+  Only .isolated files are saved in memcache when they are stored. This keeps
+  the small but very popular files, e.g. test wrappers, off the datastore.
+
+  Returns True if the entry was promoted.
+  """
+  if len(content) > MAX_MEMCACHE_ISOLATED:
+    return False
+  count = _retrieve_sketch.add('%s/%s' % (namespace, hash_key))
+  if count < HOT_ENTRY_MIN_RETRIEVES:
+    return False
+  save_in_memcache(namespace, hash_key, content, time=HOT_ENTRY_EXPIRATION)
+  return True
+
+
 def new_content_entry(key, **kwargs):
   """Generates a new ContentEntry for the request.
 
@@ -228,45 +431,27 @@ def new_content_entry(key, **kwargs):
 def delete_entry_and_gs_entry(keys_to_delete):
   """Deletes synchronously a list of ContentEntry and their GS files.
 
-  For each ContentEntry, it deletes the ContentEntry first, then the files in
-  GS. The worst case is that the GS files are left behind and will be reaped by
-  a lost GS task queue. The reverse is much worse, having a ContentEntry
-  pointing to a deleted GS entry will lead to lookup failures.
+  It deletes the ContentEntry first, then the files in GS. The worst case is
+  that the GS files are left behind and will be reaped by a lost GS task queue.
+  The reverse is much worse, having a ContentEntry pointing to a deleted GS
+  entry will lead to lookup failures.
   """
-  futures = {}
-  exc = None
   bucket = config.settings().gs_bucket
+  # Always delete ContentEntry first.
+  futures = ndb.delete_multi_async(keys_to_delete)
+  exc = None
+  deleted = []
+  for key, f in zip(keys_to_delete, futures):
+    try:
+      f.get_result()
+      deleted.append(key.string_id())
+    except Exception as e:
+      exc = e
   # Note that some content entries may NOT have corresponding GS files. That
   # happens for small entries stored inline in the datastore or memcache. Since
   # this function operates only on keys, it can't distinguish "large" entries
   # stored in GS from "small" ones stored inline. So instead it tries to delete
   # all corresponding GS files, silently skipping ones that are not there.
-  for key in keys_to_delete:
-    # Always delete ContentEntry first.
-    futures[key.delete_async()] = key.string_id()
-    # Note: this is worst case O(n²) but will scale better than that. The goal
-    # is to delete files as soon as possible.
-    for f in futures.keys():
-      if f.done():
-        k = futures.pop(f)
-        try:
-          f.get_result()
-          # This is synchronous.
-          gcs.delete_file(bucket, k, ignore_missing=True)
-        except Exception as exc:
-          break
-    if exc:
-      break
-
-  while futures:
-    f = ndb.Future.wait_any(futures)
-    k = futures.pop(f)
-    try:
-      f.get_result()
-      # This is synchronous.
-      gcs.delete_file(bucket, k, ignore_missing=True)
-    except Exception as exc:
-      continue
-
+  gcs.delete_files(bucket, deleted, ignore_missing=True)
   if exc:
     raise exc  # pylint: disable=raising-bad-type
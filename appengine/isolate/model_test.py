@@ -8,10 +8,13 @@ import logging
 import os
 import sys
 import unittest
+import zlib
 
 import test_env
 test_env.setup_test_env()
 
+from google.appengine.api import memcache
+
 from components import auth
 from components import auth_testing
 from components import datastore_utils
@@ -66,6 +69,66 @@ class MainTest(test_case.TestCase):
         actual_prefix, len(actual_prefix), 'ContentShard')
     self.assertEqual(2, len(list(model.ContentEntry.query(ancestor=k))))
 
+  def test_get_compression(self):
+    self.assertEqual(None, model.get_compression('default'))
+    self.assertEqual(None, model.get_compression('temporary-foo'))
+    self.assertEqual('gzip', model.get_compression('default-gzip'))
+    self.assertEqual('zstd', model.get_compression('sha-256-zstd'))
+    # -flate namespaces have always been stored as-is.
+    self.assertEqual(None, model.get_compression('default-flate'))
+
+  def test_expand_content(self):
+    content = 'a' * 1000
+    for namespace, compressed in (
+        ('default', content),
+        ('default-deflate', zlib.compress(content)),
+        ('default-flate', content),
+      ):
+      self.assertEqual(
+          content,
+          ''.join(model.expand_content(namespace, list(compressed))))
+
+  def test_expand_content_corrupted(self):
+    with self.assertRaises(zlib.error):
+      list(model.expand_content('default-deflate', ['garbage']))
+
+  def test_expand_content_unsupported(self):
+    self.mock(model, '_EXPANDERS', dict(model._EXPANDERS, zstd=None))
+    self.assertFalse(model.is_compression_supported('default-zstd'))
+    with self.assertRaises(ValueError):
+      list(model.expand_content('default-zstd', ['a']))
+    # bzip2 can't bound the size of its output.
+    self.assertFalse(model.is_compression_supported('default-bzip2'))
+
+  def test_frequency_sketch(self):
+    sketch = model._FrequencySketch(width=64, depth=4, sample_size=1000)
+    for i in xrange(10):
+      self.assertEqual(i + 1, sketch.add('hot'))
+    self.assertEqual(0, sketch.estimate('cold'))
+    self.assertEqual(1, sketch.add('cold'))
+    # It never underestimates.
+    self.assertTrue(sketch.estimate('hot') >= 10)
+
+  def test_frequency_sketch_aging(self):
+    sketch = model._FrequencySketch(width=64, depth=4, sample_size=10)
+    for _ in xrange(9):
+      sketch.add('hot')
+    self.assertEqual(10, sketch.add('hot'))
+    self.assertEqual(5, sketch.estimate('hot'))
+
+  def test_promote_if_hot(self):
+    self.mock(model, '_retrieve_sketch', model._FrequencySketch())
+    for _ in xrange(model.HOT_ENTRY_MIN_RETRIEVES - 1):
+      self.assertFalse(model.promote_if_hot('default', 'a' * 40, 'content'))
+    self.assertIsNone(memcache.get('a' * 40, namespace='table_default'))
+    self.assertTrue(model.promote_if_hot('default', 'a' * 40, 'content'))
+    self.assertEqual(
+        'content', memcache.get('a' * 40, namespace='table_default'))
+    # Too large.
+    self.assertFalse(
+        model.promote_if_hot(
+            'default', 'b' * 40, 'a' * (model.MAX_MEMCACHE_ISOLATED + 1)))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -2,15 +2,23 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
-"""Generates statistics out of logs. Contains the backend code.
+"""Generates statistics. Contains the backend code.
 
-The first 100mb of logs read is free. It's important to keep logs concise also
-for general performance concerns. Each http handler should strive to do only one
-log entry at info level per request.
+Each instance aggregates the statistics of the requests it handles in memory
+and periodically adds them to per-minute counters in memcache, see
+instrument_app(). The minute snapshots are generated from these counters
+instead of scanning the request logs, which is slow and lags by minutes.
+
+The statistics are still logged, one line per action, for debugging. It's
+important to keep logs concise also for general performance concerns. Each
+http handler should strive to do only one log entry at info level per request.
 """
 
+import collections
 import logging
+import threading
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import stats_framework
@@ -31,10 +39,23 @@ class _Snapshot(ndb.Model):
   downloads = ndb.IntegerProperty(default=0, indexed=False)
   downloads_bytes = ndb.IntegerProperty(default=0, indexed=False)
 
+  # Downloads served by each tier. A memcache miss is served inline from the
+  # datastore or redirected to GCS. Hot inline entries are promoted to
+  # memcache, see model.promote_if_hot().
+  downloads_memcache = ndb.IntegerProperty(default=0, indexed=False)
+  downloads_inline = ndb.IntegerProperty(default=0, indexed=False)
+  downloads_gs = ndb.IntegerProperty(default=0, indexed=False)
+  memcache_promotions = ndb.IntegerProperty(default=0, indexed=False)
+
   # Number of /contains requests and total number of items looked up.
   contains_requests = ndb.IntegerProperty(default=0, indexed=False)
   contains_lookups = ndb.IntegerProperty(default=0, indexed=False)
 
+  # Number of existing items seen by /contains that were enqueued for a tag and
+  # that were skipped because they were recently tagged.
+  tag_enqueued = ndb.IntegerProperty(default=0, indexed=False)
+  tag_coalesced = ndb.IntegerProperty(default=0, indexed=False)
+
   # Total number of requests to calculate QPS
   requests = ndb.IntegerProperty(default=0, indexed=False)
   # Number of non-200 requests.
@@ -76,7 +97,43 @@ class _Snapshot(ndb.Model):
 
 
 # Text to store for the corresponding actions.
-_ACTION_NAMES = ['store', 'return', 'lookup', 'dupe']
+_ACTION_NAMES = ['store', 'return', 'lookup', 'dupe', 'tag']
+
+
+# Seconds between two flushes of the counters of an instance to memcache.
+_FLUSH_INTERVAL = 10
+
+
+# Memcache namespace of the per-minute counters.
+_MEMCACHE_NAMESPACE = 'stats_counters'
+
+
+def _entry_to_fields(action, measurement, rest):
+  """Returns the _Snapshot properties to increment for a statistics entry, as
+  a dict(property name: value to add).
+  """
+  if action == STORE:
+    return {'uploads': 1, 'uploads_bytes': measurement}
+  if action == RETURN:
+    fields = {'downloads': 1, 'downloads_bytes': measurement}
+    # |rest| is the tier, optionally followed by details.
+    tier = rest.split('; ', 1)[0]
+    if tier == 'memcache':
+      fields['downloads_memcache'] = 1
+    elif tier == 'inline':
+      fields['downloads_inline'] = 1
+      if rest.endswith('; promoted'):
+        fields['memcache_promotions'] = 1
+    elif tier == 'GS':
+      fields['downloads_gs'] = 1
+    return fields
+  if action == LOOKUP:
+    return {'contains_requests': 1, 'contains_lookups': measurement}
+  if action == DUPE:
+    return {}
+  if action == TAG:
+    return {'tag_enqueued': measurement, 'tag_coalesced': int(rest)}
+  return None
 
 
 def _parse_line(line, values):
@@ -84,32 +141,94 @@ def _parse_line(line, values):
   """
   if line.count(';') < 2:
     return False
-  action_id, measurement, _rest = line.split('; ', 2)
-  action = _ACTION_NAMES.index(action_id)
-  measurement = int(measurement)
-
-  if action == STORE:
-    values.uploads += 1
-    values.uploads_bytes += measurement
-    return True
-  elif action == RETURN:
-    values.downloads += 1
-    values.downloads_bytes += measurement
-    return True
-  elif action == LOOKUP:
-    values.contains_requests += 1
-    values.contains_lookups += measurement
-    return True
-  elif action == DUPE:
-    return True
-  else:
+  action_id, measurement, rest = line.split('; ', 2)
+  fields = _entry_to_fields(
+      _ACTION_NAMES.index(action_id), int(measurement), rest)
+  if fields is None:
     return False
+  for name, value in fields.iteritems():
+    setattr(values, name, getattr(values, name) + value)
+  return True
+
+
+class _Counters(object):
+  """Counters of this instance not yet flushed to memcache, per minute.
+
+  Thread safe.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._minutes = collections.defaultdict(collections.Counter)
+    self._last_flush = 0
+
+  def add(self, fields):
+    """Adds the values of |fields| to the counters of the current minute."""
+    minute = int(utils.time_time()) / 60 * 60
+    with self._lock:
+      self._minutes[minute].update(fields)
+
+  def flush(self, force=False):
+    """Adds the counters to memcache if not done in the last _FLUSH_INTERVAL
+    seconds.
+    """
+    now = utils.time_time()
+    with self._lock:
+      if not force and now - self._last_flush < _FLUSH_INTERVAL:
+        return
+      pending = self._minutes
+      self._minutes = collections.defaultdict(collections.Counter)
+      self._last_flush = now
+    mapping = {
+      _counter_key(minute, name): value
+      for minute, counter in pending.iteritems()
+      for name, value in counter.iteritems() if value
+    }
+    if not mapping:
+      return
+    result = memcache.offset_multi(
+        mapping, namespace=_MEMCACHE_NAMESPACE, initial_value=0)
+    lost = [k for k in mapping if result.get(k) is None]
+    if lost:
+      logging.warning('Failed to flush %d stats counters', len(lost))
+
+
+def _counter_key(minute, name):
+  """Returns the memcache key of the counter |name| for a minute as epoch."""
+  return '%d/%s' % (minute, name)
+
+
+# Counters of this instance.
+_counters = _Counters()
+
+
+def _extract_snapshot_from_counters(start_time, end_time):
+  """Returns a _Snapshot from the counters flushed by all the instances for the
+  specified interval.
+  """
+  # pylint: disable=protected-access
+  names = [
+    name for name, prop in _Snapshot._properties.iteritems()
+    if isinstance(prop, ndb.IntegerProperty)
+  ]
+  keys = [
+    _counter_key(minute, name)
+    for minute in xrange(int(start_time), int(end_time), 60)
+    for name in names
+  ]
+  counters = memcache.get_multi(keys, namespace=_MEMCACHE_NAMESPACE)
+  values = _Snapshot()
+  for key, value in counters.iteritems():
+    name = key.split('/', 1)[1]
+    setattr(values, name, getattr(values, name) + int(value))
+  return values
 
 
 def _extract_snapshot_from_logs(start_time, end_time):
   """Returns a _Snapshot from the processed logs for the specified interval.
 
-  The data is retrieved from logservice via stats_framework.
+  The data is retrieved from logservice via stats_framework. It is not used
+  anymore to generate the snapshots, see _extract_snapshot_from_counters().
   """
   values = _Snapshot()
   total_lines = 0
@@ -133,11 +252,11 @@ def _extract_snapshot_from_logs(start_time, end_time):
 
 
 STATS_HANDLER = stats_framework.StatisticsFramework(
-    'global_stats', _Snapshot, _extract_snapshot_from_logs)
+    'global_stats', _Snapshot, _extract_snapshot_from_counters)
 
 
 # Action to log.
-STORE, RETURN, LOOKUP, DUPE = range(4)
+STORE, RETURN, LOOKUP, DUPE, TAG = range(5)
 
 
 def add_entry(action, number, where):
@@ -148,6 +267,25 @@ def add_entry(action, number, where):
   """
   stats_framework.add_entry(
       '%s; %d; %s' % (_ACTION_NAMES[action], number, where))
+  _counters.add(_entry_to_fields(action, number, str(where)))
+
+
+def instrument_app(app):
+  """Returns a WSGI application wrapping |app| that counts the requests and
+  failures and flushes the counters of this instance when due.
+  """
+  def wrapped(environ, start_response):
+    status = []
+    def _start_response(status_line, headers, exc_info=None):
+      status.append(int(status_line.split(' ', 1)[0]))
+      return start_response(status_line, headers, exc_info)
+    try:
+      return app(environ, _start_response)
+    finally:
+      failed = not status or status[-1] >= 400
+      _counters.add({'requests': 1, 'failures': int(failed)})
+      _counters.flush()
+  return wrapped
 
 
 def generate_stats():
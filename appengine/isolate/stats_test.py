@@ -37,6 +37,13 @@ class Return(webapp2.RequestHandler):
     self.response.write('Yay')
 
 
+class ReturnPromoted(webapp2.RequestHandler):
+  def get(self):
+    """Generates fake stats."""
+    stats.add_entry(stats.RETURN, 1024, 'inline; promoted')
+    self.response.write('Yay')
+
+
 class Lookup(webapp2.RequestHandler):
   def get(self):
     """Generates fake stats."""
@@ -51,6 +58,20 @@ class Dupe(webapp2.RequestHandler):
     self.response.write('Yay')
 
 
+class Fail(webapp2.RequestHandler):
+  def get(self):
+    """Generates fake stats for a failed request."""
+    stats.add_entry(stats.LOOKUP, 3, 3)
+    self.abort(500)
+
+
+class Tag(webapp2.RequestHandler):
+  def get(self):
+    """Generates fake stats."""
+    stats.add_entry(stats.TAG, 12, 88)
+    self.response.write('Yay')
+
+
 def to_str(now, delta):
   """Converts a datetime to unicode."""
   now = now + datetime.timedelta(seconds=delta)
@@ -63,12 +84,16 @@ class StatsTest(test_case.TestCase, stats_framework_mock.MockMixIn):
     fake_routes = [
         ('/store', Store),
         ('/return', Return),
+        ('/return_promoted', ReturnPromoted),
         ('/lookup', Lookup),
         ('/dupe', Dupe),
+        ('/tag', Tag),
+        ('/fail', Fail),
     ]
     self.app = webtest.TestApp(
-        webapp2.WSGIApplication(fake_routes, debug=True),
+        stats.instrument_app(webapp2.WSGIApplication(fake_routes, debug=True)),
         extra_environ={'REMOTE_ADDR': 'fake-ip'})
+    self.mock(stats, '_counters', stats._Counters())
     stats_framework_mock.configure(self)
     self.now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
     self.mock_now(self.now, 0)
@@ -90,10 +115,16 @@ class StatsTest(test_case.TestCase, stats_framework_mock.MockMixIn):
         'contains_requests': 0,
         'downloads': 0,
         'downloads_bytes': 0,
+        'downloads_gs': 0,
+        'downloads_inline': 0,
+        'downloads_memcache': 0,
         'failures': 0,
         'key': datetime.datetime(2010, 1, 2, 3, 4),
+        'memcache_promotions': 0,
         'other_requests': 0,
         'requests': 1,
+        'tag_coalesced': 0,
+        'tag_enqueued': 0,
         'uploads': 0,
         'uploads_bytes': 0,
       },
@@ -112,9 +143,19 @@ class StatsTest(test_case.TestCase, stats_framework_mock.MockMixIn):
     expected = {
       'downloads': 1,
       'downloads_bytes': 4096,
+      'downloads_memcache': 1,
     }
     self._test_handler('/return', expected)
 
+  def test_return_promoted(self):
+    expected = {
+      'downloads': 1,
+      'downloads_bytes': 1024,
+      'downloads_inline': 1,
+      'memcache_promotions': 1,
+    }
+    self._test_handler('/return_promoted', expected)
+
   def test_lookup(self):
     expected = {
       'contains_lookups': 200,
@@ -128,6 +169,51 @@ class StatsTest(test_case.TestCase, stats_framework_mock.MockMixIn):
     }
     self._test_handler('/dupe', expected)
 
+  def test_tag(self):
+    expected = {
+      'other_requests': 1,
+      'tag_coalesced': 88,
+      'tag_enqueued': 12,
+    }
+    self._test_handler('/tag', expected)
+
+  def test_counters_match_logs(self):
+    # The snapshot generated from the counters is the same as the one
+    # generated by scraping the logs.
+    # pylint: disable=protected-access
+    for url in ('/store', '/return', '/return_promoted', '/lookup', '/dupe',
+                '/tag', '/store'):
+      self.assertEqual('Yay', self.app.get(url).body)
+    self.app.get('/fail', status=500)
+    self.app.get('/missing', status=404)
+    stats._counters.flush(force=True)
+
+    start = stats.utils.datetime_to_timestamp(self.now) / 1000000 / 60 * 60
+    from_logs = stats._extract_snapshot_from_logs(start, start + 60)
+    from_counters = stats._extract_snapshot_from_counters(start, start + 60)
+    self.assertEqual(from_logs.to_dict(), from_counters.to_dict())
+    self.assertEqual(9, from_counters.requests)
+    self.assertEqual(2, from_counters.failures)
+    self.assertEqual(2, from_counters.uploads)
+    # The following minute is empty.
+    self.assertEqual(
+        0, stats._extract_snapshot_from_counters(start + 60, start + 120)
+            .requests)
+
+  def test_counters_flush_interval(self):
+    # pylint: disable=protected-access
+    self.assertEqual('Yay', self.app.get('/store').body)
+    self.mock_now(self.now, 1)
+    self.assertEqual('Yay', self.app.get('/store').body)
+    start = stats.utils.datetime_to_timestamp(self.now) / 1000000 / 60 * 60
+    # Only the first request was flushed.
+    self.assertEqual(
+        1, stats._extract_snapshot_from_counters(start, start + 60).uploads)
+    self.mock_now(self.now, stats._FLUSH_INTERVAL)
+    self.assertEqual('Yay', self.app.get('/store').body)
+    self.assertEqual(
+        3, stats._extract_snapshot_from_counters(start, start + 60).uploads)
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Benchmarks reading and hashing a large GCS object as done by the verify
+task queue, against the local GCS stand-in of the cloudstorage library.
+
+The stand-in has no network latency so --latency simulates the round trip of
+each urlfetch, which is what concurrent range reads amortize.
+
+Example:
+  verify_benchmark.py --size 1024 --size 10240 --latency 30
+"""
+
+import hashlib
+import logging
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import test_env
+test_env.setup_test_env()
+
+from google.appengine.api.blobstore import blobstore_stub
+from google.appengine.api.blobstore import file_blob_storage
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import cloudstorage
+import gcs
+import handlers_backend
+import model
+
+
+BUCKET = 'benchmark'
+
+
+def setup_stubs(blob_dir):
+  """Initializes the stubs needed by the cloudstorage local stand-in."""
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_app_identity_stub()
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  bed.init_urlfetch_stub()
+  # Store the blobs on disk; a 10gb object doesn't fit in memory.
+  storage = file_blob_storage.FileBlobStorage(blob_dir, testbed.DEFAULT_APP_ID)
+  # pylint: disable=protected-access
+  bed._register_stub(
+      testbed.BLOBSTORE_SERVICE_NAME,
+      blobstore_stub.BlobstoreServiceStub(storage))
+  return bed
+
+
+def add_latency(latency):
+  """Delays every GCS request by |latency| seconds, without blocking others."""
+  # pylint: disable=protected-access
+  api_cls = cloudstorage.storage_api._StorageApi
+  original = api_cls.do_request_async
+
+  @ndb.tasklet
+  def do_request_async(self, *args, **kwargs):
+    yield ndb.sleep(latency)
+    result = yield original(self, *args, **kwargs)
+    raise ndb.Return(result)
+  api_cls.do_request_async = do_request_async
+
+
+def write_object(name, size_mb, compress):
+  """Writes a pseudo random object of |size_mb| mb, returns its SHA-1."""
+  digest = hashlib.sha1()
+  block = os.urandom(1024*1024)
+  def gen():
+    compressor = zlib.compressobj(7) if compress else None
+    for i in xrange(size_mb):
+      # Make each block different so compression doesn't dedupe them.
+      data = ('%08d' % i) + block[8:]
+      digest.update(data)
+      if compressor:
+        data = compressor.compress(data)
+      yield data
+    if compressor:
+      yield compressor.flush()
+  assert gcs.write_file(BUCKET, name, gen())
+  return digest.hexdigest()
+
+
+def verify(name, namespace, in_flight_mb):
+  """Reads and hashes an object like InternalVerifyWorkerHandler."""
+  if in_flight_mb:
+    stream = gcs.read_file(
+        BUCKET, name, chunk_size=handlers_backend.VERIFY_PARALLEL_CHUNK_SIZE,
+        max_in_flight=in_flight_mb*1024*1024)
+  else:
+    stream = gcs.read_file(BUCKET, name)
+  digest = hashlib.sha1()
+  for data in model.expand_content(namespace, stream):
+    digest.update(data)
+    del data
+  return digest.hexdigest()
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '-s', '--size', type='int', action='append', default=[],
+      help='Object size in mb; can be specified multiple times. Defaults to '
+           '1024')
+  parser.add_option(
+      '-i', '--in-flight', type='int', action='append', default=[],
+      help='Maximum mb of concurrent range reads to benchmark; 0 means '
+           'streamed. Defaults to 0 and %d' % (
+               handlers_backend.VERIFY_MAX_BYTES_IN_FLIGHT / 1024 / 1024))
+  parser.add_option(
+      '-l', '--latency', type='float', default=0.,
+      help='Simulated latency of each GCS request in ms')
+  parser.add_option(
+      '-z', '--compress', action='store_true',
+      help='Benchmark a -deflate namespace')
+  parser.add_option('-v', '--verbose', action='store_true')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unsupported arguments: %s' % args)
+  logging.basicConfig(level=logging.DEBUG if options.verbose else logging.ERROR)
+  sizes = options.size or [1024]
+  in_flights = options.in_flight or [
+    0,
+    handlers_backend.VERIFY_MAX_BYTES_IN_FLIGHT / 1024 / 1024,
+  ]
+  namespace = 'default-deflate' if options.compress else 'default'
+
+  blob_dir = tempfile.mkdtemp(prefix='verify_benchmark')
+  bed = setup_stubs(blob_dir)
+  try:
+    if options.latency:
+      add_latency(options.latency / 1000.)
+    for size_mb in sizes:
+      name = '%s/%dmb' % (namespace, size_mb)
+      start = time.time()
+      expected = write_object(name, size_mb, options.compress)
+      print('Wrote %dmb in %.1fs' % (size_mb, time.time() - start))
+      for in_flight_mb in in_flights:
+        start = time.time()
+        actual = verify(name, namespace, in_flight_mb)
+        duration = time.time() - start
+        assert actual == expected, (actual, expected)
+        print(
+            '  %3dmb in flight: %6.1fs  %7.1fmb/s' % (
+                in_flight_mb, duration, size_mb / duration))
+      gcs.delete_file(BUCKET, name)
+  finally:
+    bed.deactivate()
+    shutil.rmtree(blob_dir)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -104,6 +104,17 @@ class CronDeleteOldBotEvents(webapp2.RequestHandler):
     self.response.out.write('Success.')
 
 
+class CronDeleteOldDedupResults(webapp2.RequestHandler):
+  """Deletes TaskDedupResult entities too old to be reused."""
+
+  @decorators.require_cronjob
+  def get(self):
+    ndb.get_context().set_cache_policy(lambda _: False)
+    task_scheduler.cron_delete_old_dedup_results()
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
 class CronMachineProviderBotsUtilizationHandler(webapp2.RequestHandler):
   """Determines Machine Provider bot utilization."""
 
@@ -387,6 +398,7 @@ def get_routes():
     ('/internal/cron/abort_expired_task_to_run',
         CronAbortExpiredShardToRunHandler),
     ('/internal/cron/task_queues_tidy', CronTidyTaskQueues),
+    ('/internal/cron/delete_old_dedup_results', CronDeleteOldDedupResults),
     ('/internal/cron/update_bot_info', CronUpdateBotInfoComposite),
     ('/internal/cron/delete_old_bot_events', CronDeleteOldBotEvents),
 
@@ -29,6 +29,14 @@ from server import task_queues
 from server import task_request
 from server import task_result
 from server import task_scheduler
+from server import task_to_run
+import ts_mon_metrics
+
+
+# Maximum duration in seconds a poll with long_poll=1 is held open while no task
+# is available. It is kept short since the bot can't be told to shut down
+# meanwhile, and to bound the number of requests held at once.
+LONG_POLL_SECS = 20
 
 
 def has_unexpected_subset_keys(expected_keys, minimum_keys, actual_keys, name):
@@ -457,6 +465,11 @@ class BotPollHandler(_BotBaseHandler):
   errors in bot code doesn't kill all the fleet at once, they should still be up
   just enough to be able to self-update again even if they don't get task
   assigned anymore.
+
+  With the query parameter long_poll=1, the request is held for up to
+  LONG_POLL_SECS when no task is available, and the task is returned as soon as
+  one is enqueued in one of the bot's queues. Otherwise, the bot backs off as
+  usual.
   """
 
   @auth.public  # auth happens in self._process()
@@ -538,10 +551,30 @@ class BotPollHandler(_BotBaseHandler):
       return
 
     # The bot is in good shape. Try to grab a task.
+    long_poll = self.request.get('long_poll') == '1'
     try:
       # This is a fairly complex function call, exceptions are expected.
       request, secret_bytes, run_result = task_scheduler.bot_reap_task(
           res.dimensions, res.version, res.lease_expiration_ts)
+      keys = None
+      if not request and long_poll:
+        keys = task_to_run.get_wait_keys(res.dimensions)
+      if keys:
+        # Hold the request until a task is enqueued for the bot. The bot is
+        # woken up once; if another bot got the task first, it backs off.
+        start = utils.time_time()
+        woken = task_to_run.wait_for_new_task(keys, LONG_POLL_SECS)
+        if woken is None:
+          # Too many requests are held already, the bot backs off as usual.
+          result = 'skipped'
+        elif woken:
+          request, secret_bytes, run_result = task_scheduler.bot_reap_task(
+              res.dimensions, res.version, res.lease_expiration_ts)
+          result = 'task' if request else 'woken'
+        else:
+          result = 'timeout'
+        ts_mon_metrics.on_bot_poll_held(
+            res.dimensions, utils.time_time() - start, result)
       if not request:
         # No task found, tell it to sleep a bit.
         bot_event('request_sleep')
@@ -660,6 +693,35 @@ class BotPollHandler(_BotBaseHandler):
     self.send_response(out)
 
 
+class BotReserveHandler(_BotBaseHandler):
+  """The bot reserves its next task while it completes its current one.
+
+  The reserved task is handed out on the next poll of the bot, see
+  task_scheduler.bot_reserve_task(). The request body is the same as a poll.
+
+  Response body is a JSON dict:
+    {
+      "task_id": <id of the task reserved or None>,
+    }
+  """
+
+  @auth.public  # auth happens in self._process()
+  def post(self):
+    res = self._process()
+    task_id = None
+    expected_version, _ = bot_code.get_bot_version(self.request.host_url)
+    # The next poll won't hand out a task in these cases.
+    if (not config.settings().force_bots_to_sleep_and_not_run_task and
+        res.version == expected_version and
+        not res.quarantined_msg and
+        not res.state.get('maintenance')):
+      request = task_scheduler.bot_reserve_task(
+          res.dimensions, res.lease_expiration_ts)
+      if request:
+        task_id = request.task_id
+    self.send_response({'task_id': task_id})
+
+
 class BotEventHandler(_BotBaseHandler):
   """On signal that a bot had an event worth logging."""
 
@@ -1076,6 +1138,7 @@ def get_routes():
       # Bot Session API RPC handlers
       ('/swarming/api/v1/bot/handshake', BotHandshakeHandler),
       ('/swarming/api/v1/bot/poll', BotPollHandler),
+      ('/swarming/api/v1/bot/reserve', BotReserveHandler),
       ('/swarming/api/v1/bot/event', BotEventHandler),
 
       # Bot Security API RPC handlers
@@ -11,6 +11,7 @@ import os
 import random
 import StringIO
 import sys
+import time
 import unittest
 import zipfile
 
@@ -34,6 +35,9 @@ from server import bot_groups_config
 from server import bot_management
 from server import service_accounts
 from server import task_queues
+from server import task_scheduler
+from server import task_to_run
+import ts_mon_metrics
 
 
 def fmtdate(d):
@@ -477,6 +481,133 @@ class BotApiTest(test_env_handlers.AppTestBase):
     self.assertEqual(
         u'print "Hi";import sys; sys.exit(1)', params['bot_config'])
 
+  def test_reserve(self):
+    self.mock(random, 'getrandbits', lambda _: 0x88)
+    params = self.do_handshake()
+    response = self.post_json('/swarming/api/v1/bot/reserve', params)
+    self.assertEqual({u'task_id': None}, response)
+
+    _, task_id = self.client_create_task_raw()
+    response = self.post_json('/swarming/api/v1/bot/reserve', params)
+    self.assertEqual({u'task_id': task_id}, response)
+    # The reserved task is handed out on the next poll.
+    response = self.post_json('/swarming/api/v1/bot/poll', params)
+    self.assertEqual(u'run', response[u'cmd'])
+    self.assertEqual(task_id[:-1] + '1', response[u'manifest'][u'task_id'])
+
+  def test_reserve_maintenance(self):
+    params = self.do_handshake()
+    self.client_create_task_raw()
+    params['state']['maintenance'] = 'very busy'
+    response = self.post_json('/swarming/api/v1/bot/reserve', params)
+    self.assertEqual({u'task_id': None}, response)
+
+  def _mock_clock(self, on_sleep=None):
+    """Mocks time.sleep() to advance utils.time_time() instead.
+
+    Returns the list of the sleep durations.
+    """
+    sleeps = []
+    clock = [utils.time_time()]
+    def sleep(duration):
+      sleeps.append(duration)
+      clock[0] += duration
+      if on_sleep:
+        on_sleep()
+    self.mock(time, 'sleep', sleep)
+    self.mock(utils, 'time_time', lambda: clock[0])
+    return sleeps
+
+  def test_poll_long_poll(self):
+    params = self.do_handshake()
+    # The bot gets its queue by running a first task.
+    self.client_create_task_raw()
+    response = self.post_json('/swarming/api/v1/bot/poll', params)
+    self.assertEqual(u'run', response[u'cmd'])
+
+    # It took the only wake up, so the poll is held then the bot backs off as
+    # usual.
+    self.assertTrue(task_to_run.wait_for_new_task(
+        task_to_run.get_wait_keys(params['dimensions']), 0))
+    sleeps = self._mock_clock()
+    self.mock(task_scheduler, 'exponential_backoff', lambda _: 13.)
+    response = self.post_json(
+        '/swarming/api/v1/bot/poll?long_poll=1', params)
+    self.assertEqual(u'sleep', response[u'cmd'])
+    self.assertEqual(13., response[u'duration'])
+    self.assertEqual(handlers_bot.LONG_POLL_SECS, sum(sleeps))
+
+  def test_poll_long_poll_wake(self):
+    params = self.do_handshake()
+    _, task_id = self.client_create_task_raw()
+    # Hide the task from the first lookup, as if it was triggered while the
+    # poll is held.
+    calls = []
+    orig_bot_reap_task = task_scheduler.bot_reap_task
+    def bot_reap_task(*args):
+      calls.append(args)
+      if len(calls) == 1:
+        return None, None, None
+      return orig_bot_reap_task(*args)
+    self.mock(task_scheduler, 'bot_reap_task', bot_reap_task)
+    sleeps = self._mock_clock()
+
+    response = self.post_json(
+        '/swarming/api/v1/bot/poll?long_poll=1', params)
+    self.assertEqual(u'run', response[u'cmd'])
+    self.assertEqual(task_id[:-1] + '1', response[u'manifest'][u'task_id'])
+    # The task was enqueued before the bot waited, it is woken up right away.
+    self.assertEqual([], sleeps)
+    self.assertEqual(2, len(calls))
+
+  def test_poll_long_poll_woken_once(self):
+    params = self.do_handshake()
+    self.client_create_task_raw()
+    # Another bot takes the task after this one is woken up; it is not held
+    # again.
+    calls = []
+    def bot_reap_task(*args):
+      calls.append(args)
+      return None, None, None
+    self.mock(task_scheduler, 'bot_reap_task', bot_reap_task)
+    sleeps = self._mock_clock()
+
+    response = self.post_json(
+        '/swarming/api/v1/bot/poll?long_poll=1', params)
+    self.assertEqual(u'sleep', response[u'cmd'])
+    self.assertEqual([], sleeps)
+    self.assertEqual(2, len(calls))
+
+  def test_poll_long_poll_no_queue(self):
+    # The bot doesn't have any queue so there's nothing to wait for; it backs
+    # off as usual.
+    params = self.do_handshake()
+    sleeps = self._mock_clock()
+    response = self.post_json(
+        '/swarming/api/v1/bot/poll?long_poll=1', params)
+    self.assertEqual(u'sleep', response[u'cmd'])
+    self.assertEqual([], sleeps)
+
+  def test_poll_long_poll_max_holds(self):
+    # Too many requests are held already; the bot backs off as usual.
+    params = self.do_handshake()
+    self.client_create_task_raw()
+    response = self.post_json('/swarming/api/v1/bot/poll', params)
+    self.assertEqual(u'run', response[u'cmd'])
+    self.mock(task_to_run, '_MAX_HOLDS', 0)
+    held = []
+    self.mock(
+        ts_mon_metrics, 'on_bot_poll_held',
+        lambda _dimensions, _secs, result: held.append(result))
+    sleeps = self._mock_clock()
+    self.mock(task_scheduler, 'exponential_backoff', lambda _: 13.)
+    response = self.post_json(
+        '/swarming/api/v1/bot/poll?long_poll=1', params)
+    self.assertEqual(u'sleep', response[u'cmd'])
+    self.assertEqual(13., response[u'duration'])
+    self.assertEqual([], sleeps)
+    self.assertEqual(['skipped'], held)
+
   def test_complete_task_isolated(self):
     # Successfully poll a task.
     self.mock(random, 'getrandbits', lambda _: 0x88)
@@ -170,9 +170,87 @@ def apply_server_property_defaults(properties):
         cfg.cipd.default_client_package.version)
 
 
+def _new_task_request_from_rpc(request):
+  """Converts and validates a swarming_rpcs.NewTaskRequest.
+
+  Also verifies the caller is allowed to schedule the task and gets the OAuth
+  token grant of the task service account.
+
+  Returns:
+    tuple(TaskRequest, SecretBytes or None).
+  """
+  sb = (request.properties.secret_bytes
+        if request.properties is not None else None)
+  if sb is not None:
+    request.properties.secret_bytes = "HIDDEN"
+  logging.debug('%s', request)
+  if sb is not None:
+    request.properties.secret_bytes = sb
+
+  try:
+    request_obj, secret_bytes = message_conversion.new_task_request_from_rpc(
+        request, utils.utcnow())
+    for index in xrange(request_obj.num_task_slices):
+      apply_server_property_defaults(request_obj.task_slice(index).properties)
+    task_request.init_new_request(
+        request_obj, acl.can_schedule_high_priority_tasks())
+    # We need to call the ndb.Model pre-put check earlier because the
+    # following checks assume that the request itself is valid and could crash
+    # otherwise.
+    request_obj._pre_put_hook()
+  except (datastore_errors.BadValueError, TypeError, ValueError) as e:
+    logging.exception('Here\'s what was wrong in the user new task request:')
+    raise endpoints.BadRequestException(e.message)
+
+  # Make sure the caller is actually allowed to schedule the task before
+  # asking the token server for a service account token.
+  task_scheduler.check_schedule_request_acl(request_obj)
+
+  # If request_obj.service_account is an email, contact the token server to
+  # generate "OAuth token grant" (or grab a cached one). By doing this we
+  # check that the given service account usage is allowed by the token server
+  # rules at the time the task is posted. This check is also performed later
+  # (when running the task), when we get the actual OAuth access token.
+  if service_accounts.is_service_account(request_obj.service_account):
+    if not service_accounts.has_token_server():
+      raise endpoints.BadRequestException(
+          'This Swarming server doesn\'t support task service accounts '
+          'because Token Server URL is not configured')
+    max_lifetime_secs = request_obj.max_lifetime_secs
+    try:
+      # Note: this raises AuthorizationError if the user is not allowed to use
+      # the requested account or service_accounts.InternalError if something
+      # unexpected happens.
+      duration = datetime.timedelta(seconds=max_lifetime_secs)
+      request_obj.service_account_token = (
+          service_accounts.get_oauth_token_grant(
+              service_account=request_obj.service_account,
+              validity_duration=duration))
+    except service_accounts.InternalError as exc:
+      raise endpoints.InternalServerErrorException(exc.message)
+  return request_obj, secret_bytes
+
+
+def _task_request_metadata(request_obj, result_summary):
+  """Returns the swarming_rpcs.TaskRequestMetadata of a new task."""
+  previous_result = None
+  if result_summary.deduped_from:
+    previous_result = message_conversion.task_result_to_rpc(
+        result_summary, False)
+
+  return swarming_rpcs.TaskRequestMetadata(
+      request=message_conversion.task_request_to_rpc(request_obj),
+      task_id=task_pack.pack_result_summary_key(result_summary.key),
+      task_result=previous_result)
+
+
 ### API
 
 
+# Maximum number of tasks created by a single tasks.new_batch call.
+NEW_BATCH_MAX_SIZE = 500
+
+
 swarming_api = auth.endpoints_api(
     name='swarming',
     version='v1',
@@ -210,7 +288,8 @@ class SwarmingServerService(remote.Service):
         display_server_url_template=cfg.display_server_url_template,
         luci_config=config.config.config_service_hostname(),
         default_isolate_server=cfg.isolate.default_server,
-        default_isolate_namespace=cfg.isolate.default_namespace)
+        default_isolate_namespace=cfg.isolate.default_namespace,
+        new_batch=True)
 
   @gae_ts_mon.instrument_endpoint()
   @auth.endpoints_method(
@@ -412,55 +491,7 @@ class SwarmingTasksService(remote.Service):
     earliest opportunity by a bot that has at least the dimensions as described
     in the task request.
     """
-    sb = (request.properties.secret_bytes
-          if request.properties is not None else None)
-    if sb is not None:
-      request.properties.secret_bytes = "HIDDEN"
-    logging.debug('%s', request)
-    if sb is not None:
-      request.properties.secret_bytes = sb
-
-    try:
-      request_obj, secret_bytes = message_conversion.new_task_request_from_rpc(
-          request, utils.utcnow())
-      for index in xrange(request_obj.num_task_slices):
-        apply_server_property_defaults(request_obj.task_slice(index).properties)
-      task_request.init_new_request(
-          request_obj, acl.can_schedule_high_priority_tasks())
-      # We need to call the ndb.Model pre-put check earlier because the
-      # following checks assume that the request itself is valid and could crash
-      # otherwise.
-      request_obj._pre_put_hook()
-    except (datastore_errors.BadValueError, TypeError, ValueError) as e:
-      logging.exception('Here\'s what was wrong in the user new task request:')
-      raise endpoints.BadRequestException(e.message)
-
-    # Make sure the caller is actually allowed to schedule the task before
-    # asking the token server for a service account token.
-    task_scheduler.check_schedule_request_acl(request_obj)
-
-    # If request_obj.service_account is an email, contact the token server to
-    # generate "OAuth token grant" (or grab a cached one). By doing this we
-    # check that the given service account usage is allowed by the token server
-    # rules at the time the task is posted. This check is also performed later
-    # (when running the task), when we get the actual OAuth access token.
-    if service_accounts.is_service_account(request_obj.service_account):
-      if not service_accounts.has_token_server():
-        raise endpoints.BadRequestException(
-            'This Swarming server doesn\'t support task service accounts '
-            'because Token Server URL is not configured')
-      max_lifetime_secs = request_obj.max_lifetime_secs
-      try:
-        # Note: this raises AuthorizationError if the user is not allowed to use
-        # the requested account or service_accounts.InternalError if something
-        # unexpected happens.
-        duration = datetime.timedelta(seconds=max_lifetime_secs)
-        request_obj.service_account_token = (
-            service_accounts.get_oauth_token_grant(
-                service_account=request_obj.service_account,
-                validity_duration=duration))
-      except service_accounts.InternalError as exc:
-        raise endpoints.InternalServerErrorException(exc.message)
+    request_obj, secret_bytes = _new_task_request_from_rpc(request)
 
     # If the user only wanted to evaluate scheduling the task, but not actually
     # schedule it, return early without a task_id.
@@ -474,16 +505,45 @@ class SwarmingTasksService(remote.Service):
           request_obj, secret_bytes)
     except (datastore_errors.BadValueError, TypeError, ValueError) as e:
       raise endpoints.BadRequestException(e.message)
+    return _task_request_metadata(request_obj, result_summary)
+
+  @gae_ts_mon.instrument_endpoint()
+  @auth.endpoints_method(
+      swarming_rpcs.NewTaskRequests, swarming_rpcs.TaskRequestMetadataList)
+  @auth.require(acl.can_create_task)
+  def new_batch(self, request):
+    """Creates many new tasks at once.
 
-    previous_result = None
-    if result_summary.deduped_from:
-      previous_result = message_conversion.task_result_to_rpc(
-          result_summary, False)
+    Same as calling new() for each request but faster, e.g. to trigger all the
+    shards of a test. All the requests are validated before any task is created.
+    evaluate_only is not supported.
 
-    return swarming_rpcs.TaskRequestMetadata(
-        request=message_conversion.task_request_to_rpc(request_obj),
-        task_id=task_pack.pack_result_summary_key(result_summary.key),
-        task_result=previous_result)
+    A task that couldn't be created has its error set instead of its task_id,
+    the other ones are created. Only the failed ones should be retried.
+    """
+    if not request.requests:
+      raise endpoints.BadRequestException('requests is required')
+    if len(request.requests) > NEW_BATCH_MAX_SIZE:
+      raise endpoints.BadRequestException(
+          'Can\'t create more than %d tasks at once, got %d' %
+          (NEW_BATCH_MAX_SIZE, len(request.requests)))
+    if any(r.evaluate_only for r in request.requests):
+      raise endpoints.BadRequestException(
+          'evaluate_only is not supported by new_batch')
+
+    items = [_new_task_request_from_rpc(r) for r in request.requests]
+    try:
+      result_summaries = task_scheduler.schedule_request_batch(items)
+    except (datastore_errors.BadValueError, TypeError, ValueError) as e:
+      raise endpoints.BadRequestException(e.message)
+    out = swarming_rpcs.TaskRequestMetadataList()
+    for (request_obj, _), result_summary in zip(items, result_summaries):
+      if result_summary:
+        out.items.append(_task_request_metadata(request_obj, result_summary))
+      else:
+        out.items.append(swarming_rpcs.TaskRequestMetadata(
+            error='Failed to create the task, it can be retried'))
+    return out
 
   @gae_ts_mon.instrument_endpoint()
   @auth.endpoints_method(
@@ -103,6 +103,7 @@ class ServerApiTest(BaseTest):
       u'luci_config': u'a.server',
       u'default_isolate_server': u'https://isolateserver.appspot.com',
       u'default_isolate_namespace': u'default-gzip',
+      u'new_batch': True,
       u'machine_provider_template':
           u'https://machine-provider.appspot.com/leases/%s',
       u'server_version': unicode(utils.get_app_version()),
@@ -318,6 +319,73 @@ class TasksApiTest(BaseTest):
         u'state': u'APPLICATION_ERROR',
     }, response.json)
 
+  def test_new_batch(self):
+    requests = [
+      self.create_new_request(
+          name='job1:%d:2' % i,
+          properties=self.create_props(
+              command=['python', 'run_test.py'],
+              env=[
+                {u'key': u'GTEST_SHARD_INDEX', u'value': unicode(i)},
+                {u'key': u'GTEST_TOTAL_SHARDS', u'value': u'2'},
+              ]))
+      for i in xrange(2)
+    ]
+    response = self.call_api(
+        'new_batch',
+        body={'requests': [message_to_dict(r) for r in requests]})
+    items = response.json['items']
+    self.assertEqual(
+        [u'job1:0:2', u'job1:1:2'], [i['request']['name'] for i in items])
+    self.assertEqual(2, len(set(i['task_id'] for i in items)))
+    for item in items:
+      result = self.client_get_results(item['task_id'])
+      self.assertEqual(u'PENDING', result['state'])
+
+  def test_new_batch_partial(self):
+    # A task that couldn't be created is reported, the others are returned.
+    orig = task_scheduler.schedule_request_batch
+    def schedule_request_batch(items):
+      out = orig(items[:1])
+      return out + [None]
+    self.mock(task_scheduler, 'schedule_request_batch', schedule_request_batch)
+    requests = [
+      self.create_new_request(name='job1:%d:2' % i) for i in xrange(2)
+    ]
+    response = self.call_api(
+        'new_batch',
+        body={'requests': [message_to_dict(r) for r in requests]})
+    items = response.json['items']
+    self.assertEqual(u'job1:0:2', items[0]['request']['name'])
+    self.assertNotIn('error', items[0])
+    self.assertEqual(
+        {u'error': u'Failed to create the task, it can be retried'}, items[1])
+
+  def test_new_batch_evaluate_only(self):
+    request = self.create_new_request(
+        properties=self.create_props(command=['rm', '-rf', '/']),
+        evaluate_only=True)
+    response = self.call_api(
+        'new_batch', body={'requests': [message_to_dict(request)]},
+        status=400)
+    self.assertEqual({
+        u'error_message': u'evaluate_only is not supported by new_batch',
+        u'state': u'APPLICATION_ERROR',
+    }, response.json)
+    self.assertEqual(0, task_request.TaskRequest.query().count())
+
+  def test_new_batch_too_many(self):
+    self.mock(handlers_endpoints, 'NEW_BATCH_MAX_SIZE', 1)
+    request = message_to_dict(
+        self.create_new_request(
+            properties=self.create_props(command=['rm', '-rf', '/'])))
+    response = self.call_api(
+        'new_batch', body={'requests': [request, request]}, status=400)
+    self.assertEqual({
+        u'error_message': u'Can\'t create more than 1 tasks at once, got 2',
+        u'state': u'APPLICATION_ERROR',
+    }, response.json)
+
   def test_new_ok_deduped(self):
     """Asserts that new returns task result for deduped."""
     # Run a task to completion.
@@ -335,6 +335,7 @@ FILES = (
     'utils/auth_server.py',
     'utils/authenticators.py',
     'utils/cacert.pem',
+    'utils/compression.py',
     'utils/file_path.py',
     'utils/fs.py',
     'utils/grpc_proxy.py',
@@ -735,6 +735,30 @@ def assert_task(request):
     _assert_task_props(t.properties, exp_ts)
 
 
+def assert_tasks(requests):
+  """Same as assert_task() for multiple TaskRequest.
+
+  Each distinct set of dimensions is asserted once, with the latest expiration
+  of the TaskSlice using it.
+  """
+  latest = {}
+  order = []
+  for request in requests:
+    assert not request.key, request.key
+    exp_ts = request.created_ts
+    for i in xrange(request.num_task_slices):
+      t = request.task_slice(i)
+      exp_ts += datetime.timedelta(seconds=t.expiration_secs)
+      k = tuple(dimensions_to_flat(t.properties.dimensions))
+      if k not in latest:
+        order.append(k)
+      elif latest[k][1] >= exp_ts:
+        continue
+      latest[k] = (t.properties, exp_ts)
+  for k in order:
+    _assert_task_props(*latest[k])
+
+
 def get_queues(bot_root_key):
   """Returns the known task queues as integers.
 
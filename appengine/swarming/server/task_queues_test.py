@@ -222,6 +222,35 @@ class TaskQueuesApiTest(test_env_handlers.AppTestBase):
     self.assertEqual(
         valid_until_ts, task_queues.TaskDimensions.query().get().valid_until_ts)
 
+  def test_assert_tasks(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5)
+    self.mock_now(now)
+    request_1 = _gen_request()
+    self.mock_now(now, 60)
+    request_2 = _gen_request()
+    request_3 = _gen_request(
+        properties=_gen_properties(
+            dimensions={u'os': [u'Amiga'], u'pool': [u'default']}))
+    # One task queue per distinct set of dimensions.
+    task_queues.assert_tasks([request_1, request_2, request_3])
+    self.assertEqual(2, self.execute_tasks())
+    self.assert_count(2, task_queues.TaskDimensions)
+    # The latest expiration is used.
+    actual = sorted(
+        (d.sets[0].dimensions_flat, d.valid_until_ts)
+        for d in task_queues.TaskDimensions.query())
+    expected = [
+      (
+        [u'cpu:x86-64', u'os:Ubuntu-16.04', u'pool:default'],
+        request_2.expiration_ts + task_queues._ADVANCE,
+      ),
+      (
+        [u'os:Amiga', u'pool:default'],
+        request_3.expiration_ts + task_queues._ADVANCE,
+      ),
+    ]
+    self.assertEqual(expected, actual)
+
   def test_get_queues(self):
     # See more complex test below.
     pass
@@ -13,6 +13,8 @@ store tasks results.
   be multiple tries for one job, for example if a bot dies.
 - The stdout of the task is saved under TaskOutput, chunked in TaskOutputChunk
   entities to fit the entity size limit.
+- TaskDedupResult maps the properties of an idempotent task to the last task
+  that succeeded with them. It is a root entity.
 
 Graph of schema:
 
@@ -963,6 +965,23 @@ class TaskResultSummary(_TaskResultCommon):
     return super(TaskResultSummary, self).to_dict(exclude=['properties_hash'])
 
 
+class TaskDedupResult(ndb.Model):
+  """Reverse map of a TaskProperties.properties_hash to the last task that
+  completed successfully with these properties.
+
+  It is written when an idempotent task succeeds, so a new task with the same
+  properties is deduped with a single GET instead of a query on
+  TaskResultSummary.properties_hash.
+
+  The key id is the properties_hash hex encoded. It is a root entity.
+  """
+  # TaskResultSummary to reuse the results of.
+  result_summary_key = ndb.KeyProperty(kind='TaskResultSummary', indexed=False)
+  # TaskResultSummary.created_ts, to enforce reusable_task_age_secs without
+  # fetching it. Indexed for task_scheduler.cron_delete_old_dedup_results().
+  created_ts = ndb.DateTimeProperty()
+
+
 class TagValues(ndb.Model):
   tag = ndb.StringProperty()
   values = ndb.StringProperty(repeated=True)
@@ -1221,6 +1240,25 @@ def new_result_summary(request):
       tags=request.tags)
 
 
+def properties_hash_to_dedup_key(properties_hash):
+  """Returns the TaskDedupResult ndb.Key for a properties_hash."""
+  assert properties_hash, properties_hash
+  return ndb.Key(TaskDedupResult, properties_hash.encode('hex'))
+
+
+def new_dedup_result(result_summary):
+  """Returns a new TaskDedupResult to reuse the results of a successful
+  idempotent task.
+
+  The caller must save it in the DB.
+  """
+  assert result_summary.properties_hash, result_summary
+  return TaskDedupResult(
+      key=properties_hash_to_dedup_key(result_summary.properties_hash),
+      result_summary_key=result_summary.key,
+      created_ts=result_summary.created_ts)
+
+
 def new_run_result(request, to_run, bot_id, bot_version, bot_dimensions):
   """Returns a new TaskRunResult for a TaskRequest.
 
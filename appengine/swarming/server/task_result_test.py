@@ -244,6 +244,26 @@ class TaskResultApiTest(TestCase):
     expected = [u'1d69ba3ea8008810', u'2d69ba3ea8008810', u'3d69ba3ea8008810']
     self.assertEqual(expected, actual.key.get().children_task_ids)
 
+  def test_properties_hash_to_dedup_key(self):
+    self.assertEqual(
+        ndb.Key('TaskDedupResult', 'ab' * 32),
+        task_result.properties_hash_to_dedup_key('\xab' * 32))
+
+  def test_new_dedup_result(self):
+    request = _gen_request()
+    summary = task_result.new_result_summary(request)
+    summary.properties_hash = '\xab' * 32
+    actual = task_result.new_dedup_result(summary)
+    actual.put()
+    expected = {
+      'created_ts': self.now,
+      'result_summary_key': summary.key,
+    }
+    self.assertEqual(
+        expected,
+        task_result.properties_hash_to_dedup_key(
+            '\xab' * 32).get().to_dict())
+
   def test_new_run_result(self):
     request = _gen_request()
     to_run = task_to_run.new_task_to_run(request, 1, 0)
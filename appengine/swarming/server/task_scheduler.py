@@ -8,11 +8,14 @@ This is the interface closest to the HTTP handlers.
 """
 
 import datetime
+import functools
 import logging
 import math
 import random
 import time
 
+from google.appengine import runtime
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
 from components import auth
@@ -119,7 +122,8 @@ def _expire_task(to_run_key, request, retries):
   # Look if the TaskToRun is reapable once before doing the check inside the
   # transaction. This reduces the likelihood of failing this check inside the
   # transaction, which is an order of magnitude more costly.
-  if not to_run_key.get().is_reapable:
+  to_run = to_run_key.get()
+  if not to_run.is_reapable:
     logging.info('Not reapable anymore')
     return None, None
 
@@ -154,13 +158,20 @@ def _expire_task(to_run_key, request, retries):
   if summary:
     logging.info(
         'Expired %s', task_pack.pack_result_summary_key(result_summary_key))
+    task_to_run.remove_from_index(to_run)
     ts_mon_metrics.on_task_completed(summary)
+  if new_to_run:
+    task_to_run.add_to_index(new_to_run)
   return summary, new_to_run
 
 
-def _reap_task(bot_dimensions, bot_version, to_run_key, request):
+def _reap_task(
+    bot_dimensions, bot_version, to_run_key, request, reserved=False):
   """Reaps a task and insert the results entity.
 
+  If reserved is True, the TaskToRun must be reserved for this bot instead of
+  being pending.
+
   Returns:
     (TaskRunResult, SecretBytes) if successful, (None, None) otherwise.
   """
@@ -192,7 +203,12 @@ def _reap_task(bot_dimensions, bot_version, to_run_key, request):
     if not to_run:
       logging.error('Missing TaskToRun?\n%s', result_summary.task_id)
       return None, None
-    if not to_run.is_reapable:
+    if reserved:
+      if not to_run.is_reserved_for(bot_id, now):
+        logging.info('%s is not reserved anymore', result_summary.task_id)
+        return None, None
+      task_to_run.clear_reservation(to_run)
+    elif not to_run.is_reapable:
       logging.info('%s is not reapable', result_summary.task_id)
       return None, None
     if result_summary.bot_id == bot_id:
@@ -220,8 +236,9 @@ def _reap_task(bot_dimensions, bot_version, to_run_key, request):
   # Add it to the negative cache *before* running the transaction. This will
   # inhibit concurrently readers to try to reap this task. The downside is if
   # this request fails in the middle of the transaction, the task may stay
-  # unreapable for up to 15 seconds.
-  if not task_to_run.set_lookup_cache(to_run_key, False):
+  # unreapable for up to 15 seconds. A reserved task is already out of reach of
+  # the other bots.
+  if not reserved and not task_to_run.set_lookup_cache(to_run_key, False):
     logging.debug('hit negative cache')
     return None, None
 
@@ -252,6 +269,62 @@ def _reap_task(bot_dimensions, bot_version, to_run_key, request):
   return run_result, secret_bytes
 
 
+def _reserve_task(bot_id, to_run_key):
+  """Reserves a pending TaskToRun for a bot.
+
+  Returns:
+    True if the TaskToRun is now reserved for the bot.
+  """
+  now = utils.utcnow()
+
+  def run():
+    # 1 GET, 1 PUT.
+    to_run = to_run_key.get()
+    if not to_run or not to_run.is_reapable:
+      return False
+    task_to_run.reserve(to_run, bot_id, now)
+    to_run.put()
+    return True
+
+  # Same as _reap_task(), the negative cache keeps concurrent bots away.
+  if not task_to_run.set_lookup_cache(to_run_key, False):
+    logging.debug('hit negative cache')
+    return False
+  try:
+    return datastore_utils.transaction(run, retries=0)
+  except datastore_utils.CommitError:
+    logging.info('CommitError; reservation failed')
+    return False
+
+
+def _release_reservation(to_run_key, request):
+  """Puts back a TaskToRun with a lapsed reservation in its queue.
+
+  Returns:
+    The TaskToRun if it was put back in its queue.
+  """
+  now = utils.utcnow()
+
+  def run():
+    # 1 GET, 1 PUT.
+    to_run = to_run_key.get()
+    if (not to_run or not to_run.reservation_bot_id or
+        to_run.reservation_expiration_ts > now):
+      return None
+    task_to_run.release_reservation(request, to_run)
+    to_run.put()
+    return to_run
+
+  try:
+    to_run = datastore_utils.transaction(run)
+  except datastore_utils.CommitError:
+    return None
+  if to_run:
+    task_to_run.set_lookup_cache(to_run_key, True)
+    task_to_run.add_to_index(to_run)
+  return to_run
+
+
 def _handle_dead_bot(run_result_key):
   """Handles TaskRunResult where its bot has stopped showing sign of life.
 
@@ -270,6 +343,8 @@ def _handle_dead_bot(run_result_key):
   server_version = utils.get_app_version()
   packed = task_pack.pack_run_result_key(run_result_key)
   request = request_future.get_result()
+  # TaskToRun enqueued by the last run() attempt to retry the task.
+  retried = {}
 
   def run():
     """Returns tuple(task_is_retried or None, bot_id).
@@ -311,6 +386,7 @@ def _handle_dead_bot(run_result_key):
       # TODO(maruel): Allow increasing the current_task_slice value.
       # Create a second TaskToRun with the same TaskSlice.
       to_run = task_to_run.new_task_to_run(request, 2, current_task_slice)
+      retried['to_run'] = to_run
       to_put = (run_result, result_summary, to_run)
       run_result.state = task_result.State.BOT_DIED
       run_result.internal_failure = True
@@ -345,6 +421,8 @@ def _handle_dead_bot(run_result_key):
     task_is_retried = None
   if task_is_retried:
     logging.info('Retried %s', packed)
+    if task_is_retried is True:
+      task_to_run.add_to_index(retried['to_run'])
   elif task_is_retried == False:
     logging.debug('Ignored %s', packed)
   return task_is_retried
@@ -443,37 +521,28 @@ def _pubsub_notify(task_id, topic, auth_token, userdata):
 def _find_dupe_task(now, h):
   """Finds a previously run task that is also idempotent and completed.
 
-  Fetch items that can be used to dedupe the task. See the comment for this
-  property for more details.
-
-  Do not use "task_result.TaskResultSummary.created_ts > oldest" here because
-  this would require a composite index. It's unnecessary because TaskRequest.key
-  is equivalent to decreasing TaskRequest.created_ts, ordering by key works as
-  well and doesn't require a composite index.
+  Looks up the TaskDedupResult stored by bot_update_task() when the last task
+  with the same properties succeeded.
   """
-  # TODO(maruel): Make a reverse map on successful task completion so this
-  # becomes a simple ndb.get().
-  cls = task_result.TaskResultSummary
-  q = cls.query(cls.properties_hash==h).order(cls.key)
-  for i, dupe_summary in enumerate(q.iter(batch_size=1)):
-    # It is possible for the query to return stale items.
-    if (dupe_summary.state != task_result.State.COMPLETED or
-        dupe_summary.failure):
-      if i == 2:
-        # Indexes are very inconsistent, give up.
-        return None
-      continue
+  dedup = task_result.properties_hash_to_dedup_key(h).get()
+  if not dedup:
+    return None
 
-    # Refuse tasks older than X days. This is due to the isolate server
-    # dropping files.
-    # TODO(maruel): The value should be calculated from the isolate server
-    # setting and be unbounded when no isolated input was used.
-    oldest = now - datetime.timedelta(
-        seconds=config.settings().reusable_task_age_secs)
-    if dupe_summary.created_ts <= oldest:
-      return None
-    return dupe_summary
-  return None
+  # Refuse tasks older than X days. This is due to the isolate server
+  # dropping files.
+  # TODO(maruel): The value should be calculated from the isolate server
+  # setting and be unbounded when no isolated input was used.
+  oldest = now - datetime.timedelta(
+      seconds=config.settings().reusable_task_age_secs)
+  if dedup.created_ts <= oldest:
+    return None
+  dupe_summary = dedup.result_summary_key.get()
+  if (not dupe_summary or
+      dupe_summary.state != task_result.State.COMPLETED or
+      dupe_summary.failure):
+    logging.error('Invalid TaskDedupResult %s', dedup.key.id())
+    return None
+  return dupe_summary
 
 
 def _dedupe_result_summary(dupe_summary, result_summary, task_slice_index):
@@ -680,6 +749,10 @@ def _bot_update_tx(
 ### Public API.
 
 
+# Maximum number of transactions schedule_request_batch() runs concurrently.
+SCHEDULE_BATCH_CONCURRENCY = 50
+
+
 def exponential_backoff(attempt_num):
   """Returns an exponential backoff value in seconds."""
   assert attempt_num >= 0
@@ -770,33 +843,22 @@ def _gen_new_keys(result_summary, to_run, secret_bytes):
   return key
 
 
-def schedule_request(request, secret_bytes):
-  """Creates and stores all the entities to schedule a new task request.
-
-  Assumes ACL check has already happened (see 'check_schedule_request_acl').
+def _new_task_entities(request, secret_bytes, now, has_capacity):
+  """Creates the entities to store to schedule a new task request.
 
-  The number of entities created is ~4: TaskRequest, TaskToRun and
-  TaskResultSummary and (optionally) SecretBytes. They are in single entity
-  group and saved in a single transaction.
+  Sets request.key. The entities are not saved in the DB.
 
   Arguments:
-  - request: TaskRequest entity to be saved in the DB. It's key must not be set
-             and the entity must not be saved in the DB yet.
-  - secret_bytes: SecretBytes entity to be saved in the DB. It's key will be set
-             and the entity will be stored by this function. None is allowed if
-             there are no SecretBytes for this task.
+  - request: TaskRequest entity without a key.
+  - secret_bytes: SecretBytes entity or None.
+  - now: time at which the task is scheduled.
+  - has_capacity: function returning True if a bot can run a set of dimensions.
 
   Returns:
-    TaskResultSummary. TaskToRun is not returned.
+    tuple(TaskResultSummary, TaskToRun, SecretBytes, dupe TaskResultSummary).
+    TaskToRun and SecretBytes are None if they must not be stored; the dupe
+    summary is None if the task was not deduped.
   """
-  assert isinstance(request, task_request.TaskRequest), request
-  assert not request.key, request.key
-
-  # This does a DB GET, occasionally triggers a task queue. May throw, which is
-  # surfaced to the user but it is safe as the task request wasn't stored yet.
-  task_queues.assert_task(request)
-
-  now = utils.utcnow()
   request.key = task_request.new_request_key()
   result_summary = task_result.new_result_summary(request)
   result_summary.modified_ts = now
@@ -809,6 +871,7 @@ def schedule_request(request, secret_bytes):
     t = request.task_slice(i)
     if t.properties.idempotent:
       dupe_summary = _find_dupe_task(now, t.properties_hash())
+      ts_mon_metrics.on_dedup_lookup(result_summary, bool(dupe_summary))
       if dupe_summary:
         _dedupe_result_summary(dupe_summary, result_summary, i)
         # In this code path, there's not much to do as the task will not be run,
@@ -831,8 +894,7 @@ def schedule_request(request, secret_bytes):
       to_run = task_to_run.new_task_to_run(request, 1, index)
       #  Make sure there's capacity if desired.
       t = request.task_slice(index)
-      if (t.wait_for_capacity or
-          bot_management.has_capacity(t.properties.dimensions)):
+      if t.wait_for_capacity or has_capacity(t.properties.dimensions):
         # It's pending at this index now.
         result_summary.current_task_slice = index
         break
@@ -846,13 +908,13 @@ def schedule_request(request, secret_bytes):
       # Instantaneously denied.
       result_summary.abandoned_ts = result_summary.created_ts
       result_summary.state = task_result.State.NO_RESOURCE
+  return result_summary, to_run, secret_bytes, dupe_summary
 
-  # Storing these entities makes this task live. It is important at this point
-  # that the HTTP handler returns as fast as possible, otherwise the task will
-  # be run but the client will not know about it.
-  _gen_key = lambda: _gen_new_keys(result_summary, to_run, secret_bytes)
-  extra = filter(bool, [result_summary, to_run, secret_bytes])
-  datastore_utils.insert(request, new_key_callback=_gen_key, extra=extra)
+
+def _on_task_scheduled(result_summary, to_run, dupe_summary):
+  """Bookkeeping once the entities of a new task request were stored."""
+  if to_run:
+    task_to_run.add_to_index(to_run)
   if dupe_summary:
     logging.debug(
         'New request %s reusing %s', result_summary.task_id,
@@ -864,38 +926,185 @@ def schedule_request(request, secret_bytes):
   else:
     logging.debug('New request %s', result_summary.task_id)
 
+
+def _is_stored(request, future):
+  """Returns True if the datastore_utils.insert_async() |future| stored the
+  TaskRequest.
+
+  A transaction that failed may still have been committed, so the TaskRequest
+  is looked up in that case.
+  """
+  try:
+    return bool(future.get_result())
+  except (datastore_errors.Error, datastore_utils.CommitError) as e:
+    stored = request.key.get(use_cache=False, use_memcache=False) is not None
+    logging.warning(
+        'Failed to store %s (stored: %s): %s', request.key, stored, e)
+    return stored
+
+
+def _add_children_to_parent(parent_task_id, task_ids, now):
+  """Lists the new tasks as children of their parent task."""
+  parent_run_key = task_pack.unpack_run_result_key(parent_task_id)
+  parent_task_keys = [
+    parent_run_key,
+    task_pack.run_result_key_to_result_summary_key(parent_run_key),
+  ]
+
+  def run_parent():
+    # This one is slower.
+    items = ndb.get_multi(parent_task_keys)
+    for item in items:
+      item.children_task_ids.extend(task_ids)
+      item.modified_ts = now
+    ndb.put_multi(items)
+
+  # Raising will abort to the caller. There's a risk that for tasks with
+  # parent tasks, the task will be lost due to this transaction.
+  # TODO(maruel): An option is to update the parent task as part of a cron
+  # job, which would remove this code from the critical path.
+  datastore_utils.transaction(run_parent)
+
+
+def schedule_request(request, secret_bytes):
+  """Creates and stores all the entities to schedule a new task request.
+
+  Assumes ACL check has already happened (see 'check_schedule_request_acl').
+
+  The number of entities created is ~4: TaskRequest, TaskToRun and
+  TaskResultSummary and (optionally) SecretBytes. They are in single entity
+  group and saved in a single transaction.
+
+  Arguments:
+  - request: TaskRequest entity to be saved in the DB. It's key must not be set
+             and the entity must not be saved in the DB yet.
+  - secret_bytes: SecretBytes entity to be saved in the DB. It's key will be set
+             and the entity will be stored by this function. None is allowed if
+             there are no SecretBytes for this task.
+
+  Returns:
+    TaskResultSummary. TaskToRun is not returned.
+  """
+  assert isinstance(request, task_request.TaskRequest), request
+  assert not request.key, request.key
+
+  # This does a DB GET, occasionally triggers a task queue. May throw, which is
+  # surfaced to the user but it is safe as the task request wasn't stored yet.
+  task_queues.assert_task(request)
+
+  now = utils.utcnow()
+  result_summary, to_run, secret_bytes, dupe_summary = _new_task_entities(
+      request, secret_bytes, now, bot_management.has_capacity)
+
+  # Storing these entities makes this task live. It is important at this point
+  # that the HTTP handler returns as fast as possible, otherwise the task will
+  # be run but the client will not know about it.
+  _gen_key = lambda: _gen_new_keys(result_summary, to_run, secret_bytes)
+  extra = filter(bool, [result_summary, to_run, secret_bytes])
+  datastore_utils.insert(request, new_key_callback=_gen_key, extra=extra)
+  _on_task_scheduled(result_summary, to_run, dupe_summary)
+
   # Get parent task details if applicable.
   if request.parent_task_id:
-    parent_run_key = task_pack.unpack_run_result_key(request.parent_task_id)
-    parent_task_keys = [
-      parent_run_key,
-      task_pack.run_result_key_to_result_summary_key(parent_run_key),
-    ]
-
-    def run_parent():
-      # This one is slower.
-      items = ndb.get_multi(parent_task_keys)
-      k = result_summary.task_id
-      for item in items:
-        item.children_task_ids.append(k)
-        item.modified_ts = now
-      ndb.put_multi(items)
-
-    # Raising will abort to the caller. There's a risk that for tasks with
-    # parent tasks, the task will be lost due to this transaction.
-    # TODO(maruel): An option is to update the parent task as part of a cron
-    # job, which would remove this code from the critical path.
-    datastore_utils.transaction(run_parent)
+    _add_children_to_parent(
+        request.parent_task_id, [result_summary.task_id], now)
 
   ts_mon_metrics.on_task_requested(result_summary, bool(dupe_summary))
   return result_summary
 
 
+def schedule_request_batch(requests):
+  """Creates and stores all the entities to schedule many new task requests.
+
+  Same as schedule_request() but the work common to the requests is done once:
+  the task queues are asserted once per set of dimensions, the bot capacity is
+  looked up once per set of dimensions and a parent task is updated once. The
+  entities of each request are still saved in their own transaction but up to
+  SCHEDULE_BATCH_CONCURRENCY transactions run concurrently.
+
+  Assumes ACL check has already happened (see 'check_schedule_request_acl').
+
+  Arguments:
+  - requests: list of tuple(TaskRequest, SecretBytes or None), with the same
+              constraints as the arguments of schedule_request().
+
+  A request that couldn't be stored doesn't fail the others, so a partial
+  failure doesn't cause the caller to retry the tasks that were created.
+
+  Returns:
+    list of TaskResultSummary, in the same order as requests. An item is None
+    if its request was not stored; it can safely be scheduled again.
+  """
+  for request, _ in requests:
+    assert isinstance(request, task_request.TaskRequest), request
+    assert not request.key, request.key
+
+  task_queues.assert_tasks([request for request, _ in requests])
+
+  capacity = {}
+  def has_capacity(dimensions):
+    k = tuple(task_queues.dimensions_to_flat(dimensions))
+    if k not in capacity:
+      capacity[k] = bot_management.has_capacity(dimensions)
+    return capacity[k]
+
+  # Fetch all the TaskDedupResult at once; _find_dupe_task() then hits the ndb
+  # context cache.
+  ndb.get_multi([
+    task_result.properties_hash_to_dedup_key(t.properties_hash())
+    for request, _ in requests
+    for t in (request.task_slice(i) for i in xrange(request.num_task_slices))
+    if t.properties.idempotent
+  ])
+
+  now = utils.utcnow()
+  scheduled = [
+    (request, _new_task_entities(request, secret_bytes, now, has_capacity))
+    for request, secret_bytes in requests
+  ]
+
+  # Storing these entities makes these tasks live.
+  stored = []
+  for i in xrange(0, len(scheduled), SCHEDULE_BATCH_CONCURRENCY):
+    chunk = scheduled[i:i+SCHEDULE_BATCH_CONCURRENCY]
+    futures = []
+    for request, entities in chunk:
+      result_summary, to_run, secret_bytes, _ = entities
+      futures.append(datastore_utils.insert_async(
+          request,
+          new_key_callback=functools.partial(
+              _gen_new_keys, result_summary, to_run, secret_bytes),
+          extra=filter(bool, [result_summary, to_run, secret_bytes])))
+    ndb.Future.wait_all(futures)
+    stored.extend(
+        _is_stored(request, f) for (request, _), f in zip(chunk, futures))
+
+  children = {}
+  for ok, (request, entities) in zip(stored, scheduled):
+    if not ok:
+      continue
+    result_summary, to_run, _, dupe_summary = entities
+    _on_task_scheduled(result_summary, to_run, dupe_summary)
+    if request.parent_task_id:
+      children.setdefault(request.parent_task_id, []).append(
+          result_summary.task_id)
+  for parent_task_id, task_ids in sorted(children.iteritems()):
+    _add_children_to_parent(parent_task_id, task_ids, now)
+
+  out = []
+  for ok, (_, (result_summary, _, _, dupe_summary)) in zip(stored, scheduled):
+    if ok:
+      ts_mon_metrics.on_task_requested(result_summary, bool(dupe_summary))
+    out.append(result_summary if ok else None)
+  return out
+
+
 def bot_reap_task(bot_dimensions, bot_version, deadline):
   """Reaps a TaskToRun if one is available.
 
   The process is to find a TaskToRun where its .queue_number is set, then
-  create a TaskRunResult for it.
+  create a TaskRunResult for it. A TaskToRun reserved for the bot with
+  bot_reserve_task() is reaped first, without searching the queues.
 
   Returns:
     tuple of (TaskRequest, SecretBytes, TaskRunResult) for the task that was
@@ -909,6 +1118,17 @@ def bot_reap_task(bot_dimensions, bot_version, deadline):
   failures = 0
   stale_index = 0
   try:
+    reserved_key = task_to_run.pop_reservation_cache(bot_id)
+    if reserved_key:
+      iterated += 1
+      request = task_to_run.task_to_run_key_to_request_key(reserved_key).get()
+      run_result, secret_bytes = _reap_task(
+          bot_dimensions, bot_version, reserved_key, request, reserved=True)
+      if run_result:
+        logging.info('Reaped reserved: %s', run_result.task_id)
+        return request, secret_bytes, run_result
+      failures += 1
+
     q = task_to_run.yield_next_available_task_to_dispatch(
         bot_dimensions, deadline)
     for request, to_run in q:
@@ -949,6 +1169,7 @@ def bot_reap_task(bot_dimensions, bot_version, deadline):
         continue
 
       logging.info('Reaped: %s', run_result.task_id)
+      task_to_run.remove_from_index(to_run)
       return request, secret_bytes, run_result
     return None, None, None
   finally:
@@ -959,6 +1180,44 @@ def bot_reap_task(bot_dimensions, bot_version, deadline):
         failures)
 
 
+def bot_reserve_task(bot_dimensions, deadline):
+  """Reserves the next TaskToRun for a bot that is about to complete its
+  current task.
+
+  The TaskToRun is taken out of its queue for
+  task_to_run.RESERVATION_LEASE_SECS and bot_reap_task() returns it on the next
+  poll of the bot, without searching the queues. If the bot doesn't poll in
+  time, cron_abort_expired_task_to_run() puts it back in its queue.
+
+  Returns:
+    The TaskRequest reserved, None if no task is available.
+  """
+  start = time.time()
+  bot_id = bot_dimensions[u'id'][0]
+  iterated = 0
+  try:
+    q = task_to_run.yield_next_available_task_to_dispatch(
+        bot_dimensions, deadline)
+    lease = datetime.timedelta(seconds=task_to_run.RESERVATION_LEASE_SECS)
+    for request, to_run in q:
+      iterated += 1
+      t = request.task_slice(to_run.task_slice_index)
+      limit = to_run.created_ts + datetime.timedelta(seconds=t.expiration_secs)
+      if limit < utils.utcnow() + lease:
+        # Leave it to bot_reap_task() or the cron job to expire it.
+        continue
+      if _reserve_task(bot_id, to_run.key):
+        task_to_run.remove_from_index(to_run)
+        task_to_run.set_reservation_cache(bot_id, to_run.key)
+        logging.info('Reserved: %s', request.task_id)
+        return request
+    return None
+  finally:
+    logging.debug(
+        'bot_reserve_task(%s) in %.3fs: %d iterated',
+        bot_id, time.time()-start, iterated)
+
+
 def bot_update_task(
     run_result_key, bot_id, output, output_chunk_start, exit_code, duration,
     hard_timeout, io_timeout, cost_usd, outputs_ref, cipd_pins,
@@ -1044,6 +1303,10 @@ def bot_update_task(
   if smry.state not in task_result.State.STATES_RUNNING:
     event_mon_metrics.send_task_event(smry)
     ts_mon_metrics.on_task_completed(smry)
+    if smry.properties_hash:
+      # The task succeeded, its results can be reused by the next task with the
+      # same properties.
+      task_result.new_dedup_result(smry).put()
 
   # Hack a bit to tell the bot what it needs to hear (see handler_bot.py). It's
   # kind of an ugly hack but the other option is to return the whole run_result.
@@ -1121,9 +1384,13 @@ def cancel_task(request, result_key, kill_running):
     # "pending".
     result_key = task_pack.run_result_key_to_result_summary_key(result_key)
   now = utils.utcnow()
+  # The pending TaskToRun to remove from its index once the transaction
+  # committed.
+  to_remove = []
 
   def run():
     """1 DB GET, 1 memcache write, 2x DB PUTs, 1x task queue."""
+    del to_remove[:]
     # Need to get the current try number to know which TaskToRun to fetch.
     result_summary = result_key.get()
     was_running = result_summary.state == task_result.State.RUNNING
@@ -1145,7 +1412,12 @@ def cancel_task(request, result_key, kill_running):
 
       to_run = to_run_future.get_result()
       entities.append(to_run)
+      if to_run.is_reapable:
+        # Keep a copy with its queue_number, which is cleared below.
+        to_remove.append(
+            task_to_run.TaskToRun(key=to_run.key, **to_run.to_dict()))
       to_run.queue_number = None
+      task_to_run.clear_reservation(to_run)
     else:
       if not kill_running:
         # Deny canceling a task that started.
@@ -1176,6 +1448,8 @@ def cancel_task(request, result_key, kill_running):
     packed = task_pack.pack_result_summary_key(result_key)
     return 'Failed killing task %s: %s' % (packed, e)
 
+  for to_run in to_remove:
+    task_to_run.remove_from_index(to_run)
   return ok, was_running
 
 
@@ -1197,13 +1471,20 @@ def cron_abort_expired_task_to_run(host):
   - Server has internal failures causing it to fail to either distribute the
     tasks or properly receive results from the bots.
 
+  It also puts back in their queue the TaskToRun whose reservation lapsed, see
+  bot_reserve_task().
+
   Returns:
     Packed tasks ids of aborted and reenqueued tasks.
   """
   killed = []
   reenqueued = []
   skipped = 0
+  released = 0
   try:
+    for to_run in task_to_run.yield_lapsed_reservations():
+      if _release_reservation(to_run.key, to_run.request_key.get()):
+        released += 1
     for to_run in task_to_run.yield_expired_task_to_run():
       request = to_run.request_key.get()
       summary, new_to_run = _expire_task(to_run.key, request, retries=4)
@@ -1225,8 +1506,8 @@ def cron_abort_expired_task_to_run(host):
               host, i.task_id, i.task_slice(0).properties.dimensions)
             for i in killed))
     logging.info(
-        'Reenqueued %d tasks, killed %d, skipped %d',
-        len(reenqueued), len(killed), skipped)
+        'Reenqueued %d tasks, killed %d, skipped %d, released %d reservations',
+        len(reenqueued), len(killed), skipped, released)
   # These are returned primarily for unit testing verification.
   return [i.task_id for i in killed], [i.task_id for i in reenqueued]
 
@@ -1266,6 +1547,42 @@ def cron_handle_bot_died(host):
   return killed, retried, ignored
 
 
+def cron_delete_old_dedup_results():
+  """Deletes the TaskDedupResult too old to be reused, see _find_dupe_task().
+
+  There is one per distinct properties_hash of an idempotent task that
+  succeeded, so they would otherwise accumulate forever. An entity rewritten
+  concurrently may be deleted, which only causes a task not to be deduped.
+
+  Returns:
+    number of TaskDedupResult deleted.
+  """
+  count = 0
+  start = utils.utcnow()
+  try:
+    # Run for 4.5 minutes, the cron job is scheduled every 5 minutes like
+    # bot_management.cron_delete_old_bot_events().
+    time_to_stop = start + datetime.timedelta(seconds=int(4.5*60))
+    oldest = start - datetime.timedelta(
+        seconds=config.settings().reusable_task_age_secs)
+    q = task_result.TaskDedupResult.query(
+        default_options=ndb.QueryOptions(keys_only=True)).filter(
+            task_result.TaskDedupResult.created_ts <= oldest)
+    more = True
+    cursor = None
+    while more:
+      keys, cursor, more = q.fetch_page(100, start_cursor=cursor)
+      ndb.delete_multi(keys)
+      count += len(keys)
+      if utils.utcnow() >= time_to_stop:
+        break
+    return count
+  except runtime.DeadlineExceededError:
+    pass
+  finally:
+    logging.info('Deleted %d TaskDedupResult', count)
+
+
 ## Task queue tasks.
 
 
@@ -312,6 +312,98 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     self.assertTrue(to_run_key.get().queue_number)
     self.assertEqual(State.PENDING, result_summary.state)
 
+  def test_schedule_request_batch(self):
+    parent_id = self._task_ran_successfully(1, 0)
+    calls = []
+    orig_has_capacity = bot_management.has_capacity
+    def has_capacity(dimensions):
+      calls.append(dimensions)
+      return orig_has_capacity(dimensions)
+    self.mock(bot_management, 'has_capacity', has_capacity)
+
+    requests = [
+      (
+        _gen_request_slices(
+            name=u'yay:%d:3' % i,
+            parent_task_id=parent_id,
+            task_slices=[
+              task_request.TaskSlice(
+                  expiration_secs=60,
+                  properties=_gen_properties(
+                      env={u'GTEST_SHARD_INDEX': unicode(i)}),
+                  wait_for_capacity=False),
+            ]),
+        None,
+      )
+      for i in xrange(3)
+    ]
+    result_summaries = task_scheduler.schedule_request_batch(requests)
+    self.assertEqual(0, self.execute_tasks())
+    self.assertEqual(
+        [State.PENDING] * 3, [r.state for r in result_summaries])
+    self.assertEqual(
+        [u'yay:0:3', u'yay:1:3', u'yay:2:3'],
+        [r.request_key.get().name for r in result_summaries])
+    # The capacity is looked up once per set of dimensions.
+    self.assertEqual(1, len(calls))
+
+    # The parent lists all its children.
+    expected = [r.task_id for r in result_summaries]
+    parent_run_result_key = task_pack.unpack_run_result_key(parent_id)
+    self.assertEqual(expected, parent_run_result_key.get().children_task_ids)
+
+    # The bot reaps them as usual.
+    reaped = [
+      task_scheduler.bot_reap_task(self.bot_dimensions, 'abc', None)[0].key
+      for _ in result_summaries
+    ]
+    self.assertEqual(
+        sorted(r.request_key for r in result_summaries), sorted(reaped))
+
+  def test_schedule_request_batch_partial(self):
+    # A request that failed to be stored doesn't fail the others. A transaction
+    # that failed but was committed is detected.
+    orig_insert_async = datastore_utils.insert_async
+    def insert_async(entity, **kwargs):
+      f = orig_insert_async(entity, **kwargs)
+      if entity.name == u'yay:0:3':
+        return f
+      f.get_result()
+      if entity.name == u'yay:1:3':
+        # Failed, not committed.
+        ndb.delete_multi(
+            ndb.Query(ancestor=entity.key).fetch(keys_only=True))
+        error = datastore_errors.Timeout()
+      else:
+        error = datastore_utils.CommitError()
+      out = ndb.Future()
+      out.set_exception(error)
+      return out
+    self.mock(datastore_utils, 'insert_async', insert_async)
+
+    requests = [
+      (
+        _gen_request_slices(
+            name=u'yay:%d:3' % i,
+            task_slices=[
+              task_request.TaskSlice(
+                  expiration_secs=60,
+                  properties=_gen_properties(
+                      env={u'GTEST_SHARD_INDEX': unicode(i)}),
+                  wait_for_capacity=False),
+            ]),
+        None,
+      )
+      for i in xrange(3)
+    ]
+    result_summaries = task_scheduler.schedule_request_batch(requests)
+    self.assertEqual(0, self.execute_tasks())
+    self.assertEqual(
+        [True, False, True], [bool(r) for r in result_summaries])
+    self.assertEqual(
+        [u'yay:0:3', u'yay:2:3'],
+        [r.request_key.get().name for r in result_summaries if r])
+
   def test_schedule_request_new_key(self):
     # Ensure that _gen_new_keys work by generating deterministic key.
     self.mock(random, 'getrandbits', lambda _bits: 42)
@@ -656,7 +748,12 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
             outputs_ref=None,
             performance_stats=None))
     # An idempotent task has properties_hash set after it succeeded.
-    self.assertTrue(run_result.result_summary_key.get().properties_hash)
+    result_summary = run_result.result_summary_key.get()
+    self.assertTrue(result_summary.properties_hash)
+    # Its results can now be reused.
+    dedup = task_result.properties_hash_to_dedup_key(
+        result_summary.properties_hash).get()
+    self.assertEqual(result_summary.key, dedup.result_summary_key)
     return unicode(run_result.task_id)
 
   def _task_deduped(self, num_task, new_ts, deduped_from, task_id, now=None):
@@ -752,7 +849,7 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
 
   def test_task_idempotent_variable(self):
     # Test the edge case where config.settings().reusable_task_age_secs is being
-    # modified. This ensure TaskResultSummary.order(TRS.key) works.
+    # modified. This ensures the most recent result is reused.
     cfg = config.settings()
     cfg.reusable_task_age_secs = 10
     self.mock(config, 'settings', lambda: cfg)
@@ -768,12 +865,22 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     # recent) is reused.
     cfg.reusable_task_age_secs = 100
 
-    # Third task is deduped against second task. That ensures ordering works
-    # correctly.
+    # Third task is deduped against second task, which replaced the first one
+    # in the TaskDedupResult.
     third_ts = self.mock_now(self.now, 20)
     self._task_deduped(
         0, third_ts, task_id, '1d69ba3ea8008b10', now=second_ts)
 
+  def test_cron_delete_old_dedup_results(self):
+    self._task_ran_successfully(1, 0)
+    self.assertEqual(1, task_result.TaskDedupResult.query().count())
+    # Still reusable.
+    self.mock_now(self.now, config.settings().reusable_task_age_secs - 1)
+    self.assertEqual(0, task_scheduler.cron_delete_old_dedup_results())
+    self.mock_now(self.now, config.settings().reusable_task_age_secs)
+    self.assertEqual(1, task_scheduler.cron_delete_old_dedup_results())
+    self.assertEqual(0, task_result.TaskDedupResult.query().count())
+
   def test_task_idempotent_second_slice(self):
     # A task will dedupe against a second slice, and skip the first slice.
     # First task is idempotent.
@@ -1247,6 +1354,82 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
           self.bot_dimensions, 'abc', None)
       self.assertEqual(request.priority, e)
 
+  def test_bot_reap_task_index(self):
+    # Polling bots look up the pending tasks in the index instead of querying
+    # the datastore on each poll.
+    calls = []
+    orig = task_to_run._get_task_to_run_query
+    def _get_task_to_run_query(dimensions_hash):
+      calls.append(dimensions_hash)
+      return orig(dimensions_hash)
+    self.mock(task_to_run, '_get_task_to_run_query', _get_task_to_run_query)
+
+    self._register_bot(0, self.bot_dimensions)
+    priorities = [20 + (i * 37) % 180 for i in xrange(50)]
+    for i, p in enumerate(priorities):
+      self._quick_schedule(num_task=int(not i), priority=p)
+    self.assertEqual(0, self.execute_tasks())
+
+    actual = []
+    for _ in priorities:
+      request, _, _ = task_scheduler.bot_reap_task(
+          self.bot_dimensions, 'abc', None)
+      actual.append(request.priority)
+    self.assertEqual(sorted(priorities), actual)
+    self.assertEqual(
+        (None, None, None),
+        task_scheduler.bot_reap_task(self.bot_dimensions, 'abc', None))
+    # The index is built once, by the first poll.
+    self.assertEqual(1, len(calls))
+
+  def test_bot_reserve_task(self):
+    self._register_bot(0, self.bot_dimensions)
+    result_summary = self._quick_schedule(
+        1,
+        task_slices=[
+          task_request.TaskSlice(
+              expiration_secs=600,
+              properties=_gen_properties(),
+              wait_for_capacity=False),
+        ])
+    request = task_scheduler.bot_reserve_task(self.bot_dimensions, None)
+    self.assertEqual(result_summary.request_key, request.key)
+    # There is nothing else to reserve.
+    self.assertEqual(
+        None, task_scheduler.bot_reserve_task(self.bot_dimensions, None))
+
+    # The next poll reaps the reserved task without searching the queues.
+    def yield_next_available_task_to_dispatch(*_):
+      self.fail('Unexpected search')
+    self.mock(
+        task_to_run, 'yield_next_available_task_to_dispatch',
+        yield_next_available_task_to_dispatch)
+    self.mock_now(self.now, 1)
+    reaped_request, _, run_result = task_scheduler.bot_reap_task(
+        self.bot_dimensions, 'abc', None)
+    self.assertEqual(request.key, reaped_request.key)
+    self.assertEqual(State.RUNNING, run_result.state)
+    to_run = task_to_run.TaskToRun.query().get()
+    self.assertEqual(None, to_run.queue_number)
+    self.assertEqual(None, to_run.reservation_bot_id)
+
+  def test_bot_reserve_task_expiring(self):
+    # A task that could expire before the bot polls for it is not reserved.
+    self._register_bot(0, self.bot_dimensions)
+    self._quick_schedule(
+        1,
+        task_slices=[
+          task_request.TaskSlice(
+              expiration_secs=task_to_run.RESERVATION_LEASE_SECS - 1,
+              properties=_gen_properties(),
+              wait_for_capacity=False),
+        ])
+    self.assertEqual(
+        None, task_scheduler.bot_reserve_task(self.bot_dimensions, None))
+    request, _, _ = task_scheduler.bot_reap_task(
+        self.bot_dimensions, 'abc', None)
+    self.assertTrue(request)
+
   def test_bot_kill_task(self):
     pub_sub_calls = self.mock_pub_sub()
     run_result = self._quick_reap(1, 0, pubsub_topic='projects/abc/topics/def')
@@ -1304,6 +1487,40 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     actual = task_to_run._lookup_cache_is_taken_async(to_run_key).get_result()
     self.assertEqual(True, actual)
 
+  def test_cancel_task_index(self):
+    # The TaskToRun is removed from its index once the transaction committed.
+    self._register_bot(0, self.bot_dimensions)
+    result_summary = self._quick_schedule(1)
+    removed = []
+    def remove_from_index(to_run):
+      removed.append((to_run.queue_number, ndb.in_transaction()))
+    self.mock(task_to_run, 'remove_from_index', remove_from_index)
+    request = result_summary.request_key.get()
+    to_run_key = task_to_run.request_to_task_to_run_key(request, 1, 0)
+    queue_number = to_run_key.get().queue_number
+    self.assertTrue(queue_number)
+
+    # Nothing is removed if the transaction fails.
+    fail = [True]
+    orig_transaction = datastore_utils.transaction
+    def transaction(*args, **kwargs):
+      if fail[0]:
+        raise datastore_utils.CommitError('Sorry!')
+      return orig_transaction(*args, **kwargs)
+    self.mock(datastore_utils, 'transaction', transaction)
+    self.assertIn(
+        'Failed killing task',
+        task_scheduler.cancel_task(request, result_summary.key, False))
+    self.assertEqual([], removed)
+
+    fail[0] = False
+    ok, was_running = task_scheduler.cancel_task(
+        request, result_summary.key, False)
+    self.assertEqual(True, ok)
+    self.assertEqual(False, was_running)
+    self.assertEqual([(queue_number, False)], removed)
+    self.assertEqual(None, to_run_key.get().queue_number)
+
   def test_cancel_task_running(self):
     # Cancel a running task.
     pub_sub_calls = self.mock_pub_sub()
@@ -1439,6 +1656,34 @@ class TaskSchedulerApiTest(test_env_handlers.AppTestBase):
     self.assertEqual(1, self.execute_tasks())
     self.assertEqual(1, len(pub_sub_calls)) # pubsub completion notification
 
+  def test_cron_abort_expired_task_to_run_lapsed_reservation(self):
+    self._register_bot(0, self.bot_dimensions)
+    self._quick_schedule(
+        1,
+        task_slices=[
+          task_request.TaskSlice(
+              expiration_secs=600,
+              properties=_gen_properties(),
+              wait_for_capacity=False),
+        ])
+    self.assertTrue(task_scheduler.bot_reserve_task(self.bot_dimensions, None))
+    self.assertEqual(
+        ([], []), task_scheduler.cron_abort_expired_task_to_run('f.local'))
+    self.assertEqual(
+        'localhost', task_to_run.TaskToRun.query().get().reservation_bot_id)
+
+    # The bot never polled for its reservation, it is put back in its queue.
+    self.mock_now(self.now, task_to_run.RESERVATION_LEASE_SECS + 1)
+    self.assertEqual(None, task_to_run.pop_reservation_cache(u'localhost'))
+    self.assertEqual(
+        ([], []), task_scheduler.cron_abort_expired_task_to_run('f.local'))
+    to_run = task_to_run.TaskToRun.query().get()
+    self.assertEqual(None, to_run.reservation_bot_id)
+    self.assertEqual(True, to_run.is_reapable)
+    request, _, _ = task_scheduler.bot_reap_task(
+        self.bot_dimensions, 'abc', None)
+    self.assertTrue(request)
+
   def test_cron_abort_expired_task_to_run_retry(self):
     pub_sub_calls = self.mock_pub_sub()
     run_result = self._quick_reap(
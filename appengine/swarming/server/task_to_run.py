@@ -29,6 +29,7 @@ Graph of the schema:
     +--------------+     +--------------+
 """
 
+import bisect
 import collections
 import datetime
 import logging
@@ -92,6 +93,13 @@ class TaskToRun(ndb.Model):
   # If this task it not ready to be scheduled, it must be None.
   queue_number = ndb.IntegerProperty()
 
+  # Bot the TaskToRun is reserved for, see task_scheduler.bot_reserve_task().
+  # queue_number is None while the TaskToRun is reserved.
+  reservation_bot_id = ndb.StringProperty(indexed=False)
+  # Moment the reservation lapses. It is indexed so the cron job can put back
+  # the TaskToRun with a lapsed reservation in its queue.
+  reservation_expiration_ts = ndb.DateTimeProperty()
+
   @property
   def task_slice_index(self):
     """Returns the TaskRequest.task_slice() index this entity represents as
@@ -114,9 +122,22 @@ class TaskToRun(ndb.Model):
     """Returns the TaskRequest ndb.Key that is parent to the task to run."""
     return task_to_run_key_to_request_key(self.key)
 
+  def is_reserved_for(self, bot_id, now):
+    """Returns True if the task is reserved for this bot and the reservation
+    didn't lapse.
+    """
+    return bool(
+        self.reservation_bot_id == bot_id and
+        self.reservation_expiration_ts and
+        self.reservation_expiration_ts > now)
+
   def to_dict(self):
     """Purely used for unit testing."""
     out = super(TaskToRun, self).to_dict()
+    if not out['reservation_bot_id']:
+      # Keep it concise, most TaskToRun are never reserved.
+      del out['reservation_bot_id']
+      del out['reservation_expiration_ts']
     # Consistent formatting makes it easier to reason about.
     if out['queue_number']:
       out['queue_number'] = '0x%016x' % out['queue_number']
@@ -128,6 +149,68 @@ class TaskToRun(ndb.Model):
 ### Private functions.
 
 
+# Memcache namespace of the index of pending TaskToRun, see add_to_index().
+_INDEX_NAMESPACE = 'task_to_run_index'
+
+
+# Maximum number of pending TaskToRun in the index of a dimensions_hash. The
+# queues with more pending tasks are queried from the datastore instead. It
+# keeps the memcache value well below 1MiB.
+_INDEX_MAX_ITEMS = 1000
+
+
+# Memcache namespace of the TaskToRun added while the index of their
+# dimensions_hash was not in memcache, see add_to_index().
+_PENDING_ADDS_NAMESPACE = 'task_to_run_pending_adds'
+
+
+# Memcache namespace of the TaskToRun reserved for each bot.
+_RESERVATION_NAMESPACE = 'task_to_run_reservation'
+
+
+# Memcache namespace of the number of waiting bots to wake up per
+# dimensions_hash. add_to_index() adds one and wait_for_new_task() takes one.
+_NOTIFY_NAMESPACE = 'task_to_run_notify'
+
+
+# Maximum number of bots to wake up kept per dimensions_hash. Tasks enqueued
+# while no bot waits would otherwise wake up every bot waiting later on.
+_NOTIFY_MAX = 10
+
+
+# Interval in seconds at which wait_for_new_task() checks for a new TaskToRun.
+_WAIT_INTERVAL_SECS = 2.
+
+
+# Memcache namespace and key of the number of requests held by
+# wait_for_new_task() across all instances.
+_HOLDS_NAMESPACE = 'task_to_run_holds'
+_HOLDS_KEY = 'holds'
+
+
+# Maximum number of requests held at once by wait_for_new_task(). Each held
+# request keeps an instance thread busy, so past this number the bots back off
+# as if they didn't ask for a long poll.
+_MAX_HOLDS = 500
+
+
+# Lifetime of the count of held requests in seconds. A request killed before it
+# could decrement the count leaks one hold until then.
+_HOLDS_EXPIRATION = 10*60
+
+
+# Lifetime of an index in seconds. It bounds the time the index can be
+# inconsistent with the datastore, e.g. when it was built from a stale query.
+_INDEX_EXPIRATION = 60
+
+
+def _get_queue_number(request, task_slice_index):
+  """Returns the TaskToRun.queue_number of a TaskSlice of a TaskRequest."""
+  h = request.task_slice(task_slice_index).properties.dimensions
+  return _gen_queue_number(
+      task_queues.hash_dimensions(h), request.created_ts, request.priority)
+
+
 def _gen_queue_number(dimensions_hash, timestamp, priority):
   """Generates a 63 bit packed value used for TaskToRun.queue_number.
 
@@ -211,6 +294,180 @@ def _lookup_cache_is_taken_async(to_run_key):
   raise ndb.Return(bool(neg))
 
 
+def _index_key(dimensions_hash):
+  """Returns the memcache key of the index of a dimensions_hash."""
+  return '%x' % dimensions_hash
+
+
+def _to_index_item(to_run):
+  """Returns the tuple representing a pending TaskToRun in an index.
+
+  The tuples sort in the queue order.
+  """
+  return (
+      to_run.queue_number, to_run.request_key.integer_id(),
+      to_run.key.integer_id(), to_run.created_ts, to_run.expiration_ts)
+
+
+def _from_index_item(item):
+  """Returns an unsaved TaskToRun out of an index item."""
+  queue_number, request_id, to_run_id, created_ts, expiration_ts = item
+  return TaskToRun(
+      key=ndb.Key(
+          TaskToRun, to_run_id,
+          parent=ndb.Key(task_request.TaskRequest, request_id)),
+      created_ts=created_ts,
+      expiration_ts=expiration_ts,
+      queue_number=queue_number)
+
+
+@ndb.tasklet
+def _build_index_async(dimensions_hash):
+  """Queries the pending TaskToRun of a dimensions_hash and stores them as its
+  index.
+
+  Returns:
+    list of index items, None if there are too many pending TaskToRun.
+  """
+  to_runs = yield _get_task_to_run_query(dimensions_hash).fetch_async(
+      _INDEX_MAX_ITEMS + 1)
+  items = None
+  if len(to_runs) <= _INDEX_MAX_ITEMS:
+    # The ndb.Query ask for a valid queue_number but under load, it happens the
+    # value is not valid anymore.
+    items = [_to_index_item(t) for t in to_runs if t.queue_number]
+  expiration = int(utils.time_time()) + _INDEX_EXPIRATION
+  # Use add() to not overwrite an index built concurrently.
+  yield ndb.get_context().memcache_add(
+      _index_key(dimensions_hash), (expiration, items),
+      time=expiration, namespace=_INDEX_NAMESPACE)
+  if items is not None:
+    # The query is eventually consistent, so it may miss the TaskToRun added
+    # recently. Merge the ones added while there was no index. It must be done
+    # once the index is in memcache, see add_to_index().
+    added = yield _get_pending_adds_async(dimensions_hash)
+    merged = _merge_items(list(items), added)
+    if merged:
+      _update_index(dimensions_hash, lambda i: _merge_items(i, added))
+      items = merged
+  raise ndb.Return(items)
+
+
+@ndb.tasklet
+def _get_pending_adds_async(dimensions_hash):
+  """Returns the index items recorded by _record_pending_add() that are still
+  pending, as confirmed by a (strongly consistent) lookup by key.
+  """
+  pending = yield ndb.get_context().memcache_get(
+      _index_key(dimensions_hash), namespace=_PENDING_ADDS_NAMESPACE)
+  if not pending:
+    raise ndb.Return([])
+  to_runs = yield ndb.get_multi_async(
+      [_from_index_item(i).key for i in pending])
+  raise ndb.Return([_to_index_item(t) for t in to_runs if t and t.queue_number])
+
+
+def _merge_items(items, added):
+  """Inserts the index items |added| that are not in |items| yet.
+
+  Returns the updated list of items or None if there is nothing to change.
+  """
+  ids = set(i[1:3] for i in items)
+  added = [i for i in added if i[1:3] not in ids]
+  if not added:
+    return None
+  for item in added:
+    bisect.insort(items, item)
+  return items
+
+
+def _record_pending_add(dimensions_hash, item):
+  """Records an index item added while the index of dimensions_hash was not in
+  memcache, so the next _build_index_async() merges it in.
+
+  The record lives as long as an index, so it covers a build that started
+  before the TaskToRun was stored.
+  """
+  client = memcache.Client()
+  key = _index_key(dimensions_hash)
+  for _ in xrange(3):
+    pending = client.gets(key, namespace=_PENDING_ADDS_NAMESPACE)
+    if pending is None:
+      if client.add(
+          key, [item], time=_INDEX_EXPIRATION,
+          namespace=_PENDING_ADDS_NAMESPACE):
+        return
+      continue
+    if item in pending or len(pending) >= _INDEX_MAX_ITEMS:
+      # The index will be too large anyway and it is queried from the
+      # datastore.
+      return
+    if client.cas(
+        key, pending + [item], time=_INDEX_EXPIRATION,
+        namespace=_PENDING_ADDS_NAMESPACE):
+      return
+  logging.warning(
+      '_record_pending_add(%x): too much contention', dimensions_hash)
+
+
+def _get_indexes(dimensions_hashes):
+  """Returns the index of each dimensions_hash, building the ones missing from
+  memcache.
+
+  Returns:
+    dict(dimensions_hash: list of index items in queue order, None if the queue
+    is too large to be indexed).
+  """
+  keys = {_index_key(h): h for h in dimensions_hashes}
+  cached = memcache.get_multi(keys.keys(), namespace=_INDEX_NAMESPACE)
+  out = {}
+  futures = {}
+  for key, dimensions_hash in keys.iteritems():
+    if key in cached:
+      out[dimensions_hash] = cached[key][1]
+    else:
+      futures[dimensions_hash] = _build_index_async(dimensions_hash)
+  for dimensions_hash, future in futures.iteritems():
+    out[dimensions_hash] = future.get_result()
+  return out
+
+
+def _update_index(dimensions_hash, update):
+  """Updates the index of a dimensions_hash with compare-and-set.
+
+  update(items) returns the new list of items or None if there is nothing to
+  change. An index that is not in memcache is left alone, it is built from the
+  datastore on the next poll.
+
+  Returns:
+    False if the index is not in memcache, including when it was dropped.
+  """
+  client = memcache.Client()
+  key = _index_key(dimensions_hash)
+  for _ in xrange(3):
+    entry = client.gets(key, namespace=_INDEX_NAMESPACE)
+    if not entry:
+      return False
+    expiration, items = entry
+    if items is None:
+      # Too large, it is queried from the datastore.
+      return True
+    items = update(items)
+    if items is None:
+      return True
+    if len(items) > _INDEX_MAX_ITEMS:
+      items = None
+    # Keep the original expiration, so the index is periodically rebuilt.
+    if client.cas(
+        key, (expiration, items), time=expiration,
+        namespace=_INDEX_NAMESPACE):
+      return True
+  # Too much contention; it's cheaper to rebuild it on the next poll.
+  logging.warning('_update_index(%x): dropping index', dimensions_hash)
+  client.delete(key, namespace=_INDEX_NAMESPACE)
+  return False
+
+
 class _QueryStats(object):
   """Statistics for a yield_next_available_task_to_dispatch() loop."""
   broken = 0
@@ -357,9 +614,13 @@ def _get_task_to_run_query(dimensions_hash):
 
 
 def _yield_potential_tasks(bot_id):
-  """Queries all the known task queues in parallel and yields the task in order
+  """Looks up all the known task queues in parallel and yields the task in order
   of priority.
 
+  The queues are looked up in their index in memcache, see add_to_index(). The
+  ones missing from memcache are built from the datastore and the ones with too
+  many pending tasks are queried from the datastore.
+
   The ordering is opportunistic, not strict. There's a risk of not returning
   exactly in the priority order depending on index staleness and query execution
   latency. The number of queries is unbounded.
@@ -377,13 +638,22 @@ def _yield_potential_tasks(bot_id):
   # Note that the default ndb.EVENTUAL_CONSISTENCY is used so stale items may be
   # returned. It's handled specifically by consumers of this function.
   start = time.time()
-  queries = [_get_task_to_run_query(d) for d in potential_dimensions_hashes]
-  yielders = [_yield_pages_async(q, 10) for q in queries]
   # We do care about the first page of each query so we cannot merge all the
   # results of every query insensibly.
   futures = []
 
   try:
+    indexes = _get_indexes(potential_dimensions_hashes)
+    # items is a list of TaskToRun. The entities are needed because property
+    # queue_number is used to sort according to each task's priority.
+    items = [
+      _from_index_item(i) for v in indexes.itervalues() if v for i in v
+    ]
+    queries = [
+      _get_task_to_run_query(d)
+      for d, v in sorted(indexes.iteritems()) if v is None
+    ]
+    yielders = [_yield_pages_async(q, 10) for q in queries]
     for y in yielders:
       futures.append(next(y, None))
 
@@ -393,13 +663,11 @@ def _yield_potential_tasks(bot_id):
         break
       time.sleep(r)
     logging.debug(
-        '_yield_potential_tasks(%s): waited %.3fs for %d items from %d Futures',
-        bot_id, time.time() - start,
+        '_yield_potential_tasks(%s): %d items from %d indexes, waited %.3fs '
+        'for %d items from %d Futures',
+        bot_id, len(items), len(indexes) - len(futures), time.time() - start,
         sum(len(f.get_result()) for f in futures if f.done()),
         len(futures))
-    # items is a list of TaskToRun. The entities are needed because property
-    # queue_number is used to sort according to each task's priority.
-    items = []
     for i, f in enumerate(futures):
       if f and f.done():
         # The ndb.Future returns a list of up to 10 TaskToRun entities.
@@ -448,6 +716,11 @@ def _yield_potential_tasks(bot_id):
 ### Public API.
 
 
+# Duration of a reservation made by task_scheduler.bot_reserve_task(). The bot
+# is expected to poll for it within this time.
+RESERVATION_LEASE_SECS = 60
+
+
 def request_to_task_to_run_key(request, try_number, task_slice_index):
   """Returns the ndb.Key for a TaskToRun from a TaskRequest."""
   assert 1 <= try_number <= 2, try_number
@@ -494,16 +767,65 @@ def new_task_to_run(request, try_number, task_slice_index):
       offset += request.task_slice(i).expiration_secs
   exp = request.created_ts + datetime.timedelta(
       seconds=request.task_slice(task_slice_index).expiration_secs+offset)
-  h = request.task_slice(task_slice_index).properties.dimensions
-  qn = _gen_queue_number(
-      task_queues.hash_dimensions(h), request.created_ts, request.priority)
   return TaskToRun(
       key=request_to_task_to_run_key(request, try_number, task_slice_index),
       created_ts=created,
-      queue_number=qn,
+      queue_number=_get_queue_number(request, task_slice_index),
       expiration_ts=exp)
 
 
+def reserve(to_run, bot_id, now):
+  """Takes a pending TaskToRun out of its queue for a bot for
+  RESERVATION_LEASE_SECS.
+
+  The caller must save it in the DB.
+  """
+  assert to_run.is_reapable, to_run
+  to_run.queue_number = None
+  to_run.reservation_bot_id = bot_id
+  to_run.reservation_expiration_ts = now + datetime.timedelta(
+      seconds=RESERVATION_LEASE_SECS)
+
+
+def clear_reservation(to_run):
+  """Clears the reservation of a TaskToRun.
+
+  The caller must save it in the DB.
+  """
+  to_run.reservation_bot_id = None
+  to_run.reservation_expiration_ts = None
+
+
+def release_reservation(request, to_run):
+  """Puts back a reserved TaskToRun in its queue.
+
+  The caller must save it in the DB.
+  """
+  assert to_run.reservation_bot_id, to_run
+  clear_reservation(to_run)
+  to_run.queue_number = _get_queue_number(request, to_run.task_slice_index)
+
+
+def set_reservation_cache(bot_id, to_run_key):
+  """Remembers the TaskToRun reserved for a bot, so its next poll finds it with
+  a single memcache lookup.
+  """
+  memcache.set(
+      bot_id, to_run_key.urlsafe(), time=RESERVATION_LEASE_SECS,
+      namespace=_RESERVATION_NAMESPACE)
+
+
+def pop_reservation_cache(bot_id):
+  """Returns the TaskToRun ndb.Key reserved for a bot and forgets it, None if
+  there's none.
+  """
+  value = memcache.get(bot_id, namespace=_RESERVATION_NAMESPACE)
+  if not value:
+    return None
+  memcache.delete(bot_id, namespace=_RESERVATION_NAMESPACE)
+  return ndb.Key(urlsafe=value)
+
+
 def match_dimensions(request_dimensions, bot_dimensions):
   """Returns True if the bot dimensions satisfies the request dimensions."""
   assert isinstance(request_dimensions, dict), request_dimensions
@@ -549,6 +871,52 @@ def set_lookup_cache(to_run_key, is_available_to_schedule):
   return memcache.add(key, True, time=cache_lifetime, namespace='task_to_run')
 
 
+def add_to_index(to_run):
+  """Adds a newly pending TaskToRun to the index of its dimensions_hash.
+
+  The index is a sorted list of the pending TaskToRun of a dimensions_hash kept
+  in memcache, so polling bots don't have to query the datastore for each of
+  their queues. It must be called once the TaskToRun was stored.
+
+  The index is a hint; the TaskToRun is validated in a transaction when reaped.
+  If it is not in memcache, it is built from the datastore on the next poll.
+  Since that query is eventually consistent, the TaskToRun is also recorded in
+  a pending adds list that is merged in once the index is built.
+
+  It also wakes up one bot waiting for this dimensions_hash in
+  wait_for_new_task().
+  """
+  assert to_run.queue_number, to_run
+  item = _to_index_item(to_run)
+  def update(items):
+    if any(i[1:3] == item[1:3] for i in items):
+      return None
+    bisect.insort(items, item)
+    return items
+  dimensions_hash = to_run.queue_number >> 31
+  if not _update_index(dimensions_hash, update):
+    _record_pending_add(dimensions_hash, item)
+    # An index built before the pending add was recorded doesn't have it.
+    _update_index(dimensions_hash, update)
+  key = str(dimensions_hash)
+  count = memcache.incr(key, initial_value=0, namespace=_NOTIFY_NAMESPACE)
+  if count > _NOTIFY_MAX:
+    memcache.set(key, _NOTIFY_MAX, namespace=_NOTIFY_NAMESPACE)
+
+
+def remove_from_index(to_run):
+  """Removes a TaskToRun that is not pending anymore from its index.
+
+  to_run.queue_number must still be set, as it was when pending.
+  """
+  assert to_run.queue_number, to_run
+  ids = _to_index_item(to_run)[1:3]
+  def update(items):
+    out = [i for i in items if i[1:3] != ids]
+    return out if len(out) != len(items) else None
+  _update_index(to_run.queue_number >> 31, update)
+
+
 def yield_next_available_task_to_dispatch(bot_dimensions, deadline):
   """Yields next available (TaskRequest, TaskToRun) in decreasing order of
   priority.
@@ -620,6 +988,73 @@ def yield_next_available_task_to_dispatch(bot_dimensions, deadline):
         bot_id, (utils.utcnow() - now).total_seconds(), stats)
 
 
+def get_wait_keys(bot_dimensions):
+  """Returns the keys of the queues the bot can run, to be passed to
+  wait_for_new_task().
+
+  Returns None if the bot has no queue, there's nothing to wait for.
+  """
+  bot_id = bot_dimensions[u'id'][0]
+  queues = task_queues.get_queues(bot_management.get_root_key(bot_id))
+  if not queues:
+    return None
+  return [str(q) for q in queues]
+
+
+def wait_for_new_task(keys, timeout):
+  """Waits up to timeout seconds for a TaskToRun to be enqueued in one of the
+  queues returned by get_wait_keys().
+
+  Each TaskToRun enqueued wakes up a single waiting bot, so a burst of bots
+  doesn't race to reap it. A TaskToRun enqueued before the call, e.g. while the
+  bot was looking for a task, wakes it up right away.
+
+  At most _MAX_HOLDS requests are held at once.
+
+  Returns:
+    True if a TaskToRun may have been enqueued for the bot, False if none was
+    enqueued before the timeout, None if the request wasn't held since
+    _MAX_HOLDS requests are already held.
+  """
+  client = memcache.Client()
+  holds = client.incr(_HOLDS_KEY, namespace=_HOLDS_NAMESPACE)
+  if holds is None:
+    client.add(
+        _HOLDS_KEY, 0, time=_HOLDS_EXPIRATION, namespace=_HOLDS_NAMESPACE)
+    holds = client.incr(_HOLDS_KEY, namespace=_HOLDS_NAMESPACE)
+  try:
+    if not holds or holds > _MAX_HOLDS:
+      return None
+    deadline = utils.time_time() + timeout
+    while True:
+      counts = client.get_multi(
+          keys, namespace=_NOTIFY_NAMESPACE, for_cas=True)
+      for key, count in counts.iteritems():
+        # Another bot may take it first, then try the next queue.
+        if (count > 0 and
+            client.cas(key, count - 1, namespace=_NOTIFY_NAMESPACE)):
+          return True
+      remaining = deadline - utils.time_time()
+      if remaining <= 0:
+        return False
+      time.sleep(min(_WAIT_INTERVAL_SECS, remaining))
+  finally:
+    if holds:
+      client.decr(_HOLDS_KEY, namespace=_HOLDS_NAMESPACE)
+
+
+def yield_lapsed_reservations():
+  """Yields all the TaskToRun whose reservation lapsed."""
+  # There's few reservations at any time since they last
+  # RESERVATION_LEASE_SECS. The lower bound skips the TaskToRun never reserved
+  # or with their reservation cleared, as null sorts before any datetime.
+  q = TaskToRun.query(
+      TaskToRun.reservation_expiration_ts > utils.EPOCH,
+      TaskToRun.reservation_expiration_ts < utils.utcnow())
+  for to_run in q:
+    yield to_run
+
+
 def yield_expired_task_to_run():
   """Yields all the expired TaskToRun still marked as available."""
   # The reason it is done this way as an iteration over all the pending entities
@@ -8,6 +8,7 @@ import logging
 import os
 import random
 import sys
+import time
 import unittest
 
 # Setups environment.
@@ -17,6 +18,7 @@ import test_env_handlers
 
 import webtest
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 import handlers_backend
@@ -813,6 +815,124 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     to_run.put()
     self.assertEqual(False, to_run.is_reapable)
 
+  def _gen_indexed_task_to_run(self, nb_task, priority):
+    """Returns a TaskToRun saved in the DB and added to its index."""
+    request = self.mkreq(
+        nb_task,
+        _gen_request(
+            properties=_gen_properties(
+                dimensions={u'os': [u'Windows-3.1.1'], u'pool': [u'default']}),
+            priority=priority))
+    to_run = task_to_run.new_task_to_run(request, 1, 0)
+    to_run.put()
+    task_to_run.add_to_index(to_run)
+    return to_run
+
+  def _mock_no_query(self):
+    """Asserts the datastore is not queried for pending TaskToRun."""
+    def _get_task_to_run_query(dimensions_hash):
+      self.fail('Unexpected query for %x' % dimensions_hash)
+    self.mock(task_to_run, '_get_task_to_run_query', _get_task_to_run_query)
+
+  def test_add_to_index(self):
+    bot_dimensions = {
+      u'id': [u'localhost'],
+      u'os': [u'Windows-3.1.1'],
+      u'pool': [u'default'],
+    }
+    # The index is not in memcache, so add_to_index() is a no-op and the first
+    # poll builds it from the datastore.
+    to_run_1 = self._gen_indexed_task_to_run(1, 50)
+    self.assertEqual(
+        [to_run_1.to_dict()],
+        _yield_next_available_task_to_dispatch(bot_dimensions, None))
+
+    # From now on, the pending tasks are found in the index.
+    self._mock_no_query()
+    self.mock_now(self.now, 1)
+    to_run_2 = self._gen_indexed_task_to_run(0, 10)
+    # Adding twice is fine.
+    task_to_run.add_to_index(to_run_2)
+    self.assertEqual(
+        [to_run_2.to_dict(), to_run_1.to_dict()],
+        _yield_next_available_task_to_dispatch(bot_dimensions, None))
+
+  def test_add_to_index_during_build(self):
+    # A TaskToRun added while there is no index is merged in when the index is
+    # built, even if the query doesn't return it yet.
+    bot_dimensions = {
+      u'id': [u'localhost'],
+      u'os': [u'Windows-3.1.1'],
+      u'pool': [u'default'],
+    }
+    to_run_1 = self._gen_indexed_task_to_run(1, 50)
+    stale = lambda _: task_to_run.TaskToRun.query(
+        task_to_run.TaskToRun.queue_number == 1)
+    self.mock(task_to_run, '_get_task_to_run_query', stale)
+    self.assertEqual(
+        [to_run_1.to_dict()],
+        _yield_next_available_task_to_dispatch(bot_dimensions, None))
+
+    # Once reaped, it is not merged in anymore.
+    memcache.flush_all()
+    task_to_run.add_to_index(to_run_1)
+    to_run_1.queue_number = None
+    to_run_1.put()
+    self.assertEqual(
+        [], _yield_next_available_task_to_dispatch(bot_dimensions, None))
+
+  def test_remove_from_index(self):
+    bot_dimensions = {
+      u'id': [u'localhost'],
+      u'os': [u'Windows-3.1.1'],
+      u'pool': [u'default'],
+    }
+    to_run_1 = self._gen_indexed_task_to_run(1, 50)
+    to_run_2 = self._gen_indexed_task_to_run(0, 10)
+    self.assertEqual(
+        2, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+
+    self._mock_no_query()
+    task_to_run.remove_from_index(to_run_2)
+    self.assertEqual(
+        [to_run_1.to_dict()],
+        _yield_next_available_task_to_dispatch(bot_dimensions, None))
+
+  def test_yield_next_available_task_to_dispatch_index_expiration(self):
+    # A stale index is rebuilt from the datastore once expired.
+    bot_dimensions = {
+      u'id': [u'localhost'],
+      u'os': [u'Windows-3.1.1'],
+      u'pool': [u'default'],
+    }
+    to_run_1 = self._gen_indexed_task_to_run(1, 50)
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+    to_run_1.queue_number = None
+    to_run_1.put()
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+    self.mock_now(self.now, task_to_run._INDEX_EXPIRATION + 1)
+    self.assertEqual(
+        [], _yield_next_available_task_to_dispatch(bot_dimensions, None))
+
+  def test_yield_next_available_task_to_dispatch_index_overflow(self):
+    # A queue with too many pending tasks is queried from the datastore.
+    self.mock(task_to_run, '_INDEX_MAX_ITEMS', 1)
+    bot_dimensions = {
+      u'id': [u'localhost'],
+      u'os': [u'Windows-3.1.1'],
+      u'pool': [u'default'],
+    }
+    to_run_1 = self._gen_indexed_task_to_run(1, 50)
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+    # Adding a second task overflows the index.
+    to_run_2 = self._gen_indexed_task_to_run(0, 10)
+    self.assertEqual(
+        [to_run_2.to_dict(), to_run_1.to_dict()],
+        _yield_next_available_task_to_dispatch(bot_dimensions, None))
+
   def test_set_lookup_cache(self):
     # Create two TaskToRun on the same TaskRequest and assert that affecting one
     # negative cache entry doesn't affect the other.
@@ -841,6 +961,194 @@ class TaskToRunApiTest(test_env_handlers.AppTestBase):
     self.assertEqual(False, lookup(to_run_1.key))
     self.assertEqual(True, lookup(to_run_2.key))
 
+  def test_reserve(self):
+    _, to_run = self._gen_new_task_to_run(1)
+    task_to_run.reserve(to_run, 'localhost', self.now)
+    to_run.put()
+    self.assertEqual(False, to_run.is_reapable)
+    self.assertEqual('localhost', to_run.reservation_bot_id)
+    self.assertEqual(
+        self.now + datetime.timedelta(
+            seconds=task_to_run.RESERVATION_LEASE_SECS),
+        to_run.reservation_expiration_ts)
+    self.assertEqual(True, to_run.is_reserved_for('localhost', self.now))
+    self.assertEqual(False, to_run.is_reserved_for('other', self.now))
+    # The reserved task is not dispatched to another bot.
+    bot_dimensions = {u'id': [u'bot1'], u'pool': [u'default']}
+    self.assertEqual(
+        [], _yield_next_available_task_to_dispatch(bot_dimensions, None))
+
+  def test_clear_reservation(self):
+    _, to_run = self._gen_new_task_to_run(1)
+    task_to_run.reserve(to_run, 'localhost', self.now)
+    task_to_run.clear_reservation(to_run)
+    self.assertEqual(False, to_run.is_reserved_for('localhost', self.now))
+    self.assertEqual(None, to_run.reservation_bot_id)
+    self.assertEqual(None, to_run.reservation_expiration_ts)
+
+  def test_release_reservation(self):
+    request, to_run = self._gen_new_task_to_run(1)
+    expected = to_run.to_dict()
+    task_to_run.reserve(to_run, 'localhost', self.now)
+    to_run.put()
+    task_to_run.release_reservation(request, to_run)
+    to_run.put()
+    # The TaskToRun is back in its queue at the same position.
+    self.assertEqual(expected, to_run.to_dict())
+    bot_dimensions = {u'id': [u'bot1'], u'pool': [u'default']}
+    self.assertEqual(
+        [expected],
+        _yield_next_available_task_to_dispatch(bot_dimensions, None))
+
+  def test_set_reservation_cache(self):
+    _, to_run = self._gen_new_task_to_run(1)
+    task_to_run.set_reservation_cache('localhost', to_run.key)
+    self.assertEqual(None, task_to_run.pop_reservation_cache('other'))
+    self.assertEqual(
+        to_run.key, task_to_run.pop_reservation_cache('localhost'))
+    # The entry lapses with the reservation.
+    task_to_run.set_reservation_cache('localhost', to_run.key)
+    self.mock_now(self.now, task_to_run.RESERVATION_LEASE_SECS + 1)
+    self.assertEqual(None, task_to_run.pop_reservation_cache('localhost'))
+
+  def test_pop_reservation_cache(self):
+    _, to_run = self._gen_new_task_to_run(1)
+    self.assertEqual(None, task_to_run.pop_reservation_cache('localhost'))
+    task_to_run.set_reservation_cache('localhost', to_run.key)
+    self.assertEqual(
+        to_run.key, task_to_run.pop_reservation_cache('localhost'))
+    # It is only returned once.
+    self.assertEqual(None, task_to_run.pop_reservation_cache('localhost'))
+
+  def test_yield_lapsed_reservations(self):
+    _, to_run_1 = self._gen_new_task_to_run(1)
+    # Never reserved.
+    self._gen_new_task_to_run(0)
+    task_to_run.reserve(to_run_1, 'localhost', self.now)
+    to_run_1.put()
+    self.assertEqual([], list(task_to_run.yield_lapsed_reservations()))
+
+    self.mock_now(self.now, task_to_run.RESERVATION_LEASE_SECS + 1)
+    self.assertEqual(
+        [to_run_1.key],
+        [t.key for t in task_to_run.yield_lapsed_reservations()])
+
+    task_to_run.clear_reservation(to_run_1)
+    to_run_1.put()
+    self.assertEqual([], list(task_to_run.yield_lapsed_reservations()))
+
+  def _mock_clock(self, on_sleep=None):
+    """Mocks time.sleep() to advance utils.time_time() instead.
+
+    Returns the list of the sleep durations.
+    """
+    sleeps = []
+    clock = [utils.time_time()]
+    def sleep(duration):
+      sleeps.append(duration)
+      clock[0] += duration
+      if on_sleep:
+        on_sleep()
+    self.mock(time, 'sleep', sleep)
+    self.mock(utils, 'time_time', lambda: clock[0])
+    return sleeps
+
+  def test_get_wait_keys(self):
+    bot_dimensions = {
+      u'id': [u'localhost'],
+      u'os': [u'Windows-3.1.1'],
+      u'pool': [u'default'],
+    }
+    to_run = self._gen_indexed_task_to_run(1, 50)
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+    self.assertEqual(
+        [str(to_run.queue_number >> 31)],
+        task_to_run.get_wait_keys(bot_dimensions))
+    # A bot without any queue has nothing to wait for.
+    self.assertEqual(None, task_to_run.get_wait_keys({u'id': [u'unknown']}))
+
+  def test_wait_for_new_task(self):
+    bot_dimensions = {
+      u'id': [u'localhost'],
+      u'os': [u'Windows-3.1.1'],
+      u'pool': [u'default'],
+    }
+    self._gen_indexed_task_to_run(1, 50)
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+    keys = task_to_run.get_wait_keys(bot_dimensions)
+
+    # The task already enqueued wakes up a single bot right away.
+    sleeps = self._mock_clock()
+    self.assertEqual(True, task_to_run.wait_for_new_task(keys, 5))
+    self.assertEqual([], sleeps)
+
+    # Nothing is enqueued, it waits for the whole duration.
+    self.assertEqual(False, task_to_run.wait_for_new_task(keys, 5))
+    self.assertEqual([2., 2., 1.], sleeps)
+
+    # A task is enqueued in the bot's queue while waiting.
+    sleeps = self._mock_clock(
+        on_sleep=lambda: self._gen_indexed_task_to_run(0, 10))
+    self.assertEqual(True, task_to_run.wait_for_new_task(keys, 10))
+    self.assertEqual([2.], sleeps)
+
+  def test_wait_for_new_task_max(self):
+    bot_dimensions = {
+      u'id': [u'localhost'],
+      u'os': [u'Windows-3.1.1'],
+      u'pool': [u'default'],
+    }
+    for i in xrange(task_to_run._NOTIFY_MAX + 5):
+      self._gen_indexed_task_to_run(i, 50)
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+    keys = task_to_run.get_wait_keys(bot_dimensions)
+    # The tasks enqueued while no bot was waiting only wake up a bounded number
+    # of bots.
+    sleeps = self._mock_clock()
+    for _ in xrange(task_to_run._NOTIFY_MAX):
+      self.assertEqual(True, task_to_run.wait_for_new_task(keys, 1))
+    self.assertEqual([], sleeps)
+    self.assertEqual(False, task_to_run.wait_for_new_task(keys, 1))
+    self.assertEqual([1.], sleeps)
+
+
+  def test_wait_for_new_task_max_holds(self):
+    bot_dimensions = {
+      u'id': [u'localhost'],
+      u'os': [u'Windows-3.1.1'],
+      u'pool': [u'default'],
+    }
+    self._gen_indexed_task_to_run(1, 50)
+    self.assertEqual(
+        1, len(_yield_next_available_task_to_dispatch(bot_dimensions, None)))
+    keys = task_to_run.get_wait_keys(bot_dimensions)
+    self.mock(task_to_run, '_MAX_HOLDS', 1)
+
+    # Another request is held already, this one isn't.
+    memcache.set(
+        task_to_run._HOLDS_KEY, 1, namespace=task_to_run._HOLDS_NAMESPACE)
+    sleeps = self._mock_clock()
+    self.assertEqual(None, task_to_run.wait_for_new_task(keys, 5))
+    self.assertEqual([], sleeps)
+    self.assertEqual(
+        1,
+        memcache.get(
+            task_to_run._HOLDS_KEY, namespace=task_to_run._HOLDS_NAMESPACE))
+
+    # Once it's released, the request is held and releases its hold.
+    memcache.decr(
+        task_to_run._HOLDS_KEY, namespace=task_to_run._HOLDS_NAMESPACE)
+    self.assertEqual(True, task_to_run.wait_for_new_task(keys, 5))
+    self.assertEqual(False, task_to_run.wait_for_new_task(keys, 5))
+    self.assertEqual([2., 2., 1.], sleeps)
+    self.assertEqual(
+        0,
+        memcache.get(
+            task_to_run._HOLDS_KEY, namespace=task_to_run._HOLDS_NAMESPACE))
+
 
 if __name__ == '__main__':
   if '-v' in sys.argv:
@@ -117,8 +117,10 @@ DEFAULT_SETTINGS = {
     'isolated': {
       'size': 50 * 1024*1024*1024,
       'items': 50*1024,
+      'verify_budget_secs': 30,
     },
   },
+  'long_poll': False,
 }
 
 # Keep in sync with ../../ts_mon_metrics.py
@@ -141,6 +143,14 @@ _hooks_durations = ts_mon.CumulativeDistributionMetric(
     bucketer=_bucketer,
     units=ts_mon.MetricsDataUnits.MILLISECONDS)
 
+_isolated_cache_verified = ts_mon.CounterMetric(
+    'swarming/bots/isolated_cache/verified',
+    'Number of isolated cache items verified while the bot is idle', [
+        ts_mon.StringField('pool'),
+        # 'verified' or 'corrupted'.
+        ts_mon.StringField('result'),
+    ])
+
 
 def _pool_from_dimensions(dimensions):
   """Return a canonical string of flattened dimensions."""
@@ -203,6 +213,9 @@ _EXTRA_BOT_CONFIG = None
 # exception. Restarting the bot will clear the quarantine, which includes
 # updated the bot due to new bot_config or new bot code.
 _QUARANTINED = None
+# True when items were added to the isolated cache since the last complete
+# verification by _verify_cache().
+_CACHE_NEEDS_VERIFICATION = True
 
 
 def _set_quarantined(reason):
@@ -687,14 +700,60 @@ def _clean_cache(botobj):
   failed and it temporarily used more space than _min_free_disk, it can cleans
   up the mess properly.
 
-  It will remove unexpected files, remove corrupted files, trim the cache size
-  based on the policies and update state.json.
+  It will remove unexpected files, trim the cache size based on the policies and
+  update state.json.
   """
+  _run_isolated_clean(botobj, [])
+
+
+def _verify_cache(botobj, max_duration):
+  """Asks run_isolated to verify its cache while the bot is idle.
+
+  Re-hashes the items used since their last verification for up to
+  |max_duration| seconds, capped to 'verify_budget_secs', removing corrupted
+  files. The remaining items are verified on the next idle period.
+
+  The number of items verified and corrupted is reported to ts_mon.
+
+  Returns the number of seconds spent.
+  """
+  global _CACHE_NEEDS_VERIFICATION
+  budget = min(
+      max_duration,
+      _get_settings(botobj)['caches']['isolated'].get('verify_budget_secs', 0))
+  if not _CACHE_NEEDS_VERIFICATION or budget <= 0:
+    return 0
+  start = time.time()
+  result_file = os.path.join(botobj.base_dir, 'verify_cache.json')
+  _run_isolated_clean(
+      botobj, ['--verify-budget', str(budget), '--json', result_file])
+  spent = time.time() - start
+  # Finishing within the budget means nothing was left to verify.
+  if spent < budget:
+    _CACHE_NEEDS_VERIFICATION = False
+  try:
+    result = tools.read_json(result_file)
+    os.remove(result_file)
+  except (IOError, OSError, ValueError) as e:
+    logging.warning('Failed to read the cache verification result: %s', e)
+    return spent
+  logging.info(
+      'Verified %d cache items, %d corrupted',
+      result['verified'], result['corrupted'])
+  flat_dims = _pool_from_dimensions(botobj.dimensions or {})
+  for key in ('verified', 'corrupted'):
+    _isolated_cache_verified.increment_by(
+        result[key], fields={u'pool': flat_dims, u'result': key})
+  return spent
+
+
+def _run_isolated_clean(botobj, args):
+  """Runs run_isolated --clean with |args|."""
   cmd = [
     sys.executable, THIS_FILE, 'run_isolated',
     '--clean',
     '--log-file', os.path.join(botobj.base_dir, 'logs', 'run_isolated.log'),
-  ]
+  ] + args
   cmd.extend(_run_isolated_flags(botobj))
   logging.info('Running: %s', cmd)
   try:
@@ -737,6 +796,27 @@ def _post_error_task(botobj, error, task_id):
   return botobj.remote.post_task_error(task_id, botobj.id, error)
 
 
+def _reserve_next_task(botobj):
+  """Starts a thread asking the server to reserve the next task.
+
+  The server hands out the reserved task on the next poll without searching for
+  one. The request is made while the bot cleans up after the current task.
+
+  Returns:
+    The thread.
+  """
+  def reserve():
+    try:
+      task_id = botobj.remote.reserve(botobj._attributes)
+      logging.info('Reserved next task: %s', task_id)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception('Failed to reserve the next task')
+  thread = threading.Thread(target=reserve, name='reserve')
+  thread.daemon = True
+  thread.start()
+  return thread
+
+
 def _run_manifest(botobj, manifest, start):
   """Defers to task_runner.py.
 
@@ -800,6 +880,7 @@ def _run_manifest(botobj, manifest, start):
   msg = None
   auth_params_dumper = None
   must_reboot = False
+  reserver = None
   # Use 'w' instead of 'work' because path length is precious on Windows.
   work_dir = os.path.join(botobj.base_dir, 'w')
   try:
@@ -903,6 +984,9 @@ def _run_manifest(botobj, manifest, start):
         return False
 
     logging.info('task_runner exit: %d', proc.returncode)
+    if not proc.returncode:
+      # The task is done server side. Get the next one ready while cleaning up.
+      reserver = _reserve_next_task(botobj)
     if os.path.exists(task_result_file):
       with open(task_result_file, 'rb') as fd:
         task_result = json.load(fd)
@@ -945,6 +1029,9 @@ def _run_manifest(botobj, manifest, start):
       except Exception as e:
         botobj.post_error(
             'Failed to delete work directory %s: %s' % (work_dir, e))
+    if reserver:
+      # Make sure the reservation is done before the next poll.
+      reserver.join()
     if must_reboot:
       botobj.host_reboot('Working around STATUS_DLL_INIT_FAILED by task_runner')
 
@@ -1129,15 +1216,57 @@ def _do_handshake(botobj, quit_bit):
     sleep_time = min(300, sleep_time * 2)
 
 
+def _long_poll(botobj, quit_bit):
+  """Polls the server with long_poll in a thread, so quit_bit is still noticed
+  while the server holds the request.
+
+  Returns None only if quit_bit was set before the server replied.
+
+  Raises:
+    PollError like remote.poll(), or any other exception raised while polling.
+  """
+  result = []
+  def run():
+    try:
+      result.append(
+          (botobj.remote.poll(botobj._attributes, long_poll=True), None))
+    except Exception:
+      result.append((None, sys.exc_info()))
+  thread = threading.Thread(target=run, name='poll')
+  thread.daemon = True
+  thread.start()
+  while thread.is_alive() and not quit_bit.is_set():
+    thread.join(1)
+  if result:
+    resp, exc_info = result[0]
+    if exc_info:
+      # Keep the traceback of the poll thread.
+      raise exc_info[0], exc_info[1], exc_info[2]
+    return resp
+  # run() catches every Exception, so without a result the server still holds
+  # the poll and quit_bit is set. A task reaped meanwhile is abandoned; the
+  # server retries it once it times out.
+  assert quit_bit.is_set()
+  logging.info('Abandoning the poll to quit')
+  return None
+
+
 def _poll_server(botobj, quit_bit, last_action):
   """Polls the server to run one loop.
 
   Returns True if executed some action, False if server asked the bot to sleep.
   """
+  global _CACHE_NEEDS_VERIFICATION
   start = time.time()
   cmd = None
   try:
-    cmd, value = botobj.remote.poll(botobj._attributes)
+    if _get_settings(botobj)['long_poll']:
+      resp = _long_poll(botobj, quit_bit)
+      if not resp:
+        return False
+      cmd, value = resp
+    else:
+      cmd, value = botobj.remote.poll(botobj._attributes)
   except remote_client_errors.PollError as e:
     # Back off on failure.
     delay = max(1, min(60, botobj.state.get(u'sleep_streak', 10) * 2))
@@ -1154,6 +1283,8 @@ def _poll_server(botobj, quit_bit, last_action):
     _call_hook_safe(
         True, botobj, 'on_bot_idle', max(0, time.time() - last_action))
     _maybe_update_lkgbc(botobj)
+    # Use the idle time to verify the cache.
+    value = max(0, value - _verify_cache(botobj, value))
     try:
       # Sometimes throw with "[Errno 4] Interrupted function call", especially
       # on Windows upon system shutdown.
@@ -1183,6 +1314,7 @@ def _poll_server(botobj, quit_bit, last_action):
       _update_lkgbc(botobj)
     # Clean up cache after a task
     _clean_cache(botobj)
+    _CACHE_NEEDS_VERIFICATION = True
     # TODO(maruel): Handle the case where quit_bit.is_set() happens here. This
     # is concerning as this means a signal (often SIGTERM) was received while
     # running the task. Make sure the host is properly restarting.
@@ -24,6 +24,7 @@ import net_utils
 
 import bot_main
 import remote_client
+import remote_client_errors
 from api import bot
 from api import os_utilities
 from api.platforms import gce
@@ -113,6 +114,9 @@ class TestBotMain(TestBotBase):
         os.path.join(test_env_bot_code.BOT_DIR, 'swarming_bot.zip'))
     # Need to disable this otherwise it'd kill the current checkout.
     self.mock(bot_main, '_cleanup_bot_directory', lambda _: None)
+    self.reserved = []
+    self._reserve_next_task_orig = self.mock(
+        bot_main, '_reserve_next_task', self.reserved.append)
     # Test results shouldn't depend on where they run. And they should not use
     # real GCE tokens.
     self.mock(gce, 'is_gce', lambda: False)
@@ -123,6 +127,7 @@ class TestBotMain(TestBotBase):
     self.mock(bot_main, '_BOT_CONFIG', None)
     self.mock(bot_main, '_EXTRA_BOT_CONFIG', None)
     self.mock(bot_main, '_QUARANTINED', None)
+    self.mock(bot_main, '_CACHE_NEEDS_VERIFICATION', False)
     self.mock(bot_main, 'SINGLETON', None)
 
   def print_err_and_fail(self, _bot, msg, _task_id):
@@ -592,6 +597,127 @@ class TestBotMain(TestBotBase):
     self.assertEqual([1.24], slept)
     self.assertEqual([1], called)
 
+  def test_poll_server_long_poll(self):
+    slept = []
+    bit = threading.Event()
+    self.mock(bit, 'wait', slept.append)
+    self.mock(bot_main, '_run_manifest', self.fail)
+    self.mock(bot_main, '_update_bot', self.fail)
+    from config import bot_config
+    self.mock(bot_config, 'get_settings', lambda _bot: {'long_poll': True})
+
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/swarming/api/v1/bot/poll?long_poll=1',
+            {
+              'data': self.attributes,
+              'follow_redirects': False,
+              'headers': {'Cookie': 'GOOGAPPUID=42'},
+              'timeout': remote_client.NET_CONNECTION_TIMEOUT_SEC,
+            },
+            {
+              'cmd': 'sleep',
+              'duration': 1.24,
+            },
+          ),
+        ])
+    self.assertFalse(bot_main._poll_server(self.bot, bit, 2))
+    self.assertEqual([1.24], slept)
+
+  def test_poll_server_long_poll_quit(self):
+    # The bot doesn't wait for the server to reply to quit.
+    bit = threading.Event()
+    self.mock(bot_main, '_run_manifest', self.fail)
+    self.mock(bot_main, '_update_bot', self.fail)
+    from config import bot_config
+    self.mock(bot_config, 'get_settings', lambda _bot: {'long_poll': True})
+    held = threading.Event()
+    def poll(attributes, long_poll):
+      self.assertEqual(self.attributes, attributes)
+      self.assertEqual(True, long_poll)
+      bit.set()
+      held.wait()
+      return 'sleep', 1
+    self.mock(self.bot.remote, 'poll', poll)
+    try:
+      self.assertFalse(bot_main._poll_server(self.bot, bit, 2))
+    finally:
+      held.set()
+
+  def test_poll_server_long_poll_error(self):
+    # A PollError raised in the poll thread is handled like a regular poll.
+    slept = []
+    bit = threading.Event()
+    self.mock(bit, 'wait', slept.append)
+    self.mock(bot_main, '_run_manifest', self.fail)
+    self.mock(bot_main, '_update_bot', self.fail)
+    from config import bot_config
+    self.mock(bot_config, 'get_settings', lambda _bot: {'long_poll': True})
+    def poll(_attributes, long_poll):
+      self.assertEqual(True, long_poll)
+      raise remote_client_errors.PollError('oops')
+    self.mock(self.bot.remote, 'poll', poll)
+    self.assertFalse(bot_main._poll_server(self.bot, bit, 2))
+    self.assertEqual(1, len(slept))
+
+  def test_poll_server_long_poll_exception(self):
+    # Any other exception raised in the poll thread is raised to the caller,
+    # the poll is not silently dropped.
+    bit = threading.Event()
+    self.mock(bot_main, '_run_manifest', self.fail)
+    self.mock(bot_main, '_update_bot', self.fail)
+    from config import bot_config
+    self.mock(bot_config, 'get_settings', lambda _bot: {'long_poll': True})
+    def poll(_attributes, long_poll):
+      self.assertEqual(True, long_poll)
+      raise KeyError('cmd')
+    self.mock(self.bot.remote, 'poll', poll)
+    with self.assertRaises(KeyError):
+      bot_main._poll_server(self.bot, bit, 2)
+    self.assertFalse(bit.is_set())
+
+  def test_poll_server_sleep_verify_cache(self):
+    slept = []
+    bit = threading.Event()
+    self.mock(bit, 'wait', slept.append)
+    now = [100.]
+    self.mock(time, 'time', lambda: now[0])
+    cleaned = []
+    result_file = os.path.join(self.bot.base_dir, 'verify_cache.json')
+    def run_isolated_clean(botobj, args):
+      self.assertEqual(self.bot, botobj)
+      cleaned.append(args)
+      now[0] += 1.
+      with open(result_file, 'wb') as f:
+        json.dump({'corrupted': 1, 'verified': 3}, f)
+    self.mock(bot_main, '_run_isolated_clean', run_isolated_clean)
+    self.mock(bot_main, '_CACHE_NEEDS_VERIFICATION', True)
+    self.mock(self.bot.remote, 'poll', lambda _attributes: ('sleep', 1.5))
+    def get_count(result):
+      fields = {
+        u'pool': bot_main._pool_from_dimensions(self.bot.dimensions),
+        u'result': result,
+      }
+      return bot_main._isolated_cache_verified.get(fields=fields) or 0
+    verified = get_count('verified')
+    corrupted = get_count('corrupted')
+
+    # The verification is done in the sleep time.
+    self.assertFalse(bot_main._poll_server(self.bot, bit, 2))
+    expected = [['--verify-budget', '1.5', '--json', result_file]]
+    self.assertEqual(expected, cleaned)
+    self.assertEqual([.5], slept)
+    self.assertFalse(os.path.exists(result_file))
+    # The results are reported to ts_mon.
+    self.assertEqual(verified + 3, get_count('verified'))
+    self.assertEqual(corrupted + 1, get_count('corrupted'))
+    # It finished within the budget, so there's nothing left to verify.
+    self.assertFalse(bot_main._CACHE_NEEDS_VERIFICATION)
+    self.assertFalse(bot_main._poll_server(self.bot, bit, 2))
+    self.assertEqual(expected, cleaned)
+    self.assertEqual([.5, 1.5], slept)
+
   def test_poll_server_sleep_with_auth(self):
     slept = []
     bit = threading.Event()
@@ -652,6 +778,7 @@ class TestBotMain(TestBotBase):
     expected = [(self.bot,)]
     self.assertEqual(expected, clean)
     self.assertEqual(None, self.bot.bot_restart_msg())
+    self.assertTrue(bot_main._CACHE_NEEDS_VERIFICATION)
 
   def test_poll_server_update(self):
     update = []
@@ -792,6 +919,22 @@ class TestBotMain(TestBotBase):
     self.mock(subprocess42, 'Popen', Popen)
     return result
 
+  def test_reserve_next_task(self):
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/swarming/api/v1/bot/reserve',
+            {
+              'data': self.bot._attributes,
+              'follow_redirects': False,
+              'headers': {'Cookie': 'GOOGAPPUID=42'},
+              'timeout': remote_client.NET_CONNECTION_TIMEOUT_SEC,
+            },
+            {'task_id': '24'},
+          ),
+        ])
+    self._reserve_next_task_orig(self.bot).join()
+
   def test_run_manifest(self):
     self.mock(bot_main, '_post_error_task', self.print_err_and_fail)
     def call_hook(botobj, name, *args):
@@ -815,6 +958,7 @@ class TestBotMain(TestBotBase):
     }
     self.assertEqual(self.root_dir, self.bot.base_dir)
     bot_main._run_manifest(self.bot, manifest, time.time())
+    self.assertEqual([self.bot], self.reserved)
 
   def test_run_manifest_with_auth_headers(self):
     self.bot = self.make_bot(
@@ -903,6 +1047,8 @@ class TestBotMain(TestBotBase):
     bot_main._run_manifest(self.bot, manifest, time.time())
     expected = [(self.bot, 'Execution failed: internal error (1).', '24')]
     self.assertEqual(expected, posted)
+    # The bot may not be in a good state to run another task.
+    self.assertEqual([], self.reserved)
 
   def test_run_manifest_exception(self):
     posted = []
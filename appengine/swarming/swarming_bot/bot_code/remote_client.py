@@ -300,16 +300,23 @@ class RemoteClientNative(object):
         '/swarming/api/v1/bot/handshake',
         data=attributes)
 
-  def poll(self, attributes):
+  def poll(self, attributes, long_poll=False):
     """Polls for new work or other commands; returns a (cmd, value) pair as
     shown below.
 
+    With long_poll, the server holds the request for a while when there's no
+    task, see handlers_bot.BotPollHandler. Older servers ignore it and reply
+    right away.
+
     Raises:
       PollError if can't contact the server after many attempts, the server
       replies with an error or the returned dict does not have the correct
       values set.
     """
-    resp = self._url_read_json('/swarming/api/v1/bot/poll', data=attributes)
+    url = '/swarming/api/v1/bot/poll'
+    if long_poll:
+      url += '?long_poll=1'
+    resp = self._url_read_json(url, data=attributes)
     if not resp or resp.get('error'):
       raise PollError(
           resp.get('error') if resp else 'Failed to contact server')
@@ -329,6 +336,15 @@ class RemoteClientNative(object):
       return (cmd, resp['message'])
     raise PollError('Unexpected command: %s\n%s' % (cmd, resp))
 
+  def reserve(self, attributes):
+    """Asks the server to reserve the next task, to be returned by the next
+    poll.
+
+    Returns the id of the task reserved, or None.
+    """
+    resp = self._url_read_json('/swarming/api/v1/bot/reserve', data=attributes)
+    return resp.get('task_id') if resp else None
+
   def get_bot_code(self, new_zip_path, bot_version, bot_id):
     """Downloads code into the file specified by new_zip_fn (a string).
 
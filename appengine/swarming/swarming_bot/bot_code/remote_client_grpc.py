@@ -110,7 +110,9 @@ class RemoteClientGrpc(object):
     logging.info('Completed handshake: %s', resp)
     return copy.deepcopy(resp)
 
-  def poll(self, attributes):
+  def poll(self, attributes, long_poll=False):
+    # long_poll is not supported, the request is never held.
+    del long_poll
     logging.info('poll(%s)', attributes)
     if self._session:
       if len(self._session.leases) == 1:
@@ -179,6 +181,10 @@ class RemoteClientGrpc(object):
 
     return self._process_lease(new_lease)
 
+  def reserve(self, _attributes):
+    # Not supported by the Bots API.
+    return None
+
   def post_bot_event(self, event_type, message, _attributes):
     """Logs bot-specific info to the server"""
     logging.info('post_bot_event(%s, %s)', event_type, message)
@@ -1080,6 +1080,8 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
       self.assertLess(0, kwargs['data'].pop('duration'))
       self.assertLess(
           0., kwargs['data']['isolated_stats']['download'].pop('duration'))
+      self.assertLessEqual(
+          0., kwargs['data']['isolated_stats']['download'].pop('time_to_exec'))
       # duration==0 can happen on Windows when the clock is in the default
       # resolution, 15.6ms.
       self.assertLessEqual(
@@ -1097,6 +1099,7 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
               'io_timeout': False,
               'isolated_stats': {
                 u'download': {
+                  u'bytes_fetched': 466,
                   u'initial_number_items': 0,
                   u'initial_size': 0,
                   u'items_cold': [10, 86, 94, 276],
@@ -1196,6 +1199,8 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
       self.assertLess(0., kwargs['data'].pop('bot_overhead'))
       self.assertLess(
           0., kwargs['data']['isolated_stats']['download'].pop('duration'))
+      self.assertLessEqual(
+          0., kwargs['data']['isolated_stats']['download'].pop('time_to_exec'))
       self.assertLess(
           0., kwargs['data']['isolated_stats']['upload'].pop('duration'))
       # Makes the diffing easier.
@@ -1220,6 +1225,7 @@ class TestTaskRunnerNoTimeMock(TestTaskRunnerBase):
               'io_timeout': True,
               'isolated_stats': {
                 u'download': {
+                  u'bytes_fetched': 886,
                   u'initial_number_items': 0,
                   u'initial_size': 0,
                   u'items_cold': [144, 150, 285, 307],
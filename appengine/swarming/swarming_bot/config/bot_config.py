@@ -120,8 +120,19 @@ def get_settings(bot):
         'size': 50 * 1024*1024*1024,
         # Maximum number of items in the local isolated cache.
         'items': 50*1024,
+        # Maximum number of seconds spent hashing the items used since their
+        # last verification, to evict corrupted ones. It only runs while the
+        # bot is idle, within the sleep duration given by the server. 0 to
+        # disable.
+        'verify_budget_secs': 30,
       },
     },
+    # Ask the server to hold the poll requests for a while when there's no
+    # task, so a task triggered meanwhile starts right away instead of after
+    # the bot's sleep. It is off by default as each waiting bot keeps a request
+    # open on the server. The server caps the number of requests held at once;
+    # past it, the bot sleeps as usual.
+    'long_poll': False,
   }
 
 
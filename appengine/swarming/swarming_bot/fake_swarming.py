@@ -48,7 +48,7 @@ class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
     if self.path == '/swarming/api/v1/bot/handshake':
       return self._send_json({'xsrf_token': 'fine'})
 
-    if self.path == '/swarming/api/v1/bot/poll':
+    if self.path.split('?', 1)[0] == '/swarming/api/v1/bot/poll':
       self.server.server.has_polled.set()
       return self._send_json({'cmd': 'sleep', 'duration': 60})
 
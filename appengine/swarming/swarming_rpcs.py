@@ -77,6 +77,8 @@ class ServerDetails(messages.Message):
   luci_config = messages.StringField(5)
   default_isolate_server = messages.StringField(6)
   default_isolate_namespace = messages.StringField(7)
+  # True if tasks.new_batch is supported.
+  new_batch = messages.BooleanField(8)
 
 
 class BootstrapToken(messages.Message):
@@ -355,6 +357,11 @@ class NewTaskRequest(messages.Message):
   evaluate_only = messages.BooleanField(13)
 
 
+class NewTaskRequests(messages.Message):
+  """Wraps a list of NewTaskRequest, to create them all at once."""
+  requests = messages.MessageField(NewTaskRequest, 1, repeated=True)
+
+
 class TaskRequest(messages.Message):
   """Description of a task request as registered by the server.
 
@@ -556,6 +563,14 @@ class TaskRequestMetadata(messages.Message):
   task_id = messages.StringField(2)
   # Set to finished task result in case task was deduplicated.
   task_result = messages.MessageField(TaskResult, 3)
+  # Set by tasks.new_batch instead of the other fields when this task couldn't
+  # be created. It can be retried.
+  error = messages.StringField(4)
+
+
+class TaskRequestMetadataList(messages.Message):
+  """Wraps a list of TaskRequestMetadata."""
+  items = messages.MessageField(TaskRequestMetadata, 1, repeated=True)
 
 
 ### Task queues
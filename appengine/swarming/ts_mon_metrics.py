@@ -99,6 +99,25 @@ _jobs_requested = gae_ts_mon.CounterMetric(
     ])
 
 
+# Swarming-specific metric. Metric fields:
+# - project_id: e.g. 'chromium'
+# - subproject_id: e.g. 'blink'. Set to empty string if not used.
+# - pool: e.g. 'Chrome'
+# - spec_name: name of a job specification, e.g. '<master>:<builder>'
+#     for buildbot jobs.
+# - hit: boolean describing whether a previous result could be reused.
+# The dedup hit rate is the ratio of hit=True.
+_tasks_dedup_lookups = gae_ts_mon.CounterMetric(
+    'swarming/tasks/dedup_lookups',
+    'Number of lookups for a previous result of an idempotent task.', [
+        gae_ts_mon.StringField('spec_name'),
+        gae_ts_mon.StringField('project_id'),
+        gae_ts_mon.StringField('subproject_id'),
+        gae_ts_mon.StringField('pool'),
+        gae_ts_mon.BooleanField('hit'),
+    ])
+
+
 # Swarming-specific metric. Metric fields:
 # - project_id: e.g. 'chromium'
 # - subproject_id: e.g. 'blink'. Set to empty string if not used.
@@ -123,6 +142,21 @@ _task_bots_runnable = gae_ts_mon.CumulativeDistributionMetric(
 )
 
 
+# Swarming-specific metric. Metric fields:
+# - pool: e.g. 'Chrome'
+# - result: 'task' if the bot got a task once woken up, 'woken' if it didn't,
+#     'timeout' if nothing was enqueued for the bot while held, 'skipped' if
+#     the request wasn't held since too many requests were held already.
+# Its count and durations give the number of requests held at any time.
+_bot_poll_holds = gae_ts_mon.CumulativeDistributionMetric(
+    'swarming/bots/poll_holds',
+    'Durations of the bot polls held waiting for a task, in seconds.', [
+        gae_ts_mon.StringField('pool'),
+        gae_ts_mon.StringField('result'),
+    ],
+    bucketer=_bucketer)
+
+
 # Global metric. Metric fields:
 # - project_id: e.g. 'chromium'
 # - subproject_id: e.g. 'blink'. Set to empty string if not used.
@@ -478,6 +512,13 @@ def on_task_requested(summary, deduped):
   _jobs_requested.increment(fields=fields)
 
 
+def on_dedup_lookup(summary, hit):
+  """When a previous result is looked up for an idempotent task."""
+  fields = _extract_job_fields(summary.tags)
+  fields['hit'] = hit
+  _tasks_dedup_lookups.increment(fields=fields)
+
+
 def on_task_completed(summary):
   """When a task is stopped from being processed."""
   fields = _extract_job_fields(summary.tags)
@@ -496,6 +537,15 @@ def on_task_completed(summary):
     _jobs_durations.add(summary.duration, fields=fields)
 
 
+def on_bot_poll_held(bot_dimensions, seconds, result):
+  """When a bot poll was held waiting for a task."""
+  fields = {
+    'pool': u'|'.join(bot_dimensions.get(u'pool', [])),
+    'result': result,
+  }
+  _bot_poll_holds.add(seconds, fields=fields)
+
+
 def on_machine_connected_time(seconds, fields):
   _machine_types_connection_time.add(seconds, fields=fields)
 
@@ -158,6 +158,41 @@ class TestMetrics(test_case.TestCase):
     ts_mon_metrics.on_task_requested(summary, deduped=False)
     self.assertEqual(1, ts_mon_metrics._jobs_requested.get(fields=fields))
 
+  def test_on_dedup_lookup(self):
+    tags = [
+        'project:test_project',
+        'subproject:test_subproject',
+        'pool:test_pool',
+        'spec_name:my:custom:test:spec:name',
+    ]
+    fields = {
+        'project_id': 'test_project',
+        'subproject_id': 'test_subproject',
+        'pool': 'test_pool',
+        'spec_name': 'my:custom:test:spec:name',
+        'hit': True,
+    }
+    summary = _gen_task_result_summary(self.now, 1, tags=tags)
+    self.assertIsNone(ts_mon_metrics._tasks_dedup_lookups.get(fields=fields))
+    ts_mon_metrics.on_dedup_lookup(summary, hit=True)
+    ts_mon_metrics.on_dedup_lookup(summary, hit=True)
+    self.assertEqual(
+        2, ts_mon_metrics._tasks_dedup_lookups.get(fields=fields))
+    fields['hit'] = False
+    self.assertIsNone(ts_mon_metrics._tasks_dedup_lookups.get(fields=fields))
+
+  def test_on_bot_poll_held(self):
+    fields = {'pool': 'default', 'result': 'timeout'}
+    self.assertIsNone(ts_mon_metrics._bot_poll_holds.get(fields=fields))
+    ts_mon_metrics.on_bot_poll_held(
+        {u'id': [u'bot1'], u'pool': [u'default']}, 20., 'timeout')
+    ts_mon_metrics.on_bot_poll_held(
+        {u'id': [u'bot2'], u'pool': [u'default']}, 20., 'timeout')
+    self.assertEqual(
+        2, ts_mon_metrics._bot_poll_holds.get(fields=fields).count)
+    fields['result'] = 'task'
+    self.assertIsNone(ts_mon_metrics._bot_poll_holds.get(fields=fields))
+
   def test_on_task_requested_experimental(self):
     tags = [
         'project:test_project',
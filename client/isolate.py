@@ -373,7 +373,8 @@ class SavedState(Flattenable):
     """
     def strip(data):
       """Returns a 'files' entry with only the whitelisted keys."""
-      return dict((k, data[k]) for k in ('h', 'l', 'm', 's') if k in data)
+      return dict(
+          (k, data[k]) for k in ('c', 'h', 'l', 'm', 's') if k in data)
 
     out = {
       'algo': isolated_format.SUPPORTED_ALGOS_REVERSE[self.algo],
@@ -570,12 +571,18 @@ class CompleteState(object):
     self.saved_state.update_isolated(command, infiles, read_only, relative_cwd)
     logging.debug(self)
 
-  def files_to_metadata(self, subdir, collapse_symlinks):
+  def files_to_metadata(
+      self, subdir, collapse_symlinks, digest_cache=None, chunked=False):
     """Updates self.saved_state.files with the files' mode and hash.
 
     If |subdir| is specified, filters to a subdirectory. The resulting .isolated
     file is tainted.
 
+    If |digest_cache| is specified, it is used for files that are not already
+    hashed in the saved state.
+
+    If |chunked| is True, large files also list their content-defined chunks.
+
     See isolated_format.file_to_metadata() for more information.
     """
     for infile in sorted(self.saved_state.files):
@@ -588,7 +595,9 @@ class CompleteState(object):
             self.saved_state.files[infile],
             self.saved_state.read_only,
             self.saved_state.algo,
-            collapse_symlinks)
+            collapse_symlinks,
+            digest_cache,
+            chunked)
 
   def save_files(self):
     """Saves self.saved_state and creates a .isolated file."""
@@ -623,7 +632,8 @@ class CompleteState(object):
     return out
 
 
-def load_complete_state(options, cwd, subdir, skip_update):
+def load_complete_state(
+    options, cwd, subdir, skip_update, digest_cache_dir=None, namespace=None):
   """Loads a CompleteState.
 
   This includes data from .isolate and .isolated.state files. Never reads the
@@ -638,6 +648,10 @@ def load_complete_state(options, cwd, subdir, skip_update):
             to CompleteState.root_dir.
     skip_update: Skip trying to load the .isolate file and processing the
                  dependencies. It is useful when not needed, like when tracing.
+    digest_cache_dir: digest cache directory to use when options.digest_cache
+                      is not set.
+    namespace: namespace the tree is archived to, if any. Large files list
+               their chunks in a chunked namespace.
   """
   assert not options.isolate or os.path.isabs(options.isolate)
   assert not options.isolated or os.path.isabs(options.isolated)
@@ -698,7 +712,16 @@ def load_complete_state(options, cwd, subdir, skip_update):
     subdir = subdir.replace('/', os.path.sep)
 
   if not skip_update:
-    complete_state.files_to_metadata(subdir, options.collapse_symlinks)
+    digest_cache = None
+    digest_cache_dir = options.digest_cache or digest_cache_dir
+    if digest_cache_dir:
+      digest_cache = isolated_format.DigestCache(
+          digest_cache_dir, complete_state.saved_state.algo)
+    complete_state.files_to_metadata(
+        subdir, options.collapse_symlinks, digest_cache,
+        isolated_format.is_namespace_with_chunking(namespace or ''))
+    if digest_cache is not None:
+      digest_cache.save()
   return complete_state
 
 
@@ -734,10 +757,10 @@ def create_isolate_tree(outdir, root_dir, files, relative_cwd, read_only):
 
 
 @tools.profile
-def prepare_for_archival(options, cwd):
+def prepare_for_archival(options, cwd, namespace, digest_cache_dir=None):
   """Loads the isolated file and create 'infiles' for archival."""
   complete_state = load_complete_state(
-      options, cwd, options.subdir, False)
+      options, cwd, options.subdir, False, digest_cache_dir, namespace)
   # Make sure that complete_state isn't modified until save_files() is
   # called, because any changes made to it here will propagate to the files
   # created (which is probably not intended).
@@ -767,7 +790,8 @@ def prepare_for_archival(options, cwd):
   return complete_state, infiles, isolated_hash
 
 
-def isolate_and_archive(trees, isolate_server, namespace):
+def isolate_and_archive(
+    trees, isolate_server, namespace, digest_cache_dir=None):
   """Isolates and uploads a bunch of isolated trees.
 
   Args:
@@ -775,6 +799,8 @@ def isolate_and_archive(trees, isolate_server, namespace):
         to isolate. Options are processed by 'process_isolate_options'.
     isolate_server: URL of Isolate Server to upload to.
     namespace: namespace to upload to.
+    digest_cache_dir: digest cache directory for the trees that don't specify
+        their own. The digests found on the server are also cached there.
 
   Returns a dict {target name -> isolate hash or None}, where target name is
   a name of *.isolated file without an extension (e.g. 'base_unittests').
@@ -804,7 +830,8 @@ def isolate_and_archive(trees, isolate_server, namespace):
     for opts, cwd in trees:
       target_name = os.path.splitext(os.path.basename(opts.isolated))[0]
       try:
-        complete_state, files, isolated_hash = prepare_for_archival(opts, cwd)
+        complete_state, files, isolated_hash = prepare_for_archival(
+            opts, cwd, namespace, digest_cache_dir)
         files_generators.append(emit_files(complete_state.root_dir, files))
         isolated_hashes[target_name] = isolated_hash[0]
         print('%s  %s' % (isolated_hash[0], target_name))
@@ -822,7 +849,8 @@ def isolate_and_archive(trees, isolate_server, namespace):
       isolateserver.upload_tree(
           base_url=isolate_server,
           infiles=itertools.chain(*files_generators),
-          namespace=namespace)
+          namespace=namespace,
+          presence_cache_dir=digest_cache_dir)
     except Exception:
       logging.exception('Exception while uploading files')
       return None
@@ -867,7 +895,8 @@ def CMDarchive(parser, args):
   result = isolate_and_archive(
       [(options, unicode(os.getcwd()))],
       options.isolate_server,
-      options.namespace)
+      options.namespace,
+      options.digest_cache)
   if result is None:
     return EXIT_CODE_UPLOAD_ERROR
   assert len(result) == 1, result
@@ -926,8 +955,11 @@ def CMDbatcharchive(parser, args):
     work_units.append((parse_archive_command_line(args, cwd), cwd))
 
   # Perform the archival, all at once.
+  digest_cache_dir = None
+  if options.digest_cache:
+    digest_cache_dir = os.path.abspath(unicode(options.digest_cache))
   isolated_hashes = isolate_and_archive(
-      work_units, options.isolate_server, options.namespace)
+      work_units, options.isolate_server, options.namespace, digest_cache_dir)
 
   # TODO(vadimsh): isolate_and_archive returns None on upload failure, there's
   # no way currently to figure out what *.isolated file from a batch were
@@ -1213,6 +1245,11 @@ def process_isolate_options(parser, options, cwd=None, require_isolated=True):
     options.isolate = os.path.abspath(os.path.join(cwd, options.isolate))
     options.isolate = file_path.get_native_path_case(options.isolate)
 
+  # Normalize the path in --digest-cache.
+  if options.digest_cache:
+    options.digest_cache = os.path.abspath(
+        os.path.join(cwd, unicode(options.digest_cache)))
+
 
 def main(argv):
   dispatcher = subcommand.CommandDispatcher(__name__)
@@ -13,9 +13,9 @@ import re
 import sys
 import threading
 import time
-import types
 import uuid
 
+from utils import compression
 from utils import file_path
 from utils import net
 
@@ -133,6 +133,19 @@ class StorageApi(object):
     """
     raise NotImplementedError()
 
+  def flatten(self, digest):
+    """Expands a .isolated file and all its includes in a single call.
+
+    Arguments:
+      digest: hash digest of the root .isolated file.
+
+    Returns:
+      dict with the merged 'files' (path -> properties as in a .isolated file),
+      'command', 'read_only', 'relative_cwd' and the 'isolated' digests, or None
+      if the storage doesn't support it.
+    """
+    return None
+
   def push(self, item, push_state, content=None):
     """Uploads an |item| with content generated by |content| generator.
 
@@ -209,17 +222,10 @@ def guard_memory_use(server, content, size):
     with server._lock:
       server._memory_use += size
   else:
-    # TODO(vadimsh): Do not read from |content| generator when retrying push.
-    # If |content| is indeed a generator, it can not be re-winded back to the
-    # beginning of the stream. A retry will find it exhausted. A possible
-    # solution is to wrap |content| generator with some sort of caching
-    # restartable generator. It should be done alongside streaming support
-    # implementation.
-    #
-    # In theory, we should keep the generator, so that it is not serialized in
-    # memory. Sadly net.HttpService.request() requires the body to be
-    # serialized.
-    assert isinstance(content, types.GeneratorType), repr(content)
+    # |content| is generated lazily. It is only fully serialized in memory for
+    # inline uploads, since net.HttpService.request() requires a JSON body to be
+    # serialized. Uploads to Google Storage are streamed and do not go through
+    # this function.
     slept = False
     # HACK HACK HACK. Please forgive me for my sins but OMG, it works!
     # One byte less than 512mb. This is to cope with incompressible content.
@@ -243,6 +249,39 @@ def guard_memory_use(server, content, size):
       logging.info('Unblocked: %d %d', memory_use, size)
 
 
+def _check_content_range(connection, offset):
+  """Verifies the server respected the requested |offset|.
+
+  Raises IOError if the Content-Range header is missing or doesn't cover the
+  whole tail of the file starting at |offset|.
+  """
+  content_range = connection.get_header('Content-Range')
+  if not content_range:
+    raise IOError('Missing Content-Range header')
+
+  # 'Content-Range' format is 'bytes <offset>-<last_byte_index>/<size>'.
+  # According to a spec, <size> can be '*' meaning "Total size of the file
+  # is not known in advance".
+  try:
+    match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', content_range)
+    if not match:
+      raise ValueError()
+    content_offset = int(match.group(1))
+    last_byte_index = int(match.group(2))
+    size = None if match.group(3) == '*' else int(match.group(3))
+  except ValueError:
+    raise IOError('Invalid Content-Range header: %s' % content_range)
+
+  # Ensure returned offset equals requested one.
+  if offset != content_offset:
+    raise IOError('Expecting offset %d, got %d (Content-Range is %s)' % (
+        offset, content_offset, content_range))
+
+  # Ensure entire tail of the file is returned.
+  if size is not None and last_byte_index + 1 != size:
+    raise IOError('Incomplete response. Content-Range: %s' % content_range)
+
+
 class IsolateServer(StorageApi):
   """StorageApi implementation that downloads and uploads to Isolate Server.
 
@@ -256,15 +295,17 @@ class IsolateServer(StorageApi):
     self._base_url = base_url.rstrip('/')
     self._namespace = namespace
     algo = isolated_format.get_hash_algo(namespace)
+    codec = compression.get_codec(namespace)
     self._namespace_dict = {
-        'compression': 'flate' if namespace.endswith(
-            ('-gzip', '-flate')) else '',
+        'compression': codec.name if codec else '',
         'digest_hash': isolated_format.SUPPORTED_ALGOS_REVERSE[algo],
         'namespace': namespace,
     }
     self._lock = threading.Lock()
     self._server_caps = None
     self._memory_use = 0
+    # Signed GS URLs returned by flatten(): digest -> url.
+    self._gs_urls = {}
 
   @property
   def _server_capabilities(self):
@@ -296,6 +337,27 @@ class IsolateServer(StorageApi):
 
   def fetch(self, digest, _size, offset):
     assert offset >= 0
+    with self._lock:
+      url = self._gs_urls.pop(digest, None)
+    if url:
+      connection = net.url_open(
+          url,
+          headers={'Range': 'bytes=%d-' % offset} if offset else None,
+          read_timeout=DOWNLOAD_READ_TIMEOUT)
+      if connection:
+        if offset:
+          _check_content_range(connection, offset)
+        for data in connection.iter_content(NET_IO_FILE_CHUNK):
+          yield data
+        return
+      # The URL may have expired, use the regular path.
+      logging.warning('Failed to download %s from GS', digest)
+
+    if (self._server_capabilities or {}).get('raw_retrieve'):
+      for data in self._fetch_raw(digest, offset):
+        yield data
+      return
+
     source_url = '%s/_ah/api/isolateservice/v1/retrieve' % (
         self._base_url)
     logging.debug('download_file(%s, %d)', source_url, offset)
@@ -323,35 +385,66 @@ class IsolateServer(StorageApi):
 
     # If |offset|, verify server respects it by checking Content-Range.
     if offset:
-      content_range = connection.get_header('Content-Range')
-      if not content_range:
-        raise IOError('Missing Content-Range header')
+      _check_content_range(connection, offset)
 
-      # 'Content-Range' format is 'bytes <offset>-<last_byte_index>/<size>'.
-      # According to a spec, <size> can be '*' meaning "Total size of the file
-      # is not known in advance".
-      try:
-        match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', content_range)
-        if not match:
-          raise ValueError()
-        content_offset = int(match.group(1))
-        last_byte_index = int(match.group(2))
-        size = None if match.group(3) == '*' else int(match.group(3))
-      except ValueError:
-        raise IOError('Invalid Content-Range header: %s' % content_range)
-
-      # Ensure returned offset equals requested one.
-      if offset != content_offset:
-        raise IOError('Expecting offset %d, got %d (Content-Range is %s)' % (
-            offset, content_offset, content_range))
-
-      # Ensure entire tail of the file is returned.
-      if size is not None and last_byte_index + 1 != size:
-        raise IOError('Incomplete response. Content-Range: %s' % content_range)
+    for data in connection.iter_content(NET_IO_FILE_CHUNK):
+      yield data
+
+  def _fetch_raw(self, digest, offset):
+    """Fetches the raw content, without the base64 and JSON encoding.
 
+    The server redirects to GS for content stored there, the Range header
+    follows the redirect.
+    """
+    source_url = '%s/isolate/api/v1/raw/%s/%s' % (
+        self._base_url, self._namespace, digest)
+    logging.debug('download_file(%s, %d)', source_url, offset)
+    connection = net.url_open(
+        source_url,
+        headers={'Range': 'bytes=%d-' % offset} if offset else None,
+        read_timeout=DOWNLOAD_READ_TIMEOUT)
+    if not connection:
+      raise IOError('Failed to download %s / %s' % (self._namespace, digest))
+    if offset:
+      _check_content_range(connection, offset)
     for data in connection.iter_content(NET_IO_FILE_CHUNK):
       yield data
 
+  def flatten(self, digest):
+    if not (self._server_capabilities or {}).get('flatten'):
+      return None
+    response = net.url_read_json(
+        url='%s/_ah/api/isolateservice/v1/flatten' % self._base_url,
+        data={'digest': digest, 'namespace': self._namespace_dict},
+        read_timeout=DOWNLOAD_READ_TIMEOUT)
+    if not response:
+      logging.warning('Failed to flatten %s', digest)
+      return None
+    files = {}
+    urls = {}
+    for f in response.get('files', []):
+      # Integers are encoded as strings.
+      props = {}
+      for key, name in (('h', 'digest'), ('l', 'link'), ('t', 'type')):
+        if f.get(name) is not None:
+          props[key] = f[name]
+      for key, name in (('m', 'mode'), ('s', 'size')):
+        if f.get(name) is not None:
+          props[key] = int(f[name])
+      files[f['path']] = props
+      if f.get('url'):
+        urls[f['digest']] = f['url']
+    with self._lock:
+      self._gs_urls.update(urls)
+    read_only = response.get('read_only')
+    return {
+      'command': response.get('command', []),
+      'files': files,
+      'isolated': response.get('isolated', []),
+      'read_only': int(read_only) if read_only is not None else None,
+      'relative_cwd': response.get('relative_cwd'),
+    }
+
   def push(self, item, push_state, content=None):
     assert isinstance(item, Item)
     assert item.digest is not None
@@ -362,7 +455,11 @@ class IsolateServer(StorageApi):
     # Default to item.content().
     content = item.content() if content is None else content
     logging.info('Push state size: %d', push_state.size)
-    guard_memory_use(self, content, push_state.size)
+    # Uploads to Google Storage are streamed, only inline uploads are held in
+    # memory.
+    in_memory = not push_state.finalize_url
+    if in_memory:
+      guard_memory_use(self, content, push_state.size)
 
     try:
       # This push operation may be a retry after failed finalization call below,
@@ -398,8 +495,9 @@ class IsolateServer(StorageApi):
               (item.digest, response))
       push_state.finalized = True
     finally:
-      with self._lock:
-        self._memory_use -= push_state.size
+      if in_memory:
+        with self._lock:
+          self._memory_use -= push_state.size
 
   def contains(self, items):
     # Ensure all items were initialized with 'prepare' call. Storage does that.
@@ -480,15 +578,13 @@ class IsolateServer(StorageApi):
       item: the original Item to be uploaded
       content: an iterable that yields 'str' chunks.
     """
-    # A cheezy way to avoid memcpy of (possibly huge) file, until streaming
-    # upload support is implemented.
-    if isinstance(content, list) and len(content) == 1:
-      content = content[0]
-    else:
-      content = ''.join(content)
-
     # DB upload
     if not push_state.finalize_url:
+      # A cheezy way to avoid memcpy of the content when it is a single chunk.
+      if isinstance(content, list) and len(content) == 1:
+        content = content[0]
+      else:
+        content = ''.join(content)
       url = '%s/%s' % (self._base_url, push_state.upload_url)
       content = base64.b64encode(content)
       data = {
@@ -499,6 +595,15 @@ class IsolateServer(StorageApi):
       return response is not None and response['ok']
 
     # upload to GS
+    if isinstance(content, list):
+      # Content is already in memory, send it as is so that net can
+      # transparently retry the request.
+      content = content[0] if len(content) == 1 else ''.join(content)
+    else:
+      # Stream the content. The generator can't be rewound, so a failed upload
+      # is retried by the caller, which regenerates the content from its
+      # source.
+      content = (chunk for chunk in content)
     url = push_state.upload_url
     response = net.url_read(
         content_type='application/octet-stream',
@@ -11,14 +11,18 @@ import os
 import re
 import stat
 import sys
+import threading
+import time
+import zlib
 
+from utils import compression
 from utils import file_path
 from utils import fs
 from utils import tools
 
 
 # Version stored and expected in .isolated files.
-ISOLATED_FILE_VERSION = '1.6'
+ISOLATED_FILE_VERSION = '1.7'
 
 
 # Chunk size to use when doing disk I/O.
@@ -41,6 +45,36 @@ SUPPORTED_ALGOS_REVERSE = dict((v, k) for k, v in SUPPORTED_ALGOS.iteritems())
 SUPPORTED_FILE_TYPES = ['basic', 'tar']
 
 
+# Files at least this large are split in content-defined chunks in a chunked
+# namespace, see is_namespace_with_chunking().
+CHUNKED_FILE_MIN_SIZE = 16 * 1024 * 1024
+
+
+# Bounds of the size of a chunk. The average is about CHUNK_MIN_SIZE plus 1mb.
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+
+# A chunk boundary is a position matching _CHUNK_CANDIDATE, about 1 in 256
+# positions, where the CRC32 of the preceding _CHUNK_WINDOW bytes has its
+# _CHUNK_MASK bits unset, 1 in 4096 candidates. Both only depend on the bytes
+# around the position so boundaries survive insertions and deletions elsewhere
+# in the file. Both searches run in C, unlike a per byte rolling hash.
+_CHUNK_CANDIDATE = re.compile(r'[\x00-\x0f][\x40-\x4f]')
+_CHUNK_WINDOW = 48
+_CHUNK_MASK = (1 << 12) - 1
+
+
+# Version of the on-disk DigestCache file format.
+DIGEST_CACHE_VERSION = 1
+
+
+# Files modified less than this number of seconds ago are not added to
+# DigestCache. A write in the same timestamp granularity as the one hashed would
+# otherwise go unnoticed.
+DIGEST_CACHE_MIN_AGE = 2
+
+
 class IsolatedError(ValueError):
   """Generic failure to load a .isolated file."""
   pass
@@ -84,7 +118,50 @@ def get_hash_algo(namespace):
 
 def is_namespace_with_compression(namespace):
   """Returns True if given |namespace| stores compressed objects."""
-  return namespace.endswith(('-gzip', '-deflate'))
+  return compression.get_codec(namespace) is not None
+
+
+def is_namespace_with_chunking(namespace):
+  """Returns True if large files are stored as content-defined chunks in
+  |namespace|, e.g. 'default-chunked-gzip'.
+  """
+  return 'chunked' in namespace.split('-')
+
+
+def iter_chunks(fileobj):
+  """Yields the content-defined chunks of a file object."""
+  buf = ''
+  while True:
+    if len(buf) < CHUNK_MAX_SIZE:
+      buf += fileobj.read(CHUNK_MAX_SIZE - len(buf))
+    if not buf:
+      return
+    cut = len(buf)
+    if cut > CHUNK_MIN_SIZE:
+      end = min(cut, CHUNK_MAX_SIZE)
+      cut = end
+      for m in _CHUNK_CANDIDATE.finditer(buf, CHUNK_MIN_SIZE, end):
+        i = m.end()
+        if not zlib.crc32(buf[i-_CHUNK_WINDOW:i]) & _CHUNK_MASK:
+          cut = i
+          break
+    yield buf[:cut]
+    buf = buf[cut:]
+
+
+def chunk_file(filepath, algo):
+  """Hashes a file and its content-defined chunks in a single pass.
+
+  Returns:
+    tuple(hash of the file, list of [hash, size] of the chunks in order).
+  """
+  digest = algo()
+  chunks = []
+  with fs.open(filepath, 'rb') as f:
+    for chunk in iter_chunks(f):
+      digest.update(chunk)
+      chunks.append([algo(chunk).hexdigest(), len(chunk)])
+  return digest.hexdigest(), chunks
 
 
 def hash_file(filepath, algo):
@@ -102,6 +179,102 @@ def hash_file(filepath, algo):
   return digest.hexdigest()
 
 
+class DigestCache(object):
+  """Persistent cache of file digests to skip hashing files that didn't change.
+
+  Entries are keyed by (device, inode) and validated with the file size and
+  modification time in nanoseconds. The cache is stored as a json file in
+  |cache_dir|, one file per hashing algorithm, so it can be shared by
+  'isolate.py archive', 'isolateserver.py archive' and 'run_isolated.py'.
+
+  Thread safe. Concurrent processes sharing the same |cache_dir| only risk
+  losing entries, since the last one to save wins.
+  """
+
+  # Maximum number of entries to keep on disk. Entries not used by this
+  # instance are evicted first.
+  MAX_ITEMS = 1000000
+
+  def __init__(self, cache_dir, algo):
+    self.algo = algo
+    self.path = os.path.join(
+        cache_dir, u'digests.%s.json' % SUPPORTED_ALGOS_REVERSE[algo])
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    # key -> [size, mtime_ns, digest].
+    self._items = {}
+    self._used = set()
+    self._dirty = False
+    if fs.isfile(self.path):
+      try:
+        data = tools.read_json(self.path)
+        if data.get('version') != DIGEST_CACHE_VERSION:
+          raise ValueError('unsupported version %s' % data.get('version'))
+        self._items = data['items']
+      except (IOError, KeyError, ValueError) as e:
+        logging.warning('Ignoring broken digest cache %s: %s', self.path, e)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, _exc_type, _exec_value, _traceback):
+    self.save()
+
+  def __len__(self):
+    return len(self._items)
+
+  def hash_file(self, filepath, filestats=None):
+    """Returns the digest of |filepath|, hashing it only if it changed.
+
+    Arguments:
+      filepath: file to hash.
+      filestats: os.stat() result for |filepath|, if already known.
+    """
+    if filestats is None:
+      filestats = fs.stat(filepath)
+    if not filestats.st_ino:
+      # Inodes are not supported by os.stat() on Windows with python 2.7.
+      return hash_file(filepath, self.algo)
+    key = '%d:%d' % (filestats.st_dev, filestats.st_ino)
+    mtime_ns = int(round(filestats.st_mtime * 1000000000))
+    with self._lock:
+      entry = self._items.get(key)
+      if entry and entry[0] == filestats.st_size and entry[1] == mtime_ns:
+        self._used.add(key)
+        self.hits += 1
+        return entry[2]
+      self.misses += 1
+    digest = hash_file(filepath, self.algo)
+    if time.time() - filestats.st_mtime >= DIGEST_CACHE_MIN_AGE:
+      with self._lock:
+        self._items[key] = [filestats.st_size, mtime_ns, digest]
+        self._used.add(key)
+        self._dirty = True
+    return digest
+
+  def save(self):
+    """Saves the cache to disk if it was modified."""
+    with self._lock:
+      logging.info(
+          'DigestCache: %d hits, %d misses, %d items',
+          self.hits, self.misses, len(self._items))
+      if not self._dirty:
+        return
+      extra = len(self._items) - self.MAX_ITEMS
+      if extra > 0:
+        unused = [k for k in self._items if k not in self._used]
+        for key in unused[:extra]:
+          del self._items[key]
+      file_path.ensure_tree(os.path.dirname(self.path))
+      file_path.atomic_replace(
+          self.path,
+          json.dumps(
+              {'items': self._items, 'version': DIGEST_CACHE_VERSION},
+              separators=(',', ':')))
+      self._dirty = False
+
+
 class IsolatedFile(object):
   """Represents a single parsed .isolated file."""
 
@@ -329,7 +502,9 @@ def expand_directories_and_symlinks(
 
 
 @tools.profile
-def file_to_metadata(filepath, prevdict, read_only, algo, collapse_symlinks):
+def file_to_metadata(
+    filepath, prevdict, read_only, algo, collapse_symlinks, digest_cache=None,
+    chunked=False):
   """Processes an input file, a dependency, and return meta data about it.
 
   Behaviors:
@@ -348,6 +523,10 @@ def file_to_metadata(filepath, prevdict, read_only, algo, collapse_symlinks):
     algo:      Hashing algorithm used.
     collapse_symlinks: True if symlinked files should be treated like they were
                        the normal underlying file.
+    digest_cache: DigestCache instance used to skip hashing files that didn't
+                  change since they were last hashed. Optional.
+    chunked:   True if files of CHUNKED_FILE_MIN_SIZE or more should list their
+               content-defined chunks in 'c'.
 
   Returns:
     The necessary dict to create a entry in the 'files' section of an .isolated
@@ -396,12 +575,22 @@ def file_to_metadata(filepath, prevdict, read_only, algo, collapse_symlinks):
     out['s'] = filestats.st_size
     # If the timestamp wasn't updated and the file size is still the same, carry
     # on the hash.
+    chunk = chunked and out['s'] >= CHUNKED_FILE_MIN_SIZE
     if (prevdict.get('t') == out['t'] and
-        prevdict.get('s') == out['s']):
+        prevdict.get('s') == out['s'] and
+        (not chunk or prevdict.get('c'))):
       # Reuse the previous hash if available.
       out['h'] = prevdict.get('h')
-    if not out.get('h'):
-      out['h'] = hash_file(filepath, algo)
+      if chunk:
+        out['c'] = prevdict['c']
+    if chunk and not out.get('h'):
+      out['h'], out['c'] = chunk_file(filepath, algo)
+    elif not out.get('h'):
+      if digest_cache is not None:
+        assert digest_cache.algo == algo, (digest_cache.algo, algo)
+        out['h'] = digest_cache.hash_file(filepath, filestats)
+      else:
+        out['h'] = hash_file(filepath, algo)
   else:
     # If the timestamp wasn't updated, carry on the link destination.
     if prevdict.get('t') == out['t']:
@@ -528,6 +717,19 @@ def load_isolated(content, algo):
           elif subsubkey == 'm':
             if not isinstance(subsubvalue, int):
               raise IsolatedError('Expected int, got %r' % subsubvalue)
+          elif subsubkey == 'c':
+            if not isinstance(subsubvalue, list) or not subsubvalue:
+              raise IsolatedError('Expected non-empty list, got %r' %
+                                  subsubvalue)
+            for chunk in subsubvalue:
+              if (not isinstance(chunk, list) or len(chunk) != 2 or
+                  not is_valid_hash(chunk[0], algo) or
+                  not isinstance(chunk[1], (int, long))):
+                raise IsolatedError('Expected [%s, size], got %r' %
+                                    (algo_name, chunk))
+            if sum(c[1] for c in subsubvalue) != subvalue.get('s'):
+              raise IsolatedError(
+                  'Chunks must add up to \'s\' (size), got: %r' % subvalue)
           elif subsubkey == 'h':
             if not is_valid_hash(subsubvalue, algo):
               raise IsolatedError('Expected %s, got %r' %
@@ -553,6 +755,9 @@ def load_isolated(content, algo):
           raise IsolatedError(
               'Need only one of \'s\' (size) or \'l\' (link), got: %r' %
               subvalue)
+        if 'c' in subvalue and subvalue.get('t', 'basic') != 'basic':
+          raise IsolatedError(
+              'Only basic files can be chunked, got: %r' % subvalue)
         if bool('l' in subvalue) and bool('m' in subvalue):
           raise IsolatedError(
               'Cannot use \'m\' (mode) and \'l\' (link), got: %r' %
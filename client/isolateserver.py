@@ -5,26 +5,31 @@
 
 """Archives a set of files or directories to an Isolate Server."""
 
-__version__ = '0.8.5'
+__version__ = '0.8.6'
 
 import errno
+import fnmatch
 import functools
+import hashlib
+import json
 import logging
 import optparse
 import os
+import Queue
 import re
 import signal
 import stat
 import sys
 import tarfile
 import tempfile
+import threading
 import time
-import zlib
 
 from third_party import colorama
 from third_party.depot_tools import fix_encoding
 from third_party.depot_tools import subcommand
 
+from utils import compression
 from utils import file_path
 from utils import fs
 from utils import logging_utils
@@ -50,25 +55,51 @@ ISOLATE_PROTOCOL_VERSION = '1.0'
 DEADLOCK_TIMEOUT = 5 * 60
 
 
-# The number of files to check the isolate server per /pre-upload query.
-# All files are sorted by likelihood of a change in the file content
+# Bounds of the number of files to check the isolate server per /pre-upload
+# query. All files are sorted by likelihood of a change in the file content
 # (currently file size is used to estimate this: larger the file -> larger the
-# possibility it has changed). Then first ITEMS_PER_CONTAINS_QUERIES[0] files
-# are taken and send to '/pre-upload', then next ITEMS_PER_CONTAINS_QUERIES[1],
-# and so on. Numbers here is a trade-off; the more per request, the lower the
-# effect of HTTP round trip latency and TCP-level chattiness. On the other hand,
-# larger values cause longer lookups, increasing the initial latency to start
-# uploading, which is especially an issue for large files. This value is
-# optimized for the "few thousands files to look up with minimal number of large
-# files missing" case.
-ITEMS_PER_CONTAINS_QUERIES = (20, 20, 50, 50, 50, 100)
+# possibility it has changed). The first queries are small, so uploading the
+# large files starts quickly, then ContainsWindow grows them as long as the
+# HTTP round trip dominates the query latency. The isolate server rejects
+# queries of more than 1000 items.
+MIN_ITEMS_PER_CONTAINS_QUERY = 20
+MAX_ITEMS_PER_CONTAINS_QUERY = 1000
+
+
+# Bounds of the number of /pre-upload queries in flight at once, see
+# ContainsWindow.
+INITIAL_CONTAINS_QUERIES = 4
+MAX_CONTAINS_QUERIES = threading_utils.IOAutoRetryThreadPool.MAX_WORKERS
+
+
+# Number of seconds a digest found on the server is assumed to still be there
+# by PresenceCache. This has to be much shorter than the server's expiration.
+PRESENCE_CACHE_TTL = 30 * 60
+
+
+# Version of the PresenceCache file format.
+PRESENCE_CACHE_VERSION = 1
+
+
+# Maximum number of compressed chunks buffered between the 'zip' thread and the
+# network thread for a single streaming upload. This bounds memory used per
+# upload to roughly this many times the size of a compressed chunk.
+MAX_IN_FLIGHT_UPLOAD_CHUNKS = 16
+
+
+# Number of threads creating the files of an isolated tree from the cache.
+# Mapping is dominated by file system calls that release the GIL but handing off
+# each file to a thread has a cost, so it uses at most one thread per core. With
+# a single thread, files are created by the thread waiting for the fetches.
+MAP_THREADS = min(16, threading_utils.num_processors())
 
 
 # A list of already compressed extension types that should not receive any
 # compression before being uploaded.
 ALREADY_COMPRESSED_TYPES = [
-    '7z', 'avi', 'cur', 'gif', 'h264', 'jar', 'jpeg', 'jpg', 'mp4', 'pdf',
-    'png', 'wav', 'zip',
+    '7z', 'apk', 'avi', 'br', 'bz2', 'cur', 'gif', 'gz', 'h264', 'jar', 'jpeg',
+    'jpg', 'lz4', 'mkv', 'mov', 'mp3', 'mp4', 'ogg', 'pdf', 'png', 'tgz', 'wav',
+    'webm', 'webp', 'whl', 'woff2', 'xz', 'zip', 'zst',
 ]
 
 
@@ -100,15 +131,20 @@ class AlreadyExists(Error):
   """File already exists."""
 
 
-def file_read(path, chunk_size=isolated_format.DISK_FILE_CHUNK, offset=0):
-  """Yields file content in chunks of |chunk_size| starting from |offset|."""
+def file_read(
+    path, chunk_size=isolated_format.DISK_FILE_CHUNK, offset=0, size=-1):
+  """Yields file content in chunks of |chunk_size| starting from |offset|, up to
+  |size| bytes if not -1.
+  """
   with fs.open(path, 'rb') as f:
     if offset:
       f.seek(offset)
-    while True:
-      data = f.read(chunk_size)
+    while size:
+      data = f.read(chunk_size if size < 0 else min(chunk_size, size))
       if not data:
         break
+      if size > 0:
+        size -= len(data)
       yield data
 
 
@@ -234,14 +270,7 @@ def putfile(srcfileobj, dstpath, file_mode=None, size=-1, use_symlink=False):
 
 def zip_compress(content_generator, level=7):
   """Reads chunks from |content_generator| and yields zip compressed chunks."""
-  compressor = zlib.compressobj(level)
-  for chunk in content_generator:
-    compressed = compressor.compress(chunk)
-    if compressed:
-      yield compressed
-  tail = compressor.flush(zlib.Z_FINISH)
-  if tail:
-    yield tail
+  return compression.ZLIB.compress(content_generator, level)
 
 
 def zip_decompress(
@@ -253,32 +282,15 @@ def zip_decompress(
 
   Raises IOError if data is corrupted or incomplete.
   """
-  decompressor = zlib.decompressobj()
-  compressed_size = 0
-  try:
-    for chunk in content_generator:
-      compressed_size += len(chunk)
-      data = decompressor.decompress(chunk, chunk_size)
-      if data:
-        yield data
-      while decompressor.unconsumed_tail:
-        data = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
-        if data:
-          yield data
-    tail = decompressor.flush()
-    if tail:
-      yield tail
-  except zlib.error as e:
-    raise IOError(
-        'Corrupted zip stream (read %d bytes) - %s' % (compressed_size, e))
-  # Ensure all data was read and decompressed.
-  if decompressor.unused_data or decompressor.unconsumed_tail:
-    raise IOError('Not all data was decompressed')
+  return compression.ZLIB.decompress(content_generator, chunk_size)
 
 
 def get_zip_compression_level(filename):
-  """Given a filename calculates the ideal zip compression level to use."""
-  file_ext = os.path.splitext(filename)[1].lower()
+  """Given a filename calculates the ideal zip compression level to use.
+
+  The level is mapped to the namespace's codec scale by Codec.get_level().
+  """
+  file_ext = os.path.splitext(filename)[1].lower().lstrip('.')
   # TODO(csharp): Profile to find what compression level works best.
   return 0 if file_ext in ALREADY_COMPRESSED_TYPES else 7
 
@@ -336,6 +348,49 @@ class FileItem(isolate_storage.Item):
     return file_read(self.path)
 
 
+class FileChunkItem(isolate_storage.Item):
+  """A content-defined chunk of a file to push to Storage."""
+
+  def __init__(self, path, offset, digest, size, high_priority=False):
+    super(FileChunkItem, self).__init__(digest, size, high_priority)
+    self.path = path
+    self.offset = offset
+    self.compression_level = get_zip_compression_level(path)
+
+  def content(self):
+    return file_read(self.path, offset=self.offset, size=self.size)
+
+
+def iter_file_items(path, metadata, high_priority=False):
+  """Yields the items to push for a file given its .isolated |metadata|.
+
+  A chunked file is pushed as its chunks, so only the ones that changed are
+  uploaded.
+  """
+  if 'c' in metadata:
+    offset = 0
+    for digest, size in metadata['c']:
+      yield FileChunkItem(path, offset, digest, size, high_priority)
+      offset += size
+  else:
+    yield FileItem(
+        path=path,
+        digest=metadata['h'],
+        size=metadata['s'],
+        high_priority=high_priority)
+
+
+def file_digests(props):
+  """Returns the list of (digest, size) to fetch for a file given its .isolated
+  |props|, the chunks of a chunked file or its content.
+  """
+  if 'c' in props:
+    return [(digest, size) for digest, size in props['c']]
+  if 'h' in props:
+    return [(props['h'], props['s'])]
+  return []
+
+
 class BufferItem(isolate_storage.Item):
   """A byte buffer to push to Storage."""
 
@@ -360,10 +415,17 @@ class Storage(object):
   signal handlers table to handle Ctrl+C.
   """
 
-  def __init__(self, storage_api):
+  def __init__(self, storage_api, presence_cache=None, flatten=False):
     self._storage_api = storage_api
-    self._use_zip = isolated_format.is_namespace_with_compression(
-        storage_api.namespace) and not storage_api.internal_compression
+    self._presence_cache = presence_cache
+    self._flatten = flatten
+    self._codec = None
+    if not storage_api.internal_compression:
+      self._codec = compression.get_codec(storage_api.namespace)
+      if self._codec and not self._codec.available:
+        raise ValueError(
+            'Python module %s is needed to use namespace %s' % (
+              self._codec.module_name, storage_api.namespace))
     self._hash_algo = isolated_format.get_hash_algo(storage_api.namespace)
     self._cpu_thread_pool = None
     self._net_thread_pool = None
@@ -391,6 +453,18 @@ class Storage(object):
     """
     return self._storage_api.namespace
 
+  def flatten(self, digest):
+    """Returns the .isolated tree |digest| expanded by the server.
+
+    Returns None if disabled or not supported, see StorageApi.flatten(). The
+    server doesn't return the chunks of chunked files so it is never used in a
+    chunked namespace.
+    """
+    if (not self._flatten or
+        isolated_format.is_namespace_with_chunking(self.namespace)):
+      return None
+    return self._storage_api.flatten(digest)
+
   @property
   def cpu_thread_pool(self):
     """ThreadPool for CPU-bound tasks like zipping."""
@@ -420,6 +494,13 @@ class Storage(object):
       self._net_thread_pool.join()
       self._net_thread_pool.close()
       self._net_thread_pool = None
+    if self._presence_cache is not None:
+      self._presence_cache.save()
+    for urlhost, stats in sorted(net.get_connection_stats().iteritems()):
+      logging.info(
+          '%s: %d requests, %d new connections, %d reused',
+          urlhost, stats['requests'], stats['new_connections'],
+          stats['reused_connections'])
     logging.info('Done.')
 
   def abort(self):
@@ -454,38 +535,49 @@ class Storage(object):
 
     Arguments:
       items: list of isolate_storage.Item instances that represents data to
-             upload.
+             upload. It can also be a generator, in which case items are looked
+             up on the server and uploaded as soon as they are yielded, while
+             the generator produces the next ones.
 
     Returns:
       List of items that were uploaded. All other items are already there.
     """
-    logging.info('upload_items(items=%d)', len(items))
-
-    # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
+    is_list = isinstance(items, list)
+    if is_list:
+      logging.info('upload_items(items=%d)', len(items))
+    else:
+      logging.info('upload_items(items=<generator>)')
 
     # For each digest keep only first isolate_storage.Item that matches it. All
     # other items are just indistinguishable copies from the point of view of
     # isolate server (it doesn't care about paths at all, only content and
     # digests).
     seen = {}
-    duplicates = 0
-    for item in items:
-      if seen.setdefault(item.digest, item) is not item:
-        duplicates += 1
-    items = seen.values()
-    if duplicates:
-      logging.info('Skipped %d files with duplicated content', duplicates)
+    total_count = [0]
+    def unique_items():
+      for item in items:
+        total_count[0] += 1
+        # Ensure the digest is calculated.
+        item.prepare(self._hash_algo)
+        if seen.setdefault(item.digest, item) is item:
+          yield item
+    to_check = unique_items()
+    if is_list:
+      to_check = list(to_check)
 
     # Enqueue all upload tasks.
     missing = set()
     uploaded = []
     channel = threading_utils.TaskChannel()
-    for missing_item, push_state in self.get_missing_items(items):
+    for missing_item, push_state in self.get_missing_items(to_check):
       missing.add(missing_item)
       self.async_push(channel, missing_item, push_state)
 
+    items = seen.values()
+    duplicates = total_count[0] - len(items)
+    if duplicates:
+      logging.info('Skipped %d files with duplicated content', duplicates)
+
     # No need to spawn deadlock detector thread if there's nothing to upload.
     if missing:
       with threading_utils.DeadlockDetector(DEADLOCK_TIMEOUT) as detector:
@@ -551,33 +643,21 @@ class Storage(object):
         raise Aborted()
       item.prepare(self._hash_algo)
       self._storage_api.push(item, push_state, content)
+      if self._presence_cache is not None:
+        self._presence_cache.add([item.digest])
       return item
 
     # If zipping is not required, just start a push task. Don't pass 'content'
     # so that it can create a new generator when it retries on failures.
-    if not self._use_zip:
+    if not self._codec:
       self.net_thread_pool.add_task_with_channel(channel, priority, push, None)
       return
 
-    # If zipping is enabled, zip in a separate thread.
-    def zip_and_push():
-      # TODO(vadimsh): Implement streaming uploads. Before it's done, assemble
-      # content right here. It will block until all file is zipped.
-      try:
-        if self._aborted:
-          raise Aborted()
-        stream = zip_compress(item.content(), item.compression_level)
-        data = ''.join(stream)
-      except Exception as exc:
-        logging.error('Failed to zip \'%s\': %s', item, exc)
-        channel.send_exception()
-        return
-      # Pass '[data]' explicitly because the compressed data is not same as the
-      # one provided by 'item'. Since '[data]' is a list, it can safely be
-      # reused during retries.
-      self.net_thread_pool.add_task_with_channel(
-          channel, priority, push, [data])
-    self.cpu_thread_pool.add_task(priority, zip_and_push)
+    # If zipping is enabled, zip in a separate thread while the content is
+    # being uploaded. The stream restarts compression from item.content() each
+    # time it is iterated, so it can safely be reused during retries.
+    stream = _ZipStream(self, item, priority)
+    self.net_thread_pool.add_task_with_channel(channel, priority, push, stream)
 
   def push(self, item, push_state):
     """Synchronously pushes a single item to the server.
@@ -613,8 +693,9 @@ class Storage(object):
       try:
         # Prepare reading pipeline.
         stream = self._storage_api.fetch(digest, size, 0)
-        if self._use_zip:
-          stream = zip_decompress(stream, isolated_format.DISK_FILE_CHUNK)
+        if self._codec:
+          stream = self._codec.decompress(
+              stream, isolated_format.DISK_FILE_CHUNK)
         # Run |stream| through verifier that will assert its size.
         verifier = FetchStreamVerifier(stream, self._hash_algo, digest, size)
         # Verified stream goes to |sink|.
@@ -631,10 +712,15 @@ class Storage(object):
   def get_missing_items(self, items):
     """Yields items that are missing from the server.
 
-    Issues multiple parallel queries via StorageApi's 'contains' method.
+    Issues multiple parallel queries via StorageApi's 'contains' method. The
+    size and number of concurrent queries are adapted to the server latency by a
+    ContainsWindow. Items known to be present by the PresenceCache, if any, are
+    not looked up.
 
     Arguments:
-      items: a list of isolate_storage.Item objects to check.
+      items: a list of isolate_storage.Item objects to check. It can also be a
+          generator, in which case queries are issued as soon as enough items
+          are yielded to fill a batch.
 
     Yields:
       For each missing item it yields a pair (item, push_state), where:
@@ -646,21 +732,54 @@ class Storage(object):
     """
     channel = threading_utils.TaskChannel()
     pending = 0
+    window = ContainsWindow()
+    presence_cache = self._presence_cache
 
     # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
+    if isinstance(items, list):
+      for item in items:
+        item.prepare(self._hash_algo)
+      if presence_cache is not None:
+        items = [i for i in items if not presence_cache.is_present(i.digest)]
+    elif presence_cache is not None:
+      items = _filter_present(items, self._hash_algo, presence_cache)
 
     def contains(batch):
       if self._aborted:
         raise Aborted()
-      return self._storage_api.contains(batch)
+      start = time.time()
+      try:
+        result = self._storage_api.contains(batch)
+      except Exception:
+        window.on_failure()
+        raise
+      window.on_success(len(batch), time.time() - start)
+      if presence_cache is not None:
+        presence_cache.add(i.digest for i in batch if i not in result)
+      return result
 
     # Enqueue all requests.
-    for batch in batch_items_for_check(items):
+    for batch in batch_items_for_check(items, window):
+      for item in batch:
+        item.prepare(self._hash_algo)
+      # Wait for a query to complete if the window is full.
+      if pending >= window.concurrency:
+        pending -= 1
+        for missing_item, push_state in channel.pull().iteritems():
+          yield missing_item, push_state
       self.net_thread_pool.add_task_with_channel(
           channel, threading_utils.PRIORITY_HIGH, contains, batch)
       pending += 1
+      # Yield the results already available, so uploads can start while the
+      # next batches are being produced.
+      while pending:
+        try:
+          result = channel.pull(timeout=0)
+        except threading_utils.TaskChannel.Timeout:
+          break
+        pending -= 1
+        for missing_item, push_state in result.iteritems():
+          yield missing_item, push_state
 
     # Yield results as they come in.
     for _ in xrange(pending):
@@ -668,34 +787,242 @@ class Storage(object):
         yield missing_item, push_state
 
 
-def batch_items_for_check(items):
+class _ZipStream(object):
+  """Restartable iterable that yields the compressed content of an item.
+
+  Compression runs in Storage.cpu_thread_pool and the compressed chunks are
+  handed over to the consumer (usually a network thread) through a bounded
+  queue, so at most MAX_IN_FLIGHT_UPLOAD_CHUNKS chunks are held in memory.
+
+  Each iteration starts compressing from item.content() again instead of
+  holding the whole compressed blob for retries.
+  """
+
+  # Queue sentinel marking the end of the stream.
+  _DONE = object()
+
+  def __init__(self, storage, item, priority):
+    self._storage = storage
+    self._item = item
+    self._priority = priority
+
+  def __iter__(self):
+    chunks = Queue.Queue(MAX_IN_FLIGHT_UPLOAD_CHUNKS)
+    cancelled = threading.Event()
+
+    def put(value):
+      # Do not block forever if the consumer went away.
+      while not cancelled.is_set():
+        try:
+          chunks.put(value, timeout=1.)
+          return True
+        except Queue.Full:
+          pass
+      return False
+
+    def produce():
+      try:
+        if self._storage._aborted:
+          raise Aborted()
+        stream = self._storage._codec.compress(
+            self._item.content(), self._item.compression_level)
+        for chunk in stream:
+          if self._storage._aborted:
+            raise Aborted()
+          if not put(chunk):
+            return
+      except Exception as exc:
+        logging.error('Failed to zip \'%s\': %s', self._item, exc)
+        put(sys.exc_info())
+        return
+      put(self._DONE)
+
+    self._storage.cpu_thread_pool.add_task(self._priority, produce)
+    try:
+      while True:
+        value = chunks.get()
+        if value is self._DONE:
+          return
+        if isinstance(value, tuple):
+          # Exception raised by the producer, as returned by sys.exc_info().
+          raise value[0], value[1], value[2]
+        yield value
+    finally:
+      cancelled.set()
+
+
+def batch_items_for_check(items, window=None):
   """Splits list of items to check for existence on the server into batches.
 
   Each batch corresponds to a single 'exists?' query to the server via a call
   to StorageApi's 'contains' method.
 
   Arguments:
-    items: a list of isolate_storage.Item objects.
+    items: a list of isolate_storage.Item objects, sorted by size to query the
+        largest ones first. It can also be a generator, in which case the items
+        are batched in the order they are yielded.
+    window: ContainsWindow that decides the size of each batch as it is
+        started. Defaults to batches of MIN_ITEMS_PER_CONTAINS_QUERY items.
 
   Yields:
     Batches of items to query for existence in a single operation,
     each batch is a list of isolate_storage.Item objects.
   """
-  batch_count = 0
-  batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[0]
+  if isinstance(items, list):
+    items = sorted(items, key=lambda x: x.size, reverse=True)
+  if window is None:
+    window = ContainsWindow()
   next_queries = []
-  for item in sorted(items, key=lambda x: x.size, reverse=True):
+  for item in items:
     next_queries.append(item)
-    if len(next_queries) == batch_size_limit:
+    if len(next_queries) >= window.batch_size:
       yield next_queries
       next_queries = []
-      batch_count += 1
-      batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[
-          min(batch_count, len(ITEMS_PER_CONTAINS_QUERIES) - 1)]
   if next_queries:
     yield next_queries
 
 
+def _filter_present(items, algo, presence_cache):
+  """Yields the items of a generator not known to be on the server."""
+  for item in items:
+    item.prepare(algo)
+    if not presence_cache.is_present(item.digest):
+      yield item
+
+
+class ContainsWindow(object):
+  """Adapts the size and number of concurrent /pre-upload queries to latency.
+
+  It works like a TCP congestion window. The fastest query seen estimates the
+  round trip time. As long as queries complete within SLOW_FACTOR times that,
+  the round trip dominates so the batch size doubles and one more concurrent
+  query is allowed. A slower query means the server is the bottleneck, so the
+  batch size is halved, and the concurrency is halved too when it is really
+  slow or fails.
+
+  Thread safe.
+  """
+  SLOW_FACTOR = 2.
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._batch_size = MIN_ITEMS_PER_CONTAINS_QUERY
+    self._concurrency = INITIAL_CONTAINS_QUERIES
+    self._min_latency = None
+
+  @property
+  def batch_size(self):
+    """Number of items in the next query."""
+    with self._lock:
+      return self._batch_size
+
+  @property
+  def concurrency(self):
+    """Maximum number of queries in flight."""
+    with self._lock:
+      return self._concurrency
+
+  def on_success(self, size, latency):
+    """Records that a query of |size| items took |latency| seconds."""
+    with self._lock:
+      if self._min_latency is None or latency < self._min_latency:
+        self._min_latency = latency
+      if latency <= self._min_latency * self.SLOW_FACTOR:
+        if size >= self._batch_size:
+          self._batch_size = min(
+              self._batch_size * 2, MAX_ITEMS_PER_CONTAINS_QUERY)
+        self._concurrency = min(self._concurrency + 1, MAX_CONTAINS_QUERIES)
+        return
+      self._batch_size = max(
+          self._batch_size / 2, MIN_ITEMS_PER_CONTAINS_QUERY)
+      if latency > self._min_latency * self.SLOW_FACTOR * self.SLOW_FACTOR:
+        self._concurrency = max(self._concurrency / 2, 1)
+
+  def on_failure(self):
+    """Records that a query failed, it will be retried."""
+    with self._lock:
+      self._batch_size = max(
+          self._batch_size / 2, MIN_ITEMS_PER_CONTAINS_QUERY)
+      self._concurrency = max(self._concurrency / 2, 1)
+
+
+class PresenceCache(object):
+  """Persistent cache of the digests recently found on an isolate server.
+
+  Digests found on the server or uploaded to it in the last |ttl| seconds are
+  not looked up again, so repeated archives from the same bot skip the
+  /pre-upload round trips for content that didn't change. The cache is stored
+  as a json file in |cache_dir|, one file per server and namespace.
+
+  Thread safe. Concurrent processes sharing the same |cache_dir| only risk
+  losing entries, since the last one to save wins.
+  """
+
+  def __init__(
+      self, cache_dir, location, namespace, ttl=PRESENCE_CACHE_TTL,
+      time_fn=None):
+    self.path = os.path.join(
+        cache_dir,
+        u'present.%s.json' %
+            hashlib.sha1('%s|%s' % (location, namespace)).hexdigest()[:16])
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._time_fn = time_fn or time.time
+    self._lock = threading.Lock()
+    # digest -> timestamp it was last seen on the server.
+    self._items = {}
+    self._dirty = False
+    if fs.isfile(self.path):
+      try:
+        data = tools.read_json(self.path)
+        if data.get('version') != PRESENCE_CACHE_VERSION:
+          raise ValueError('unsupported version %s' % data.get('version'))
+        cutoff = self._time_fn() - self.ttl
+        self._items = {
+          k: v for k, v in data['items'].iteritems() if v >= cutoff
+        }
+      except (AttributeError, IOError, KeyError, ValueError) as e:
+        logging.warning('Ignoring broken presence cache %s: %s', self.path, e)
+
+  def __len__(self):
+    return len(self._items)
+
+  def is_present(self, digest):
+    """Returns True if |digest| was seen on the server less than |ttl| ago."""
+    with self._lock:
+      timestamp = self._items.get(digest)
+      if timestamp is not None and timestamp >= self._time_fn() - self.ttl:
+        self.hits += 1
+        return True
+      self.misses += 1
+      return False
+
+  def add(self, digests):
+    """Records that |digests| are on the server now."""
+    now = self._time_fn()
+    with self._lock:
+      for digest in digests:
+        self._items[digest] = now
+        self._dirty = True
+
+  def save(self):
+    """Saves the cache to disk if it was modified."""
+    with self._lock:
+      logging.info(
+          'PresenceCache: %d hits, %d misses, %d items',
+          self.hits, self.misses, len(self._items))
+      if not self._dirty:
+        return
+      file_path.ensure_tree(os.path.dirname(self.path))
+      file_path.atomic_replace(
+          self.path,
+          json.dumps(
+              {'items': self._items, 'version': PRESENCE_CACHE_VERSION},
+              separators=(',', ':')))
+      self._dirty = False
+
+
 class FetchQueue(object):
   """Fetches items from Storage and places them into ContentAddressedCache.
 
@@ -894,7 +1221,12 @@ class FetchStreamVerifier(object):
 class IsolatedBundle(object):
   """Fetched and parsed .isolated file with all dependencies."""
 
-  def __init__(self):
+  def __init__(self, prefetch=True):
+    """Arguments:
+      prefetch: if True, fetch() starts fetching the data files as soon as their
+          *.isolated file is loaded.
+    """
+    self._prefetch = prefetch
     self.command = []
     self.files = {}
     self.read_only = None
@@ -920,9 +1252,9 @@ class IsolatedBundle(object):
     .isolated file earlier in the 'includes' list. So the order of the elements
     in 'includes' is important.
 
-    As a side effect this method starts asynchronous fetch of all data files
-    by adding them to |fetch_queue|. It doesn't wait for data files to finish
-    fetching though.
+    As a side effect, unless |prefetch| was False, this method starts
+    asynchronous fetch of all data files by adding them to |fetch_queue|. It
+    doesn't wait for data files to finish fetching though.
     """
     self.root = isolated_format.IsolatedFile(root_isolated_hash, algo)
 
@@ -982,6 +1314,27 @@ class IsolatedBundle(object):
       self._update_self(node)
     self.relative_cwd = self.relative_cwd or ''
 
+  def load_flattened(self, fetch_queue, tree):
+    """Loads a tree as returned by Storage.flatten() instead of fetching the
+    .isolated files.
+
+    Like fetch(), starts fetching the data files unless |prefetch| was False.
+    """
+    logging.debug(
+        'load_flattened(%d .isolated, %d files)',
+        len(tree['isolated']), len(tree['files']))
+    self.files = tree['files']
+    if self._prefetch:
+      for properties in self.files.itervalues():
+        for digest, size in file_digests(properties):
+          fetch_queue.add(digest, size, threading_utils.PRIORITY_MED)
+    self.command = tree['command']
+    if self.command:
+      # Ensure paths are correctly separated on windows.
+      self.command[0] = self.command[0].replace('/', os.path.sep)
+    self.read_only = tree['read_only']
+    self.relative_cwd = tree['relative_cwd'] or ''
+
   def _start_fetching_files(self, isolated, fetch_queue):
     """Starts fetching files from |isolated| that are not yet being fetched.
 
@@ -1001,9 +1354,9 @@ class IsolatedBundle(object):
           properties['m'] &= ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
 
         # Preemptively request hashed files.
-        if 'h' in properties:
-          fetch_queue.add(
-              properties['h'], properties['s'], threading_utils.PRIORITY_MED)
+        if self._prefetch:
+          for digest, size in file_digests(properties):
+            fetch_queue.add(digest, size, threading_utils.PRIORITY_MED)
 
   def _update_self(self, node):
     """Extracts bundle global parameters from loaded *.isolated file.
@@ -1024,7 +1377,7 @@ class IsolatedBundle(object):
       self.relative_cwd = node.data['relative_cwd']
 
 
-def get_storage(url, namespace):
+def get_storage(url, namespace, presence_cache_dir=None, flatten=False):
   """Returns Storage class that can upload and download from |namespace|.
 
   Arguments:
@@ -1032,20 +1385,31 @@ def get_storage(url, namespace):
     namespace: isolate namespace to operate in, also defines hashing and
         compression scheme used, i.e. namespace names that end with '-gzip'
         store compressed data.
+    presence_cache_dir: optional directory of a PresenceCache, to skip looking
+        up the items recently found on the server.
+    flatten: if True, the server expands the *.isolated files of a tree in one
+        call when it supports it, instead of fetching them one level at a time.
 
   Returns:
     Instance of Storage.
   """
-  return Storage(isolate_storage.get_storage_api(url, namespace))
+  storage_api = isolate_storage.get_storage_api(url, namespace)
+  presence_cache = None
+  if presence_cache_dir:
+    presence_cache = PresenceCache(
+        unicode(os.path.abspath(presence_cache_dir)), storage_api.location,
+        namespace)
+  return Storage(storage_api, presence_cache, flatten)
 
 
-def upload_tree(base_url, infiles, namespace):
+def upload_tree(base_url, infiles, namespace, presence_cache_dir=None):
   """Uploads the given tree to the given url.
 
   Arguments:
     base_url:  The url of the isolate server to upload to.
     infiles:   iterable of pairs (absolute path, metadata dict) of files.
     namespace: The namespace to use on the server.
+    presence_cache_dir: optional directory of a PresenceCache.
   """
   # Convert |infiles| into a list of FileItem objects, skip duplicates.
   # Filter out symlinks, since they are not represented by items on isolate
@@ -1057,17 +1421,13 @@ def upload_tree(base_url, infiles, namespace):
     assert isinstance(filepath, unicode), filepath
     if 'l' not in metadata and filepath not in seen:
       seen.add(filepath)
-      item = FileItem(
-          path=filepath,
-          digest=metadata['h'],
-          size=metadata['s'],
-          high_priority=metadata.get('priority') == '0')
-      items.append(item)
+      items.extend(iter_file_items(
+          filepath, metadata, metadata.get('priority') == '0'))
     else:
       skipped += 1
 
   logging.info('Skipped %d duplicated entries', skipped)
-  with get_storage(base_url, namespace) as storage:
+  with get_storage(base_url, namespace, presence_cache_dir) as storage:
     return storage.upload_items(items)
 
 
@@ -1088,116 +1448,380 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
   logging.debug(
       'fetch_isolated(%s, %s, %s, %s, %s)',
       isolated_hash, storage, cache, outdir, use_symlinks)
-  # Hash algorithm to use, defined by namespace |storage| is using.
-  algo = storage.hash_algo
   with cache:
     fetch_queue = FetchQueue(storage, cache)
     bundle = IsolatedBundle()
 
     with tools.Profiler('GetIsolateds'):
-      # Optionally support local files by manually adding them to cache.
-      if not isolated_format.is_valid_hash(isolated_hash, algo):
-        logging.debug('%s is not a valid hash, assuming a file '
-                      '(algo was %s, hash size was %d)',
-                      isolated_hash, algo(), algo().digest_size)
-        path = unicode(os.path.abspath(isolated_hash))
-        try:
-          isolated_hash = fetch_queue.inject_local_file(path, algo)
-        except IOError as e:
-          raise isolated_format.MappingError(
-              '%s doesn\'t seem to be a valid file. Did you intent to pass a '
-              'valid hash (error: %s)?' % (isolated_hash, e))
-
-      # Load all *.isolated and start loading rest of the files.
-      bundle.fetch(fetch_queue, isolated_hash, algo)
+      _fetch_bundle(fetch_queue, bundle, isolated_hash, storage.hash_algo)
 
     with tools.Profiler('GetRest'):
-      # Create file system hierarchy.
-      file_path.ensure_tree(outdir)
-      create_directories(outdir, bundle.files)
-      create_symlinks(outdir, bundle.files.iteritems())
-
-      # Ensure working directory exists.
-      cwd = os.path.normpath(os.path.join(outdir, bundle.relative_cwd))
-      file_path.ensure_tree(cwd)
-
-      # Multimap: digest -> list of pairs (path, props).
-      remaining = {}
-      for filepath, props in bundle.files.iteritems():
-        if 'h' in props:
-          remaining.setdefault(props['h'], []).append((filepath, props))
-          fetch_queue.wait_on(props['h'])
-
-      # Now block on the remaining files to be downloaded and mapped.
-      logging.info('Retrieving remaining files (%d of them)...',
-          fetch_queue.pending_count)
-      last_update = time.time()
-      with threading_utils.DeadlockDetector(DEADLOCK_TIMEOUT) as detector:
-        while remaining:
+      remaining = _create_tree(bundle, outdir)
+      for digest in remaining:
+        fetch_queue.wait_on(digest)
+      _map_tree(fetch_queue, bundle, outdir, remaining, use_symlinks)
+      assert fetch_queue.wait_queue_empty, 'FetchQueue should have been emptied'
+
+  _verify_all_cached(fetch_queue, cache)
+  return bundle
+
+
+class LazyFetch(object):
+  """Fetches an isolated tree but only waits for the files needed to start.
+
+  start() returns once the *.isolated files and the files in the hot set are
+  mapped. The rest of the files are then fetched and mapped in a background
+  thread, files from the access profile first, then smallest first, until
+  wait() is called.
+
+  Unlike a virtual file system, a file accessed before being mapped is missing,
+  not blocked on. So the hot set must contain everything needed before
+  |done_file| is created, and a reader of the other files must wait for it.
+  """
+
+  def __init__(
+      self, storage, cache, outdir, use_symlinks, hot_set=None,
+      access_profile=None, done_file=None):
+    """Arguments:
+      storage: Storage class that communicates with isolate storage.
+      cache: ContentAddressedCache class that knows how to store and map files
+             locally.
+      outdir: Output directory to map file tree to.
+      use_symlinks: Use symlinks instead of hardlinks when True.
+      hot_set: list of fnmatch patterns of the paths, relative to |outdir|, to
+          map before start() returns. The files referenced by the command are
+          always in it.
+      access_profile: dict(path: score) of the files accessed by previous runs,
+          the files with the highest score are fetched first.
+      done_file: file created once the background mapping is over. It is empty
+          if all the files were mapped, otherwise it holds the error.
+    """
+    self._storage = storage
+    self._cache = cache
+    self._outdir = outdir
+    self._use_symlinks = use_symlinks
+    self._hot_set = hot_set or []
+    self._access_profile = access_profile or {}
+    self._done_file = done_file
+    self._fetch_queue = None
+    self._thread = None
+    self._exc_info = None
+
+  def start(self, isolated_hash):
+    """Maps the hot set and starts mapping the rest in the background.
+
+    Returns:
+      IsolatedBundle object that holds details about loaded *.isolated file.
+    """
+    logging.debug('LazyFetch.start(%s)', isolated_hash)
+    self._cache.__enter__()
+    try:
+      self._fetch_queue = FetchQueue(self._storage, self._cache)
+      # Files are only fetched once the hot set is known, in priority order.
+      bundle = IsolatedBundle(prefetch=False)
+      with tools.Profiler('GetIsolateds'):
+        _fetch_bundle(
+            self._fetch_queue, bundle, isolated_hash, self._storage.hash_algo)
+
+      with tools.Profiler('GetHotSet'):
+        remaining = _create_tree(bundle, self._outdir)
+        hot = self._start_fetching_files(bundle, remaining)
+        for digest in remaining:
+          self._fetch_queue.wait_on(digest)
+        logging.info(
+            'Mapping %d hot items of %d items', len(hot), len(remaining))
+        _map_tree(
+            self._fetch_queue, bundle, self._outdir, remaining,
+            self._use_symlinks, hot)
+    except:
+      self._cache.__exit__(*sys.exc_info())
+      raise
+
+    self._thread = threading.Thread(
+        target=self._map_remaining, args=(bundle, remaining),
+        name='LazyFetch')
+    self._thread.daemon = True
+    self._thread.start()
+    return bundle
+
+  def wait(self):
+    """Waits for all the files to be mapped.
+
+    Raises the exception that occurred while mapping, if any.
+    """
+    self._thread.join()
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    _verify_all_cached(self._fetch_queue, self._cache)
+
+  def _start_fetching_files(self, bundle, remaining):
+    """Starts fetching all the files, hot set first.
+
+    Returns the set of digests of the hot set.
+    """
+    # The files referenced by the command, e.g. the executable or the script it
+    # runs, are always needed.
+    hot_set = list(self._hot_set) + [
+      os.path.normpath(os.path.join(bundle.relative_cwd, arg))
+      for arg in bundle.command
+    ]
+    hot = set()
+    for digest, files in remaining.iteritems():
+      if any(
+          fnmatch.fnmatch(filepath, pattern)
+          for filepath, _ in files for pattern in hot_set):
+        hot.add(digest)
+
+    def key(digest):
+      filepath, props = remaining[digest][0]
+      score = max(
+          self._access_profile.get(f, 0) for f, _ in remaining[digest])
+      return -score, props['s'], filepath
+
+    for digest in sorted(hot, key=key):
+      self._fetch_queue.add(
+          digest, remaining[digest][0][1]['s'], threading_utils.PRIORITY_MED)
+    for digest in sorted(set(remaining) - hot, key=key):
+      self._fetch_queue.add(
+          digest, remaining[digest][0][1]['s'], threading_utils.PRIORITY_LOW)
+    return hot
+
+  def _map_remaining(self, bundle, remaining):
+    """Runs in the background thread to map the rest of the files."""
+    try:
+      with tools.Profiler('GetRest'):
+        _map_tree(
+            self._fetch_queue, bundle, self._outdir, remaining,
+            self._use_symlinks)
+      assert self._fetch_queue.wait_queue_empty, (
+          'FetchQueue should have been emptied')
+    except Exception:
+      logging.exception('Failed to map the isolated tree')
+      self._exc_info = sys.exc_info()
+    finally:
+      self._cache.__exit__(None, None, None)
+      if self._done_file:
+        # Written atomically, so a reader never sees a partial error.
+        file_path.atomic_replace(
+            self._done_file, str(self._exc_info[1]) if self._exc_info else '')
+
+
+def _fetch_bundle(fetch_queue, bundle, isolated_hash, algo):
+  """Fetches and loads all the *.isolated files into |bundle|."""
+  # Optionally support local files by manually adding them to cache.
+  if not isolated_format.is_valid_hash(isolated_hash, algo):
+    logging.debug('%s is not a valid hash, assuming a file '
+                  '(algo was %s, hash size was %d)',
+                  isolated_hash, algo(), algo().digest_size)
+    path = unicode(os.path.abspath(isolated_hash))
+    try:
+      isolated_hash = fetch_queue.inject_local_file(path, algo)
+    except IOError as e:
+      raise isolated_format.MappingError(
+          '%s doesn\'t seem to be a valid file. Did you intent to pass a '
+          'valid hash (error: %s)?' % (isolated_hash, e))
+
+  # Let the server expand the *.isolated files if possible.
+  tree = fetch_queue.storage.flatten(isolated_hash)
+  if tree:
+    bundle.load_flattened(fetch_queue, tree)
+    return
+
+  # Load all *.isolated and start loading rest of the files.
+  bundle.fetch(fetch_queue, isolated_hash, algo)
+
+
+def _create_tree(bundle, outdir):
+  """Creates the directories and symlinks of |bundle| in |outdir|.
+
+  Returns:
+    Multimap of the files to map: digest -> list of pairs (path, props). A
+    chunked file is listed once under each of its chunks, with props holding
+    the size of the chunk and a _ChunkedFile.
+  """
+  # Create file system hierarchy.
+  file_path.ensure_tree(outdir)
+  create_directories(outdir, bundle.files)
+  create_symlinks(outdir, bundle.files.iteritems())
+
+  # Ensure working directory exists.
+  cwd = os.path.normpath(os.path.join(outdir, bundle.relative_cwd))
+  file_path.ensure_tree(cwd)
+
+  remaining = {}
+  for filepath, props in bundle.files.iteritems():
+    if 'c' in props:
+      chunked = _ChunkedFile(props)
+      for digest, size in props['c']:
+        if digest not in chunked.pending:
+          chunked.pending.add(digest)
+          remaining.setdefault(digest, []).append(
+              (filepath, {'s': size, 'chunked': chunked}))
+    elif 'h' in props:
+      remaining.setdefault(props['h'], []).append((filepath, props))
+  return remaining
+
+
+class _ChunkedFile(object):
+  """Tracks the chunks of a chunked file not yet fetched by _map_tree()."""
+
+  def __init__(self, props):
+    self.props = props
+    self.pending = set()
+
+
+def _map_tree(fetch_queue, bundle, outdir, remaining, use_symlinks, until=None):
+  """Maps the files in |remaining| in |outdir| as they are fetched.
+
+  The directories must already exist. On multi-core machines, files are
+  created by a pool of threads as soon as their content lands in the cache, so
+  the main thread only waits for fetches.
+
+  Arguments:
+    remaining: multimap digest -> list of pairs (path, props), the digests are
+        removed as their files are mapped.
+    until: if specified, returns as soon as all these digests are mapped
+        instead of waiting for |remaining| to be empty. It is modified.
+  """
+  logging.info('Retrieving remaining files (%d of them)...',
+      fetch_queue.pending_count)
+  last_update = time.time()
+  pool = None
+  if MAP_THREADS > 1:
+    pool = threading_utils.ThreadPool(0, MAP_THREADS, 0, 'map')
+  try:
+    with threading_utils.DeadlockDetector(DEADLOCK_TIMEOUT) as detector:
+      while remaining if until is None else until:
+        detector.ping()
+
+        # Wait for any item to finish fetching to cache.
+        digest = fetch_queue.wait()
+        if until is not None:
+          until.discard(digest)
+
+        # Create the files in the destination using item in cache as the
+        # source.
+        for filepath, props in remaining.pop(digest):
+          fullpath = os.path.join(outdir, filepath)
+          chunked = props.get('chunked')
+          if chunked:
+            # A chunked file is created once all its chunks are in cache.
+            chunked.pending.discard(digest)
+            if chunked.pending:
+              continue
+            func = _map_chunked_file
+            args = (
+              fetch_queue.cache, fullpath, chunked.props, bundle.read_only,
+              fetch_queue.storage.hash_algo)
+          else:
+            func = _map_file
+            args = (
+              fetch_queue.cache, digest, fullpath, props, bundle.read_only,
+              use_symlinks)
+          if pool:
+            pool.add_task(0, func, *args)
+          else:
+            func(*args)
+
+        # Report progress.
+        duration = time.time() - last_update
+        if duration > DELAY_BETWEEN_UPDATES_IN_SECS:
+          msg = '%d files remaining...' % len(remaining)
+          sys.stdout.write(msg + '\n')
+          sys.stdout.flush()
+          logging.info(msg)
+          last_update = time.time()
+
+      if pool:
+        # Wait for the files to be created, raising the first error if any.
+        for _ in pool.iter_results():
           detector.ping()
+  finally:
+    if pool:
+      pool.close()
+
+
+def _map_file(cache, digest, fullpath, props, read_only, use_symlinks):
+  """Creates the file |fullpath| using the item |digest| in cache as source."""
+  with cache.getfileobj(digest) as srcfileobj:
+    filetype = props.get('t', 'basic')
+
+    if filetype == 'basic':
+      # Ignore all bits apart from the user.
+      file_mode = (props.get('m') or 0500) & 0700
+      if read_only:
+        # Enforce read-only if the root bundle does.
+        file_mode &= 0500
+      putfile(
+          srcfileobj, fullpath, file_mode,
+          use_symlink=use_symlinks)
+
+    elif filetype == 'tar':
+      basedir = os.path.dirname(fullpath)
+      with tarfile.TarFile(fileobj=srcfileobj, encoding='utf-8') as t:
+        for ti in t:
+          if not ti.isfile():
+            logging.warning(
+                'Path(%r) is nonfile (%s), skipped',
+                ti.name, ti.type)
+            continue
+          # Handle files created on Windows fetched on POSIX and the
+          # reverse.
+          other_sep = '/' if os.path.sep == '\\' else '\\'
+          name = ti.name.replace(other_sep, os.path.sep)
+          fp = os.path.normpath(os.path.join(basedir, name))
+          if not fp.startswith(basedir):
+            logging.error(
+                'Path(%r) is outside root directory',
+                fp)
+          ifd = t.extractfile(ti)
+          try:
+            file_path.ensure_tree(os.path.dirname(fp))
+          except OSError:
+            # Another thread may have created it concurrently.
+            if not fs.isdir(os.path.dirname(fp)):
+              raise
+          file_mode = ti.mode & 0700
+          if read_only:
+            # Enforce read-only if the root bundle does.
+            file_mode &= 0500
+          putfile(ifd, fp, file_mode, ti.size)
 
-          # Wait for any item to finish fetching to cache.
-          digest = fetch_queue.wait()
-
-          # Create the files in the destination using item in cache as the
-          # source.
-          for filepath, props in remaining.pop(digest):
-            fullpath = os.path.join(outdir, filepath)
-
-            with cache.getfileobj(digest) as srcfileobj:
-              filetype = props.get('t', 'basic')
-
-              if filetype == 'basic':
-                # Ignore all bits apart from the user.
-                file_mode = (props.get('m') or 0500) & 0700
-                if bundle.read_only:
-                  # Enforce read-only if the root bundle does.
-                  file_mode &= 0500
-                putfile(
-                    srcfileobj, fullpath, file_mode,
-                    use_symlink=use_symlinks)
-
-              elif filetype == 'tar':
-                basedir = os.path.dirname(fullpath)
-                with tarfile.TarFile(fileobj=srcfileobj, encoding='utf-8') as t:
-                  for ti in t:
-                    if not ti.isfile():
-                      logging.warning(
-                          'Path(%r) is nonfile (%s), skipped',
-                          ti.name, ti.type)
-                      continue
-                    # Handle files created on Windows fetched on POSIX and the
-                    # reverse.
-                    other_sep = '/' if os.path.sep == '\\' else '\\'
-                    name = ti.name.replace(other_sep, os.path.sep)
-                    fp = os.path.normpath(os.path.join(basedir, name))
-                    if not fp.startswith(basedir):
-                      logging.error(
-                          'Path(%r) is outside root directory',
-                          fp)
-                    ifd = t.extractfile(ti)
-                    file_path.ensure_tree(os.path.dirname(fp))
-                    file_mode = ti.mode & 0700
-                    if bundle.read_only:
-                      # Enforce read-only if the root bundle does.
-                      file_mode &= 0500
-                    putfile(ifd, fp, file_mode, ti.size)
-
-              else:
-                raise isolated_format.IsolatedError(
-                      'Unknown file type %r', filetype)
-
-          # Report progress.
-          duration = time.time() - last_update
-          if duration > DELAY_BETWEEN_UPDATES_IN_SECS:
-            msg = '%d files remaining...' % len(remaining)
-            sys.stdout.write(msg + '\n')
-            sys.stdout.flush()
-            logging.info(msg)
-            last_update = time.time()
-      assert fetch_queue.wait_queue_empty, 'FetchQueue should have been emptied'
+    else:
+      raise isolated_format.IsolatedError(
+            'Unknown file type %r', filetype)
+
+
+def _map_chunked_file(cache, fullpath, props, read_only, algo):
+  """Creates the file |fullpath| by concatenating its chunks in cache.
 
-  # Cache could evict some items we just tried to fetch, it's a fatal error.
+  The file is always copied since no single item in cache holds its content.
+  The content is verified against the file digest as it is written.
+  """
+  digest = algo()
+  with fs.open(fullpath, 'wb') as dstfileobj:
+    for chunk_digest, _ in props['c']:
+      with cache.getfileobj(chunk_digest) as srcfileobj:
+        while True:
+          data = srcfileobj.read(isolated_format.DISK_FILE_CHUNK)
+          if not data:
+            break
+          digest.update(data)
+          dstfileobj.write(data)
+  if digest.hexdigest() != props['h']:
+    fs.remove(fullpath)
+    raise isolated_format.IsolatedError(
+        'Chunks of %s don\'t match its digest %s' % (fullpath, props['h']))
+  # Ignore all bits apart from the user.
+  file_mode = (props.get('m') or 0500) & 0700
+  if read_only:
+    # Enforce read-only if the root bundle does.
+    file_mode &= 0500
+  fs.chmod(fullpath, file_mode)
+
+
+def _verify_all_cached(fetch_queue, cache):
+  """Raises MappingError if the cache evicted items that were just fetched."""
   if not fetch_queue.verify_all_cached():
     free_disk = file_path.get_free_space(cache.cache_dir)
     msg = (
@@ -1205,40 +1829,68 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, use_symlinks):
         '  %s\n  cache=%dbytes, %d items; %sb free_space') % (
           cache.policies, cache.total_size, cache.number_items, free_disk)
     raise isolated_format.MappingError(msg)
-  return bundle
 
 
-def directory_to_metadata(root, algo, blacklist):
-  """Returns the FileItem list and .isolated metadata for a directory."""
+def directory_to_metadata(
+    root, algo, blacklist, digest_cache=None, chunked=False):
+  """Returns the FileItem list and .isolated metadata for a directory.
+
+  If |digest_cache| is specified, it is used to skip hashing unchanged files.
+  If |chunked| is True, large files are split in chunks.
+  """
+  metadata = {}
+  items = list(_iter_directory_items(
+      root, algo, blacklist, digest_cache, metadata, chunked))
+  return items, metadata
+
+
+def _iter_directory_items(
+    root, algo, blacklist, digest_cache, metadata, chunked=False):
+  """Yields the items for each file in a directory as soon as it is hashed.
+
+  Files are hashed in parallel. hashlib and file I/O release the GIL, so a
+  thread pool scales with the number of cores. The .isolated metadata of each
+  entry is added to |metadata| as it is calculated; it is complete once the
+  generator is exhausted.
+  """
   root = file_path.get_native_path_case(root)
   paths = isolated_format.expand_directory_and_symlink(
       root, u'.' + os.path.sep, blacklist, sys.platform != 'win32')
-  metadata = {
-    relpath: isolated_format.file_to_metadata(
-        os.path.join(root, relpath), {}, 0, algo, False)
-    for relpath in paths
-  }
-  for v in metadata.itervalues():
-    v.pop('t')
-  items = [
-      FileItem(
-          path=os.path.join(root, relpath),
-          digest=meta['h'],
-          size=meta['s'],
-          high_priority=relpath.endswith('.isolated'))
-      for relpath, meta in metadata.iteritems() if 'h' in meta
-  ]
-  return items, metadata
 
+  def to_metadata(relpath):
+    return relpath, isolated_format.file_to_metadata(
+        os.path.join(root, relpath), {}, 0, algo, False, digest_cache, chunked)
 
-def archive_files_to_storage(storage, files, blacklist):
+  threads = max(threading_utils.num_processors(), 2)
+  pool = threading_utils.ThreadPool(min(2, threads), threads, 0, 'hash')
+  try:
+    for relpath in paths:
+      pool.add_task(threading_utils.PRIORITY_MED, to_metadata, relpath)
+    for relpath, meta in pool.iter_results():
+      meta.pop('t')
+      metadata[relpath] = meta
+      if 'h' in meta:
+        for item in iter_file_items(
+            os.path.join(root, relpath), meta, relpath.endswith('.isolated')):
+          yield item
+  finally:
+    pool.abort()
+    pool.close()
+
+
+def archive_files_to_storage(storage, files, blacklist, digest_cache=None):
   """Stores every entries and returns the relevant data.
 
+  Files are hashed in parallel, and looked up and uploaded to the server as
+  soon as they are hashed, while the next ones are being hashed.
+
   Arguments:
     storage: a Storage object that communicates with the remote object store.
     files: list of file paths to upload. If a directory is specified, a
            .isolated file is created and its hash is returned.
     blacklist: function that returns True if a file should be omitted.
+    digest_cache: optional isolated_format.DigestCache to skip hashing
+           unchanged files.
 
   Returns:
     tuple(list(tuple(hash, path)), list(FileItem cold), list(FileItem hot)).
@@ -1251,22 +1903,29 @@ def archive_files_to_storage(storage, files, blacklist):
   # List of tuple(hash, path).
   results = []
   # The temporary directory is only created as needed.
-  tempdir = None
-  try:
-    # TODO(maruel): Yield the files to a worker thread.
-    items_to_upload = []
+  tempdir = [None]
+  items_to_upload = []
+
+  def iter_items():
     for f in files:
       try:
         filepath = os.path.abspath(f)
         if fs.isdir(filepath):
           # Uploading a whole directory.
-          items, metadata = directory_to_metadata(
-              filepath, storage.hash_algo, blacklist)
+          metadata = {}
+          chunked = isolated_format.is_namespace_with_chunking(
+              storage.namespace)
+          for item in _iter_directory_items(
+              filepath, storage.hash_algo, blacklist, digest_cache, metadata,
+              chunked):
+            items_to_upload.append(item)
+            yield item
 
           # Create the .isolated file.
-          if not tempdir:
-            tempdir = tempfile.mkdtemp(prefix=u'isolateserver')
-          handle, isolated = tempfile.mkstemp(dir=tempdir, suffix=u'.isolated')
+          if not tempdir[0]:
+            tempdir[0] = tempfile.mkdtemp(prefix=u'isolateserver')
+          handle, isolated = tempfile.mkstemp(
+              dir=tempdir[0], suffix=u'.isolated')
           os.close(handle)
           data = {
               'algo':
@@ -1276,38 +1935,53 @@ def archive_files_to_storage(storage, files, blacklist):
           }
           isolated_format.save_isolated(isolated, data)
           h = isolated_format.hash_file(isolated, storage.hash_algo)
-          items_to_upload.extend(items)
-          items_to_upload.append(
-              FileItem(
-                  path=isolated,
-                  digest=h,
-                  size=fs.stat(isolated).st_size,
-                  high_priority=True))
+          item = FileItem(
+              path=isolated,
+              digest=h,
+              size=fs.stat(isolated).st_size,
+              high_priority=True)
           results.append((h, f))
 
         elif fs.isfile(filepath):
-          h = isolated_format.hash_file(filepath, storage.hash_algo)
-          items_to_upload.append(
-            FileItem(
-                path=filepath,
-                digest=h,
-                size=fs.stat(filepath).st_size,
-                high_priority=f.endswith('.isolated')))
+          if digest_cache is not None:
+            h = digest_cache.hash_file(filepath)
+          else:
+            h = isolated_format.hash_file(filepath, storage.hash_algo)
+          item = FileItem(
+              path=filepath,
+              digest=h,
+              size=fs.stat(filepath).st_size,
+              high_priority=f.endswith('.isolated'))
           results.append((h, f))
         else:
           raise Error('%s is neither a file or directory.' % f)
       except OSError:
         raise Error('Failed to process %s.' % f)
-    uploaded = storage.upload_items(items_to_upload)
+      items_to_upload.append(item)
+      yield item
+
+  items = iter_items()
+  try:
+    uploaded = storage.upload_items(items)
     cold = [i for i in items_to_upload if i in uploaded]
     hot = [i for i in items_to_upload if i not in uploaded]
     return results, cold, hot
   finally:
-    if tempdir and fs.isdir(tempdir):
-      file_path.rmtree(tempdir)
+    items.close()
+    if tempdir[0] and fs.isdir(tempdir[0]):
+      file_path.rmtree(tempdir[0])
+
 
+def get_digest_cache(cache_dir, namespace):
+  """Returns a DigestCache for |namespace| in |cache_dir|, or None."""
+  if not cache_dir:
+    return None
+  return isolated_format.DigestCache(
+      unicode(os.path.abspath(cache_dir)),
+      isolated_format.get_hash_algo(namespace))
 
-def archive(out, namespace, files, blacklist):
+
+def archive(out, namespace, files, blacklist, digest_cache_dir=None):
   if files == ['-']:
     files = sys.stdin.readlines()
 
@@ -1316,9 +1990,14 @@ def archive(out, namespace, files, blacklist):
 
   files = [f.decode('utf-8') for f in files]
   blacklist = tools.gen_blacklist(blacklist)
-  with get_storage(out, namespace) as storage:
+  digest_cache = get_digest_cache(digest_cache_dir, namespace)
+  # The digests found on the server are cached alongside the file digests.
+  with get_storage(out, namespace, digest_cache_dir) as storage:
     # Ignore stats.
-    results = archive_files_to_storage(storage, files, blacklist)[0]
+    results = archive_files_to_storage(
+        storage, files, blacklist, digest_cache)[0]
+  if digest_cache is not None:
+    digest_cache.save()
   print('\n'.join('%s %s' % (r[0], r[1]) for r in results))
 
 
@@ -1339,7 +2018,9 @@ def CMDarchive(parser, args):
   options, files = parser.parse_args(args)
   process_isolate_server_options(parser, options, True, True)
   try:
-    archive(options.isolate_server, options.namespace, files, options.blacklist)
+    archive(
+        options.isolate_server, options.namespace, files, options.blacklist,
+        options.digest_cache)
   except (Error, local_caching.NoMoreSpace) as e:
     parser.error(e.args[0])
   return 0
@@ -1431,6 +2112,12 @@ def add_archive_options(parser):
       action='append', default=list(DEFAULT_BLACKLIST),
       help='List of regexp to use as blacklist filter when uploading '
            'directories')
+  parser.add_option(
+      '--digest-cache', metavar='DIR',
+      help='Directory to keep a cache of file digests, so files that did not '
+           'change since they were last archived are not hashed again, and '
+           'of the digests recently found on the server, so they are not '
+           'looked up again')
 
 
 def add_isolate_server_options(parser):
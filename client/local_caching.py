@@ -12,6 +12,8 @@ import os
 import random
 import string
 import sys
+import threading
+import time
 
 from utils import file_path
 from utils import fs
@@ -19,6 +21,8 @@ from utils import lru
 from utils import threading_utils
 from utils import tools
 
+import isolated_format
+
 
 # The file size to be used when we don't know the correct file size,
 # generally used for .isolated files.
@@ -43,6 +47,43 @@ def file_write(path, content_generator):
   return total
 
 
+def _delete_tree(root):
+  """Deletes the directory tree |root| bottom up, one file at a time.
+
+  Yields the size of each file as it is deleted, so the caller can stop midway.
+  Files that cannot be deleted are logged and skipped.
+  """
+  for dirpath, dirnames, filenames in fs.walk(root, topdown=False):
+    if sys.platform != 'win32':
+      # Deleting a file fails if the directory is read-only.
+      file_path.set_read_only_swallow(dirpath, False)
+    for filename in filenames:
+      p = os.path.join(dirpath, filename)
+      try:
+        size = fs.lstat(p).st_size
+        if sys.platform == 'win32':
+          # Deleting a read-only file fails.
+          file_path.set_read_only(p, False)
+        fs.remove(p)
+      except OSError as e:
+        logging.warning('Failed to delete %r: %s', p, e)
+        continue
+      yield size
+    for dirname in dirnames:
+      p = os.path.join(dirpath, dirname)
+      try:
+        if fs.islink(p):
+          fs.unlink(p)
+        else:
+          fs.rmdir(p)
+      except OSError as e:
+        logging.warning('Failed to delete %r: %s', p, e)
+  try:
+    fs.rmdir(root)
+  except OSError as e:
+    logging.warning('Failed to delete %r: %s', root, e)
+
+
 def is_valid_file(path, size):
   """Determines if the given files appears valid.
 
@@ -121,6 +162,8 @@ class Cache(object):
     self._added = []
     self._evicted = []
     self._used = []
+    self._verified = []
+    self._corrupted = []
 
   @property
   def added(self):
@@ -132,6 +175,18 @@ class Cache(object):
     with self._lock:
       return self._used[:]
 
+  @property
+  def verified(self):
+    """Sizes of the items found valid by verify()."""
+    with self._lock:
+      return self._verified[:]
+
+  @property
+  def corrupted(self):
+    """Sizes of the items found corrupted and evicted by verify()."""
+    with self._lock:
+      return self._corrupted[:]
+
   def cleanup(self):
     """Deletes any corrupted item from the cache and trims it if necessary."""
     raise NotImplementedError()
@@ -221,6 +276,20 @@ class ContentAddressedCache(Cache):
     """
     raise NotImplementedError()
 
+  def verify(self, max_duration=None, max_bytes=None):
+    """Re-hashes items used since they were last verified.
+
+    Corrupted items are evicted.
+
+    Arguments:
+      max_duration: maximum number of seconds to spend hashing, or None.
+      max_bytes: maximum number of bytes to hash, or None.
+
+    Returns:
+      Number of items left to verify due to the budget.
+    """
+    raise NotImplementedError()
+
 
 class MemoryContentAddressedCache(ContentAddressedCache):
   """ContentAddressedCache implementation that stores everything in memory."""
@@ -286,13 +355,21 @@ class MemoryContentAddressedCache(ContentAddressedCache):
     """Trimming is not implemented for MemoryContentAddressedCache."""
     return 0
 
+  def verify(self, max_duration=None, max_bytes=None):
+    """Verification is not implemented for MemoryContentAddressedCache."""
+    return 0
+
 
 class DiskContentAddressedCache(ContentAddressedCache):
   """Stateful LRU cache in a flat hash table in a directory.
 
-  Saves its state as json file.
+  Saves its state as a journaled json file, so saving after a task only appends
+  the LRU changes instead of rewriting the whole state.
   """
   STATE_FILE = u'state.json'
+  # Timestamp of the last content verification of each item, journaled like
+  # STATE_FILE.
+  VERIFIED_FILE = u'verified.json'
 
   def __init__(self, cache_dir, policies, hash_algo, trim, time_fn=None):
     """
@@ -309,8 +386,11 @@ class DiskContentAddressedCache(ContentAddressedCache):
     self.policies = policies
     self.hash_algo = hash_algo
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
+    self.verified_file = os.path.join(cache_dir, self.VERIFIED_FILE)
     # Items in a LRU lookup dict(digest: size).
     self._lru = lru.LRUDict()
+    # LRUDict(digest: timestamp of the last verification), loaded by verify().
+    self._verification = None
     # Current cached free disk space. It is updated by self._trim().
     file_path.ensure_tree(self.cache_dir)
     self._free_disk = file_path.get_free_space(self.cache_dir)
@@ -381,7 +461,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
       previous = self._lru.keys_set()
       # It'd be faster if there were a readdir() function.
       for filename in fs.listdir(self.cache_dir):
-        if filename == self.STATE_FILE:
+        if filename in (self.STATE_FILE, self.VERIFIED_FILE):
           fs.chmod(os.path.join(self.cache_dir, filename), 0600)
           continue
         if filename in previous:
@@ -408,19 +488,9 @@ class DiskContentAddressedCache(ContentAddressedCache):
           self._lru.pop(filename)
         self._save()
 
-    # What remains to be done is to hash every single item to
-    # detect corruption, then save to ensure state.json is up to date.
-    # Sadly, on a 50GiB cache with 100MiB/s I/O, this is still over 8 minutes.
-    # TODO(maruel): Let's revisit once directory metadata is stored in
-    # state.json so only the files that had been mapped since the last cleanup()
-    # call are manually verified.
-    #
-    #with self._lock:
-    #  for digest in self._lru:
-    #    if not isolated_format.is_valid_hash(
-    #        self._path(digest), self.hash_algo):
-    #      self.evict(digest)
-    #      logging.info('Deleted corrupted item: %s', digest)
+    # Hashing every single item to detect corruption is not done here since on
+    # a 50GiB cache with 100MiB/s I/O, this is over 8 minutes. verify() only
+    # hashes the items used since they were last verified, within a budget.
 
   def touch(self, digest, size):
     """Verifies an actual file is valid and bumps its LRU position.
@@ -429,9 +499,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
     though (call 'evict' explicitly).
 
     Note that is doesn't compute the hash so it could still be corrupted if the
-    file size didn't change.
-
-    TODO(maruel): More stringent verification while keeping the check fast.
+    file size didn't change. verify() does it asynchronously.
     """
     # Do the check outside the lock.
     if not is_valid_file(self._path(digest), size):
@@ -507,6 +575,66 @@ class DiskContentAddressedCache(ContentAddressedCache):
     with self._lock:
       return self._trim()
 
+  def verify(self, max_duration=None, max_bytes=None):
+    """Re-hashes items used since they were last verified.
+
+    Corrupted items are evicted. The most recently used items are verified
+    first. The items not verified due to the budget are verified on the next
+    call. The lock is not held while hashing, so it can run concurrently with
+    other cache operations.
+    """
+    start = time.time()
+    with self._lock:
+      verified = self._load_verified()
+      # Forget the items evicted since the last verification.
+      for digest in [d for d in verified if d not in self._lru]:
+        verified.pop(digest)
+      # Newest items first.
+      candidates = [
+        (digest, self._lru[digest]) for digest in self._lru
+        if self._lru.get_timestamp(digest) > verified.get(digest, 0)
+      ][::-1]
+
+    hashed = 0
+    done = 0
+    corrupted = 0
+    for digest, size in candidates:
+      if max_duration is not None and time.time() - start >= max_duration:
+        break
+      if max_bytes is not None and hashed and hashed + size > max_bytes:
+        break
+      now = self._lru.time_fn()
+      try:
+        valid = isolated_format.hash_file(
+            self._path(digest), self.hash_algo) == digest
+      except (IOError, OSError):
+        valid = False
+      hashed += size
+      done += 1
+      with self._lock:
+        if digest not in self._lru:
+          # Evicted in the meantime.
+          continue
+        if valid:
+          verified.add(digest, now)
+          self._verified.append(size)
+        else:
+          logging.error('Deleted corrupted item: %s', digest)
+          self._lru.pop(digest)
+          self._delete_file(digest, UNKNOWN_FILE_SIZE)
+          self._corrupted.append(size)
+          corrupted += 1
+
+    with self._lock:
+      # _save() also ensures the cache directory is writable.
+      self._save()
+      verified.save(self.verified_file, journal=True)
+    logging.info(
+        'Verified %d items (%dkb) in %.1fs, %d corrupted, %d left',
+        done, hashed / 1024, time.time() - start, corrupted,
+        len(candidates) - done)
+    return len(candidates) - done
+
   def _load(self, trim, time_fn):
     """Loads state of the cache from json file.
 
@@ -538,6 +666,19 @@ class DiskContentAddressedCache(ContentAddressedCache):
           'Trimming evicted items with the following sizes: %s',
           sorted(self._evicted))
 
+  def _load_verified(self):
+    """Returns the LRUDict(digest: timestamp) of the last verification."""
+    self._lock.assert_locked()
+    if self._verification is None:
+      self._verification = lru.LRUDict()
+      if fs.isfile(self.verified_file):
+        try:
+          self._verification = lru.LRUDict.load(self.verified_file)
+        except ValueError as err:
+          # The items are verified again.
+          logging.warning('Ignoring verification state: %s', err)
+    return self._verification
+
   def _save(self):
     """Saves the LRU ordering."""
     self._lock.assert_locked()
@@ -548,7 +689,7 @@ class DiskContentAddressedCache(ContentAddressedCache):
         file_path.set_read_only(d, False)
     if fs.isfile(self.state_file):
       file_path.set_read_only(self.state_file, False)
-    self._lru.save(self.state_file)
+    self._lru.save(self.state_file, journal=True)
 
   def _trim(self):
     """Trims anything we don't know, make sure enough free space exists."""
@@ -675,6 +816,9 @@ class NamedCache(Cache):
   """
   _DIR_ALPHABET = string.ascii_letters + string.digits
   STATE_FILE = u'state.json'
+  # Evicted caches are renamed into this directory and deleted file by file
+  # later, see empty_trash().
+  TRASH_DIR = u'trash'
 
   def __init__(self, cache_dir, policies, time_fn=None):
     """Initializes NamedCaches.
@@ -689,7 +833,11 @@ class NamedCache(Cache):
     self._policies = policies
     # LRU {cache_name -> cache_location}
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
+    self.trash_dir = os.path.join(cache_dir, self.TRASH_DIR)
     self._lru = lru.LRUDict()
+    # Held while deleting the content of the trash directory. It is not
+    # self._lock since the trash is emptied while caches are installed.
+    self._trash_lock = threading.Lock()
     if not fs.isdir(self.cache_dir):
       fs.makedirs(self.cache_dir)
     if os.path.isfile(self.state_file):
@@ -813,6 +961,8 @@ class NamedCache(Cache):
 
         # Move the dir and create an entry for the named cache.
         abs_cache = os.path.join(self.cache_dir, rel_cache)
+        if os.path.isdir(abs_cache):
+          self._move_to_trash(abs_cache)
         logging.info('Moving %r to %r', path, abs_cache)
         file_path.ensure_tree(os.path.dirname(abs_cache))
         fs.rename(path, abs_cache)
@@ -874,11 +1024,18 @@ class NamedCache(Cache):
             break
           _remove_lru_file()
 
-      # Trim according to minimum free space.
+      # Trim according to minimum free space. Evicted caches are only moved to
+      # the trash, so delete from it only what is needed to reach the minimum
+      # and leave the rest to empty_trash().
       if self._policies.min_free_space:
         while True:
           free_space = file_path.get_free_space(self.cache_dir)
-          if not self._lru or free_space >= self._policies.min_free_space:
+          if free_space >= self._policies.min_free_space:
+            break
+          if self._delete_trash(
+              max_bytes=self._policies.min_free_space - free_space):
+            continue
+          if not self._lru:
             break
           _remove_lru_file()
 
@@ -894,6 +1051,100 @@ class NamedCache(Cache):
     # TODO(maruel): Implement.
     pass
 
+  def empty_trash(self, max_duration=None, max_rate=None, stop=None):
+    """Deletes the evicted caches moved to the trash directory.
+
+    It is safe to call while NamedCache is open and caches are installed, e.g.
+    from a background thread while a task runs. What is not deleted is left for
+    the next call.
+
+    Arguments:
+      max_duration: maximum number of seconds to spend deleting, or None.
+      max_rate: maximum number of files deleted per second, or None.
+      stop: threading.Event that interrupts the deletion when set, or None.
+
+    Returns:
+      Number of bytes freed.
+    """
+    return self._delete_trash(
+        max_duration=max_duration, max_rate=max_rate, stop=stop)
+
+  @contextlib.contextmanager
+  def emptying_trash(self, max_rate=None):
+    """Empties the trash in a background thread while in the context."""
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=self.empty_trash, name='empty_trash',
+        kwargs={'max_rate': max_rate, 'stop': stop})
+    thread.daemon = True
+    thread.start()
+    try:
+      yield
+    finally:
+      stop.set()
+      thread.join()
+
+  def _move_to_trash(self, abs_path):
+    """Renames a cache directory into the trash directory.
+
+    Falls back to deleting it right away if it cannot be renamed.
+    """
+    name = os.path.basename(abs_path)
+    while True:
+      dst = os.path.join(
+          self.trash_dir, u'%s_%d' % (name, random.randint(0, 2**31)))
+      if not fs.exists(dst):
+        break
+    try:
+      file_path.ensure_tree(self.trash_dir)
+      fs.rename(abs_path, dst)
+    except OSError as e:
+      logging.warning('Failed to move %r to the trash: %s', abs_path, e)
+      file_path.rmtree(abs_path)
+
+  def _delete_trash(
+      self, max_duration=None, max_bytes=None, max_rate=None, stop=None):
+    """Deletes files from the trash directory.
+
+    The freed space is accounted incrementally from each file deleted instead
+    of measuring the directories beforehand.
+
+    Returns:
+      Number of bytes freed.
+    """
+    start = time.time()
+    freed = 0
+    deleted = 0
+
+    def done():
+      if stop and stop.is_set():
+        return True
+      if max_bytes is not None and freed >= max_bytes:
+        return True
+      return max_duration is not None and time.time() - start >= max_duration
+
+    with self._trash_lock:
+      if not fs.isdir(self.trash_dir):
+        return 0
+      for name in sorted(fs.listdir(self.trash_dir)):
+        root = os.path.join(self.trash_dir, name)
+        for size in _delete_tree(root):
+          freed += size
+          deleted += 1
+          if max_rate:
+            delay = start + float(deleted) / max_rate - time.time()
+            if delay > 0:
+              time.sleep(delay)
+          if done():
+            break
+        if done():
+          break
+    if deleted:
+      logging.info(
+          'Deleted %d files (%dkb) from the named cache trash in %.1fs',
+          deleted, freed / 1024, time.time() - start)
+    return freed
+
   def _allocate_dir(self):
     """Creates and returns relative path of a new cache directory."""
     # We randomly generate directory names that have two lower/upper case
@@ -933,7 +1184,7 @@ class NamedCache(Cache):
 
     abs_path = os.path.join(self.cache_dir, rel_path)
     if os.path.isdir(abs_path):
-      file_path.rmtree(abs_path)
+      self._move_to_trash(abs_path)
     self._lru.pop(name)
 
   def _save(self):
@@ -25,6 +25,11 @@ Any ${SWARMING_BOT_FILE} on the command line will be replaced by the value of
 the --bot-file parameter. This file is used by a swarming bot to communicate
 state of the host to tasks. It is written to by the swarming bot's
 on_before_task() hook in the swarming server's custom bot_config.py.
+
+With --lazy-fetch, the ISOLATED_LAZY_FETCH_DONE environment variable is set to
+the path of a file created once all the files are mapped. The command must wait
+for it before reading files outside of the hot set. It is empty on success,
+otherwise it holds the error.
 """
 
 __version__ = '0.10.5'
@@ -85,6 +90,9 @@ ISOLATED_OUTDIR_PARAMETER = '${ISOLATED_OUTDIR}'
 EXECUTABLE_SUFFIX_PARAMETER = '${EXECUTABLE_SUFFIX}'
 SWARMING_BOT_FILE_PARAMETER = '${SWARMING_BOT_FILE}'
 
+# Environment variable set to the file created once a lazy fetch is done.
+LAZY_FETCH_DONE_ENV_VAR = 'ISOLATED_LAZY_FETCH_DONE'
+
 
 # The name of the log file to use.
 RUN_ISOLATED_LOG_FILE = 'run_isolated.log'
@@ -113,6 +121,16 @@ ISOLATED_TMP_DIR = u'it'
 CACHE_NAME_RE = re.compile(ur'^[a-z0-9_]{1,4096}$')
 
 
+# Version of the --access-profile file format.
+ACCESS_PROFILE_VERSION = 1
+
+
+# Maximum number of files per second deleted from the trash of evicted named
+# caches while a task runs, so it doesn't compete too much with the task for
+# I/O.
+NAMED_CACHE_TRASH_RATE = 1000
+
+
 OUTLIVING_ZOMBIE_MSG = """\
 *** Swarming tried multiple times to delete the %s directory and failed ***
 *** Hard failing the task ***
@@ -199,7 +217,17 @@ TaskData = collections.namedtuple(
       'env',
       # Environment variables to mutate with relative directories.
       # Example: {"ENV_KEY": ['relative', 'paths', 'to', 'prepend']}
-      'env_prefix'])
+      'env_prefix',
+      # isolated_format.DigestCache instance used to skip hashing unchanged
+      # output files, or None.
+      'digest_cache',
+      # List of fnmatch patterns of the files that must be mapped before the
+      # command starts, the rest being mapped while it runs. None to map all
+      # the files before starting the command.
+      'hot_set',
+      # Path to the json file recording the files accessed by previous runs,
+      # used to prioritize fetching when hot_set is set, or None.
+      'access_profile'])
 
 
 def get_as_zip_package(executable=True):
@@ -477,25 +505,73 @@ def run_command(command, cwd, env, hard_timeout, grace_period):
   return exit_code, had_hard_timeout
 
 
-def fetch_and_map(isolated_hash, storage, cache, outdir, use_symlinks):
-  """Fetches an isolated tree, create the tree and returns (bundle, stats)."""
+def fetch_and_map(
+    isolated_hash, storage, cache, outdir, use_symlinks, lazy_fetch=None):
+  """Fetches an isolated tree, create the tree and returns (bundle, stats).
+
+  If lazy_fetch is specified, only waits for its hot set to be mapped. The
+  stats must then be updated with get_download_stats() once it completed.
+  """
   start = time.time()
-  bundle = isolateserver.fetch_isolated(
-      isolated_hash=isolated_hash,
-      storage=storage,
-      cache=cache,
-      outdir=outdir,
-      use_symlinks=use_symlinks)
-  return bundle, {
+  if lazy_fetch:
+    bundle = lazy_fetch.start(isolated_hash)
+  else:
+    bundle = isolateserver.fetch_isolated(
+        isolated_hash=isolated_hash,
+        storage=storage,
+        cache=cache,
+        outdir=outdir,
+        use_symlinks=use_symlinks)
+  stats = {
     'duration': time.time() - start,
     'initial_number_items': cache.initial_number_items,
     'initial_size': cache.initial_size,
+  }
+  stats.update(get_download_stats(cache))
+  return bundle, stats
+
+
+def get_download_stats(cache):
+  """Returns the stats of the items fetched and used from |cache|."""
+  return {
+    'bytes_fetched': sum(cache.added),
     'items_cold': base64.b64encode(large.pack(sorted(cache.added))),
     'items_hot': base64.b64encode(
         large.pack(sorted(set(cache.used) - set(cache.added)))),
   }
 
 
+def load_access_profile(path):
+  """Returns the dict(path: score) of the files accessed by previous runs."""
+  try:
+    data = tools.read_json(path)
+    if data.get('version') == ACCESS_PROFILE_VERSION:
+      return data['files']
+  except (AttributeError, IOError, KeyError, ValueError) as e:
+    logging.info('Ignoring access profile %s: %s', path, e)
+  return {}
+
+
+def save_access_profile(path, profile, run_dir, files, since):
+  """Updates the access profile with the files in |run_dir| accessed |since|.
+
+  The score of each file decays exponentially so the profile adapts to the
+  files used by the most recent runs. It relies on the access time being
+  updated, so it is a noop on file systems mounted with noatime.
+  """
+  profile = {k: v * 0.5 for k, v in profile.iteritems() if v >= 0.02}
+  for filepath, props in files.iteritems():
+    if 'h' not in props:
+      continue
+    try:
+      if fs.stat(os.path.join(run_dir, filepath)).st_atime >= since:
+        profile[filepath] = profile.get(filepath, 0) + 1
+    except OSError:
+      pass
+  tools.write_json(
+      path, {'files': profile, 'version': ACCESS_PROFILE_VERSION}, True)
+
+
 def link_outputs_to_outdir(run_dir, out_dir, outputs):
   """Links any named outputs to out_dir so they can be uploaded.
 
@@ -547,9 +623,12 @@ def copy_recursively(src, dst):
       logging.info("Couldn't collect output file %s: %s", src, e)
 
 
-def delete_and_upload(storage, out_dir, leak_temp_dir):
+def delete_and_upload(storage, out_dir, leak_temp_dir, digest_cache=None):
   """Deletes the temporary run directory and uploads results back.
 
+  If |digest_cache| is specified, it is used to skip hashing output files that
+  are known, e.g. hardlinked from the isolated cache.
+
   Returns:
     tuple(outputs_ref, success, stats)
     - outputs_ref: a dict referring to the results archived back to the isolated
@@ -570,7 +649,7 @@ def delete_and_upload(storage, out_dir, leak_temp_dir):
     with tools.Profiler('ArchiveOutput'):
       try:
         results, f_cold, f_hot = isolateserver.archive_files_to_storage(
-            storage, [out_dir], None)
+            storage, [out_dir], None, digest_cache)
         outputs_ref = {
           'isolated': results[0][0],
           'isolatedserver': storage.location,
@@ -628,11 +707,13 @@ def map_and_run(data, constant_run_path):
     #      'get_client_duration': 0.,
     #    },
     #    'download': {
+    #      'bytes_fetched': 0,
     #      'duration': 0.,
     #      'initial_number_items': 0,
     #      'initial_size': 0,
     #      'items_cold': '<large.pack()>',
     #      'items_hot': '<large.pack()>',
+    #      'time_to_exec': 0.,
     #    },
     #    'upload': {
     #      'duration': 0.,
@@ -677,6 +758,10 @@ def map_and_run(data, constant_run_path):
   if data.relative_cwd:
     cwd = os.path.normpath(os.path.join(cwd, data.relative_cwd))
   command = data.command
+  # Set when the isolated tree is mapped while the command runs.
+  lazy_fetch = None
+  bundle = None
+  start = time.time()
   try:
     with data.install_packages_fn(run_dir) as cipd_info:
       if cipd_info:
@@ -685,13 +770,25 @@ def map_and_run(data, constant_run_path):
 
       if data.isolated_hash:
         isolated_stats = result['stats'].setdefault('isolated', {})
+        if data.hot_set is not None:
+          lazy_fetch_done = os.path.join(tmp_dir, u'lazy_fetch_done')
+          lazy_fetch = isolateserver.LazyFetch(
+              data.storage, data.isolate_cache, run_dir, data.use_symlinks,
+              data.hot_set,
+              load_access_profile(data.access_profile)
+                  if data.access_profile else None,
+              lazy_fetch_done)
         bundle, isolated_stats['download'] = fetch_and_map(
             isolated_hash=data.isolated_hash,
             storage=data.storage,
             cache=data.isolate_cache,
             outdir=run_dir,
-            use_symlinks=data.use_symlinks)
-        change_tree_read_only(run_dir, bundle.read_only)
+            use_symlinks=data.use_symlinks,
+            lazy_fetch=lazy_fetch)
+        if not lazy_fetch:
+          # With lazy_fetch, files are still being added to the directories so
+          # they can't be made read-only. The file modes are still enforced.
+          change_tree_read_only(run_dir, bundle.read_only)
         # Inject the command
         if not command and bundle.command:
           command = bundle.command + data.extra_args
@@ -726,6 +823,8 @@ def map_and_run(data, constant_run_path):
 
       with data.install_named_caches(run_dir):
         sys.stdout.flush()
+        if data.isolated_hash:
+          isolated_stats['download']['time_to_exec'] = time.time() - start
         start = time.time()
         try:
           # Need to switch the default account before 'get_command_env' call,
@@ -733,6 +832,8 @@ def map_and_run(data, constant_run_path):
           with set_luci_context_account(data.switch_to_account, tmp_dir):
             env = get_command_env(
                 tmp_dir, cipd_info, run_dir, data.env, data.env_prefix)
+            if lazy_fetch:
+              env[LAZY_FETCH_DONE_ENV_VAR] = _to_str(lazy_fetch_done)
             command = tools.fix_python_cmd(command, env)
             command = process_command(command, out_dir, data.bot_file)
             file_path.ensure_command_has_abs_path(command, cwd)
@@ -755,6 +856,9 @@ def map_and_run(data, constant_run_path):
   # Clean up
   finally:
     try:
+      if lazy_fetch:
+        _complete_lazy_fetch(lazy_fetch, data, bundle, run_dir, start, result)
+
       # Try to link files to the output directory, if specified.
       if out_dir:
         link_outputs_to_outdir(run_dir, out_dir, data.outputs)
@@ -795,7 +899,8 @@ def map_and_run(data, constant_run_path):
       if out_dir:
         isolated_stats = result['stats'].setdefault('isolated', {})
         result['outputs_ref'], success, isolated_stats['upload'] = (
-            delete_and_upload(data.storage, out_dir, data.leak_temp_dir))
+            delete_and_upload(
+                data.storage, out_dir, data.leak_temp_dir, data.digest_cache))
       if not success and result['exit_code'] == 0:
         result['exit_code'] = 1
     except Exception as e:
@@ -806,6 +911,26 @@ def map_and_run(data, constant_run_path):
   return result
 
 
+def _complete_lazy_fetch(lazy_fetch, data, bundle, run_dir, start, result):
+  """Waits for the files still being mapped after the command completed.
+
+  The directory must not be deleted while files are being mapped in it. Also
+  updates the download stats and the access profile.
+  """
+  try:
+    lazy_fetch.wait()
+  except Exception as e:
+    logging.exception('Failed to map the isolated tree: %s', e)
+    if not result['internal_failure']:
+      result['internal_failure'] = str(e)
+  result['stats']['isolated']['download'].update(
+      get_download_stats(data.isolate_cache))
+  if data.access_profile and bundle and result['duration'] is not None:
+    save_access_profile(
+        data.access_profile, load_access_profile(data.access_profile),
+        run_dir, bundle.files, start)
+
+
 def run_tha_test(data, result_json):
   """Runs an executable and records execution metadata.
 
@@ -1015,11 +1140,14 @@ def install_client_and_packages(
       })
 
 
-def clean_caches(isolate_cache, named_cache_manager):
+def clean_caches(isolate_cache, named_cache_manager, verify_budget=None):
   """Trims isolated and named caches.
 
   The goal here is to coherently trim both caches, deleting older items
   independent of which container they belong to.
+
+  If verify_budget is set, spends up to this number of seconds verifying the
+  content of the isolated cache items used since their last verification.
   """
   # TODO(maruel): Trim CIPD cache the same way.
   total = 0
@@ -1043,6 +1171,8 @@ def clean_caches(isolate_cache, named_cache_manager):
     for trim, _ in trimmers:
       total += trim()
   isolate_cache.cleanup()
+  if verify_budget:
+    isolate_cache.verify(max_duration=verify_budget)
   return total
 
 
@@ -1056,6 +1186,11 @@ def create_option_parser():
       help='Cleans the cache, trimming it necessary and remove corrupted items '
            'and returns without executing anything; use with -v to know what '
            'was done')
+  parser.add_option(
+      '--verify-budget', type='float', metavar='SECS',
+      help='With --clean, spends up to this number of seconds hashing the '
+           'isolated cache items used since they were last verified, '
+           'evicting the corrupted ones')
   parser.add_option(
       '--no-clean', action='store_true',
       help='Do not clean the cache automatically on startup. This is meant for '
@@ -1067,7 +1202,8 @@ def create_option_parser():
   parser.add_option(
       '--json',
       help='dump output metadata to json file. When used, run_isolated returns '
-           'non-zero only on internal failure')
+           'non-zero only on internal failure. With --clean, it contains the '
+           'number of isolated cache items verified and corrupted')
   parser.add_option(
       '--hard-timeout', type='float', help='Enforce hard timeout in execution')
   parser.add_option(
@@ -1120,6 +1256,33 @@ def create_option_parser():
       '-s', '--isolated',
       help='Hash of the .isolated to grab from the isolate server.')
   isolateserver.add_isolate_server_options(data_group)
+  data_group.add_option(
+      '--digest-cache', metavar='DIR',
+      help='Directory to keep a cache of file digests, so output files that '
+           'are already known are not hashed again')
+  data_group.add_option(
+      '--flatten-isolated', action='store_true',
+      help='Asks the isolate server to expand the .isolated file and its '
+           'includes in a single call, instead of fetching them one level at '
+           'a time. Ignored if the server doesn\'t support it')
+  data_group.add_option(
+      '--lazy-fetch', action='store_true',
+      help='Starts the command as soon as the files in the hot set are mapped, '
+           'the other files are mapped while the command runs. A file that is '
+           'accessed before being mapped is missing, so the command must only '
+           'use files in the hot set until the file named by '
+           '$%s exists. The tree directories are not made '
+           'read-only in this mode' % LAZY_FETCH_DONE_ENV_VAR)
+  data_group.add_option(
+      '--hot-set', action='append', default=[], metavar='PATTERN',
+      help='With --lazy-fetch, fnmatch pattern of the files relative to the '
+           'run directory to map before starting the command. The files '
+           'referenced by the isolated command are always included. Can be '
+           'specified multiple times')
+  data_group.add_option(
+      '--access-profile', metavar='FILE',
+      help='With --lazy-fetch, json file recording the files accessed by '
+           'previous runs, to fetch them first. It is updated after the run')
   parser.add_option_group(data_group)
 
   isolateserver.add_cache_options(parser)
@@ -1230,11 +1393,15 @@ def main(args):
       parser.error('Can\'t use --isolated with --clean.')
     if options.isolate_server:
       parser.error('Can\'t use --isolate-server with --clean.')
-    if options.json:
-      parser.error('Can\'t use --json with --clean.')
     if options.named_caches:
       parser.error('Can\t use --named-cache with --clean.')
-    clean_caches(isolate_cache, named_cache_manager)
+    clean_caches(
+        isolate_cache, named_cache_manager, verify_budget=options.verify_budget)
+    if options.json:
+      tools.write_json(options.json, {
+        'corrupted': len(isolate_cache.corrupted),
+        'verified': len(isolate_cache.verified),
+      }, dense=True)
     return 0
 
   if not options.no_clean:
@@ -1258,6 +1425,10 @@ def main(args):
     options.root_dir = unicode(os.path.abspath(options.root_dir))
   if options.json:
     options.json = unicode(os.path.abspath(options.json))
+  if (options.hot_set or options.access_profile) and not options.lazy_fetch:
+    parser.error('--hot-set and --access-profile require --lazy-fetch')
+  if options.access_profile:
+    options.access_profile = unicode(os.path.abspath(options.access_profile))
 
   if any('=' not in i for i in options.env):
     parser.error(
@@ -1306,7 +1477,10 @@ def main(args):
       for path, name in caches:
         named_cache_manager.install(path, name)
     try:
-      yield
+      # Caches evicted by clean_caches() are deleted while the task runs.
+      with named_cache_manager.emptying_trash(
+          max_rate=NAMED_CACHE_TRASH_RATE):
+        yield
     finally:
       # Uninstall each named cache, returning it to the cache pool. If an
       # uninstall fails for a given cache, it will remain in the task's
@@ -1354,16 +1528,27 @@ def main(args):
       install_packages_fn=install_packages_fn,
       use_symlinks=options.use_symlinks,
       env=options.env,
-      env_prefix=options.env_prefix)
+      env_prefix=options.env_prefix,
+      digest_cache=None,
+      hot_set=options.hot_set if options.lazy_fetch else None,
+      access_profile=options.access_profile)
   try:
     if options.isolate_server:
       storage = isolateserver.get_storage(
-          options.isolate_server, options.namespace)
+          options.isolate_server, options.namespace,
+          flatten=options.flatten_isolated)
       with storage:
-        data = data._replace(storage=storage)
+        data = data._replace(
+            storage=storage,
+            digest_cache=isolateserver.get_digest_cache(
+                options.digest_cache, options.namespace))
         # Hashing schemes used by |storage| and |isolate_cache| MUST match.
         assert storage.hash_algo == isolate_cache.hash_algo
-        return run_tha_test(data, options.json)
+        try:
+          return run_tha_test(data, options.json)
+        finally:
+          if data.digest_cache is not None:
+            data.digest_cache.save()
     return run_tha_test(data, options.json)
   except (
       cipd.Error,
@@ -9,6 +9,7 @@ __version__ = '0.12'
 
 import collections
 import datetime
+import itertools
 import json
 import logging
 import optparse
@@ -65,6 +66,11 @@ def default_task_name(options):
 ### Triggering.
 
 
+# Maximum number of tasks triggered by a single tasks/new_batch call. It must
+# not exceed NEW_BATCH_MAX_SIZE in ../appengine/swarming/handlers_endpoints.py.
+TRIGGER_BATCH_SIZE = 500
+
+
 # See ../appengine/swarming/swarming_rpcs.py.
 CipdPackage = collections.namedtuple(
     'CipdPackage',
@@ -184,6 +190,19 @@ def task_request_to_raw_request(task_request):
   return out
 
 
+def _get_error_message(result, msg):
+  """Appends the error details replied by the server to msg."""
+  if result['error'].get('errors'):
+    for err in result['error']['errors']:
+      if err.get('message'):
+        msg += '\nMessage: %s' % err['message']
+      if err.get('debugInfo'):
+        msg += '\nDebug info:\n%s' % err['debugInfo']
+  elif result['error'].get('message'):
+    msg += '\nMessage: %s' % result['error']['message']
+  return msg
+
+
 def swarming_trigger(swarming, raw_request):
   """Triggers a request on the Swarming server and returns the json data.
 
@@ -207,21 +226,37 @@ def swarming_trigger(swarming, raw_request):
     return None
   if result.get('error'):
     # The reply is an error.
-    msg = 'Failed to trigger task %s' % raw_request['name']
-    if result['error'].get('errors'):
-      for err in result['error']['errors']:
-        if err.get('message'):
-          msg += '\nMessage: %s' % err['message']
-        if err.get('debugInfo'):
-          msg += '\nDebug info:\n%s' % err['debugInfo']
-    elif result['error'].get('message'):
-      msg += '\nMessage: %s' % result['error']['message']
-
-    on_error.report(msg)
+    on_error.report(_get_error_message(
+        result, 'Failed to trigger task %s' % raw_request['name']))
     return None
   return result
 
 
+def swarming_trigger_batch(swarming, raw_requests):
+  """Triggers many requests on the Swarming server in a single call.
+
+  The call is not retried on server errors since some tasks may have been
+  created. The tasks that the server failed to create are reported per item
+  instead.
+
+  Returns:
+    list of the json data returned by swarming_trigger() for each request, None
+    on failure. An item has an 'error' key if this task wasn't created.
+  """
+  logging.info('Triggering %d tasks', len(raw_requests))
+  result = net.url_read_json(
+      swarming + '/_ah/api/swarming/v1/tasks/new_batch',
+      data={'requests': raw_requests}, retry_50x=False)
+  if not result:
+    on_error.report('Failed to trigger %d tasks' % len(raw_requests))
+    return None
+  if result.get('error'):
+    on_error.report(_get_error_message(
+        result, 'Failed to trigger %d tasks' % len(raw_requests)))
+    return None
+  return result['items']
+
+
 def setup_googletest(env, shards, index):
   """Sets googletest specific environment variables."""
   if shards > 1:
@@ -233,6 +268,38 @@ def setup_googletest(env, shards, index):
   return env
 
 
+def _supports_trigger_batch(swarming):
+  """Returns True if the server supports tasks/new_batch."""
+  result = net.url_read_json(swarming + '/_ah/api/swarming/v1/server/details')
+  return bool(result and result.get('new_batch'))
+
+
+def _trigger_batches(swarming, requests):
+  """Triggers the requests with swarming_trigger_batch().
+
+  The tasks the server failed to create are triggered once more.
+
+  Returns:
+    list of the json data for each request triggered, None for the ones that
+    were not. It is shorter than requests if a batch failed; the tasks of this
+    batch may have been created but their IDs are unknown.
+  """
+  results = []
+  for i in xrange(0, len(requests), TRIGGER_BATCH_SIZE):
+    chunk = requests[i:i+TRIGGER_BATCH_SIZE]
+    batch = swarming_trigger_batch(swarming, chunk)
+    if batch is None:
+      break
+    failed = [j for j, task in enumerate(batch) if task.get('error')]
+    if failed:
+      logging.warning('Triggering again %d tasks', len(failed))
+      retried = swarming_trigger_batch(swarming, [chunk[j] for j in failed])
+      for j, task in zip(failed, retried or []):
+        batch[j] = task
+    results.extend(None if task.get('error') else task for task in batch)
+  return results
+
+
 def trigger_task_shards(swarming, task_request, shards):
   """Triggers one or many subtasks of a sharded task.
 
@@ -248,13 +315,24 @@ def trigger_task_shards(swarming, task_request, shards):
       req['name'] += ':%s:%s' % (index, shards)
     return req
 
+  def trigger_each():
+    for request in requests:
+      task = swarming_trigger(swarming, request)
+      yield task
+      if not task:
+        return
+
   requests = [convert(index) for index in xrange(shards)]
+  if shards > 1 and _supports_trigger_batch(swarming):
+    results = _trigger_batches(swarming, requests)
+  else:
+    # Either there's a single shard or the server doesn't support batches.
+    results = trigger_each()
   tasks = {}
   priority_warning = False
-  for index, request in enumerate(requests):
-    task = swarming_trigger(swarming, request)
+  for index, (request, task) in enumerate(itertools.izip(requests, results)):
     if not task:
-      break
+      continue
     logging.info('Request result: %s', task)
     if (not priority_warning and
         int(task['request']['priority']) != task_request.priority):
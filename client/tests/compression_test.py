@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+import logging
+import os
+import sys
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+
+from utils import compression
+
+
+class CompressionTest(unittest.TestCase):
+  def test_get_codec(self):
+    self.assertIsNone(compression.get_codec('default'))
+    self.assertIsNone(compression.get_codec('temporary-foo'))
+    self.assertIs(compression.ZLIB, compression.get_codec('default-gzip'))
+    self.assertIs(compression.ZLIB, compression.get_codec('default-deflate'))
+    self.assertIsNone(compression.get_codec('default-bzip2'))
+    self.assertIsNone(compression.get_codec('default-flate'))
+    self.assertIs(compression.ZSTD, compression.get_codec('sha-256-zstd'))
+    self.assertIs(compression.LZ4, compression.get_codec('default-lz4'))
+
+  def test_roundtrip(self):
+    data = ['a' * 1000, os.urandom(100), 'b' * 2000]
+    for codec in set(compression.CODECS.itervalues()):
+      if not codec.available:
+        continue
+      for level in (0, 7):
+        compressed = ''.join(codec.compress(data, level))
+        self.assertEqual(
+            ''.join(data),
+            ''.join(codec.decompress([compressed], 512)), codec.name)
+        # Feed the compressed stream byte by byte.
+        self.assertEqual(
+            ''.join(data),
+            ''.join(codec.decompress(list(compressed), 512)), codec.name)
+
+  def test_chunk_size(self):
+    data = ['a' * 100000]
+    for codec in set(compression.CODECS.itervalues()):
+      if not codec.available:
+        continue
+      compressed = ''.join(codec.compress(data, 7))
+      chunks = list(codec.decompress([compressed], 512))
+      self.assertEqual(data[0], ''.join(chunks), codec.name)
+      self.assertEqual(512, max(len(c) for c in chunks), codec.name)
+
+  def test_corrupted(self):
+    for codec in set(compression.CODECS.itervalues()):
+      if not codec.available:
+        continue
+      compressed = ''.join(codec.compress(['a' * 1000], 7))
+      with self.assertRaises(IOError):
+        list(codec.decompress([compressed, 'garbage'], 512))
+
+  def test_unavailable(self):
+    for codec in set(compression.CODECS.itervalues()):
+      if codec.available:
+        continue
+      with self.assertRaises(ValueError):
+        list(codec.compress(['a'], 7))
+      with self.assertRaises(ValueError):
+        list(codec.decompress(['a'], 512))
+
+
+if __name__ == '__main__':
+  VERBOSE = '-v' in sys.argv
+  logging.basicConfig(level=logging.DEBUG if VERBOSE else logging.ERROR)
+  unittest.main()
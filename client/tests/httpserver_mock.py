@@ -6,6 +6,7 @@ import BaseHTTPServer
 import httplib
 import json
 import logging
+import SocketServer
 import threading
 
 
@@ -18,32 +19,63 @@ class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
   def send_json(self, data):
     """Sends a JSON response."""
+    data = json.dumps(data)
     self.send_response(200)
     self.send_header('Content-type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
     self.end_headers()
-    json.dump(data, self.wfile)
+    self.wfile.write(data)
 
   def send_octet_stream(self, data):
     """Sends a binary response."""
     self.send_response(200)
     self.send_header('Content-type', 'application/octet-stream')
+    self.send_header('Content-Length', str(len(data)))
     self.end_headers()
     self.wfile.write(data)
 
   def read_body(self):
     """Reads the request body."""
+    if self.headers.get('Transfer-Encoding') == 'chunked':
+      return ''.join(self._iter_chunks())
     return self.rfile.read(int(self.headers['Content-Length']))
 
   def drop_body(self):
     """Reads the request body."""
+    if self.headers.get('Transfer-Encoding') == 'chunked':
+      for _ in self._iter_chunks():
+        pass
+      return
     size = int(self.headers['Content-Length'])
     while size:
       chunk = min(4096, size)
       self.rfile.read(chunk)
       size -= chunk
 
+  ### Private methods
+
+  def _iter_chunks(self):
+    """Yields the chunks of a request body sent with chunked encoding."""
+    while True:
+      size = int(self.rfile.readline().split(';', 1)[0], 16)
+      if not size:
+        # Skip the trailer.
+        while self.rfile.readline().strip():
+          pass
+        return
+      yield self.rfile.read(size)
+      self.rfile.readline()
+
   ### Overrides from BaseHTTPRequestHandler
 
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    with self.server.parent._lock:
+      self.server.parent.connections += 1
+    if self.server.parent.keep_alive:
+      # HTTP/1.1 keeps the connection open between requests.
+      self.protocol_version = 'HTTP/1.1'
+
   def do_OPTIONS(self):
     if self.path == _STOP_EVENT:
       self.server.parent._stopped = True
@@ -55,15 +87,33 @@ class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         fmt % args)
 
 
+class _ThreadingHTTPServer(
+    SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  # The stop event is handled in another thread than MockServer._run(), so
+  # handle_request() must not block forever.
+  timeout = 0.1
+
+
 class MockServer(object):
   _HANDLER_CLS = None
 
-  def __init__(self):
+  def __init__(self, keep_alive=False):
+    """Starts the server.
+
+    If keep_alive is True, the server speaks HTTP/1.1 and handles each
+    connection in its own thread, so clients can reuse their connections.
+    """
     assert issubclass(self._HANDLER_CLS, MockHandler), self._HANDLER_CLS
+    self.keep_alive = keep_alive
+    # Number of connections accepted.
+    self.connections = 0
+    self._lock = threading.Lock()
     self._closed = False
     self._stopped = False
-    self._server = BaseHTTPServer.HTTPServer(
-        ('127.0.0.1', 0), self._HANDLER_CLS)
+    server_cls = (
+        _ThreadingHTTPServer if keep_alive else BaseHTTPServer.HTTPServer)
+    self._server = server_cls(('127.0.0.1', 0), self._HANDLER_CLS)
     self._server.parent = self
     self._server.url = self.url = 'http://127.0.0.1:%d' % (
         self._server.server_port)
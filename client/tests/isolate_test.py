@@ -290,6 +290,7 @@ class IsolateLoad(IsolateBase):
       extra_variables = {'foo': 'bar'}
       ignore_broken_items = False
       collapse_symlinks = False
+      digest_cache = None
     return Options()
 
   def _cleanup_isolated(self, expected_isolated):
@@ -1243,7 +1244,9 @@ class IsolateCommand(IsolateBase):
   def test_CMDarchive(self):
     actual = []
 
-    def mocked_upload_tree(base_url, infiles, namespace):
+    def mocked_upload_tree(
+        base_url, infiles, namespace, presence_cache_dir=None):
+      self.assertIsNone(presence_cache_dir)
       # |infiles| may be a generator of pair, materialize it into a list.
       actual.append({
         'base_url': base_url,
@@ -1307,7 +1310,9 @@ class IsolateCommand(IsolateBase):
     # Same as test_CMDarchive but via code path that parses *.gen.json files.
     actual = []
 
-    def mocked_upload_tree(base_url, infiles, namespace):
+    def mocked_upload_tree(
+        base_url, infiles, namespace, presence_cache_dir=None):
+      self.assertIsNone(presence_cache_dir)
       # |infiles| may be a generator of pair, materialize it into a list.
       actual.append({
         'base_url': base_url,
@@ -1426,6 +1431,74 @@ class IsolateCommand(IsolateBase):
     }
     self.assertEqual(expected_json, tools.read_json('json_output.json'))
 
+  def _write_gen_json(self, name, filename, content):
+    """Writes a tree with a single file and returns its .isolated.gen.json."""
+    isolate_file = os.path.join(self.cwd, name + '.isolate')
+    with open(isolate_file, 'wb') as f:
+      f.write(
+          '{'
+          '  \'variables\': {'
+          '    \'files\': [%r],'
+          '  },'
+          '}' % filename)
+    with open(os.path.join(self.cwd, filename), 'wb') as f:
+      f.write(content)
+    gen_json = os.path.join(self.cwd, name + '.isolated.gen.json')
+    with open(gen_json, 'wb') as f:
+      json.dump({
+        'args': [
+          '-i', isolate_file,
+          '-s', os.path.join(self.cwd, name + '.isolated'),
+        ],
+        'dir': self.cwd,
+        'version': 1,
+      }, f)
+    return gen_json
+
+  def test_CMDbatcharchive_digest_cache(self):
+    # The top level --digest-cache is used for the trees that don't specify
+    # one, and to cache the digests present on the server.
+    presence_cache_dirs = []
+    def mocked_upload_tree(
+        base_url, infiles, namespace, presence_cache_dir=None):
+      list(infiles)
+      presence_cache_dirs.append(presence_cache_dir)
+    self.mock(isolateserver, 'upload_tree', mocked_upload_tree)
+    self.mock(sys, 'stdout', cStringIO.StringIO())
+    gen_json = self._write_gen_json('x', 'foo', 'fooo')
+    # Recently modified files are not cached.
+    os.utime(os.path.join(self.cwd, 'foo'), (1000000000, 1000000000))
+    cache_dir = os.path.join(self.cwd, 'digests')
+    cmd = [
+      '--isolate-server', 'http://localhost:1',
+      '--digest-cache', cache_dir,
+      gen_json,
+    ]
+    self.assertEqual(
+        0,
+        isolate.CMDbatcharchive(logging_utils.OptionParserWithLogging(), cmd))
+    cache = isolated_format.DigestCache(unicode(cache_dir), ALGO)
+    self.assertEqual(1, len(cache))
+    self.assertEqual([cache_dir], presence_cache_dirs)
+
+  def test_CMDbatcharchive_chunked(self):
+    # The top level --namespace decides whether large files are chunked.
+    self.mock(isolateserver, 'upload_tree', lambda **kwargs: None)
+    self.mock(sys, 'stdout', cStringIO.StringIO())
+    self.mock(isolated_format, 'CHUNKED_FILE_MIN_SIZE', 4)
+    gen_json = self._write_gen_json('x', 'foo', 'fooo')
+    cmd = [
+      '--isolate-server', 'http://localhost:1',
+      '--namespace', 'default-chunked-gzip',
+      gen_json,
+    ]
+    self.assertEqual(
+        0,
+        isolate.CMDbatcharchive(logging_utils.OptionParserWithLogging(), cmd))
+    isolated = tools.read_json(os.path.join(self.cwd, 'x.isolated'))
+    self.assertEqual(
+        [[ALGO('fooo').hexdigest(), 4]], isolated['files']['foo']['c'])
+
   def test_CMDcheck_empty(self):
     isolate_file = os.path.join(self.cwd, 'x.isolate')
     isolated_file = os.path.join(self.cwd, 'x.isolated')
@@ -4,11 +4,13 @@
 # that can be found in the LICENSE file.
 
 import hashlib
+import io
 import json
 import logging
 import os
 import sys
 import tempfile
+import time
 import unittest
 
 # net_utils adjusts sys.path.
@@ -182,6 +184,151 @@ class SymlinkTest(unittest.TestCase):
       self.assertEqual(expected, actual)
 
 
+class DigestCacheTest(auto_stub.TestCase):
+  def setUp(self):
+    super(DigestCacheTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+    self.cache_dir = os.path.join(self.tempdir, u'cache')
+    self.hashed = []
+    hash_file = isolated_format.hash_file
+    def mock_hash_file(filepath, algo):
+      self.hashed.append(filepath)
+      return hash_file(filepath, algo)
+    self.mock(isolated_format, 'hash_file', mock_hash_file)
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(DigestCacheTest, self).tearDown()
+
+  def make_file(self, name, content, mtime=1000000000):
+    path = os.path.join(self.tempdir, name)
+    with open(path, 'wb') as f:
+      f.write(content)
+    os.utime(path, (mtime, mtime))
+    return path
+
+  def test_hit_across_instances(self):
+    path = self.make_file(u'a', 'foo')
+    with isolated_format.DigestCache(self.cache_dir, ALGO) as cache:
+      self.assertEqual(ALGO('foo').hexdigest(), cache.hash_file(path))
+      self.assertEqual(ALGO('foo').hexdigest(), cache.hash_file(path))
+      self.assertEqual((1, 1), (cache.hits, cache.misses))
+    self.assertEqual([path], self.hashed)
+    self.assertTrue(
+        os.path.isfile(os.path.join(self.cache_dir, 'digests.sha-1.json')))
+
+    cache = isolated_format.DigestCache(self.cache_dir, ALGO)
+    self.assertEqual(1, len(cache))
+    self.assertEqual(ALGO('foo').hexdigest(), cache.hash_file(path))
+    self.assertEqual([path], self.hashed)
+
+  def test_invalidated_on_change(self):
+    path = self.make_file(u'a', 'foo')
+    cache = isolated_format.DigestCache(self.cache_dir, ALGO)
+    cache.hash_file(path)
+    # Same size, different mtime.
+    self.make_file(u'a', 'bar', mtime=1000000001)
+    self.assertEqual(ALGO('bar').hexdigest(), cache.hash_file(path))
+    # Same mtime, different size.
+    self.make_file(u'a', 'bazz', mtime=1000000001)
+    self.assertEqual(ALGO('bazz').hexdigest(), cache.hash_file(path))
+    self.assertEqual([path, path, path], self.hashed)
+
+  def test_recent_file_not_cached(self):
+    path = self.make_file(u'a', 'foo', mtime=time.time())
+    cache = isolated_format.DigestCache(self.cache_dir, ALGO)
+    cache.hash_file(path)
+    cache.hash_file(path)
+    self.assertEqual([path, path], self.hashed)
+    self.assertEqual(0, len(cache))
+
+  def test_broken_file_ignored(self):
+    os.mkdir(self.cache_dir)
+    with open(os.path.join(self.cache_dir, 'digests.sha-1.json'), 'wb') as f:
+      f.write('not json')
+    cache = isolated_format.DigestCache(self.cache_dir, ALGO)
+    self.assertEqual(0, len(cache))
+
+  def test_file_to_metadata(self):
+    path = self.make_file(u'a', 'foo')
+    cache = isolated_format.DigestCache(self.cache_dir, ALGO)
+    for _ in xrange(2):
+      meta = isolated_format.file_to_metadata(
+          path, {}, 0, ALGO, False, cache)
+      self.assertEqual(ALGO('foo').hexdigest(), meta['h'])
+    self.assertEqual([path], self.hashed)
+
+
+class ChunkTest(auto_stub.TestCase):
+  def setUp(self):
+    super(ChunkTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+
+  def tearDown(self):
+    try:
+      file_path.rmtree(self.tempdir)
+    finally:
+      super(ChunkTest, self).tearDown()
+
+  @staticmethod
+  def _content(size):
+    # Deterministic pseudo random content so the boundaries are stable.
+    return ''.join(
+        hashlib.sha512(str(i)).digest() for i in xrange(size / 64))
+
+  @staticmethod
+  def _chunks(content):
+    return list(isolated_format.iter_chunks(io.BytesIO(content)))
+
+  def test_is_namespace_with_chunking(self):
+    self.assertTrue(
+        isolated_format.is_namespace_with_chunking('default-chunked-gzip'))
+    self.assertFalse(isolated_format.is_namespace_with_chunking('default-gzip'))
+
+  def test_iter_chunks(self):
+    content = self._content(20 * 1024 * 1024)
+    chunks = self._chunks(content)
+    self.assertEqual(content, ''.join(chunks))
+    self.assertTrue(len(chunks) > 1)
+    for chunk in chunks[:-1]:
+      self.assertTrue(
+          isolated_format.CHUNK_MIN_SIZE < len(chunk) <=
+          isolated_format.CHUNK_MAX_SIZE)
+
+  def test_iter_chunks_small(self):
+    self.assertEqual([], self._chunks(''))
+    self.assertEqual(['a'], self._chunks('a'))
+
+  def test_iter_chunks_shifted(self):
+    # Inserting bytes at the start of a file only changes the first chunk.
+    content = self._content(20 * 1024 * 1024)
+    chunks = self._chunks(content)
+    shifted = self._chunks('inserted' + content)
+    self.assertEqual(chunks[1:], shifted[1:])
+
+  def test_file_to_metadata(self):
+    self.mock(isolated_format, 'CHUNKED_FILE_MIN_SIZE', 1024 * 1024)
+    content = self._content(5 * 1024 * 1024)
+    path = os.path.join(self.tempdir, u'big')
+    with open(path, 'wb') as f:
+      f.write(content)
+    out = isolated_format.file_to_metadata(
+        path, {}, False, ALGO, False, chunked=True)
+    self.assertEqual(ALGO(content).hexdigest(), out['h'])
+    self.assertEqual(
+        [[ALGO(c).hexdigest(), len(c)] for c in self._chunks(content)],
+        out['c'])
+    # Not chunked without chunking or below the threshold.
+    out = isolated_format.file_to_metadata(path, {}, False, ALGO, False)
+    self.assertNotIn('c', out)
+    self.mock(isolated_format, 'CHUNKED_FILE_MIN_SIZE', len(content) + 1)
+    out = isolated_format.file_to_metadata(
+        path, {}, False, ALGO, False, chunked=True)
+    self.assertNotIn('c', out)
+
+
 class TestIsolated(auto_stub.TestCase):
   def test_load_isolated_empty(self):
     m = isolated_format.load_isolated('{}', isolateserver_mock.ALGO)
@@ -268,6 +415,37 @@ class TestIsolated(auto_stub.TestCase):
     expected = gen_data(os.path.sep)
     self.assertEqual(expected, actual)
 
+  def test_load_isolated_chunked(self):
+    digest = u'0123456789abcdef0123456789abcdef01234567'
+    data = {
+      u'files': {
+        u'a': {
+          u'c': [[digest, 2], [digest, 1]],
+          u'h': digest,
+          u's': 3,
+        },
+      },
+      u'version': isolated_format.ISOLATED_FILE_VERSION,
+    }
+    m = isolated_format.load_isolated(json.dumps(data), isolateserver_mock.ALGO)
+    self.assertEqual(data, m)
+
+  def test_load_isolated_chunked_bad(self):
+    digest = u'0123456789abcdef0123456789abcdef01234567'
+    for props in (
+        {u'c': [], u'h': digest, u's': 0},
+        {u'c': [[digest, 2]], u'h': digest, u's': 3},
+        {u'c': [[u'bad', 3]], u'h': digest, u's': 3},
+        {u'c': [[digest, 3]], u'h': digest, u's': 3, u't': u'tar'},
+      ):
+      data = {
+        u'files': {u'a': props},
+        u'version': isolated_format.ISOLATED_FILE_VERSION,
+      }
+      with self.assertRaises(isolated_format.IsolatedError):
+        isolated_format.load_isolated(
+            json.dumps(data), isolateserver_mock.ALGO)
+
   def test_save_isolated_good_long_size(self):
     calls = []
     self.mock(tools, 'write_json', lambda *x: calls.append(x))
@@ -68,6 +68,41 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
     self.server.contents[namespace][embedded['d']] = content
     self.send_json({'ok': True})
 
+  def _flatten(self, namespace, digest):
+    """Merges a .isolated file and its includes, like the server does."""
+    self.server.flattened.append(digest)
+    tree = {'command': [], 'files': [], 'isolated': []}
+    seen_files = set()
+    def walk(d):
+      tree['isolated'].append(d)
+      content = base64.b64decode(self.server.contents[namespace][d])
+      if namespace.endswith(('-gzip', '-deflate')):
+        content = zlib.decompress(content)
+      data = json.loads(content)
+      if not tree['command'] and data.get('command'):
+        tree['command'] = data['command']
+      for key in ('read_only', 'relative_cwd'):
+        if key not in tree and data.get(key) is not None:
+          # Integers are encoded as strings by the server.
+          tree[key] = (
+              str(data[key]) if isinstance(data[key], int) else data[key])
+      for path, props in sorted(data.get('files', {}).iteritems()):
+        if path not in seen_files:
+          seen_files.add(path)
+          f = {'path': path}
+          for key, name in (
+              ('h', 'digest'), ('l', 'link'), ('m', 'mode'), ('s', 'size'),
+              ('t', 'type')):
+            if key in props:
+              f[name] = (
+                  str(props[key]) if isinstance(props[key], int)
+                  else props[key])
+          tree['files'].append(f)
+      for child in data.get('includes', []):
+        walk(child)
+    walk(digest)
+    return tree
+
   ### Mocked HTTP Methods
 
   def do_GET(self):
@@ -79,6 +114,30 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
           'primary_url': self.server.url})
     elif self.path == '/auth/api/v1/accounts/self':
       self.send_json({'identity': 'user:joe', 'xsrf_token': 'foo'})
+    elif self.path.startswith('/isolate/api/v1/raw/'):
+      namespace, digest = self.path[len('/isolate/api/v1/raw/'):].split('/')
+      data = self.server.contents.get(namespace, {}).get(digest)
+      if data is None:
+        logging.error('Failed to retrieve %s / %s', namespace, digest)
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      data = base64.b64decode(data)
+      m = re.match(r'^bytes=(\d+)-$', self.headers.get('Range', ''))
+      if m:
+        offset = int(m.group(1))
+        self.send_response(206)
+        self.send_header(
+            'Content-Range', 'bytes %d-%d/%d' % (
+                offset, len(data) - 1, len(data)))
+        data = data[offset:]
+      else:
+        self.send_response(200)
+      self.send_header('Content-Type', 'application/octet-stream')
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
     else:
       raise NotImplementedError(self.path)
 
@@ -125,8 +184,16 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
         logging.error(
             'Failed to retrieve %s / %s', namespace, request['digest'])
       self.send_json({'content': data})
+    elif self.path.startswith('/_ah/api/isolateservice/v1/flatten'):
+      request = json.loads(body)
+      self.send_json(
+          self._flatten(request['namespace']['namespace'], request['digest']))
     elif self.path.startswith('/_ah/api/isolateservice/v1/server_details'):
-      self.send_json({'server_version': 'such a good version'})
+      self.send_json({
+        'flatten': True,
+        'raw_retrieve': True,
+        'server_version': 'such a good version',
+      })
     else:
       raise NotImplementedError(self.path)
 
@@ -147,10 +214,12 @@ class IsolateServerHandler(httpserver_mock.MockHandler):
 class MockIsolateServer(httpserver_mock.MockServer):
   _HANDLER_CLS = IsolateServerHandler
 
-  def __init__(self):
-    super(MockIsolateServer, self).__init__()
+  def __init__(self, keep_alive=False):
+    super(MockIsolateServer, self).__init__(keep_alive)
     self._server.contents = {}
     self._server.discard_content = False
+    # Digests of the .isolated files flattened.
+    self._server.flattened = []
 
   def discard_content(self):
     """Stops saving content in memory. Used to test large files."""
@@ -160,6 +229,10 @@ class MockIsolateServer(httpserver_mock.MockServer):
   def contents(self):
     return self._server.contents
 
+  @property
+  def flattened(self):
+    return self._server.flattened
+
   def add_content_compressed(self, namespace, content):
     assert not self._server.discard_content
     h = hash_content(content)
@@ -16,6 +16,7 @@ import stat
 import sys
 import tarfile
 import tempfile
+import threading
 import unittest
 import zlib
 
@@ -30,9 +31,11 @@ import isolate_storage
 import local_caching
 import test_utils
 from depot_tools import fix_encoding
+from utils import compression
 from utils import file_path
 from utils import fs
 from utils import logging_utils
+from utils import net
 from utils import threading_utils
 
 import isolateserver_mock
@@ -345,6 +348,87 @@ class StorageTest(TestCase):
     batches = list(isolateserver.batch_items_for_check(items))
     self.assertEqual(batches, expected)
 
+  def test_batch_items_for_check_generator(self):
+    items = [isolate_storage.Item(str(i), i) for i in xrange(25)]
+    batches = list(isolateserver.batch_items_for_check(i for i in items))
+    # Generated items are not sorted.
+    self.assertEqual([items[:20], items[20:]], batches)
+
+  def test_contains_window(self):
+    window = isolateserver.ContainsWindow()
+    self.assertEqual(20, window.batch_size)
+    self.assertEqual(4, window.concurrency)
+    # Fast queries grow both.
+    window.on_success(20, 0.1)
+    window.on_success(40, 0.15)
+    self.assertEqual(80, window.batch_size)
+    self.assertEqual(6, window.concurrency)
+    # A partial batch doesn't grow the batch size.
+    window.on_success(10, 0.1)
+    self.assertEqual(80, window.batch_size)
+    self.assertEqual(7, window.concurrency)
+    # A slow query shrinks the batch size, a really slow one the concurrency.
+    window.on_success(80, 0.3)
+    self.assertEqual(40, window.batch_size)
+    self.assertEqual(7, window.concurrency)
+    window.on_success(40, 0.5)
+    self.assertEqual(20, window.batch_size)
+    self.assertEqual(3, window.concurrency)
+    window.on_failure()
+    self.assertEqual(20, window.batch_size)
+    self.assertEqual(1, window.concurrency)
+    for _ in xrange(10):
+      window.on_success(window.batch_size, 0.1)
+    self.assertEqual(1000, window.batch_size)
+    self.assertEqual(11, window.concurrency)
+
+  def test_batch_items_for_check_window(self):
+    items = [isolate_storage.Item(str(i), i) for i in xrange(100)]
+    window = isolateserver.ContainsWindow()
+    batches = []
+    for batch in isolateserver.batch_items_for_check(
+        (i for i in items), window):
+      batches.append(batch)
+      window.on_success(len(batch), 0.1)
+    self.assertEqual([20, 40, 40], map(len, batches))
+
+  def test_get_missing_items_presence_cache(self):
+    items = [FakeItem(str(i)) for i in xrange(4)]
+    storage_api = MockedStorageApi({items[0].digest: 'push_state'})
+    now = [1000.]
+    presence_cache = isolateserver.PresenceCache(
+        self.tempdir, 'https://localhost:1', 'default', ttl=60,
+        time_fn=lambda: now[0])
+    storage = isolateserver.Storage(storage_api, presence_cache)
+    self.assertEqual(
+        {items[0]: 'push_state'}, dict(storage.get_missing_items(items)))
+    self.assertEqual(3, len(presence_cache))
+
+    # The items found are not looked up again, also from a generator.
+    storage_api.contains_calls = []
+    self.assertEqual(
+        {items[0]: 'push_state'},
+        dict(storage.get_missing_items(i for i in items)))
+    self.assertEqual([[items[0]]], storage_api.contains_calls)
+    storage.close()
+
+    # Once saved, it is reloaded without the expired entries.
+    now[0] += 30
+    presence_cache.add([items[0].digest])
+    presence_cache.save()
+    now[0] += 31
+    presence_cache = isolateserver.PresenceCache(
+        self.tempdir, 'https://localhost:1', 'default', ttl=60,
+        time_fn=lambda: now[0])
+    self.assertEqual(1, len(presence_cache))
+    self.assertTrue(presence_cache.is_present(items[0].digest))
+    self.assertFalse(presence_cache.is_present(items[1].digest))
+    # Other servers don't share the cache.
+    self.assertEqual(
+        0,
+        len(isolateserver.PresenceCache(
+            self.tempdir, 'https://localhost:2', 'default')))
+
   def test_get_missing_items(self):
     items = [
       isolate_storage.Item('foo', 12),
@@ -366,6 +450,27 @@ class StorageTest(TestCase):
     result = dict(storage.get_missing_items(items))
     self.assertEqual(missing, result)
 
+  def test_upload_items_generator(self):
+    items = [FakeItem(str(i)) for i in xrange(30)]
+    storage_api = MockedStorageApi({items[3].digest: 'push_state'})
+    storage = isolateserver.Storage(storage_api)
+    queried = threading.Event()
+    self.mock(
+        storage_api, 'contains',
+        lambda batch: queried.set() or MockedStorageApi.contains(
+            storage_api, batch))
+
+    def gen():
+      for i, item in enumerate(items):
+        if i == 25:
+          # The first batch is looked up while items are still being generated.
+          self.assertTrue(queried.wait(10))
+        yield item
+
+    self.assertEqual([items[3]], storage.upload_items(gen()))
+    self.assertEqual([items[:20], items[20:]], storage_api.contains_calls)
+    storage.close()
+
   def test_async_push(self):
     for use_zip in (False, True):
       item = FakeItem('1234567')
@@ -383,6 +488,27 @@ class StorageTest(TestCase):
           [(item, 'push_state', item.zipped if use_zip else item.data)],
           storage_api.push_calls)
 
+  def test_async_push_flate(self):
+    # The content of -flate namespaces is stored as-is.
+    item = FakeItem('1234567')
+    storage_api = MockedStorageApi(
+        {item.digest: 'push_state'}, namespace='default-flate')
+    storage = isolateserver.Storage(storage_api)
+    channel = threading_utils.TaskChannel()
+    storage.async_push(channel, item, self.get_push_state(storage, item))
+    self.assertEqual(item, channel.pull())
+    self.assertEqual(
+        [(item, 'push_state', item.data)], storage_api.push_calls)
+
+  def test_storage_codec_unavailable(self):
+    self.mock(compression, 'zstandard', None)
+    with self.assertRaises(ValueError):
+      isolateserver.Storage(MockedStorageApi({}, namespace='default-zstd'))
+
+  def test_get_zip_compression_level(self):
+    self.assertEqual(0, isolateserver.get_zip_compression_level('a/b.ZIP'))
+    self.assertEqual(7, isolateserver.get_zip_compression_level('a/b.so'))
+
   def test_async_push_generator_errors(self):
     class FakeException(Exception):
       pass
@@ -438,6 +564,20 @@ class StorageTest(TestCase):
         self.assertEqual(
             [expected_push] * attempts, storage_api.push_calls)
 
+  def test_zip_stream_restarts(self):
+    item = FakeItem('1234567' * 100000)
+    storage = isolateserver.Storage(
+        MockedStorageApi({}, namespace='default-gzip'))
+    stream = isolateserver._ZipStream(
+        storage, item, threading_utils.PRIORITY_MED)
+    # Abandon the first iteration midway, as a failed upload would.
+    first = iter(stream)
+    next(first)
+    first.close()
+    self.assertEqual(item.zipped, ''.join(stream))
+    self.assertEqual(item.zipped, ''.join(stream))
+    storage.close()
+
   def test_upload_tree(self):
     files = {
       u'/a': {
@@ -472,9 +612,10 @@ class StorageTest(TestCase):
 
     storage_api = MockedStorageApi(missing_hashes)
     storage = isolateserver.Storage(storage_api)
-    def mock_get_storage(base_url, namespace):
+    def mock_get_storage(base_url, namespace, presence_cache_dir):
       self.assertEqual('base_url', base_url)
       self.assertEqual('some-namespace', namespace)
+      self.assertIsNone(presence_cache_dir)
       return storage
     self.mock(isolateserver, 'get_storage', mock_get_storage)
 
@@ -505,6 +646,33 @@ class StorageTest(TestCase):
       self.assertEqual(files_data[filename], pushed_content)
       self.assertEqual(missing_hashes[pushed_item.digest], push_state)
 
+  def test_upload_tree_chunked(self):
+    # Only the chunks of a chunked file are uploaded, not the whole file.
+    content = 'aabbbcccc'
+    chunks = ['aa', 'bbb', 'cccc']
+    metadata = {
+      'h': isolateserver_mock.hash_content(content),
+      's': len(content),
+      'c': [[isolateserver_mock.hash_content(c), len(c)] for c in chunks],
+    }
+    path = os.path.join(self.tempdir, u'big')
+    with open(path, 'wb') as f:
+      f.write(content)
+    # The first chunk is already on the server.
+    missing_hashes = {d: 'push' for d, _ in metadata['c'][1:]}
+    storage_api = MockedStorageApi(missing_hashes)
+    storage = isolateserver.Storage(storage_api)
+    self.mock(isolateserver, 'get_storage', lambda *_: storage)
+
+    isolateserver.upload_tree(
+        'base_url', [(path, metadata)], 'default-chunked')
+
+    self.assertEqualIgnoringOrder(
+        [d for d, _ in metadata['c']],
+        [i.digest for i in sum(storage_api.contains_calls, [])])
+    self.assertEqualIgnoringOrder(
+        ['bbb', 'cccc'], [c for _, _, c in storage_api.push_calls])
+
 
 class IsolateServerStorageApiTest(TestCase):
   @staticmethod
@@ -532,11 +700,29 @@ class IsolateServerStorageApiTest(TestCase):
     )
 
   @staticmethod
-  def mock_server_details_request(server):
+  def mock_server_details_request(server, raw_retrieve=False, flatten=False):
+    response = {'server_version': 'such a good version'}
+    if raw_retrieve:
+      response['raw_retrieve'] = True
+    if flatten:
+      response['flatten'] = True
     return (
         server + '/_ah/api/isolateservice/v1/server_details',
         {'data': {}},
-        {'server_version': 'such a good version'}
+        response,
+    )
+
+  @staticmethod
+  def mock_fetch_raw_request(
+      server, namespace, item, data=None, offset=0, response_headers=None):
+    return (
+        server + '/isolate/api/v1/raw/%s/%s' % (namespace, item),
+        {
+            'headers': {'Range': 'bytes=%d-' % offset} if offset else None,
+            'read_timeout': 60,
+        },
+        data[offset:] if data is not None else None,
+        response_headers,
     )
 
   @staticmethod
@@ -580,8 +766,10 @@ class IsolateServerStorageApiTest(TestCase):
     namespace = 'default'
     data = ''.join(str(x) for x in xrange(1000))
     item = isolateserver_mock.hash_content(data)
-    self.expected_requests(
-        [self.mock_fetch_request(server, namespace, item, data)])
+    self.expected_requests([
+      self.mock_server_details_request(server),
+      self.mock_fetch_request(server, namespace, item, data),
+    ])
     storage = isolate_storage.IsolateServer(server, namespace)
     fetched = ''.join(storage.fetch(item, 0, 0))
     self.assertEqual(data, fetched)
@@ -590,8 +778,10 @@ class IsolateServerStorageApiTest(TestCase):
     server = 'http://example.com'
     namespace = 'default'
     item = isolateserver_mock.hash_content('something')
-    self.expected_requests(
-        [self.mock_fetch_request(server, namespace, item)[:-1] + (None,)])
+    self.expected_requests([
+      self.mock_server_details_request(server),
+      self.mock_fetch_request(server, namespace, item)[:-1] + (None,),
+    ])
     storage = isolate_storage.IsolateServer(server, namespace)
     with self.assertRaises(IOError):
       _ = ''.join(storage.fetch(item, 0, 0))
@@ -610,8 +800,10 @@ class IsolateServerStorageApiTest(TestCase):
     ]
 
     for _content_range_header in good_content_range_headers:
-      self.expected_requests([self.mock_fetch_request(
-          server, namespace, item, data, offset=offset)])
+      self.expected_requests([
+        self.mock_server_details_request(server),
+        self.mock_fetch_request(server, namespace, item, data, offset=offset),
+      ])
       storage = isolate_storage.IsolateServer(server, namespace)
       fetched = ''.join(storage.fetch(item, 0, offset))
       self.assertEqual(data[offset:], fetched)
@@ -639,6 +831,7 @@ class IsolateServerStorageApiTest(TestCase):
 
     for content_range_header in bad_content_range_headers:
       self.expected_requests([
+          self.mock_server_details_request(server),
           self.mock_fetch_request(
               server, namespace, item, offset=offset),
           self.mock_gs_request(
@@ -650,6 +843,115 @@ class IsolateServerStorageApiTest(TestCase):
       with self.assertRaises(IOError):
         _ = ''.join(storage.fetch(item, 0, offset))
 
+  def test_fetch_raw_success(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = isolateserver_mock.hash_content(data)
+    self.expected_requests([
+      self.mock_server_details_request(server, raw_retrieve=True),
+      self.mock_fetch_raw_request(server, namespace, item, data),
+    ])
+    storage = isolate_storage.IsolateServer(server, namespace)
+    self.assertEqual(data, ''.join(storage.fetch(item, 0, 0)))
+
+  def test_fetch_raw_failure(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    item = isolateserver_mock.hash_content('something')
+    self.expected_requests([
+      self.mock_server_details_request(server, raw_retrieve=True),
+      self.mock_fetch_raw_request(server, namespace, item),
+    ])
+    storage = isolate_storage.IsolateServer(server, namespace)
+    with self.assertRaises(IOError):
+      _ = ''.join(storage.fetch(item, 0, 0))
+
+  def test_fetch_raw_offset(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = isolateserver_mock.hash_content(data)
+    offset = 200
+    size = len(data)
+    self.expected_requests([
+      self.mock_server_details_request(server, raw_retrieve=True),
+      self.mock_fetch_raw_request(
+          server, namespace, item, data, offset=offset,
+          response_headers={
+            'Content-Range': 'bytes %d-%d/%d' % (offset, size - 1, size),
+          }),
+    ])
+    storage = isolate_storage.IsolateServer(server, namespace)
+    self.assertEqual(data[offset:], ''.join(storage.fetch(item, 0, offset)))
+
+  def test_fetch_raw_offset_bad_header(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = isolateserver_mock.hash_content(data)
+    self.expected_requests([
+      self.mock_server_details_request(server, raw_retrieve=True),
+      # The server ignored the Range header.
+      self.mock_fetch_raw_request(server, namespace, item, data, offset=200),
+    ])
+    storage = isolate_storage.IsolateServer(server, namespace)
+    with self.assertRaises(IOError):
+      _ = ''.join(storage.fetch(item, 0, 200))
+
+  def test_flatten(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = isolateserver_mock.hash_content(data)
+    root = isolateserver_mock.hash_content('root')
+    gs_url = server + '/some/gs/url/%s/%s' % (namespace, item)
+    flattened = {
+      'command': ['python', 'run.py'],
+      'files': [
+        {'path': 'a', 'digest': item, 'size': '1000', 'url': gs_url},
+        {'path': 'b', 'link': 'a'},
+      ],
+      'isolated': [root],
+      'read_only': '1',
+    }
+    self.expected_requests([
+      self.mock_server_details_request(server, flatten=True),
+      (
+        server + '/_ah/api/isolateservice/v1/flatten',
+        {
+          'data': {
+            'digest': root,
+            'namespace': {
+              'compression': '',
+              'digest_hash': 'sha-1',
+              'namespace': namespace,
+            },
+          },
+          'read_timeout': 60,
+        },
+        flattened,
+      ),
+      # The content is fetched directly from GS.
+      (gs_url, {'headers': None, 'read_timeout': 60}, data, None),
+    ])
+    storage = isolate_storage.IsolateServer(server, namespace)
+    expected = {
+      'command': ['python', 'run.py'],
+      'files': {'a': {'h': item, 's': 1000}, 'b': {'l': 'a'}},
+      'isolated': [root],
+      'read_only': 1,
+      'relative_cwd': None,
+    }
+    self.assertEqual(expected, storage.flatten(root))
+    self.assertEqual(data, ''.join(storage.fetch(item, 0, 0)))
+
+  def test_flatten_unsupported(self):
+    server = 'http://example.com'
+    self.expected_requests([self.mock_server_details_request(server)])
+    storage = isolate_storage.IsolateServer(server, 'default')
+    self.assertEqual(None, storage.flatten('0' * 40))
+
   def test_push_success(self):
     server = 'http://example.com'
     namespace = 'default'
@@ -745,6 +1047,48 @@ class IsolateServerStorageApiTest(TestCase):
     self.assertTrue(push_state.uploaded)
     self.assertFalse(push_state.finalized)
 
+  def test_push_gs_streamed(self):
+    server = 'http://example.com'
+    namespace = 'default'
+    data = ''.join(str(x) for x in xrange(1000))
+    item = FakeItem(data)
+    contains_request = {'items': [
+        {'digest': item.digest, 'size': item.size, 'is_isolated': 0}]}
+    contains_response = {'items': [
+        {'index': 0,
+         'gs_upload_url': server + '/FAKE_GCS/whatevs/1234',
+         'upload_ticket': 'ticket!'}]}
+
+    def check_put(kwargs):
+      # The content is passed as a generator to be streamed.
+      self.assertEqual(data, ''.join(kwargs.pop('data')))
+      self.assertEqual(
+          {
+            'content_type': 'application/octet-stream',
+            'method': 'PUT',
+            'headers': {'Cache-Control': 'public, max-age=31536000'},
+          },
+          kwargs)
+
+    requests = [
+      self.mock_contains_request(
+          server, namespace, contains_request, contains_response),
+      (server + '/FAKE_GCS/whatevs/1234', check_put, '', None),
+      (
+        server + '/_ah/api/isolateservice/v1/finalize_gs_upload',
+        {'data': {'upload_ticket': 'ticket!'}},
+        {'ok': True},
+      ),
+    ]
+    self.expected_requests(requests)
+    storage = isolate_storage.IsolateServer(server, namespace)
+    missing = storage.contains([item])
+    push_state = missing[item]
+    storage.push(item, push_state, (c for c in [data[:10], data[10:]]))
+    self.assertTrue(push_state.uploaded)
+    self.assertTrue(push_state.finalized)
+    self.assertEqual(0, storage._memory_use)
+
   def test_contains_success(self):
     server = 'http://example.com'
     namespace = 'default'
@@ -828,6 +1172,100 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
     # All items are there now.
     self.assertFalse(dict(storage.get_missing_items(items)))
 
+  def run_fetch_isolated_test(self, flatten):
+    namespace = 'default-gzip'
+    def add_isolated(data):
+      data = dict(
+          data, algo='sha-1', version=isolated_format.ISOLATED_FILE_VERSION)
+      return self.server.add_content_compressed(
+          namespace, json.dumps(data, sort_keys=True, separators=(',', ':')))
+    def add_file(content):
+      return {
+        'h': self.server.add_content_compressed(namespace, content),
+        's': len(content),
+      }
+    child = add_isolated({
+      'command': ['child'],
+      'files': {'a': add_file('child a'), 'b': add_file('child b')},
+      'relative_cwd': 'c',
+    })
+    root = add_isolated({
+      'files': {'a': add_file('root a')},
+      'includes': [child],
+    })
+    outdir = os.path.join(self.tempdir, 'out')
+    storage = isolateserver.get_storage(
+        self.server.url, namespace, flatten=flatten)
+    with storage:
+      bundle = isolateserver.fetch_isolated(
+          root, storage, local_caching.MemoryContentAddressedCache(), outdir,
+          False)
+    self.assertEqual(['child'], bundle.command)
+    self.assertEqual('c', bundle.relative_cwd)
+    # The relative_cwd is created too.
+    self.assertEqual(['a', 'b', 'c'], sorted(os.listdir(outdir)))
+    with open(os.path.join(outdir, 'a'), 'rb') as f:
+      self.assertEqual('root a', f.read())
+    with open(os.path.join(outdir, 'b'), 'rb') as f:
+      self.assertEqual('child b', f.read())
+    return root
+
+  def test_fetch_isolated(self):
+    self.run_fetch_isolated_test(False)
+    self.assertEqual([], self.server.flattened)
+
+  def test_fetch_isolated_map_threads(self):
+    # Multi-core machines create the files in a pool of threads.
+    old_map_threads = isolateserver.MAP_THREADS
+    isolateserver.MAP_THREADS = 4
+    try:
+      self.run_fetch_isolated_test(False)
+    finally:
+      isolateserver.MAP_THREADS = old_map_threads
+
+  def test_fetch_isolated_flatten(self):
+    root = self.run_fetch_isolated_test(True)
+    self.assertEqual([root], self.server.flattened)
+
+  def run_keep_alive_test(self, keep_alive):
+    """Fetches 5 items and returns the client connection stats of the 4 last
+    fetches.
+    """
+    server = isolateserver_mock.MockIsolateServer(keep_alive=keep_alive)
+    try:
+      digests = [
+        server.add_content('default', 'item %d' % i) for i in xrange(5)
+      ]
+      storage_api = isolate_storage.get_storage_api(server.url, 'default')
+      # The first fetch may also look up the OAuth config on its own
+      # connection.
+      self.assertEqual(6, len(''.join(storage_api.fetch(digests[0], 6, 0))))
+      connections = server.connections
+      before = net.get_connection_stats()[server.url]
+      for digest in digests[1:]:
+        self.assertEqual(6, len(''.join(storage_api.fetch(digest, 6, 0))))
+      after = net.get_connection_stats()[server.url]
+      # The client counts the connections the server accepted.
+      self.assertEqual(
+          server.connections - connections,
+          after['new_connections'] - before['new_connections'])
+      net.get_http_service(server.url).engine.session.close()
+    finally:
+      server.close()
+    return {k: after[k] - before[k] for k in after}
+
+  def test_keep_alive(self):
+    # The following fetches reuse the connection.
+    self.assertEqual(
+        {'new_connections': 0, 'requests': 4, 'reused_connections': 4},
+        self.run_keep_alive_test(True))
+
+  def test_no_keep_alive(self):
+    # The server closes the connection after each request.
+    self.assertEqual(
+        {'new_connections': 4, 'requests': 4, 'reused_connections': 0},
+        self.run_keep_alive_test(False))
+
   def test_synchronous_push(self):
     self.run_synchronous_push_test('default')
 
@@ -940,6 +1378,17 @@ class IsolateServerDownloadTest(TestCase):
   def _url_read_json(self, url, **kwargs):
     """Current _url_read_json mock doesn't respect identical URLs."""
     logging.warn('url_read_json(%s, %s)', url[:500], str(kwargs)[:500])
+    return self._find_request(3, url, kwargs)
+
+  def _url_open(self, url, **kwargs):
+    """Current _url_open mock doesn't respect identical URLs."""
+    logging.warn('url_open(%s, %s)', url[:500], str(kwargs)[:500])
+    result = self._find_request(4, url, kwargs)
+    if result is None:
+      return None
+    return net_utils.make_fake_response(result, url)
+
+  def _find_request(self, length, url, kwargs):
     with self._lock:
       if not self._requests:
         return None
@@ -947,10 +1396,11 @@ class IsolateServerDownloadTest(TestCase):
         self._flagged_requests = [0 for _element in self._requests]
       # Ignore 'stream' argument, it's not important for these tests.
       kwargs.pop('stream', None)
-      for i, (new_url, expected_kwargs, result) in enumerate(self._requests):
-        if new_url == url and expected_kwargs == kwargs:
+      for i, request in enumerate(self._requests):
+        if (len(request) == length and request[0] == url and
+            request[1] == kwargs):
           self._flagged_requests[i] = 1
-          return result
+          return request[2]
     self.fail('Unknown request %s' % url)
 
   def _get_actual(self):
@@ -988,22 +1438,15 @@ class IsolateServerDownloadTest(TestCase):
     byebye_sha1 = hashlib.sha1('Bye Bye').hexdigest()
     requests = [
       (
-        server + '/_ah/api/isolateservice/v1/retrieve',
-        {
-            'data': {
-                'digest': h.encode('utf-8'),
-                'namespace': {
-                    'namespace': 'default-gzip',
-                    'digest_hash': 'sha-1',
-                    'compression': 'flate',
-                },
-                'offset': 0,
-            },
-            'read_timeout': 60,
-        },
-        {'content': base64.b64encode(zlib.compress(v))},
+        server + '/isolate/api/v1/raw/default-gzip/%s' % h,
+        {'headers': None, 'read_timeout': 60},
+        zlib.compress(v),
+        None,
       ) for h, v in [(coucou_sha1, 'Coucou'), (byebye_sha1, 'Bye Bye')]
     ]
+    requests.append(
+        IsolateServerStorageApiTest.mock_server_details_request(
+            server, raw_retrieve=True))
     self.expected_requests(requests)
     cmd = [
       'download',
@@ -1056,22 +1499,15 @@ class IsolateServerDownloadTest(TestCase):
     requests.append((isolated_hash, isolated_data))
     requests = [
       (
-        server + '/_ah/api/isolateservice/v1/retrieve',
-        {
-            'data': {
-                'digest': h.encode('utf-8'),
-                'namespace': {
-                    'namespace': 'default-gzip',
-                    'digest_hash': 'sha-1',
-                    'compression': 'flate',
-                },
-                'offset': 0,
-            },
-            'read_timeout': 60,
-        },
-        {'content': base64.b64encode(zlib.compress(v))},
+        server + '/isolate/api/v1/raw/default-gzip/%s' % h,
+        {'headers': None, 'read_timeout': 60},
+        zlib.compress(v),
+        None,
       ) for h, v in requests
     ]
+    requests.append(
+        IsolateServerStorageApiTest.mock_server_details_request(
+            server, raw_retrieve=True))
     cmd = [
       'download',
       '--isolate-server', server,
@@ -1146,22 +1582,15 @@ class IsolateServerDownloadTest(TestCase):
     requests.append((isolated_hash, isolated_data))
     requests = [
       (
-        server + '/_ah/api/isolateservice/v1/retrieve',
-        {
-            'data': {
-                'digest': h.encode('utf-8'),
-                'namespace': {
-                    'namespace': 'default-gzip',
-                    'digest_hash': 'sha-1',
-                    'compression': 'flate',
-                },
-                'offset': 0,
-            },
-            'read_timeout': 60,
-        },
-        {'content': base64.b64encode(zlib.compress(v))},
+        server + '/isolate/api/v1/raw/default-gzip/%s' % h,
+        {'headers': None, 'read_timeout': 60},
+        zlib.compress(v),
+        None,
       ) for h, v in requests
     ]
+    requests.append(
+        IsolateServerStorageApiTest.mock_server_details_request(
+            server, raw_retrieve=True))
     cmd = [
       'download',
       '--isolate-server', server,
@@ -1180,7 +1609,8 @@ class IsolateServerDownloadTest(TestCase):
     self.checkOutput(expected_stdout, '')
 
 
-def get_storage(_isolate_server, namespace):
+def get_storage(
+    _isolate_server, namespace, _presence_cache_dir=None, flatten=False):
   class StorageFake(object):
     def __enter__(self, *_):
       return self
@@ -1192,13 +1622,123 @@ def get_storage(_isolate_server, namespace):
     def hash_algo(self):  # pylint: disable=R0201
       return isolated_format.get_hash_algo(namespace)
 
+    @property
+    def namespace(self):  # pylint: disable=R0201
+      return namespace
+
     @staticmethod
     def upload_items(items):
       # Always returns the second item as not present.
-      return [items[1]]
+      return [list(items)[1]]
   return StorageFake()
 
 
+class LazyFetchTest(TestCase):
+  def test_lazy_fetch(self):
+    # The command can start once the hot set is mapped, the cold files are
+    # mapped in the background.
+    contents = {
+      'hot.py': 'hot',
+      'run.py': 'run',
+      'cold': 'cold',
+    }
+    isolated = {
+      'algo': 'sha-1',
+      'command': ['python', 'run.py'],
+      'files': {
+        k: {'h': isolateserver_mock.hash_content(v), 's': len(v), 'm': 0600}
+        for k, v in contents.iteritems()
+      },
+      'version': isolated_format.ISOLATED_FILE_VERSION,
+    }
+    isolated_data = json.dumps(isolated, sort_keys=True, separators=(',',':'))
+    by_digest = {
+      isolateserver_mock.hash_content(v): v
+      for v in contents.values() + [isolated_data]
+    }
+    cold_digest = isolateserver_mock.hash_content('cold')
+    release = threading.Event()
+
+    class FetchingStorageApi(MockedStorageApi):
+      def fetch(self, digest, _size, _offset):
+        if digest == cold_digest:
+          release.wait()
+        yield by_digest[digest]
+
+    outdir = os.path.join(self.tempdir, 'out')
+    done_file = os.path.join(self.tempdir, 'done')
+    cache = local_caching.MemoryContentAddressedCache()
+    with isolateserver.Storage(FetchingStorageApi({})) as storage:
+      lazy_fetch = isolateserver.LazyFetch(
+          storage, cache, outdir, False, hot_set=['hot.*'],
+          done_file=done_file)
+      bundle = lazy_fetch.start(
+          isolateserver_mock.hash_content(isolated_data))
+      self.assertEqual(['python', 'run.py'], bundle.command)
+      self.assertEqual(
+          ['hot.py', 'run.py'], sorted(os.listdir(outdir)))
+      self.assertFalse(os.path.isfile(done_file))
+      release.set()
+      lazy_fetch.wait()
+    self.assertEqual(
+        ['cold', 'hot.py', 'run.py'], sorted(os.listdir(outdir)))
+    with open(os.path.join(outdir, 'cold'), 'rb') as f:
+      self.assertEqual('cold', f.read())
+    with open(done_file, 'rb') as f:
+      self.assertEqual('', f.read())
+
+
+class ChunkedFetchTest(TestCase):
+  def _fetch(self, chunk_contents, content):
+    isolated = {
+      'algo': 'sha-1',
+      'files': {
+        'big': {
+          'c': [
+            [isolateserver_mock.hash_content(c), len(c)]
+            for c in chunk_contents
+          ],
+          'h': isolateserver_mock.hash_content(content),
+          'm': 0600,
+          's': len(content),
+        },
+      },
+      'version': isolated_format.ISOLATED_FILE_VERSION,
+    }
+    isolated_data = json.dumps(isolated, sort_keys=True, separators=(',',':'))
+    by_digest = {
+      isolateserver_mock.hash_content(v): v
+      for v in chunk_contents + [isolated_data]
+    }
+    fetched = []
+
+    class FetchingStorageApi(MockedStorageApi):
+      def fetch(self, digest, _size, _offset):
+        fetched.append(digest)
+        yield by_digest[digest]
+
+    outdir = os.path.join(self.tempdir, 'out')
+    cache = local_caching.MemoryContentAddressedCache()
+    with isolateserver.Storage(
+        FetchingStorageApi({}, namespace='default-chunked')) as storage:
+      isolateserver.fetch_isolated(
+          isolateserver_mock.hash_content(isolated_data), storage, cache,
+          outdir, False)
+    return outdir, fetched
+
+  def test_fetch_chunked(self):
+    # The file is reassembled from its chunks, each fetched once.
+    outdir, fetched = self._fetch(['aa', 'bbb', 'aa'], 'aabbbaa')
+    self.assertEqual(3, len(fetched))
+    with open(os.path.join(outdir, 'big'), 'rb') as f:
+      self.assertEqual('aabbbaa', f.read())
+    self.assertEqual(0600, os.stat(os.path.join(outdir, 'big')).st_mode & 0777)
+
+  def test_fetch_chunked_corrupted(self):
+    with self.assertRaises(isolated_format.IsolatedError):
+      self._fetch(['aa', 'bbb'], 'aabbbb')
+
+
 class TestArchive(TestCase):
   @staticmethod
   def get_isolateserver_prog():
@@ -8,6 +8,8 @@ import logging
 import os
 import sys
 import tempfile
+import threading
+import time
 import unittest
 
 TEST_DIR = os.path.dirname(os.path.abspath(
@@ -22,6 +24,7 @@ from depot_tools import fix_encoding
 from utils import file_path
 from utils import fs
 
+import isolated_format
 import local_caching
 
 
@@ -247,6 +250,103 @@ class DiskContentAddressedCacheTest(TestCase):
       cache.evict(h_a)
       self.assertEqual(set(), cache.cached_set())
 
+  def test_state_journal(self):
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    self._free_disk = 1100
+    state_file = os.path.join(self.tempdir, 'cache', u'state.json')
+    # Start with a plain json state as written by older versions.
+    os.mkdir(os.path.join(self.tempdir, 'cache'))
+    write_file(os.path.join(self.tempdir, 'cache', h_a), 'a')
+    write_file(
+        state_file, '{"items":[["%s",[1,1]]],"version":2}' % h_a)
+
+    # It is migrated to the journaled state on first save.
+    with self.get_cache() as cache:
+      self.assertEqual({h_a}, cache.cached_set())
+    self.assertEqual(1, len(read_file(state_file).splitlines()))
+
+    # Following saves only append the changes.
+    with self.get_cache() as cache:
+      cache.write(h_b, 'b')
+    lines = read_file(state_file).splitlines()
+    self.assertEqual(2, len(lines))
+    self.assertTrue(lines[1].startswith('["%s",[1,' % h_b), lines[1])
+
+    with self.get_cache() as cache:
+      self.assertEqual([h_a, h_b], list(cache._lru))
+      cache.cleanup()
+    self.assertEqual(
+        sorted([h_a, h_b, u'state.json']), sorted(os.listdir(cache.cache_dir)))
+
+  def test_verify(self):
+    self._free_disk = 1100
+    self._policies = local_caching.CachePolicies(
+        max_cache_size=1000, min_free_space=1000, max_items=10, max_age_secs=0)
+    now = 100
+    h_a = self.to_hash('a')[0]
+    h_b = self.to_hash('b')[0]
+    h_c = self.to_hash('c')[0]
+    hashed = []
+    hash_file = isolated_format.hash_file
+    def hash_file_hook(path, algo):
+      hashed.append(os.path.basename(path))
+      return hash_file(path, algo)
+    self.mock(isolated_format, 'hash_file', hash_file_hook)
+    with self.get_cache(time_fn=lambda: now) as cache:
+      for h, c in ((h_a, 'a'), (h_b, 'b'), (h_c, 'c')):
+        cache.write(h, c)
+        now += 1
+
+      # Corrupt h_a and h_c.
+      for h in (h_a, h_c):
+        p = os.path.join(cache.cache_dir, h)
+        file_path.set_read_only(p, False)
+        write_file(p, 'x')
+
+      # Newest items are verified first; the budget leaves h_a for later.
+      self.assertEqual(1, cache.verify(max_bytes=2))
+      self.assertEqual({h_a, h_b}, cache.cached_set())
+      self.assertEqual([h_c, h_b], hashed)
+      self.assertEqual([1], cache.verified)
+      self.assertEqual([1], cache.corrupted)
+
+      # Only the items not verified yet are hashed.
+      self.assertEqual(0, cache.verify())
+      self.assertEqual({h_b}, cache.cached_set())
+      self.assertEqual([h_c, h_b, h_a], hashed)
+      self.assertEqual([1], cache.verified)
+      self.assertEqual([1, 1], cache.corrupted)
+      self.assertEqual(0, cache.verify())
+      self.assertEqual([h_c, h_b, h_a], hashed)
+      self.assertEqual([1], cache.verified)
+
+      # Using an item makes it verified again. The verification state is
+      # appended to instead of being rewritten.
+      verified_file = os.path.join(cache.cache_dir, u'verified.json')
+      lines = read_file(verified_file).splitlines()
+      now += 1
+      self.assertTrue(cache.touch(h_b, 1))
+      self.assertEqual(0, cache.verify(max_duration=60))
+      self.assertEqual([h_c, h_b, h_a, h_b], hashed)
+      self.assertEqual([1, 1], cache.verified)
+      self.assertEqual(
+          lines, read_file(verified_file).splitlines()[:len(lines)])
+
+    self.assertEqual(
+        sorted([h_b, u'state.json', u'verified.json']),
+        sorted(os.listdir(cache.cache_dir)))
+    # The verification state is persisted.
+    with self.get_cache(time_fn=lambda: now) as cache:
+      cache.cleanup()
+      self.assertEqual(0, cache.verify())
+      self.assertEqual([h_c, h_b, h_a, h_b], hashed)
+      self.assertEqual([], cache.verified)
+      self.assertEqual([], cache.corrupted)
+    self.assertEqual(
+        sorted([h_b, u'state.json', u'verified.json']),
+        sorted(os.listdir(cache.cache_dir)))
+
 
 class NamedCacheTest(TestCase):
   def setUp(self):
@@ -363,6 +463,59 @@ class NamedCacheTest(TestCase):
       self.assertEqual(
           set(map(str, xrange(10, 10 + self.policies.max_items))),
           set(os.listdir(os.path.join(cache.cache_dir, 'named'))))
+      # The evicted caches are in the trash until it is emptied.
+      self.assertEqual(10, len(os.listdir(cache.trash_dir)))
+      self.assertEqual(0, cache.empty_trash())
+      self.assertEqual([], os.listdir(cache.trash_dir))
+
+  def test_empty_trash(self):
+    dest_dir = os.path.join(self.tempdir, 'dest')
+    with local_caching.NamedCache(self.cache_dir, self.policies) as cache:
+      for name in (u'1', u'2'):
+        path = os.path.join(dest_dir, name)
+        cache.install(path, name)
+        os.mkdir(os.path.join(path, u'sub'))
+        write_file(os.path.join(path, u'sub', u'x'), u'x' * 10)
+        file_path.make_tree_read_only(os.path.join(path, u'sub'))
+        os.symlink(os.path.join(path, u'sub'), os.path.join(path, u'link'))
+        cache.uninstall(path, name)
+      cache._policies.max_items = 0
+      self.assertEqual(2, cache.trim())
+      self.assertEqual(2, len(os.listdir(cache.trash_dir)))
+
+      stop = threading.Event()
+      stop.set()
+      self.assertEqual(10, cache.empty_trash(stop=stop))
+      self.assertEqual(2, len(os.listdir(cache.trash_dir)))
+      with cache.emptying_trash(max_rate=1000):
+        timeout = time.time() + 60
+        while os.listdir(cache.trash_dir) and time.time() < timeout:
+          time.sleep(0.01)
+      self.assertEqual([], os.listdir(cache.trash_dir))
+      self.assertEqual(0, cache.empty_trash())
+
+  def test_trim_min_free_space(self):
+    free_space = [0]
+    self.mock(file_path, 'get_free_space', lambda _: free_space[0])
+    with local_caching.NamedCache(self.cache_dir, self.policies) as cache:
+      self.make_caches(cache, range(3))
+      for i in xrange(3):
+        write_file(
+            os.path.join(cache.cache_dir, cache._lru[str(i)], u'x'), u'x' * 600)
+      orig = local_caching._delete_tree
+      def delete_tree(root):
+        for size in orig(root):
+          free_space[0] += size
+          yield size
+      self.mock(local_caching, '_delete_tree', delete_tree)
+      # Deletes two caches to free the 1024 bytes needed, without evicting the
+      # third.
+      self.assertEqual(2, cache.trim())
+      self.assertEqual([u'2'], list(cache.available))
+      self.assertEqual(1200, free_space[0])
+      # Only the empty directory of the last cache deleted is left.
+      self.assertEqual(0, cache.empty_trash())
+      self.assertEqual([], os.listdir(cache.trash_dir))
 
   def test_corrupted(self):
     os.mkdir(self.cache_dir)
@@ -178,6 +178,86 @@ class LRUDictTest(unittest.TestCase):
     lru_dict = save_and_load(lru_dict)
     self.assert_order(lru_dict, data + [4])
 
+  def test_load_save_journal(self):
+    handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
+    os.close(handle)
+    try:
+      def read_lines():
+        with open(tmp_name, 'rb') as f:
+          return f.read().splitlines()
+
+      # The first journaled save writes a full snapshot.
+      lru_dict = self.prepare_lru_dict([1, 2, 3])
+      self.assertTrue(lru_dict.save(tmp_name, journal=True))
+      self.assertEqual(1, len(read_lines()))
+      self.assertFalse(lru_dict.save(tmp_name, journal=True))
+
+      # Following saves only append the changes.
+      lru_dict.touch(1)
+      lru_dict.pop(2)
+      lru_dict.add(4, None)
+      self.assertTrue(lru_dict.save(tmp_name, journal=True))
+      lines = read_lines()
+      self.assertEqual(4, len(lines))
+      self.assertEqual('[2,null]', lines[2])
+
+      # The loaded dict appends to the same journal.
+      lru_dict = lru.LRUDict.load(tmp_name)
+      lru_dict.pop_oldest()
+      self.assertTrue(lru_dict.save(tmp_name, journal=True))
+      self.assertEqual(5, len(read_lines()))
+      self.assert_order(lru.LRUDict.load(tmp_name), [1, 4])
+
+      # A truncated last record, e.g. a crash while saving, is ignored and
+      # the next save rewrites the snapshot.
+      with open(tmp_name, 'ab') as f:
+        f.write('[5,[nu')
+      lru_dict = lru.LRUDict.load(tmp_name)
+      self.assertEqual([1, 4], list(lru_dict))
+      lru_dict.add(5, None)
+      lru_dict.save(tmp_name, journal=True)
+      self.assertEqual(1, len(read_lines()))
+      self.assert_order(lru.LRUDict.load(tmp_name), [1, 4, 5])
+
+      # A corrupted record in the middle of the journal is not acceptable.
+      with open(tmp_name, 'ab') as f:
+        f.write('garbage\n[1,null]\n')
+      with self.assertRaises(ValueError):
+        lru.LRUDict.load(tmp_name)
+    finally:
+      os.unlink(tmp_name)
+
+  def test_journal_migration_and_compaction(self):
+    handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
+    os.close(handle)
+    try:
+      def count_lines():
+        with open(tmp_name, 'rb') as f:
+          return len(f.read().splitlines())
+
+      # A plain version 2 state is migrated on the first journaled save.
+      self.prepare_lru_dict(range(10)).save(tmp_name)
+      lru_dict = lru.LRUDict.load(tmp_name)
+      lru_dict.touch(0)
+      lru_dict.save(tmp_name, journal=True)
+      self.assertEqual(1, count_lines())
+      with open(tmp_name, 'rb') as f:
+        self.assertEqual(3, json.loads(f.readline())['version'])
+
+      # The snapshot is rewritten once the journal is larger than the items.
+      lru_dict.JOURNAL_MIN_COMPACTION = 0
+      for i in xrange(10):
+        lru_dict.touch(i)
+        lru_dict.save(tmp_name, journal=True)
+        self.assertEqual(i + 2, count_lines())
+      lru_dict.touch(0)
+      lru_dict.save(tmp_name, journal=True)
+      self.assertEqual(1, count_lines())
+      self.assert_order(
+          lru.LRUDict.load(tmp_name), range(1, 10) + [0])
+    finally:
+      os.unlink(tmp_name)
+
   def test_corrupted_state_file(self):
     def load_from_state(state_text):
       handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
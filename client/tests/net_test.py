@@ -194,6 +194,22 @@ class HttpServiceTest(RetryLoopMockedTest):
     self.assertEqual(response.read(), response_body)
     self.assertAttempts(1, net.URL_OPEN_TIMEOUT)
 
+  def test_request_PUT_streamed_no_retry(self):
+    attempts = []
+
+    def mock_perform_request(request):
+      attempts.append(request)
+      self.assertEqual(['a', 'b'], list(request.body))
+      self.assertNotIn('Content-Length', request.headers)
+      raise net.ConnectionError()
+
+    service = self.mocked_http_service(perform_request=mock_perform_request)
+    response = service.request(
+        '/', data=(c for c in 'ab'),
+        content_type='application/octet-stream', method='PUT')
+    self.assertEqual(None, response)
+    self.assertEqual(1, len(attempts))
+
   def test_request_success_after_failure(self):
     response = 'True'
     attempts = []
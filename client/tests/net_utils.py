@@ -98,7 +98,7 @@ class TestCase(auto_stub.TestCase):
           else:
             self.assertEqual(expected_kwargs, kwargs)
           if result is not None:
-            return make_fake_response(result, url, headers)
+            return make_fake_response(result, url, headers=headers)
           return None
     self.fail('Unknown request %s' % url)
 
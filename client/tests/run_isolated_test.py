@@ -106,9 +106,12 @@ class StorageFake(object):
     sink([self._files[digest]])
     channel.send_result(digest)
 
+  def flatten(self, _digest):
+    return None
+
   def upload_items(self, items_to_upload):
     # Return all except the first one.
-    return items_to_upload[1:]
+    return list(items_to_upload)[1:]
 
 
 class RunIsolatedTestBase(auto_stub.TestCase):
@@ -228,7 +231,7 @@ class RunIsolatedTest(RunIsolatedTestBase):
           'command': ['foo.exe', 'cmd with space'],
         })
     isolated_hash = isolateserver_mock.hash_content(isolated)
-    def get_storage(_isolate_server, _namespace):
+    def get_storage(_isolate_server, _namespace, flatten=False):
       return StorageFake({isolated_hash:isolated})
     self.mock(isolateserver, 'get_storage', get_storage)
 
@@ -253,7 +256,7 @@ class RunIsolatedTest(RunIsolatedTestBase):
     self.mock(tools, 'disable_buffering', lambda: None)
     isolated = json_dumps({'command': ['foo.exe', 'cmd w/ space']})
     isolated_hash = isolateserver_mock.hash_content(isolated)
-    def get_storage(_isolate_server, _namespace):
+    def get_storage(_isolate_server, _namespace, flatten=False):
       return StorageFake({isolated_hash:isolated})
     self.mock(isolateserver, 'get_storage', get_storage)
 
@@ -278,7 +281,8 @@ class RunIsolatedTest(RunIsolatedTestBase):
         ],
         self.popen_calls)
 
-  def _run_tha_test(self, isolated_hash=None, files=None, command=None):
+  def _run_tha_test(
+      self, isolated_hash=None, files=None, command=None, hot_set=None):
     files = files or {}
     make_tree_call = []
     def add(i, _):
@@ -305,7 +309,10 @@ class RunIsolatedTest(RunIsolatedTestBase):
         install_packages_fn=run_isolated.noop_install_packages,
         use_symlinks=False,
         env={},
-        env_prefix={})
+        env_prefix={},
+        digest_cache=None,
+        hot_set=hot_set,
+        access_profile=None)
     ret = run_isolated.run_tha_test(data, None)
     self.assertEqual(0, ret)
     return make_tree_call
@@ -373,6 +380,40 @@ class RunIsolatedTest(RunIsolatedTestBase):
         ],
         self.popen_calls)
 
+  def test_run_tha_test_lazy_fetch(self):
+    isolated = json_dumps(
+        {
+          'command': ['invalid', 'command'],
+          'files': {
+            'data': {'h': isolateserver_mock.hash_content('data'), 's': 4},
+          },
+          'read_only': 2,
+        })
+    isolated_hash = isolateserver_mock.hash_content(isolated)
+    files = {
+      isolated_hash: isolated,
+      isolateserver_mock.hash_content('data'): 'data',
+    }
+    self.capture_popen_env = True
+    make_tree_call = self._run_tha_test(isolated_hash, files, hot_set=[])
+    # The tree is not made read only while files are mapped.
+    self.assertEqual(
+        ['make_tree_deleteable', 'make_tree_deleteable',
+         'make_tree_deleteable'],
+        make_tree_call)
+    # The command is told where to wait for the rest of the files.
+    env = self.popen_calls[0][1].pop('env')
+    self.assertEqual(
+        os.path.join(
+            self.tempdir, run_isolated.ISOLATED_TMP_DIR, 'lazy_fetch_done'),
+        env['ISOLATED_LAZY_FETCH_DONE'])
+    self.assertEqual(
+        [
+          ([self.ir_dir(u'invalid'), u'command'],
+            {'cwd': self.ir_dir(), 'detached': True}),
+        ],
+        self.popen_calls)
+
   def test_run_tha_test_naked_read_only_2(self):
     isolated = json_dumps(
         {
@@ -408,7 +449,7 @@ class RunIsolatedTest(RunIsolatedTestBase):
     self.mock(tools, 'disable_buffering', lambda: None)
     isolated = json_dumps({'command': ['invalid', 'command']})
     isolated_hash = isolateserver_mock.hash_content(isolated)
-    def get_storage(_isolate_server, _namespace):
+    def get_storage(_isolate_server, _namespace, flatten=False):
       return StorageFake({isolated_hash:isolated})
     self.mock(isolateserver, 'get_storage', get_storage)
 
@@ -740,6 +781,27 @@ class RunIsolatedTest(RunIsolatedTestBase):
         ],
         self.popen_calls)
 
+  def test_access_profile(self):
+    path = os.path.join(self.tempdir, 'profile.json')
+    self.assertEqual({}, run_isolated.load_access_profile(path))
+    run_dir = os.path.join(self.tempdir, 'run')
+    os.mkdir(run_dir)
+    for name, atime in (('old', 10), ('new', 1000)):
+      p = os.path.join(run_dir, name)
+      with open(p, 'wb') as f:
+        f.write(name)
+      os.utime(p, (atime, atime))
+    files = {
+      'old': {'h': 'a', 's': 3},
+      'new': {'h': 'b', 's': 3},
+      'link': {'l': 'new'},
+      'missing': {'h': 'c', 's': 3},
+    }
+    run_isolated.save_access_profile(
+        path, {'old': 1., 'gone': 0.01}, run_dir, files, 100)
+    self.assertEqual(
+        {'new': 1., 'old': 0.5}, run_isolated.load_access_profile(path))
+
   def test_clean_caches(self):
     # Create an isolated cache and a named cache each with 2 items. Ensure that
     # one item from each is removed.
@@ -798,19 +860,22 @@ class RunIsolatedTest(RunIsolatedTestBase):
       big_digest: big,
       small_digest: small,
       u'state.json':
-          '{"items":[["%s",[10140,%s]],["%s",[10,%s]]],"version":2}' % (
+          '{"items":[["%s",[10140,%s]],["%s",[10,%s]]],"version":3}\n' % (
           big_digest, now+1, small_digest, now+2),
     }
     self.assertEqual(expected, read_tree(ip))
 
     # Request triming.
     fake_free_space[0] = 1020
-    # Abuse the fact that named cache is trimed after isolated cache.
-    def rmtree(p):
-      self.assertEqual(os.path.join(np, cache_big), p)
-      fake_free_space[0] += 10240
-      return old_rmtree(p)
-    old_rmtree = self.mock(file_path, 'rmtree', rmtree)
+    # Abuse the fact that named cache is trimed after isolated cache. The
+    # evicted named cache is moved to the trash, then deleted file by file.
+    def delete_tree(p):
+      self.assertEqual(os.path.join(np, u'trash'), os.path.dirname(p))
+      self.assertTrue(os.path.basename(p).startswith(cache_big + u'_'))
+      for size in old_delete_tree(p):
+        fake_free_space[0] += size
+        yield size
+    old_delete_tree = self.mock(local_caching, '_delete_tree', delete_tree)
     isolate_cache = isolateserver.process_cache_options(options, trim=False)
     named_cache_manager = run_isolated.process_named_cache_options(
         parser, options)
@@ -831,15 +896,41 @@ class RunIsolatedTest(RunIsolatedTestBase):
           (cache_small, now+3),
     }
     self.assertEqual(expected, actual)
+    # The isolated cache state is journaled, the eviction is appended.
     expected = {
       small_digest: small,
       u'state.json':
-          '{"items":[["%s",[10,%s]]],"version":2}' %
-          (small_digest, now+2),
+          '{"items":[["%s",[10140,%s]],["%s",[10,%s]]],"version":3}\n'
+          '["%s",null]\n' % (
+          big_digest, now+1, small_digest, now+2, big_digest),
     }
     self.assertEqual(expected, read_tree(ip))
 
 
+  def test_clean_verify_json(self):
+    # The number of items verified and corrupted is reported in --json.
+    ip = os.path.join(self.tempdir, 'isolated_cache')
+    out = os.path.join(self.tempdir, 'res.json')
+    self.mock(file_path, 'get_free_space', lambda _: 102400)
+    isolate_cache = local_caching.DiskContentAddressedCache(
+        unicode(ip), local_caching.CachePolicies(0, 0, 0, 0), ALGO, False)
+    with isolate_cache:
+      for content in ('valid', 'corrupted'):
+        isolate_cache.write(unicode(ALGO(content).hexdigest()), [content])
+    p = os.path.join(ip, ALGO('corrupted').hexdigest())
+    file_path.set_read_only(p, False)
+    write_content(p, 'x')
+
+    cmd = [
+      '--named-cache-root', os.path.join(self.tempdir, 'named_cache'),
+      '--cache', ip, '--clean', '--verify-budget', '60', '--json', out,
+      '--min-free-space', '10240',
+      '--log-file', self.ir_dir('run_isolated.log'),
+    ]
+    self.assertEqual(0, run_isolated.main(cmd))
+    self.assertEqual({'corrupted': 1, 'verified': 1}, tools.read_json(out))
+
+
 class RunIsolatedTestRun(RunIsolatedTestBase):
   # Runs the actual command requested.
   def test_output(self):
@@ -890,7 +981,10 @@ class RunIsolatedTestRun(RunIsolatedTestBase):
           install_packages_fn=run_isolated.noop_install_packages,
           use_symlinks=False,
           env={},
-          env_prefix={})
+          env_prefix={},
+          digest_cache=None,
+        hot_set=None,
+        access_profile=None)
       ret = run_isolated.run_tha_test(data, None)
       self.assertEqual(0, ret)
 
@@ -1251,7 +1345,10 @@ class RunIsolatedTestOutputFiles(RunIsolatedTestBase):
           install_packages_fn=run_isolated.noop_install_packages,
           use_symlinks=False,
           env={},
-          env_prefix={})
+          env_prefix={},
+          digest_cache=None,
+        hot_set=None,
+        access_profile=None)
       ret = run_isolated.run_tha_test(data, None)
       self.assertEqual(0, ret)
 
@@ -1371,7 +1468,7 @@ class RunIsolatedJsonTest(RunIsolatedTestBase):
     ]
     isolated_in_json = json_dumps({'command': sub_cmd})
     isolated_in_hash = isolateserver_mock.hash_content(isolated_in_json)
-    def get_storage(_isolate_server, _namespace):
+    def get_storage(_isolate_server, _namespace, flatten=False):
       return StorageFake({isolated_in_hash:isolated_in_json})
     self.mock(isolateserver, 'get_storage', get_storage)
 
@@ -1420,6 +1517,7 @@ class RunIsolatedJsonTest(RunIsolatedTestBase):
       u'stats': {
         u'isolated': {
           u'download': {
+            u'bytes_fetched': len(isolated_in_json),
             u'initial_number_items': 0,
             u'initial_size': 0,
             u'items_cold': [len(isolated_in_json)],
@@ -1439,6 +1537,8 @@ class RunIsolatedJsonTest(RunIsolatedTestBase):
     self.assertLessEqual(0, actual.pop(u'duration'))
     actual_isolated_stats = actual[u'stats'][u'isolated']
     self.assertLessEqual(0, actual_isolated_stats[u'download'].pop(u'duration'))
+    self.assertLessEqual(
+        0, actual_isolated_stats[u'download'].pop(u'time_to_exec'))
     self.assertLessEqual(0, actual_isolated_stats[u'upload'].pop(u'duration'))
     for i in (u'download', u'upload'):
       for j in (u'items_cold', u'items_hot'):
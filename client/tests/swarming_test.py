@@ -341,7 +341,10 @@ class TestIsolated(auto_stub.TestCase, Common):
 
 
 class TestSwarmingTrigger(NetTestCase):
-  def test_trigger_task_shards_2_shards(self):
+  def _gen_2_shards(self):
+    """Returns the NewTaskRequest and the raw requests and responses of its 2
+    shards.
+    """
     task_request = swarming.NewTaskRequest(
         name=TEST_NAME,
         parent_task_id=None,
@@ -390,20 +393,9 @@ class TestSwarmingTrigger(NetTestCase):
       {'key': 'GTEST_TOTAL_SHARDS', 'value': '2'},
     ]
     result_2 = gen_request_response(request_2, task_id='12400')
-    self.expected_requests(
-        [
-          (
-            'https://localhost:1/_ah/api/swarming/v1/tasks/new',
-            {'data': request_1},
-            result_1,
-          ),
-          (
-            'https://localhost:1/_ah/api/swarming/v1/tasks/new',
-            {'data': request_2},
-            result_2,
-          ),
-        ])
+    return task_request, request_1, result_1, request_2, result_2
 
+  def _trigger_2_shards(self, task_request):
     tasks = swarming.trigger_task_shards(
         swarming='https://localhost:1',
         task_request=task_request,
@@ -422,6 +414,129 @@ class TestSwarmingTrigger(NetTestCase):
     }
     self.assertEqual(expected, tasks)
 
+  def test_trigger_task_shards_2_shards(self):
+    task_request, request_1, result_1, request_2, result_2 = (
+        self._gen_2_shards())
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/_ah/api/swarming/v1/server/details',
+            {},
+            {'new_batch': True},
+          ),
+          (
+            'https://localhost:1/_ah/api/swarming/v1/tasks/new_batch',
+            {
+              'data': {'requests': [request_1, request_2]},
+              'retry_50x': False,
+            },
+            {'items': [result_1, result_2]},
+          ),
+        ])
+    self._trigger_2_shards(task_request)
+
+  def test_trigger_task_shards_2_shards_batch_size(self):
+    self.mock(swarming, 'TRIGGER_BATCH_SIZE', 1)
+    task_request, request_1, result_1, request_2, result_2 = (
+        self._gen_2_shards())
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/_ah/api/swarming/v1/server/details',
+            {},
+            {'new_batch': True},
+          ),
+          (
+            'https://localhost:1/_ah/api/swarming/v1/tasks/new_batch',
+            {'data': {'requests': [request_1]}, 'retry_50x': False},
+            {'items': [result_1]},
+          ),
+          (
+            'https://localhost:1/_ah/api/swarming/v1/tasks/new_batch',
+            {'data': {'requests': [request_2]}, 'retry_50x': False},
+            {'items': [result_2]},
+          ),
+        ])
+    self._trigger_2_shards(task_request)
+
+  def test_trigger_task_shards_2_shards_batch_partial(self):
+    # Only the task the server failed to create is triggered again.
+    task_request, request_1, result_1, request_2, result_2 = (
+        self._gen_2_shards())
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/_ah/api/swarming/v1/server/details',
+            {},
+            {'new_batch': True},
+          ),
+          (
+            'https://localhost:1/_ah/api/swarming/v1/tasks/new_batch',
+            {
+              'data': {'requests': [request_1, request_2]},
+              'retry_50x': False,
+            },
+            {'items': [result_1, {'error': 'Failed'}]},
+          ),
+          (
+            'https://localhost:1/_ah/api/swarming/v1/tasks/new_batch',
+            {'data': {'requests': [request_2]}, 'retry_50x': False},
+            {'items': [result_2]},
+          ),
+        ])
+    self._trigger_2_shards(task_request)
+
+  def test_trigger_task_shards_2_shards_batch_failure(self):
+    # A failed batch is neither retried nor triggered one shard at a time, the
+    # tasks may have been created.
+    task_request, request_1, _, request_2, _ = self._gen_2_shards()
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/_ah/api/swarming/v1/server/details',
+            {},
+            {'new_batch': True},
+          ),
+          (
+            'https://localhost:1/_ah/api/swarming/v1/tasks/new_batch',
+            {
+              'data': {'requests': [request_1, request_2]},
+              'retry_50x': False,
+            },
+            None,
+          ),
+        ])
+    self.assertEqual(
+        None,
+        swarming.trigger_task_shards(
+            swarming='https://localhost:1',
+            task_request=task_request,
+            shards=2))
+
+  def test_trigger_task_shards_2_shards_no_batch(self):
+    # The server doesn't support tasks/new_batch.
+    task_request, request_1, result_1, request_2, result_2 = (
+        self._gen_2_shards())
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/_ah/api/swarming/v1/server/details',
+            {},
+            {'server_version': 'old'},
+          ),
+          (
+            'https://localhost:1/_ah/api/swarming/v1/tasks/new',
+            {'data': request_1},
+            result_1,
+          ),
+          (
+            'https://localhost:1/_ah/api/swarming/v1/tasks/new',
+            {'data': request_2},
+            result_2,
+          ),
+        ])
+    self._trigger_2_shards(task_request)
+
   def test_trigger_task_shards_priority_override(self):
     task_request = swarming.NewTaskRequest(
         name=TEST_NAME,
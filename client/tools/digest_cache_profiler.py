@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Copyright 2018 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Profiles the time it takes to calculate the .isolated metadata of a directory
+with and without a warm isolated_format.DigestCache.
+"""
+
+import hashlib
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+
+from third_party.depot_tools import fix_encoding
+from utils import file_path
+from utils import tools
+
+import isolated_format
+import isolateserver
+
+
+def make_tree(root_dir, files, size):
+  """Creates |files| files of |size| bytes each, with an old timestamp."""
+  for i in xrange(files):
+    d = os.path.join(root_dir, '%02d' % (i % 100))
+    if not os.path.isdir(d):
+      os.mkdir(d)
+    p = os.path.join(d, '%d' % i)
+    with open(p, 'wb') as f:
+      f.write(os.urandom(size))
+    # DigestCache ignores files that were just modified.
+    os.utime(p, (1000000000, 1000000000))
+
+
+def profile(name, root_dir, digest_cache):
+  start = time.time()
+  isolateserver.directory_to_metadata(
+      root_dir, hashlib.sha1, tools.gen_blacklist([]), digest_cache)
+  if digest_cache is not None:
+    digest_cache.save()
+  print('%-10s %8.3fs' % (name, time.time() - start))
+
+
+def main():
+  tools.disable_buffering()
+  parser = optparse.OptionParser()
+  parser.add_option(
+      '--files', type='int', default=40000,
+      help='Number of files to create, default: %default')
+  parser.add_option(
+      '--size', type='int', default=64*1024,
+      help='Size of each file in bytes, default: %default')
+  parser.add_option(
+      '-d', '--directory',
+      help='Directory to archive instead of a generated one')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unsupported argument: %s' % args)
+
+  tempdir = unicode(tempfile.mkdtemp(prefix=u'digest_cache_profiler'))
+  try:
+    root_dir = options.directory
+    if root_dir:
+      root_dir = unicode(os.path.abspath(root_dir))
+    else:
+      root_dir = os.path.join(tempdir, u'tree')
+      os.mkdir(root_dir)
+      print('Creating %d files of %d bytes' % (options.files, options.size))
+      make_tree(root_dir, options.files, options.size)
+    cache_dir = os.path.join(tempdir, u'cache')
+    profile('no cache', root_dir, None)
+    profile('cold', root_dir,
+            isolated_format.DigestCache(cache_dir, hashlib.sha1))
+    profile('warm', root_dir,
+            isolated_format.DigestCache(cache_dir, hashlib.sha1))
+  finally:
+    file_path.rmtree(tempdir)
+  return 0
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  sys.exit(main())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Copyright 2018 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Profiles the mapping speed of isolateserver.fetch_isolated() in files/s on a
+synthetic tree whose content is already in the local cache.
+"""
+
+import hashlib
+import json
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+
+from third_party.depot_tools import fix_encoding
+from utils import file_path
+from utils import tools
+
+import isolate_storage
+import isolated_format
+import isolateserver
+import local_caching
+
+
+class CachedStorageApi(isolate_storage.StorageApi):
+  """StorageApi that doesn't have anything, everything must be in cache."""
+  @property
+  def location(self):
+    return 'cache'
+
+  @property
+  def namespace(self):
+    return 'default'
+
+  def fetch(self, digest, size, offset):
+    raise IOError('%s is not in the cache' % digest)
+
+
+def make_cache(cache_dir, files, size):
+  """Returns the hash of a .isolated of |files| files stored in the cache."""
+  policies = local_caching.CachePolicies(0, 0, 0, 0)
+  with local_caching.DiskContentAddressedCache(
+      cache_dir, policies, hashlib.sha1, False) as cache:
+    entries = {}
+    for i in xrange(files):
+      content = ('%d' % i).ljust(size, '.')
+      digest = hashlib.sha1(content).hexdigest()
+      cache.write(digest, [content])
+      entries['%02d/%03d/%d' % (i % 97, i % 101, i)] = {
+        'h': digest, 's': size, 'm': 0500,
+      }
+    data = json.dumps({
+      'algo': 'sha-1',
+      'files': entries,
+      'version': isolated_format.ISOLATED_FILE_VERSION,
+    })
+    return cache.write(hashlib.sha1(data).hexdigest(), [data])
+
+
+def profile(cache_dir, isolated_hash, outdir, files, threads):
+  isolateserver.MAP_THREADS = threads
+  policies = local_caching.CachePolicies(0, 0, 0, 0)
+  cache = local_caching.DiskContentAddressedCache(
+      cache_dir, policies, hashlib.sha1, False)
+  start = time.time()
+  with isolateserver.Storage(CachedStorageApi()) as storage:
+    isolateserver.fetch_isolated(isolated_hash, storage, cache, outdir, False)
+  duration = time.time() - start
+  print('%2d threads: %7.3fs, %8.0f files/s' % (
+      threads, duration, files / duration))
+  file_path.rmtree(outdir)
+
+
+def main():
+  tools.disable_buffering()
+  parser = optparse.OptionParser()
+  parser.add_option(
+      '--files', type='int', default=100000,
+      help='Number of files in the tree, default: %default')
+  parser.add_option(
+      '--size', type='int', default=64,
+      help='Size of each file in bytes, default: %default')
+  parser.add_option(
+      '--threads', type='int', action='append',
+      help='Number of mapping threads to try, can be specified multiple '
+           'times, default: 1, 4 and 16')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unsupported argument: %s' % args)
+
+  tempdir = unicode(tempfile.mkdtemp(prefix=u'fetch_isolated_profiler'))
+  try:
+    cache_dir = os.path.join(tempdir, u'cache')
+    print('Creating %d files of %d bytes in cache' % (
+        options.files, options.size))
+    isolated_hash = make_cache(cache_dir, options.files, options.size)
+    for threads in (options.threads or [1, 4, 16]):
+      profile(
+          cache_dir, isolated_hash, os.path.join(tempdir, u'out'),
+          options.files, threads)
+  finally:
+    file_path.rmtree(tempdir)
+  return 0
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Copyright 2018 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Profiles the latency of fetching many small objects from a local
+isolateserver_mock, with and without HTTP keep-alive.
+
+It shows the cost of opening a new connection per request, which is what
+utils/net.py connection pools avoid.
+"""
+
+import optparse
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'tests'))
+
+from third_party.depot_tools import fix_encoding
+from utils import net
+from utils import threading_utils
+from utils import tools
+
+import isolateserver
+import isolateserver_mock
+
+
+def profile(name, keep_alive, items, size):
+  server = isolateserver_mock.MockIsolateServer(keep_alive)
+  try:
+    digests = [
+      server.add_content('default', ('%d' % i).ljust(size, '.'))
+      for i in xrange(items)
+    ]
+    latencies = []
+    storage = isolateserver.get_storage(server.url, 'default')
+    channel = threading_utils.TaskChannel()
+    start = time.time()
+    with storage:
+      for digest in digests:
+        # The request is sent when the stream is iterated.
+        def sink(stream):
+          started = time.time()
+          for _ in stream:
+            pass
+          latencies.append(time.time() - started)
+        storage.async_fetch(
+            channel, threading_utils.PRIORITY_MED, digest, size, sink)
+      for _ in digests:
+        channel.pull()
+    duration = time.time() - start
+    stats = net.get_connection_stats()[server.url]
+    # Closes the kept alive connections before the server.
+    net.get_http_service(server.url).engine.session.close()
+  finally:
+    server.close()
+  latencies.sort()
+  print('%-14s %7.3fs %7.0f items/s  p50 %6.1fms  p99 %6.1fms  '
+        '%d requests, %d new connections' % (
+          name, duration, items / duration,
+          latencies[len(latencies) / 2] * 1000,
+          latencies[len(latencies) * 99 / 100] * 1000,
+          stats['requests'], stats['new_connections']))
+
+
+def main():
+  tools.disable_buffering()
+  parser = optparse.OptionParser()
+  parser.add_option(
+      '--items', type='int', default=10000,
+      help='Number of objects to fetch, default: %default')
+  parser.add_option(
+      '--size', type='int', default=1024,
+      help='Size of each object in bytes, default: %default')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unsupported argument: %s' % args)
+
+  net.disable_oauth_config()
+  print('Fetching %d objects of %d bytes' % (options.items, options.size))
+  profile('no keep-alive', False, options.items, options.size)
+  profile('keep-alive', True, options.items, options.size)
+  return 0
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  sys.exit(main())
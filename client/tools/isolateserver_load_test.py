@@ -7,8 +7,9 @@
 
 Generates an histogram with the latencies to download a just uploaded file.
 
-Note that it only looks at uploading and downloading and do not test
-preupload, which is datastore read bound.
+With --preupload, it only sends /preupload requests instead, which are
+datastore read bound. A fraction of each batch is known to be present on the
+server so the server side existence cache is exercised too.
 """
 
 import functools
@@ -26,6 +27,8 @@ sys.path.insert(0, ROOT_DIR)
 
 from third_party import colorama
 
+import isolate_storage
+import isolated_format
 import isolateserver
 import local_caching
 
@@ -142,6 +145,64 @@ def send_and_receive(random_pool, storage, progress, size):
   return (duration, size)
 
 
+def print_lookup_results(results, columns, buckets):
+  delays = [i[0] for i in results if isinstance(i[0], float)]
+  failures = [i for i in results if not isinstance(i[0], float)]
+  items = sum(i[1] for i in results)
+
+  print('Total items : %d' % items)
+  print('Total delay : %.1fs' % sum(delays))
+  if delays:
+    print('Items/s     : %.1f' % (items / sum(delays)))
+  print('')
+  print('%sDELAYS%s (seconds):' % (colorama.Fore.RED, colorama.Fore.RESET))
+  graph.print_histogram(
+      graph.generate_histogram(delays, buckets), columns, '%.3f')
+
+  if failures:
+    print('')
+    print('%sFAILURES%s:' % (colorama.Fore.RED, colorama.Fore.RESET))
+    print('\n'.join('  %s (%d items)' % i for i in failures))
+
+
+def upload_known(random_pool, storage, count):
+  """Uploads |count| small items so they are present on the server.
+
+  Returns the list of uploaded items.
+  """
+  items = [
+    isolateserver.BufferItem(random_pool.gen(random.randint(1, 400)), False)
+    for _ in xrange(count)
+  ]
+  storage.upload_items(items)
+  return items
+
+
+def lookup(storage_api, progress, known, hit_ratio, mid_size, batch):
+  """Sends a single /preupload request for |batch| items.
+
+  A fraction |hit_ratio| of the items is picked from |known|, the rest is
+  random digests that are not present on the server.
+
+  Returns (delay, batch)
+  """
+  hits = random.sample(known, min(len(known), int(batch * hit_ratio)))
+  items = hits + [
+    isolate_storage.Item('%040x' % random.getrandbits(160), gen_size(mid_size))
+    for _ in xrange(batch - len(hits))
+  ]
+  random.shuffle(items)
+  start = time.time()
+  try:
+    missing = storage_api.contains(items)
+    assert len(missing) == len(items) - len(hits), (len(missing), len(hits))
+    duration = max(0, time.time() - start)
+  except isolated_format.MappingError as e:
+    duration = str(e)
+  progress.update_item('', index=1, data=batch)
+  return (duration, batch)
+
+
 def main():
   colorama.init()
 
@@ -168,6 +229,21 @@ def main():
       help='Rough average size of each item, default:%default')
   parser.add_option_group(data_group)
 
+  preupload_group = optparse.OptionGroup(parser, 'Preupload')
+  preupload_group.add_option(
+      '--preupload', action='store_true',
+      help='Only send /preupload requests; --items is the number of requests')
+  preupload_group.add_option(
+      '--batch', type='int', default=1000, metavar='N',
+      help='Number of items per /preupload request, default:%default')
+  preupload_group.add_option(
+      '--known', type='int', default=1000, metavar='N',
+      help='Number of items uploaded beforehand, default:%default')
+  preupload_group.add_option(
+      '--hit-ratio', type='float', default=0.5, metavar='R',
+      help='Ratio of items in a batch that are present, default:%default')
+  parser.add_option_group(preupload_group)
+
   ui_group = optparse.OptionGroup(parser, 'Result histogram')
   ui_group.add_option(
       '--columns', type='int', default=graph.get_console_width(), metavar='N',
@@ -195,6 +271,8 @@ def main():
         '  Use --max-size if you want to run it until NN bytes where '
         'transfered.\n'
         '  Otherwise use --items to run it for NN items.')
+  if options.preupload and not options.items:
+    parser.error('--preupload requires --items.')
   options.isolate_server = options.isolate_server.rstrip('/')
   if not options.isolate_server:
     parser.error('--isolate-server is required.')
@@ -211,11 +289,23 @@ def main():
   columns = [('index', 0), ('data', 0), ('size', options.items)]
   progress = Progress(columns)
   storage = isolateserver.get_storage(options.isolate_server, options.namespace)
-  do_item = functools.partial(
-      send_and_receive,
-      random_pool,
-      storage,
-      progress)
+  if options.preupload:
+    known = upload_known(random_pool, storage, options.known)
+    print(' - Uploaded %d items after %.1fs' % (
+        len(known), time.time() - start))
+    # Each task is one /preupload request, independently of the
+    # isolateserver.Storage batching.
+    storage_api = isolate_storage.get_storage_api(
+        options.isolate_server, options.namespace)
+    do_item = lambda _size: lookup(
+        storage_api, progress, known, options.hit_ratio, options.mid_size,
+        options.batch)
+  else:
+    do_item = functools.partial(
+        send_and_receive,
+        random_pool,
+        storage,
+        progress)
 
   # TODO(maruel): Handle Ctrl-C should:
   # - Stop adding tasks.
@@ -244,7 +334,10 @@ def main():
   print('')
   print(' - Took %.1fs.' % (time.time() - start))
   print('')
-  print_results(results, options.columns, options.buckets)
+  if options.preupload:
+    print_lookup_results(results, options.columns, options.buckets)
+  else:
+    print_results(results, options.columns, options.buckets)
   if options.dump:
     with open(options.dump, 'w') as f:
       json.dump(results, f, separators=(',',':'))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# Copyright 2018 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Profiles loading and saving the state of a lru.LRUDict, as used by the local
+isolated cache, in both the plain json and the journaled formats.
+"""
+
+import hashlib
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__.decode(sys.getfilesystemencoding()))))
+sys.path.insert(0, ROOT_DIR)
+
+from third_party.depot_tools import fix_encoding
+from utils import file_path
+from utils import lru
+from utils import tools
+
+
+def make_lru(items):
+  """Returns a LRUDict with |items| entries keyed like the isolated cache."""
+  lru_dict = lru.LRUDict()
+  for i in xrange(items):
+    lru_dict.add(unicode(hashlib.sha1(str(i)).hexdigest()), i)
+  return lru_dict
+
+
+def mutate(lru_dict, changes):
+  """Simulates a task: touches, adds and evicts |changes| items each."""
+  keys = list(lru_dict)[:changes]
+  for key in keys:
+    lru_dict.touch(key)
+  for i in xrange(changes):
+    lru_dict.add(unicode(hashlib.sha1('new%d' % i).hexdigest()), i)
+    lru_dict.pop_oldest()
+
+
+def profile(name, fn):
+  start = time.time()
+  result = fn()
+  print('  %-28s %8.3fs' % (name, time.time() - start))
+  return result
+
+
+def run(tempdir, items, changes):
+  print('%d items, %d changes per save' % (items, changes))
+  plain = os.path.join(tempdir, u'plain.json')
+  journaled = os.path.join(tempdir, u'journaled.json')
+  lru_dict = make_lru(items)
+
+  profile('plain save', lambda: lru_dict.save(plain))
+  lru_dict = profile('plain load', lambda: lru.LRUDict.load(plain))
+  mutate(lru_dict, changes)
+  profile('plain save after changes', lambda: lru_dict.save(plain))
+
+  profile(
+      'journal migration', lambda: lru_dict.save(journaled, journal=True))
+  lru_dict = profile('journal load', lambda: lru.LRUDict.load(journaled))
+  mutate(lru_dict, changes)
+  profile(
+      'journal save after changes',
+      lambda: lru_dict.save(journaled, journal=True))
+  profile('journal load with changes', lambda: lru.LRUDict.load(journaled))
+  print('  %-28s %8dkb' % ('state size', os.stat(journaled).st_size / 1024))
+
+
+def main():
+  tools.disable_buffering()
+  parser = optparse.OptionParser()
+  parser.add_option(
+      '--items', type='int', action='append',
+      help='Number of items in the LRU, can be specified multiple times, '
+           'default: 100000 and 1000000')
+  parser.add_option(
+      '--changes', type='int', default=1000,
+      help='Number of items touched, added and evicted between saves, '
+           'default: %default')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unsupported argument: %s' % args)
+
+  tempdir = unicode(tempfile.mkdtemp(prefix=u'lru_state_profiler'))
+  try:
+    for items in (options.items or [100000, 1000000]):
+      run(tempdir, items, options.changes)
+  finally:
+    file_path.rmtree(tempdir)
+  return 0
+
+
+if __name__ == '__main__':
+  fix_encoding.fix_encoding()
+  sys.exit(main())
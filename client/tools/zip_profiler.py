@@ -3,61 +3,87 @@
 # Use of this source code is governed under the Apache License, Version 2.0
 # that can be found in the LICENSE file.
 
-"""Profiler to compare various compression levels with regards to speed
-and final size when compressing the full set of files from a given
-isolated file.
+"""Profiler to compare the compression codecs of the isolate namespaces and
+their levels with regards to speed and final size when compressing the full set
+of files from a given isolated file or directory.
+
+Throughput is reported in uncompressed mb/s for both compression and
+decompression, the latter being the bottleneck when fetching on fast networks.
+zstd and lz4 are only profiled when their python module is installed.
 """
 
-import bz2
 import optparse
 import os
 import subprocess
 import sys
 import tempfile
 import time
-import zlib
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(
     __file__.decode(sys.getfilesystemencoding()))))
 sys.path.insert(0, ROOT_DIR)
 
 from third_party.depot_tools import fix_encoding
+from utils import compression
 from utils import file_path
 from utils import tools
 
+import isolated_format
+
+
+# Codecs to profile and the levels to try, on the zlib scale used by Items,
+# see Codec.get_level().
+CODECS = [
+  ('zlib', compression.ZLIB, range(10)),
+  ('zstd', compression.ZSTD, [0, 7]),
+  ('lz4', compression.LZ4, [7]),
+]
+
 
-def zip_file(compressor_constructor, compression_level, filename):
-  compressed_size = 0
-  compressor = compressor_constructor(compression_level)
+def read_file(filename):
   with open(filename, 'rb') as f:
     while True:
-      chunk = f.read(16 * 1024)
+      chunk = f.read(isolated_format.DISK_FILE_CHUNK)
       if not chunk:
         break
-      compressed_size += len(compressor.compress(f.read()))
-    compressed_size += len(compressor.flush())
-
-  return compressed_size
-
-
-def zip_directory(compressor_constructor, compression_level, root_dir):
-  compressed_size = 0
-  for root, _, files in os.walk(root_dir):
-    compressed_size += sum(zip_file(compressor_constructor, compression_level,
-                                    os.path.join(root, name))
-                           for name in files)
-  return compressed_size
-
-
-def profile_compress(zip_module_name, compressor_constructor,
-                     compression_range, compress_func, compress_target):
-  for i in compression_range:
-    start_time = time.time()
-    compressed_size = compress_func(compressor_constructor, i, compress_target)
-    end_time = time.time()
-
-    print('%4s at compression level %s, total size %11d, time taken %6.3f' %
-          (zip_module_name, i, compressed_size, end_time - start_time))
+      yield chunk
+
+
+def zip_file(codec, compression_level, filename):
+  """Returns (compressed size, compression time, decompression time)."""
+  start = time.time()
+  compressed = list(codec.compress(read_file(filename), compression_level))
+  compress_time = time.time() - start
+  start = time.time()
+  for _ in codec.decompress(compressed, isolated_format.DISK_FILE_CHUNK):
+    pass
+  decompress_time = time.time() - start
+  return sum(len(c) for c in compressed), compress_time, decompress_time
+
+
+def zip_files(codec, compression_level, filenames):
+  totals = [0, 0., 0.]
+  for filename in filenames:
+    for i, value in enumerate(zip_file(codec, compression_level, filename)):
+      totals[i] += value
+  return totals
+
+
+def profile_compress(filenames, total_size):
+  for name, codec, levels in CODECS:
+    if not codec.available:
+      print('%5s skipped, %s is not installed' % (name, codec.module_name))
+      continue
+    for level in levels:
+      compressed_size, compress_time, decompress_time = zip_files(
+          codec, level, filenames)
+      mb = total_size / 1024. / 1024.
+      print(
+          '%5s at compression level %s, total size %11d (%5.1f%%), '
+          'compress %7.1fmb/s, decompress %7.1fmb/s' % (
+            name, codec.get_level(level), compressed_size,
+            100. * compressed_size / (total_size or 1),
+            mb / (compress_time or 1e-6), mb / (decompress_time or 1e-6)))
 
 
 def tree_files(root_dir):
@@ -74,6 +100,10 @@ def main():
   tools.disable_buffering()
   parser = optparse.OptionParser()
   parser.add_option('-s', '--isolated', help='.isolated file to profile with.')
+  parser.add_option(
+      '-d', '--directory',
+      help='Directory to profile with instead of an .isolated file, e.g. a '
+           'build output directory.')
   parser.add_option('--largest_files', type='int',
                     help='If this is set, instead of compressing all the '
                     'files, only the large n files will be compressed')
@@ -81,20 +111,23 @@ def main():
 
   if args:
     parser.error('Unknown args passed in; %s' % args)
-  if not options.isolated:
-    parser.error('The .isolated file must be given.')
+  if bool(options.isolated) == bool(options.directory):
+    parser.error('Exactly one of --isolated or --directory must be given.')
 
   temp_dir = None
   try:
-    temp_dir = tempfile.mkdtemp(prefix=u'zip_profiler')
-
-    # Create a directory of the required files
-    subprocess.check_call([os.path.join(ROOT_DIR, 'isolate.py'),
-                           'remap',
-                           '-s', options.isolated,
-                           '--outdir', temp_dir])
+    if options.directory:
+      root_dir = options.directory
+    else:
+      temp_dir = tempfile.mkdtemp(prefix=u'zip_profiler')
+      root_dir = temp_dir
+      # Create a directory of the required files
+      subprocess.check_call([os.path.join(ROOT_DIR, 'isolate.py'),
+                             'remap',
+                             '-s', options.isolated,
+                             '--outdir', temp_dir])
 
-    file_set = tree_files(temp_dir)
+    file_set = tree_files(root_dir)
 
     if options.largest_files:
       sorted_by_size = sorted(file_set.iteritems(),  key=lambda x: x[1],
@@ -103,22 +136,16 @@ def main():
 
       for filename, size in files_to_compress:
         print('Compressing %s, uncompressed size %d' % (filename, size))
-
-        profile_compress('zlib', zlib.compressobj, range(10), zip_file,
-                         filename)
-        profile_compress('bz2', bz2.BZ2Compressor, range(1, 10), zip_file,
-                         filename)
+        profile_compress([filename], size)
     else:
       print('Number of files: %s' % len(file_set))
       print('Total size: %s' % sum(file_set.itervalues()))
 
       # Profile!
-      profile_compress('zlib', zlib.compressobj, range(10), zip_directory,
-                       temp_dir)
-      profile_compress('bz2', bz2.BZ2Compressor, range(1, 10), zip_directory,
-                       temp_dir)
+      profile_compress(sorted(file_set), sum(file_set.itervalues()))
   finally:
-    file_path.rmtree(temp_dir)
+    if temp_dir:
+      file_path.rmtree(temp_dir)
 
 
 if __name__ == '__main__':
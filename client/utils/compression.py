@@ -0,0 +1,283 @@
+# Copyright 2017 The LUCI Authors. All rights reserved.
+# Use of this source code is governed under the Apache License, Version 2.0
+# that can be found in the LICENSE file.
+
+"""Compression codecs of the isolate namespaces.
+
+The codec is selected by the last component of the namespace, e.g.
+'default-zstd'. The digest is always calculated on the uncompressed content so
+a .isolated file is valid in all the namespaces using the same hash algorithm.
+
+zstd and lz4 are optional, the codec raises ValueError when used if the module
+can't be imported.
+
+bzip2 is not supported: python 2's BZ2Decompressor can't bound the size of its
+output, so a small stream could expand to gigabytes in a single call.
+"""
+
+import zlib
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  import lz4.frame as lz4_frame
+except ImportError:
+  lz4_frame = None
+
+
+class _Source(object):
+  """Reads a generator of compressed chunks, counting the bytes read.
+
+  Can be iterated or read like a file.
+  """
+
+  def __init__(self, content_generator):
+    self._chunks = iter(content_generator)
+    self._buf = ''
+    self.size = 0
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    if self._buf:
+      chunk, self._buf = self._buf, ''
+      return chunk
+    chunk = next(self._chunks)
+    self.size += len(chunk)
+    return chunk
+
+  def read(self, size=-1):
+    """Returns at most |size| bytes of the current chunk, '' at the end."""
+    while not self._buf:
+      try:
+        self._buf = next(self._chunks)
+      except StopIteration:
+        return ''
+      self.size += len(self._buf)
+    if size < 0:
+      size = len(self._buf)
+    out, self._buf = self._buf[:size], self._buf[size:]
+    return out
+
+  def exhausted(self):
+    """Returns True if all the data was read."""
+    while not self._buf:
+      chunk = next(self._chunks, None)
+      if chunk is None:
+        return True
+      self._buf = chunk
+      self.size += len(chunk)
+    return False
+
+
+class Codec(object):
+  """Compresses and decompresses streams of data in one format.
+
+  Subclasses implement compressobj() and iter_decompress().
+  """
+  # Name of the format sent to the server, see isolate_storage.IsolateServer.
+  name = None
+  # Name of the module required by this codec, or None if builtin.
+  module_name = None
+  # Exceptions raised by the module on corrupted data.
+  errors = ()
+
+  @property
+  def available(self):
+    """True if the module needed by this codec is present."""
+    return True
+
+  def get_level(self, level):
+    """Maps a zlib compression level (0-9), as set on Items, to this codec's
+    scale.
+
+    A level of 0 means the content is already compressed.
+    """
+    return level
+
+  def compressobj(self, level):
+    """Returns an object with compress(data) and flush() methods."""
+    raise NotImplementedError()
+
+  def iter_decompress(self, source, chunk_size):
+    """Yields the data decompressed from the _Source |source|, in chunks no
+    larger than |chunk_size|.
+
+    Raises IOError if the stream is incomplete or has trailing data.
+    """
+    raise NotImplementedError()
+
+  def compress(self, content_generator, level):
+    """Reads chunks from |content_generator| and yields compressed chunks."""
+    if not self.available:
+      raise ValueError('%s is needed to compress %s' % (
+          self.module_name, self.name))
+    compressor = self.compressobj(self.get_level(level))
+    for chunk in content_generator:
+      compressed = compressor.compress(chunk)
+      if compressed:
+        yield compressed
+    tail = compressor.flush()
+    if tail:
+      yield tail
+
+  def decompress(self, content_generator, chunk_size):
+    """Reads compressed data from |content_generator| and yields decompressed
+    data.
+
+    The data is yielded in chunks no larger than |chunk_size| so that a zip
+    bomb doesn't cause the decompressor to allocate a huge amount of memory.
+
+    Raises IOError if data is corrupted or incomplete.
+    """
+    if not self.available:
+      raise ValueError('%s is needed to decompress %s' % (
+          self.module_name, self.name))
+    source = _Source(content_generator)
+    try:
+      for data in self.iter_decompress(source, chunk_size):
+        yield data
+    except self.errors as e:
+      raise IOError(
+          'Corrupted %s stream (read %d bytes) - %s' % (
+            self.name, source.size, e))
+
+
+class _Zlib(Codec):
+  name = 'flate'
+  errors = (zlib.error,)
+
+  def compressobj(self, level):
+    return zlib.compressobj(level)
+
+  def iter_decompress(self, source, chunk_size):
+    decompressor = zlib.decompressobj()
+    for chunk in source:
+      data = decompressor.decompress(chunk, chunk_size)
+      if data:
+        yield data
+      # Once the stream ended, trailing data stays in unconsumed_tail.
+      while decompressor.unconsumed_tail and not decompressor.unused_data:
+        data = decompressor.decompress(
+            decompressor.unconsumed_tail, chunk_size)
+        if data:
+          yield data
+    tail = decompressor.flush()
+    if tail:
+      yield tail
+    # Ensure all data was read and decompressed.
+    if decompressor.unused_data or decompressor.unconsumed_tail:
+      raise IOError('Not all data was decompressed')
+
+
+class _Zstd(Codec):
+  name = 'zstd'
+  module_name = 'zstandard'
+
+  @property
+  def available(self):
+    return bool(zstandard)
+
+  @property
+  def errors(self):
+    return (zstandard.ZstdError,)
+
+  def get_level(self, level):
+    # Level 3 is zstd's default; it compresses about as well as zlib at level 6
+    # at several times the speed. Level 1 is for already compressed content.
+    return 3 if level else 1
+
+  def compressobj(self, level):
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+  def iter_decompress(self, source, chunk_size):
+    # decompressobj() can't bound its output, stream_reader() can. It stops at
+    # the end of the frame; the source reads one chunk at a time so trailing
+    # chunks are left in it.
+    reader = zstandard.ZstdDecompressor().stream_reader(source)
+    while True:
+      data = reader.read(chunk_size)
+      if not data:
+        break
+      yield data
+    if not source.exhausted():
+      raise IOError('Not all data was decompressed')
+
+
+class _LZ4Compressor(object):
+  """Adapts LZ4FrameCompressor to the compressobj() interface."""
+
+  def __init__(self, level):
+    self._compressor = lz4_frame.LZ4FrameCompressor(compression_level=level)
+    self._header = self._compressor.begin()
+
+  def compress(self, data):
+    out = self._header + self._compressor.compress(data)
+    self._header = ''
+    return out
+
+  def flush(self):
+    out = self._header + self._compressor.flush()
+    self._header = ''
+    return out
+
+
+class _LZ4(Codec):
+  name = 'lz4'
+  module_name = 'lz4'
+  # EOFError is raised on data after the end of the frame.
+  errors = (EOFError, RuntimeError)
+
+  @property
+  def available(self):
+    return bool(lz4_frame)
+
+  def get_level(self, level):
+    # lz4 is only worth it in its fast mode, the high compression levels are
+    # slower than zstd for a worse ratio.
+    return 0
+
+  def compressobj(self, level):
+    return _LZ4Compressor(level)
+
+  def iter_decompress(self, source, chunk_size):
+    decompressor = lz4_frame.LZ4FrameDecompressor()
+    for chunk in source:
+      data = decompressor.decompress(chunk, max_length=chunk_size)
+      if data:
+        yield data
+      # Drain the output buffered past |chunk_size| before reading more.
+      while not decompressor.needs_input and not decompressor.eof:
+        data = decompressor.decompress('', max_length=chunk_size)
+        if data:
+          yield data
+    if not decompressor.eof or decompressor.unused_data:
+      raise IOError('Not all data was decompressed')
+
+
+ZLIB = _Zlib()
+ZSTD = _Zstd()
+LZ4 = _LZ4()
+
+
+# Codecs keyed by namespace suffix. '-flate' is not a compressed namespace, its
+# content has always been stored as-is.
+CODECS = {
+  'deflate': ZLIB,
+  'gzip': ZLIB,
+  'lz4': LZ4,
+  'zstd': ZSTD,
+}
+
+
+def get_codec(namespace):
+  """Returns the Codec used by |namespace|, or None if it stores the content
+  as-is.
+  """
+  if '-' not in namespace:
+    return None
+  return CODECS.get(namespace.rsplit('-', 1)[1])
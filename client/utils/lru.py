@@ -6,8 +6,12 @@
 
 import collections
 import json
+import logging
+import os
 import time
 
+from utils import file_path
+
 
 class LRUDict(object):
   """Dictionary that can evict least recently used items.
@@ -18,19 +22,35 @@ class LRUDict(object):
 
   That is, the first item in self._items is the oldest item.
 
-  Can also store its state as *.json file on disk.
+  Can also store its state as *.json file on disk. The state can optionally be
+  journaled: the first line of the file is a full snapshot and each following
+  line is a change applied on top of it. This makes saves O(changes) instead of
+  O(items); the snapshot is rewritten atomically once the journal grows too
+  large.
   """
 
   # Used to determine current timestamp.
   # Can be substituted in individual LRUDict instances.
   time_fn = time.time
 
+  # Minimum number of journal records before the state file is compacted. Past
+  # this, it is compacted once there are more journal records than items.
+  JOURNAL_MIN_COMPACTION = 1000
+
   def __init__(self):
     # Ordered key -> (value, timestamp) mapping,
     # newest items at the bottom.
     self._items = collections.OrderedDict()
     # True if was modified after loading.
     self._dirty = True
+    # Changes not yet appended to the journaled state file, as a list of
+    # (key, (value, timestamp)) or (key, None) for removal. None if the next
+    # save() must write a full snapshot.
+    self._journal = None
+    # Journaled state file self._journal applies to.
+    self._journal_file = None
+    # Number of journal records already in self._journal_file.
+    self._journal_size = 0
 
   def __nonzero__(self):
     """False if dict is empty."""
@@ -56,20 +76,27 @@ class LRUDict(object):
   def load(cls, state_file):
     """Loads previously saved state and returns LRUDict in that state.
 
+    Accepts both the plain json state (version 2) and the journaled state
+    (version 3). A truncated last journal record, e.g. due to a crash while
+    saving, is ignored.
+
     Raises ValueError if state file is corrupted.
     """
     try:
-      state = json.load(open(state_file, 'r'))
+      with open(state_file, 'rb') as f:
+        snapshot = f.readline()
+        records = f.readlines()
+      state = json.loads(snapshot)
     except (IOError, ValueError) as e:
       raise ValueError('Broken state file %s: %s' % (state_file, e))
     if not isinstance(state, dict):
       raise ValueError(
           'Broken state file %s, should be json object or list' % (state_file,))
     state_ver = state.get('version')
-    if state_ver != 2:
+    if state_ver not in (2, 3):
       raise ValueError(
           'Unsupported state file %s, version is %s. '
-          'Latest supported is 2' % (state_file, state_ver))
+          'Latest supported is 3' % (state_file, state_ver))
     state_items = state.get('items')
     if not isinstance(state_items, list):
       raise ValueError(
@@ -77,17 +104,7 @@ class LRUDict(object):
     lru = cls()
     # Items are stored oldest to newest. Put them back in the same order.
     for item in state_items:
-      if not isinstance(item, list) or len(item) != 2:
-        raise ValueError(
-            'Broken state file %s, expecting pairs: %s' % (state_file, item))
-      if not isinstance(item[1], list) or len(item[1]) != 2:
-        raise ValueError(
-            'Broken state file %s, expecting second item to be a item: %s' % (
-              state_file, item))
-      if not isinstance(item[1][1], (int, float)):
-        raise ValueError(
-            'Broken state file %s, expecting second item of the second item '
-            'to be a number: %s' % (state_file, item))
+      _check_item(state_file, item)
 
     lru._items = collections.OrderedDict(state_items)
 
@@ -96,21 +113,60 @@ class LRUDict(object):
       raise ValueError(
           'Broken state file %s, found duplicate keys' % (state_file,))
 
+    # Replay the journal on top of the snapshot.
+    truncated = False
+    for i, line in enumerate(records):
+      try:
+        record = json.loads(line)
+      except ValueError as e:
+        if i != len(records) - 1:
+          raise ValueError('Broken state file %s: %s' % (state_file, e))
+        logging.warning(
+            'Ignoring truncated journal record in %s: %r', state_file, line)
+        truncated = True
+        break
+      if not isinstance(record, list) or len(record) != 2:
+        raise ValueError(
+            'Broken state file %s, expecting pairs: %s' % (state_file, record))
+      lru._items.pop(record[0], None)
+      if record[1] is not None:
+        _check_item(state_file, record)
+        lru._items[record[0]] = record[1]
+
     # Now state from the file corresponds to state in the memory.
     lru._dirty = False
+    if state_ver == 3 and not truncated:
+      # Following journaled saves can append to this file. Otherwise it is
+      # rewritten on the next journaled save.
+      lru._journal = []
+      lru._journal_file = state_file
+      lru._journal_size = len(records)
     return lru
 
-  def save(self, state_file):
-    """Saves cache state to a file if it was modified."""
-    if not self._dirty:
+  def save(self, state_file, journal=False):
+    """Saves cache state to a file if it was modified.
+
+    Arguments:
+      state_file: path to the state file.
+      journal: if True, only appends the changes since the last journaled save
+          to |state_file| when possible. The file then uses the version 3
+          format.
+    """
+    # A journaled save also needs to happen when the state file has to be
+    # rewritten, e.g. to migrate it or to get rid of a truncated record.
+    if not self._dirty and (not journal or self._journal is not None):
       return False
 
-    with open(state_file, 'wb') as f:
-      contents = {
-        'version': 2,
-        'items': self._items.items(),
-      }
-      json.dump(contents, f, separators=(',',':'))
+    if journal:
+      self._save_journaled(state_file)
+    else:
+      with open(state_file, 'wb') as f:
+        contents = {
+          'version': 2,
+          'items': self._items.items(),
+        }
+        json.dump(contents, f, separators=(',',':'))
+      self._journal = None
 
     self._dirty = False
     return True
@@ -120,6 +176,7 @@ class LRUDict(object):
     self._items.pop(key, None)
     self._items[key] = (value, self.time_fn())
     self._dirty = True
+    self._log(key, self._items[key])
 
   def keys_set(self):
     """Set of keys of items in this dict."""
@@ -144,6 +201,7 @@ class LRUDict(object):
     """
     self._items[key] = (self._items.pop(key)[0], self.time_fn())
     self._dirty = True
+    self._log(key, self._items[key])
 
   def pop(self, key):
     """Removes item from the dict, returns its value.
@@ -152,6 +210,7 @@ class LRUDict(object):
     """
     item = self._items.pop(key)
     self._dirty = True
+    self._log(key, None)
     return item[0]
 
   def get_oldest(self):
@@ -170,9 +229,63 @@ class LRUDict(object):
     """
     item = self._items.popitem(last=False)
     self._dirty = True
+    self._log(item[0], None)
     return item
 
   def itervalues(self):
     """Iterator over stored values in arbitrary order."""
     for val, _ in self._items.itervalues():
       yield val
+
+  def _log(self, key, item):
+    """Records a change to be appended to the journaled state file."""
+    if self._journal is None:
+      return
+    self._journal.append((key, item))
+    if self._needs_compaction():
+      # A full snapshot will be written anyway, stop accumulating changes.
+      self._journal = None
+
+  def _needs_compaction(self):
+    """Returns True if the journal is large enough to rewrite the snapshot."""
+    records = self._journal_size + len(self._journal)
+    return records > max(len(self._items), self.JOURNAL_MIN_COMPACTION)
+
+  def _save_journaled(self, state_file):
+    """Saves the state as a snapshot followed by journal records."""
+    if (self._journal is None or self._journal_file != state_file or
+        not os.path.isfile(state_file)):
+      # Atomically write a new snapshot, so a crash never leaves a corrupted
+      # state file behind.
+      contents = {
+        'version': 3,
+        'items': self._items.items(),
+      }
+      file_path.atomic_replace(
+          state_file, json.dumps(contents, separators=(',',':')) + '\n')
+      self._journal_file = state_file
+      self._journal_size = 0
+    elif self._journal:
+      # A crash while appending leaves at worst a truncated last record, which
+      # is ignored by load().
+      with open(state_file, 'ab') as f:
+        f.write(''.join(
+            json.dumps(record, separators=(',',':')) + '\n'
+            for record in self._journal))
+      self._journal_size += len(self._journal)
+    self._journal = []
+
+
+def _check_item(state_file, item):
+  """Raises ValueError if |item| is not a valid (key, (value, timestamp))."""
+  if not isinstance(item, list) or len(item) != 2:
+    raise ValueError(
+        'Broken state file %s, expecting pairs: %s' % (state_file, item))
+  if not isinstance(item[1], list) or len(item[1]) != 2:
+    raise ValueError(
+        'Broken state file %s, expecting second item to be a item: %s' % (
+          state_file, item))
+  if not isinstance(item[1][1], (int, float)):
+    raise ValueError(
+        'Broken state file %s, expecting second item of the second item '
+        'to be a number: %s' % (state_file, item))
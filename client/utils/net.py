@@ -16,6 +16,7 @@ import socket
 import ssl
 import threading
 import time
+import types
 import urllib
 import urlparse
 
@@ -25,6 +26,7 @@ from third_party.requests import structures
 
 from utils import authenticators
 from utils import oauth
+from utils import threading_utils
 from utils import tools
 
 # TODO(vadimsh): Refactor this stuff to be less magical, less global and less
@@ -55,6 +57,14 @@ CONTENT_ENCODERS = {
 }
 
 
+# Number of hosts and of connections per host kept alive by RequestsLibEngine.
+# An engine is used concurrently by at most the threads of an
+# IOAutoRetryThreadPool, see isolateserver.Storage. A pool smaller than that
+# closes the extra connections after each request, and the next request pays
+# for a new TCP and TLS handshake.
+CONNECTION_POOL_SIZE = threading_utils.IOAutoRetryThreadPool.MAX_WORKERS
+
+
 # Google Storage URL regular expression.
 GS_STORAGE_HOST_URL_RE = re.compile(r'https://(.+\.)?storage\.googleapis\.com')
 
@@ -184,6 +194,7 @@ def url_open(url, **kwargs):  # pylint: disable=W0621
   |data| can be either:
     - None for a GET request
     - str for pre-encoded data
+    - generator of str chunks for pre-encoded data to stream
     - list for data to be encoded
     - dict for data to be encoded
 
@@ -271,6 +282,22 @@ def fix_url(url):
   return urlparse.urlunparse(new)
 
 
+def get_connection_stats():
+  """Returns the keep-alive statistics of the cached HttpService instances.
+
+  Returns:
+    dict {urlhost: {'requests': N, 'new_connections': M,
+    'reused_connections': N-M}} for the services whose engine supports
+    get_stats().
+  """
+  with _http_services_lock:
+    services = _http_services.values()
+  return {
+    s.urlhost: s.engine.get_stats() for s in services
+    if hasattr(s.engine, 'get_stats')
+  }
+
+
 def get_http_service(urlhost, allow_cached=True):
   """Returns existing or creates new instance of HttpService that can send
   requests to given base urlhost.
@@ -380,7 +407,7 @@ class HttpService(object):
   def encode_request_body(body, content_type):
     """Returns request body encoded according to its content type."""
     # No body or it is already encoded.
-    if body is None or isinstance(body, str):
+    if body is None or isinstance(body, (str, types.GeneratorType)):
       return body
     # Any body should have content type set.
     assert content_type, 'Request has body, but no content type'
@@ -432,9 +459,14 @@ class HttpService(object):
     |data| can be either:
       - None for a GET request
       - str for pre-encoded data
+      - generator of str chunks for pre-encoded data to stream
       - list for data to be form-encoded
       - dict for data to be form-encoded
 
+    A streamed body is sent with chunked transfer encoding. Since it can't be
+    rewound, the request is attempted only once and retries are left to the
+    caller.
+
     - Optionally retries HTTP 404 and 50x.
     - Retries up to |max_attempts| times. If None or 0, there's no limit in the
       number of retries.
@@ -472,6 +504,8 @@ class HttpService(object):
       method = method or 'POST'
       content_type = content_type or DEFAULT_CONTENT_TYPE
       body = self.encode_request_body(data, content_type)
+      if isinstance(body, types.GeneratorType):
+        max_attempts = 1
     else:
       assert method in (None, 'DELETE', 'GET')
       method = method or 'GET'
@@ -486,7 +520,8 @@ class HttpService(object):
     # Prepare headers.
     headers = get_case_insensitive_dict(headers or {})
     if body is not None:
-      headers['Content-Length'] = len(body)
+      if isinstance(body, str):
+        headers['Content-Length'] = len(body)
       if content_type:
         headers['Content-Type'] = content_type
 
@@ -617,7 +652,7 @@ class HttpRequest(object):
       |method| - HTTP method to use
       |url| - relative URL to the resource, without query parameters
       |params| - list of (key, value) pairs to put into GET parameters
-      |body| - encoded body of the request (None or str)
+      |body| - encoded body of the request (None, str or generator)
       |headers| - dict with request headers
       |timeout| - socket read timeout (None to disable)
       |stream| - True to stream response from socket
@@ -751,12 +786,27 @@ class RequestsLibEngine(object):
     self.session.trust_env = False
     self.session.verify = tools.get_cacerts_bundle()
     # Configure connection pools.
+    self._adapters = []
     for protocol in ('https://', 'http://'):
-      self.session.mount(protocol, adapters.HTTPAdapter(
-          pool_connections=64,
-          pool_maxsize=64,
+      adapter = _CountingHTTPAdapter(
+          pool_connections=CONNECTION_POOL_SIZE,
+          pool_maxsize=CONNECTION_POOL_SIZE,
           max_retries=0,
-          pool_block=False))
+          pool_block=False)
+      self.session.mount(protocol, adapter)
+      self._adapters.append(adapter)
+
+  def get_stats(self):
+    """Returns the number of requests sent and of connections opened or
+    reused for them.
+    """
+    requests_sent = sum(a.requests for a in self._adapters)
+    connections = sum(a.connections for a in self._adapters)
+    return {
+      'new_connections': connections,
+      'requests': requests_sent,
+      'reused_connections': max(0, requests_sent - connections),
+    }
 
   def perform_request(self, request):
     """Sends a HttpRequest to the server and reads back the response.
@@ -788,6 +838,10 @@ class RequestsLibEngine(object):
           code=response.status_code,
           headers=response.headers,
           timeout_exc_classes=self.timeout_exception_classes)
+      if request.stream and response.status_code >= 400:
+        # Read the error body now, so the connection is returned to the pool
+        # instead of being closed. It is small and read by the caller anyway.
+        _ = response.content
       response.raise_for_status()
       return resp
     except requests.Timeout as e:
@@ -799,6 +853,58 @@ class RequestsLibEngine(object):
       raise ConnectionError(e)
 
 
+class _CountingHTTPAdapter(adapters.HTTPAdapter):
+  """HTTPAdapter that counts the requests it sends and the connections it
+  opens, including the reconnections of pooled connections dropped by the
+  server.
+  """
+
+  def __init__(self, **kwargs):
+    self.connections = 0
+    self.requests = 0
+    self._counters_lock = threading.Lock()
+    super(_CountingHTTPAdapter, self).__init__(**kwargs)
+
+  def init_poolmanager(
+      self, connections, maxsize, block=adapters.DEFAULT_POOLBLOCK,
+      **pool_kwargs):
+    self._pool_connections = connections
+    self._pool_maxsize = maxsize
+    self._pool_block = block
+    self.poolmanager = _CountingPoolManager(
+        self, num_pools=connections, maxsize=maxsize, block=block, strict=True,
+        **pool_kwargs)
+
+  def send(self, request, **kwargs):
+    with self._counters_lock:
+      self.requests += 1
+    return super(_CountingHTTPAdapter, self).send(request, **kwargs)
+
+  def on_connect(self):
+    with self._counters_lock:
+      self.connections += 1
+
+
+class _CountingPoolManager(requests.packages.urllib3.PoolManager):
+  """PoolManager whose connections report to a _CountingHTTPAdapter when they
+  connect.
+  """
+
+  def __init__(self, adapter, **kwargs):
+    self._adapter = adapter
+    super(_CountingPoolManager, self).__init__(**kwargs)
+
+  def _new_pool(self, scheme, host, port):
+    pool = super(_CountingPoolManager, self)._new_pool(scheme, host, port)
+    adapter = self._adapter
+    class CountingConnection(pool.ConnectionCls):
+      def connect(self):
+        adapter.on_connect()
+        return super(CountingConnection, self).connect()
+    pool.ConnectionCls = CountingConnection
+    return pool
+
+
 class RetryAttempt(object):
   """Contains information about current retry attempt.
 